@@ -1,18 +1,77 @@
-from work_assistant.txtapp import app
-from waitress import serve
+import argparse
 import logging
+import os
+import threading
 
 # Setup Logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger('waitress')
 
+APP = 'work_assistant.txtapp:app'
+
+
+def worker_started(threads):
+    """每個 worker process 載入 app 之後呼叫"""
+    from work_assistant import admission, metrics, offload, search_index, txtapp
+    metrics.WORKER_THREADS.set(threads)  # in_flight / threads = saturation
+    admission.set_server_threads(threads)  # 保留 reserve_threads 給一般請求
+    admission.set_worker_count(int(os.getenv('WEB_WORKERS', '1')))  # bulkhead 上限由各 worker 均分
+    offload.warm()  # 預先啟動文件渲染/解析用的 process pool
+    search_index.warm()  # 背景載入全文檢索 segment
+    # 既有專案補建模板指紋 (template_registry)
+    threading.Thread(target=txtapp.backfill_template_fingerprints, name='template-backfill', daemon=True).start()
+
+
+def worker_draining(timeout):
+    """worker 回收/結束前: 等本行程的月報 job 完成，再結束 offload process pool"""
+    from work_assistant import monthly_jobs, offload
+    clean = monthly_jobs.drain(timeout)
+    offload.shutdown(wait=clean)
+    return clean
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Production server (waitress)')
+    parser.add_argument('--host', default=os.getenv('WEB_HOST', '0.0.0.0'))
+    parser.add_argument('--port', type=int, default=int(os.getenv('WEB_PORT', '8080')))
+    parser.add_argument('--workers', type=int, default=int(os.getenv('WEB_WORKERS', '1')),
+                        help='worker processes (default 1 = single process). With N > 1 each worker keeps its own '
+                             'state: admission limits are split between workers; /metrics, monthly job '
+                             'de-duplication and the offload pool are per worker (the CPUs are split between '
+                             'the offload pools)')
+    parser.add_argument('--threads', type=int, default=int(os.getenv('WEB_THREADS', '6')),
+                        help='waitress threads per worker')
+    parser.add_argument('--max-requests', type=int, default=int(os.getenv('WEB_MAX_REQUESTS', '2000')),
+                        help='recycle a worker after this many requests (0 = never)')
+    parser.add_argument('--max-memory-mb', type=int, default=int(os.getenv('WEB_MAX_MEMORY_MB', '1500')),
+                        help='recycle a worker whose RSS exceeds this (0 = never)')
+    parser.add_argument('--graceful-timeout', type=int, default=int(os.getenv('WEB_GRACEFUL_TIMEOUT', '60')),
+                        help='seconds a stopping worker may spend finishing requests and report jobs')
+    return parser.parse_args(argv)
+
+
 if __name__ == "__main__":
+    args = parse_args()
     print("-------------------------------------------------------")
     print("  Administrative Assistant Production Server")
     print("  Status: Running")
-    print("  Access URL: http://0.0.0.0:8080")
-    print("  (Accessible from this machine at http://localhost:8080)")
+    print(f"  Access URL: http://{args.host}:{args.port}")
+    print(f"  (Accessible from this machine at http://localhost:{args.port})")
+    print(f"  Workers: {args.workers} x {args.threads} threads")
     print("-------------------------------------------------------")
-    
-    # Run the server on port 8080
-    serve(app, host='0.0.0.0', port=8080, threads=6)
+
+    if args.workers <= 1:
+        from waitress import serve
+        from work_assistant.txtapp import app
+        worker_started(args.threads)
+        serve(app, host=args.host, port=args.port, threads=args.threads)
+    else:
+        from work_assistant import prefork
+        # spawn 的 worker 以環境變數得知 worker 數 (admission 均分上限)
+        os.environ['WEB_WORKERS'] = str(args.workers)
+        # 每個 worker 各有自己的 offload process pool，總數不超過 CPU 數
+        os.environ.setdefault('OFFLOAD_WORKERS', str(max(1, (os.cpu_count() or 1) // args.workers)))
+        prefork.serve(APP, host=args.host, port=args.port, workers=args.workers, threads=args.threads,
+                      max_requests=args.max_requests, max_memory_mb=args.max_memory_mb,
+                      graceful_timeout=args.graceful_timeout,
+                      on_worker_start=worker_started, on_drain=worker_draining)
@@ -0,0 +1,132 @@
+"""
+Micro-benchmark: 舊版 (每個參數 x 每個儲存格) vs renderer.CellRenderer (單次掃描)
+
+模擬 200 個儲存格、40 個參數的 Excel 模板，分別以
+  - generate_document 舊邏輯 (每格檢查所有 context key)
+  - api_generate_monthly 舊邏輯 (每個參數重掃整張表)
+  - 新的 CellRenderer
+填值，並列印每次渲染的平均時間。
+
+如何執行:
+    python tests/bench_renderer.py
+"""
+import os
+import sys
+import time
+
+import openpyxl
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'work_assistant'))
+import renderer  # noqa: E402
+
+ROWS, COLS, PARAMS = 20, 10, 40
+REPEAT = 200
+
+parameters = [
+    {'name': f'field_{i}', 'type': 'number' if i % 4 == 0 else 'string'}
+    for i in range(PARAMS)
+]
+context = {
+    p['name']: (str(i * 10) if p['type'] == 'number' else f'值_{i}')
+    for i, p in enumerate(parameters)
+}
+
+
+def build_values():
+    """200 格: 每 5 格中 2 格為整格標籤、1 格為句中標籤、其餘為靜態文字"""
+    values = {}
+    n = 0
+    for r in range(1, ROWS + 1):
+        for c in range(1, COLS + 1):
+            key = parameters[n % PARAMS]['name']
+            kind = n % 5
+            if kind in (0, 1):
+                values[(r, c)] = f'{{{{ {key} }}}}'
+            elif kind == 2:
+                values[(r, c)] = f'項目: {{{{ {key} }}}} 公斤'
+            else:
+                values[(r, c)] = f'固定文字 {n}'
+            n += 1
+    return values
+
+
+VALUES = build_values()
+
+
+def reset(ws):
+    for (r, c), v in VALUES.items():
+        ws.cell(row=r, column=c).value = v
+
+
+def legacy_generate_document(ws):
+    for row in ws.iter_rows():
+        for cell in row:
+            if cell.value and isinstance(cell.value, str):
+                for key, val in context.items():
+                    tag = f"{{{{ {key} }}}}"
+                    # 舊程式在整格轉成數字後會繼續比對而拋出 TypeError，此處加上型別檢查以便量測
+                    if isinstance(cell.value, str) and tag in cell.value:
+                        if cell.value.strip() == tag:
+                            try:
+                                cell.value = float(val) if '.' in val else int(val)
+                            except ValueError:
+                                cell.value = val
+                        else:
+                            cell.value = cell.value.replace(tag, str(val))
+
+
+def legacy_monthly(ws):
+    for param in parameters:
+        key = param['name']
+        val = context.get(key)
+        tag = f"{{{{ {key} }}}}"
+        for row in ws.iter_rows():
+            for cell in row:
+                if cell.value and isinstance(cell.value, str) and tag in cell.value:
+                    if cell.value.strip() == tag:
+                        try:
+                            if str(val).isdigit():
+                                cell.value = int(val)
+                            elif str(val).replace('.', '', 1).isdigit():
+                                cell.value = float(val)
+                            else:
+                                cell.value = val
+                        except:
+                            cell.value = val
+                    else:
+                        cell.value = cell.value.replace(tag, str(val))
+
+
+def bench(label, fn, ws):
+    total = 0.0
+    for _ in range(REPEAT):
+        reset(ws)
+        start = time.perf_counter()
+        fn(ws)
+        total += time.perf_counter() - start
+    avg_ms = total / REPEAT * 1000
+    print(f"{label:<32} {avg_ms:8.3f} ms / sheet")
+    return avg_ms
+
+
+if __name__ == '__main__':
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    cell_renderer = renderer.CellRenderer(parameters)
+
+    print(f"Template: {ROWS * COLS} cells, {PARAMS} parameters, {REPEAT} runs")
+    old_doc = bench("legacy generate_document", legacy_generate_document, ws)
+    old_monthly = bench("legacy api_generate_monthly", legacy_monthly, ws)
+    new = bench("CellRenderer.render_sheet", lambda s: cell_renderer.render_sheet(s, context), ws)
+
+    # 結果一致性檢查
+    reset(ws)
+    legacy_monthly(ws)
+    expected = [[c.value for c in row] for row in ws.iter_rows()]
+    reset(ws)
+    cell_renderer.render_sheet(ws, context)
+    actual = [[c.value for c in row] for row in ws.iter_rows()]
+    print(f"Output identical to legacy monthly: {expected == actual}")
+
+    print(f"Speed-up vs generate_document: x{old_doc / new:.1f}")
+    print(f"Speed-up vs generate_monthly:  x{old_monthly / new:.1f}")
@@ -0,0 +1,279 @@
+"""
+合成工作負載效能基準 (Benchmark suite)
+
+以 synthetic_docs 產生的範本/舊範例/entry 量測:
+  - extract_xlsx_structure / extract_docx_structure   (1 / 30 / 100 張工作表或表格)
+  - diff (api_analyze 的 DeepDiff 階段)
+  - create_template
+  - generate_document (Excel 1 / 30 / 100 張工作表、Word)
+  - api_generate_monthly (10 / 100 / 500 筆 entry，每次都是冷啟動: 清除片段、封存與照片快取)
+全部在暫存目錄執行，不讀寫專案的 users.json / projects/ / uploads/。
+結果寫成 JSON (含 commit 與環境資訊)，可用 --compare 與其他 commit 的結果比較。
+
+如何執行:
+    python tests/bench_suite.py
+    python tests/bench_suite.py --quick                 # 只跑最小的規模
+    python tests/bench_suite.py --only monthly          # 名稱包含 monthly 的項目
+    python tests/bench_suite.py --compare tests/bench_results/<舊結果>.json
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(REPO_ROOT, 'tests', 'bench_results')
+
+SHEET_POINTS = (1, 30, 100)
+ENTRY_POINTS = (10, 100, 500)
+PHOTO_COUNT = 20
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def measure(fn, repeat, setup=None):
+    """回傳 {runs, min_s, median_s, mean_s, max_s}；setup() 在每次計時前執行且不計入"""
+    times = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return {
+        'runs': repeat,
+        'min_s': round(min(times), 6),
+        'median_s': round(statistics.median(times), 6),
+        'mean_s': round(statistics.mean(times), 6),
+        'max_s': round(max(times), 6),
+    }
+
+
+class Bench:
+    def __init__(self, args):
+        self.args = args
+        self.results = []
+        self.work = tempfile.mkdtemp(prefix='bench_')
+        os.chdir(self.work)
+        os.makedirs(os.path.join('work_assistant', 'projects'))
+        with open('users.json', 'w', encoding='utf-8') as f:
+            json.dump({'bench': {'password': 'bench', 'name': 'Bench', 'role': 'developer'}}, f)
+
+        sys.path.insert(0, REPO_ROOT)
+        sys.path.insert(0, os.path.join(REPO_ROOT, 'tests'))
+        global synthetic_docs, txtapp, database, template_cache, image_prep, DeepDiff
+        import synthetic_docs
+        from deepdiff import DeepDiff
+        from work_assistant import txtapp, database, template_cache, image_prep
+
+        self.app = txtapp.app
+        self.upload = self.app.config['UPLOAD_FOLDER'] = os.path.join(self.work, 'uploads')
+        os.makedirs(self.upload)
+        self.client = self.app.test_client()
+        self.client.post('/login', data={'username': 'bench', 'password': 'bench'})
+        self.photos = synthetic_docs.make_photos(self.upload, PHOTO_COUNT)
+
+    def points(self, values):
+        return values[:1] if self.args.quick else values
+
+    def wanted(self, name):
+        return not self.args.only or any(key in name for key in self.args.only)
+
+    def record(self, name, params, stats, **extra):
+        result = dict(name=name, params=params, **stats, **extra)
+        self.results.append(result)
+        print(f"{name:<28} {json.dumps(params, ensure_ascii=False):<24} "
+              f"median {stats['median_s'] * 1000:9.1f} ms  min {stats['min_s'] * 1000:9.1f} ms", flush=True)
+
+    def path(self, name):
+        return os.path.join(self.upload, name)
+
+    # --- documents ---
+
+    def xlsx_set(self, sheets):
+        """同一版面的 blank / source / template 三份 Excel 與參數"""
+        params = synthetic_docs.make_parameters(fields=12, images=1)
+        files = {}
+        for variant in synthetic_docs.VARIANTS:
+            files[variant] = self.path(f'x{sheets}_{variant}.xlsx')
+            synthetic_docs.make_xlsx(files[variant], params, variant, sheets=sheets, image_path=self.photos[0])
+        return params, files
+
+    def docx_set(self, tables):
+        params = synthetic_docs.make_parameters(fields=12, images=1)
+        files = {}
+        for variant in synthetic_docs.VARIANTS:
+            files[variant] = self.path(f'd{tables}_{variant}.docx')
+            synthetic_docs.make_docx(files[variant], params, variant, tables=tables, image_path=self.photos[0])
+        return params, files
+
+    # --- benchmarks ---
+
+    def run_extract_and_templating(self):
+        repeat = self.args.repeat
+        for sheets in self.points(SHEET_POINTS):
+            params, files = self.xlsx_set(sheets)
+            size = {'sheets': sheets}
+            if self.wanted('extract_xlsx_structure'):
+                self.record('extract_xlsx_structure', size,
+                            measure(lambda: txtapp.extract_xlsx_structure(files['source']), repeat),
+                            bytes=os.path.getsize(files['source']))
+            if self.wanted('diff_xlsx'):
+                blank = txtapp.extract_xlsx_structure(files['blank'])
+                filled = txtapp.extract_xlsx_structure(files['source'])
+                self.record('diff_xlsx', size, measure(
+                    lambda: DeepDiff(blank, filled, ignore_order=False, view='tree'), repeat))
+            if self.wanted('create_template_xlsx'):
+                self.record('create_template_xlsx', size, measure(
+                    lambda: os.remove(self.path(txtapp.create_template(files['source'], params))), repeat))
+            if self.wanted('generate_document_xlsx'):
+                self.record('generate_document_xlsx', size, self.generate_document(files['template'], params))
+
+        for tables in self.points(SHEET_POINTS):
+            params, files = self.docx_set(tables)
+            size = {'tables': tables}
+            if self.wanted('extract_docx_structure'):
+                self.record('extract_docx_structure', size,
+                            measure(lambda: txtapp.extract_docx_structure(files['source']), repeat),
+                            bytes=os.path.getsize(files['source']))
+            if self.wanted('diff_docx'):
+                blank = txtapp.extract_docx_structure(files['blank'])
+                filled = txtapp.extract_docx_structure(files['source'])
+                self.record('diff_docx', size, measure(
+                    lambda: DeepDiff(blank, filled, ignore_order=False, view='tree'), repeat))
+            if self.wanted('create_template_docx'):
+                self.record('create_template_docx', size, measure(
+                    lambda: os.remove(self.path(txtapp.create_template(files['source'], params))), repeat))
+            if self.wanted('generate_document_docx'):
+                self.record('generate_document_docx', size, self.generate_document(files['template'], params))
+
+    def generate_document(self, template_path, params):
+        """/generate_document 整個請求 (範本快取為暖的狀態；第一次呼叫不計時)"""
+        project_id = f'doc-{os.path.basename(template_path)}'
+        database.save_project_config(project_id, {
+            'name': 'Bench', 'template_file': os.path.basename(template_path), 'parameters': params})
+        form = dict(synthetic_docs.make_context(params), project_id=project_id)
+
+        def call():
+            response = self.client.post('/generate_document', data=form)
+            assert response.status_code == 200, response.status_code
+            response.get_data()
+        call()
+        return measure(call, self.args.repeat)
+
+    def run_monthly(self):
+        if not self.wanted('api_generate_monthly'):
+            return
+        params = synthetic_docs.make_parameters(fields=12, images=1)
+        template = self.path('monthly_template.xlsx')
+        synthetic_docs.make_xlsx(template, params, 'template', sheets=1)
+        for count in self.points(ENTRY_POINTS):
+            project_id = f'monthly-{count}'
+            database.save_project_config(project_id, {
+                'name': 'Bench', 'mode': 'monthly', 'template_file': os.path.basename(template),
+                'parameters': params})
+            for entry in synthetic_docs.make_entries(params, count, self.photos):
+                database.save_project_entry(project_id, entry)
+            project_dir = os.path.join(database.PROJECTS_DIR, project_id)
+
+            def cold():
+                # 清掉片段、已產生的報表、封存與照片快取，量測完整的產生時間
+                for name in ('monthly_build', 'archives'):
+                    shutil.rmtree(os.path.join(project_dir, name), ignore_errors=True)
+                shutil.rmtree(os.path.join(self.upload, image_prep.CACHE_DIR_NAME), ignore_errors=True)
+
+            sizes = []
+
+            def call():
+                response = self.client.post(f'/api/project/{project_id}/generate_monthly', json={'month': '2026-09'})
+                job = response.get_json()
+                while job['status'] in ('queued', 'running'):
+                    time.sleep(0.02)
+                    job = self.client.get(job['status_url']).get_json()
+                assert job['status'] == 'done', job
+                sizes.append(len(self.client.get(job['download_url']).get_data()))
+
+            repeat = max(1, self.args.repeat if count < 500 else min(self.args.repeat, 2))
+            self.record('api_generate_monthly', {'entries': count}, measure(call, repeat, setup=cold),
+                        bytes=sizes[-1])
+
+    # --- output ---
+
+    def save(self):
+        payload = {
+            'meta': {
+                'commit': git_commit(),
+                'timestamp': datetime.now().isoformat(timespec='seconds'),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpus': os.cpu_count(),
+                'repeat': self.args.repeat,
+                'quick': self.args.quick,
+            },
+            'results': self.results,
+        }
+        out = self.args.out
+        if not out:
+            os.makedirs(RESULTS_DIR, exist_ok=True)
+            out = os.path.join(RESULTS_DIR, f"{payload['meta']['commit']}_{datetime.now().strftime('%Y%m%d%H%M%S')}.json")
+        with open(out, 'w', encoding='utf-8') as f:
+            json.dump(payload, f, ensure_ascii=False, indent=2)
+        print(f"\nResults: {out}")
+        return payload
+
+    def cleanup(self):
+        os.chdir(REPO_ROOT)
+        shutil.rmtree(self.work, ignore_errors=True)
+
+
+def compare(baseline_path, payload):
+    """以中位數比較；ratio > 1 表示變慢"""
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    old = {(r['name'], json.dumps(r['params'], sort_keys=True)): r for r in baseline['results']}
+    print(f"\nCompared with {baseline['meta'].get('commit')} ({baseline['meta'].get('timestamp')}):")
+    for result in payload['results']:
+        ref = old.get((result['name'], json.dumps(result['params'], sort_keys=True)))
+        if not ref:
+            continue
+        ratio = result['median_s'] / ref['median_s'] if ref['median_s'] else float('inf')
+        flag = '  <-- slower' if ratio > 1.1 else ('  faster' if ratio < 0.9 else '')
+        print(f"  {result['name']:<28} {json.dumps(result['params']):<20} "
+              f"{ref['median_s'] * 1000:9.1f} -> {result['median_s'] * 1000:9.1f} ms  x{ratio:.2f}{flag}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Synthetic-workload benchmarks')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--quick', action='store_true', help='only the smallest scaling point')
+    parser.add_argument('--only', action='append', help='run benchmarks whose name contains this (repeatable)')
+    parser.add_argument('--out', help='result file (default: tests/bench_results/<commit>_<time>.json)')
+    parser.add_argument('--compare', help='previous result file to compare against')
+    args = parser.parse_args()
+
+    bench = Bench(args)
+    try:
+        bench.run_extract_and_templating()
+        bench.run_monthly()
+        payload = bench.save()
+    finally:
+        bench.cleanup()
+    if args.compare:
+        compare(args.compare, payload)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,26 @@
+"""讓 tests/ 下的測試可以 import work_assistant (與 python -m pytest 的執行目錄無關)，以及共用的 fixture"""
+import os
+import sys
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+
+@pytest.fixture
+def app_client(tmp_path, monkeypatch):
+    """
+    txtapp 的 Flask test client: 工作目錄 (projects/) 與上傳資料夾都在 tmp_path，略過登入，
+    不在背景更新搜尋索引。回傳 (client, 上傳資料夾)。
+    """
+    from work_assistant import txtapp
+    monkeypatch.chdir(tmp_path)
+    uploads = tmp_path / 'uploads'
+    uploads.mkdir()
+    monkeypatch.setitem(txtapp.app.config, 'UPLOAD_FOLDER', str(uploads))
+    monkeypatch.setitem(txtapp.app.config, 'LOGIN_DISABLED', True)
+    monkeypatch.setitem(txtapp.app.config, 'TESTING', True)
+    monkeypatch.setattr(txtapp.search_index, 'schedule_refresh', lambda project_id: None)
+    return txtapp.app.test_client(), uploads
@@ -0,0 +1,109 @@
+"""
+啟動時間 / import 成本報告 (Import-time profile)
+
+在全新的直譯器中以 python -X importtime 匯入 work_assistant.txtapp，列出:
+  - 總匯入時間 (多次取最小值)
+  - 累計時間最高的模組 (含子模組)
+  - 第一層套件的自身時間總和
+  - 哪些延遲載入的重量級依賴被提早匯入 (應該都沒有)
+test_startup_budget.py 使用同一套量測。
+
+如何執行:
+    python tests/import_profile.py
+    python tests/import_profile.py --top 40 --module work_assistant.monthly_jobs
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+import tempfile
+from collections import defaultdict
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_MODULE = 'work_assistant.txtapp'
+# 只應在第一次使用時載入 (work_assistant/lazy_imports.py)
+HEAVY_MODULES = ('google.generativeai', 'pandas', 'deepdiff', 'docx', 'docxtpl', 'openpyxl')
+
+_LINE_RE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+
+_PROBE = """
+import sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print('ELAPSED_MS', elapsed * 1000)
+print('LOADED', ','.join(m for m in {heavy!r} if m in sys.modules))
+"""
+
+
+def _run(module, importtime=False):
+    env = dict(os.environ, PYTHONPATH=REPO_ROOT, PYTHONDONTWRITEBYTECODE='1')
+    env.pop('GEMINI_API_KEY', None)
+    args = [sys.executable] + (['-X', 'importtime'] if importtime else []) + \
+        ['-c', _PROBE.format(module=module, heavy=HEAVY_MODULES)]
+    # 在暫存目錄執行，不讀寫專案的 users.json / projects/
+    with tempfile.TemporaryDirectory(prefix='import_profile_') as cwd:
+        proc = subprocess.run(args, cwd=cwd, env=env, capture_output=True, text=True, timeout=120)
+    if proc.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{proc.stderr}")
+    result = {'elapsed_ms': None, 'loaded': [], 'stderr': proc.stderr}
+    for line in proc.stdout.splitlines():
+        if line.startswith('ELAPSED_MS '):
+            result['elapsed_ms'] = float(line.split()[1])
+        elif line.startswith('LOADED '):
+            result['loaded'] = [m for m in line.split(' ', 1)[1].split(',') if m]
+    return result
+
+
+def measure(module=DEFAULT_MODULE, runs=3):
+    """回傳 {'elapsed_ms': 最小值, 'runs': [...], 'loaded': [提早匯入的重量級模組]}"""
+    results = [_run(module) for _ in range(runs)]
+    return {
+        'elapsed_ms': min(r['elapsed_ms'] for r in results),
+        'runs': [round(r['elapsed_ms'], 1) for r in results],
+        'loaded': sorted(set().union(*(r['loaded'] for r in results))),
+    }
+
+
+def parse_importtime(stderr):
+    """[(module, self_us, cumulative_us, depth)]"""
+    rows = []
+    for line in stderr.splitlines():
+        m = _LINE_RE.match(line)
+        if m:
+            rows.append((m.group(4), int(m.group(1)), int(m.group(2)), len(m.group(3)) // 2))
+    return rows
+
+
+def report(module=DEFAULT_MODULE, top=25, runs=3):
+    stats = measure(module, runs)
+    rows = parse_importtime(_run(module, importtime=True)['stderr'])
+
+    print(f"import {module}: {stats['elapsed_ms']:.0f} ms (runs: {stats['runs']})")
+    print(f"Heavy modules loaded at import: {', '.join(stats['loaded']) or 'none'}")
+
+    print(f"\nTop {top} by cumulative time:")
+    for name, self_us, cum_us, depth in sorted(rows, key=lambda r: r[2], reverse=True)[:top]:
+        print(f"  {cum_us / 1000:8.1f} ms  {self_us / 1000:7.1f} ms self  {name}")
+
+    by_package = defaultdict(int)
+    for name, self_us, _, _ in rows:
+        by_package[name.split('.')[0]] += self_us
+    print(f"\nTop {top} packages by self time:")
+    for name, self_us in sorted(by_package.items(), key=lambda kv: kv[1], reverse=True)[:top]:
+        print(f"  {self_us / 1000:8.1f} ms  {name}")
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import-time profile of the web app')
+    parser.add_argument('--module', default=DEFAULT_MODULE)
+    parser.add_argument('--top', type=int, default=25)
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+    report(args.module, args.top, args.runs)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,338 @@
+"""
+本機負載測試 (Local load-test harness)
+
+在同一台 Linux 主機上以 waitress 啟動真正的 WSGI app (與 run_production.py 相同的 threads 設定)，
+再以多個虛擬使用者依腳本重播作業員 / 管理者的操作:
+  - 作業員: 登入、首頁/專案頁、entry 列表、上傳照片新增 entry、下載月報
+  - 管理者: 登入、專案設定頁、上傳範本與舊範例並執行 AI 分析、下載月報
+AI 模型以 stub 取代 (固定延遲 + 固定回應)，不需要任何外部服務。
+全部在暫存目錄執行，不會動到專案的 users.json / projects/ / uploads/。
+結束後列出每個路由的吞吐量、延遲百分位數、錯誤率與被准入控制拒絕 (429) 的比例 (--out 另存 JSON)。
+
+如何執行:
+    python tests/load_test.py --users 20 --ramp 10 --duration 60
+    python tests/load_test.py --users 40 --threads 12 --model-latency 3 --out load.json
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from datetime import date
+
+import requests
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROJECT_ID = 'load-monthly'
+PASSWORD = 'load'
+
+
+class Stats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.rejected = defaultdict(int)
+
+    def add(self, route, seconds, ok, rejected=False):
+        """rejected: 被准入控制擋下 (429)，不算錯誤"""
+        with self._lock:
+            self.latencies[route].append(seconds)
+            if rejected:
+                self.rejected[route] += 1
+            elif not ok:
+                self.errors[route] += 1
+
+    @staticmethod
+    def percentile(sorted_values, q):
+        if not sorted_values:
+            return 0.0
+        k = min(len(sorted_values) - 1, max(0, int(round(q / 100.0 * len(sorted_values) + 0.5)) - 1))
+        return sorted_values[k]
+
+    def mark_error(self, route):
+        """回應狀態正常但內容表示失敗 (例如 {'success': false})"""
+        with self._lock:
+            self.errors[route] += 1
+
+    def summary(self, elapsed):
+        rows = []
+        with self._lock:
+            items = {route: sorted(values) for route, values in self.latencies.items()}
+            errors = dict(self.errors)
+            rejected = dict(self.rejected)
+        for route, values in sorted(items.items()):
+            rows.append({
+                'route': route,
+                'requests': len(values),
+                'errors': errors.get(route, 0),
+                'error_rate': round(errors.get(route, 0) / len(values), 4),
+                'rejected': rejected.get(route, 0),
+                'rejected_rate': round(rejected.get(route, 0) / len(values), 4),
+                'rps': round(len(values) / elapsed, 2),
+                'mean_ms': round(statistics.mean(values) * 1000, 1),
+                'p50_ms': round(self.percentile(values, 50) * 1000, 1),
+                'p90_ms': round(self.percentile(values, 90) * 1000, 1),
+                'p95_ms': round(self.percentile(values, 95) * 1000, 1),
+                'p99_ms': round(self.percentile(values, 99) * 1000, 1),
+                'max_ms': round(values[-1] * 1000, 1),
+            })
+        return rows
+
+
+class VirtualUser:
+    def __init__(self, harness, username, role, seed):
+        self.h = harness
+        self.username = username
+        self.role = role
+        self.rng = random.Random(seed)
+        self.session = requests.Session()
+
+    def call(self, route, method, path, ok_status=(200,), **kwargs):
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, self.h.base_url + path, allow_redirects=False,
+                                            timeout=self.h.args.timeout, **kwargs)
+            response.content  # 讀完整個回應 (下載也計入延遲)
+            ok = response.status_code in ok_status
+        except requests.RequestException:
+            response, ok = None, False
+        self.h.stats.add(route, time.perf_counter() - start, ok,
+                         rejected=response is not None and response.status_code == 429)
+        return response if ok else None
+
+    # --- actions ---
+
+    def login(self):
+        return self.call('POST /login', 'POST', '/login', ok_status=(302,),
+                         data={'username': self.username, 'password': PASSWORD})
+
+    def dashboard(self):
+        self.call('GET /', 'GET', '/')
+        self.call('GET /project/<id>', 'GET', f'/project/{PROJECT_ID}')
+
+    def list_entries(self):
+        self.call('GET /api/project/<id>/entries', 'GET', f'/api/project/{PROJECT_ID}/entries')
+
+    def submit_entry(self):
+        today = date.today()
+        form = {name: value for name, value in
+                self.h.synthetic_docs.make_context(self.h.parameters, seed=self.rng.randrange(10 ** 6)).items()}
+        form['entry_date'] = today.replace(day=self.rng.randint(1, today.day)).isoformat()
+        photo = self.rng.choice(self.h.photos)
+        with open(photo, 'rb') as f:
+            files = {p['name']: (os.path.basename(photo), f, 'image/jpeg')
+                     for p in self.h.parameters if p['type'] == 'image'}
+            response = self.call('POST /api/project/<id>/entry', 'POST', f'/api/project/{PROJECT_ID}/entry',
+                                 data=form, files=files)
+        if response is not None and not response.json().get('success'):
+            self.h.stats.mark_error('POST /api/project/<id>/entry')
+
+    def monthly_download(self):
+        start = time.perf_counter()
+        response = self.call('POST /api/project/<id>/generate_monthly', 'POST',
+                             f'/api/project/{PROJECT_ID}/generate_monthly', ok_status=(200, 202), json={})
+        ok = False
+        if response is not None:
+            job = response.json()
+            while job.get('status') in ('queued', 'running') and time.perf_counter() - start < self.h.args.timeout:
+                time.sleep(1.0)     # 與前端相同的輪詢間隔
+                polled = self.call('GET /api/project/<id>/monthly_jobs/<job>', 'GET', job['status_url'],
+                                   ok_status=(200, 202))
+                if polled is None:
+                    break
+                job = polled.json()
+            if job.get('status') == 'done':
+                ok = self.call('GET /api/project/<id>/monthly_jobs/<job>/download', 'GET',
+                               job['download_url']) is not None
+        self.h.stats.add('monthly report (end to end)', time.perf_counter() - start, ok)
+
+    def project_setup(self):
+        self.call('GET /project_setup', 'GET', '/project_setup')
+
+    def analyze(self):
+        ids = {}
+        for zone, path in (('template', self.h.blank_path), ('reference', self.h.source_path)):
+            with open(path, 'rb') as f:
+                response = self.call('POST /api/upload', 'POST', '/api/upload',
+                                     files={'file': (os.path.basename(path), f)})
+            if response is None:
+                return
+            ids[zone] = response.json()['file_id']
+        self.call('POST /api/analyze', 'POST', '/api/analyze',
+                  json={'template_file_id': ids['template'], 'old_doc_file_id': ids['reference']})
+
+    # --- script ---
+
+    def actions(self):
+        if self.role == 'manager':
+            return [(self.project_setup, 1), (self.analyze, 2), (self.dashboard, 2), (self.monthly_download, 1)]
+        return [(self.dashboard, 2), (self.list_entries, 3), (self.submit_entry, 3), (self.monthly_download, 1)]
+
+    def run(self, deadline):
+        if self.login() is None:
+            return
+        self.call('GET /', 'GET', '/')
+        actions, weights = zip(*self.actions())
+        while time.time() < deadline:
+            self.rng.choices(actions, weights)[0]()
+            time.sleep(min(self.rng.expovariate(1.0 / self.h.args.think), 5 * self.h.args.think))
+
+
+class Harness:
+    def __init__(self, args):
+        self.args = args
+        self.stats = Stats()
+        self.work = tempfile.mkdtemp(prefix='loadtest_')
+        os.chdir(self.work)
+        os.makedirs(os.path.join('work_assistant', 'projects'))
+
+        sys.path.insert(0, REPO_ROOT)
+        sys.path.insert(0, os.path.join(REPO_ROOT, 'tests'))
+        import synthetic_docs
+        from work_assistant import txtapp, database
+        self.synthetic_docs = synthetic_docs
+        self.app = txtapp.app
+        self.upload = self.app.config['UPLOAD_FOLDER'] = os.path.join(self.work, 'uploads')
+        os.makedirs(self.upload)
+
+        managers = max(1, round(args.users * args.manager_share)) if args.manager_share > 0 else 0
+        self.roles = ['manager'] * managers + ['operator'] * (args.users - managers)
+        users = {f'user{i}': {'password': PASSWORD, 'name': f'User {i}', 'role': role}
+                 for i, role in enumerate(self.roles)}
+        with open('users.json', 'w', encoding='utf-8') as f:
+            json.dump(users, f)
+        # 使用不含其他大括號的提示詞，stub 模型不在意內容
+        database.save_system_config({
+            'model_name': 'stub',
+            'ai_prompt_template': '{template_type}\n{formatted_diff_report}\n{template_sheets}\n{filled_sheets}\n'
+                                  '{new_sheets}\n{blank_json}\n{filled_json}',
+        })
+
+        self.photos = synthetic_docs.make_photos(os.path.join(self.work, 'photos'), 8)
+        self.parameters = synthetic_docs.make_parameters(fields=12, images=1)
+        template = os.path.join(self.upload, 'Template_load.xlsx')
+        synthetic_docs.make_xlsx(template, self.parameters, 'template', sheets=1)
+        self.blank_path = os.path.join(self.work, 'blank.xlsx')
+        self.source_path = os.path.join(self.work, 'source.xlsx')
+        synthetic_docs.make_xlsx(self.blank_path, self.parameters, 'blank', sheets=3)
+        synthetic_docs.make_xlsx(self.source_path, self.parameters, 'source', sheets=3, image_path=self.photos[0])
+        database.save_project_config(PROJECT_ID, {
+            'name': 'Load', 'mode': 'monthly', 'template_file': os.path.basename(template),
+            'parameters': self.parameters, 'description': 'load test', 'created_at': date.today().isoformat(),
+            'features': {'monthly': True, 'daily': True}})
+        for photo in self.photos:
+            shutil.copy(photo, self.upload)
+        month_start = date.today().replace(day=1)
+        for entry in synthetic_docs.make_entries(self.parameters, args.seed_entries, self.photos, month_start):
+            entry['date'] = min(entry['date'], date.today().isoformat())
+            database.save_project_entry(PROJECT_ID, entry)
+
+        self._stub_model(txtapp, args.model_latency)
+
+    def _stub_model(self, txtapp, latency):
+        parameters = json.dumps({'parameters': self.parameters, 'logic_summary': 'stub'}, ensure_ascii=False)
+
+        class Usage:
+            prompt_token_count = 1200
+            candidates_token_count = 300
+            total_token_count = 1500
+
+        class Response:
+            text = f'```json\n{parameters}\n```'
+            usage_metadata = Usage()
+
+        class StubModel:
+            def __init__(self, model_name):
+                self.model_name = model_name
+
+            def generate_content(self, prompt):
+                time.sleep(random.uniform(0.5, 1.5) * latency)
+                return Response()
+
+        txtapp.genai.GenerativeModel = StubModel
+
+    def start_server(self):
+        from waitress.server import create_server
+        import run_production
+        # 與 run_production 相同: 設定 threads 指標與准入控制的保留執行緒、預熱 offload pool
+        run_production.worker_started(self.args.threads)
+        self.server = create_server(self.app, host='127.0.0.1', port=0, threads=self.args.threads)
+        self.base_url = f'http://127.0.0.1:{self.server.effective_port}'
+        threading.Thread(target=self.server.run, name='waitress', daemon=True).start()
+
+    def run(self):
+        self.start_server()
+        start = time.time()
+        deadline = start + self.args.duration
+        threads = []
+        for i, role in enumerate(self.roles):
+            user = VirtualUser(self, f'user{i}', role, seed=i)
+            delay = self.args.ramp * i / max(1, len(self.roles))
+            thread = threading.Thread(target=lambda u=user, d=delay: (time.sleep(d), u.run(deadline)),
+                                      name=f'vu-{i}', daemon=True)
+            threads.append(thread)
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+        self.server.close()
+        return elapsed
+
+    def cleanup(self):
+        os.chdir(REPO_ROOT)
+        shutil.rmtree(self.work, ignore_errors=True)
+
+
+def print_report(rows, elapsed, args):
+    print(f"\n{args.users} users ({args.manager_share:.0%} managers), ramp {args.ramp}s, "
+          f"{elapsed:.1f}s, waitress threads={args.threads}, model latency {args.model_latency}s")
+    header = f"{'route':<48}{'reqs':>7}{'err%':>7}{'429%':>7}{'rps':>8}{'p50':>9}{'p90':>9}{'p95':>9}{'p99':>9}{'max':>9}"
+    print(header)
+    print('-' * len(header))
+    for row in rows:
+        print(f"{row['route']:<48}{row['requests']:>7}{row['error_rate'] * 100:>6.1f}%"
+              f"{row['rejected_rate'] * 100:>6.1f}%{row['rps']:>8.2f}"
+              f"{row['p50_ms']:>9.0f}{row['p90_ms']:>9.0f}{row['p95_ms']:>9.0f}{row['p99_ms']:>9.0f}"
+              f"{row['max_ms']:>9.0f}")
+    total = sum(r['requests'] for r in rows if not r['route'].startswith('monthly report'))
+    errors = sum(r['errors'] for r in rows if not r['route'].startswith('monthly report'))
+    print(f"\nTotal {total} requests, {total / elapsed:.2f} req/s, error rate {errors / max(total, 1):.2%} "
+          f"(latencies in ms)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay operator/manager traffic against the real WSGI app')
+    parser.add_argument('--users', type=int, default=10, help='concurrent virtual users')
+    parser.add_argument('--ramp', type=float, default=5.0, help='seconds to start all users')
+    parser.add_argument('--duration', type=float, default=30.0, help='total seconds, including ramp')
+    parser.add_argument('--think', type=float, default=1.0, help='mean think time between actions (s)')
+    parser.add_argument('--manager-share', type=float, default=0.2, help='fraction of users that are managers')
+    parser.add_argument('--threads', type=int, default=6, help='waitress threads (run_production uses 6)')
+    parser.add_argument('--model-latency', type=float, default=2.0, help='mean stub Gemini latency (s)')
+    parser.add_argument('--seed-entries', type=int, default=60, help='entries already in this month')
+    parser.add_argument('--timeout', type=float, default=120.0, help='per-request timeout (s)')
+    parser.add_argument('--out', help='write the per-route summary as JSON')
+    args = parser.parse_args()
+
+    harness = Harness(args)
+    try:
+        elapsed = harness.run()
+        rows = harness.stats.summary(elapsed)
+    finally:
+        harness.cleanup()
+    print_report(rows, elapsed, args)
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            json.dump({'args': vars(args), 'elapsed_s': round(elapsed, 2), 'routes': rows}, f,
+                      ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+"""
+合成工作負載產生器 (Synthetic templates, references and entries)
+
+不依賴本機的參考檔 (參考/空白.xlsx、C:\\Users\\... 路徑)，
+依參數產生同一版面的三種 Excel / Word 文件:
+  - 'blank'     空白範本 (api_analyze 的 Zone A)
+  - 'source'    填好的舊範例，欄位是 original_text、圖片已嵌入 (Zone B / create_template 的輸入)
+  - 'template'  欄位換成 {{ 標籤 }} 的模板 (generate_document / 月報使用)
+以及對應的 parameters 清單、照片與月報 entry。
+由 bench_suite.py 與 load_test.py 共用。
+"""
+import os
+import random
+from datetime import date, timedelta
+
+import openpyxl
+from docx import Document
+from docx.shared import Inches
+from openpyxl.drawing.image import Image as OpenpyxlImage
+from openpyxl.utils import get_column_letter
+from PIL import Image
+
+VARIANTS = ('blank', 'source', 'template')
+IMAGE_BLOCK_ROWS = 8        # 照片區: 1 列標題 + 8 列合併的照片框
+
+
+def make_photo(path, size=(1600, 1200), seed=0):
+    """產生一張 JPEG 照片 (漸層 + 雜訊，壓縮後大小接近實際照片)"""
+    rng = random.Random(seed)
+    base = Image.linear_gradient('L').resize(size).convert('RGB')
+    tint = Image.new('RGB', size, (rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+    noise = Image.effect_noise(size, 40).convert('RGB')
+    Image.blend(Image.blend(base, tint, 0.5), noise, 0.25).save(path, 'JPEG', quality=90)
+    return path
+
+
+def make_photos(folder, count, size=(1600, 1200)):
+    os.makedirs(folder, exist_ok=True)
+    return [make_photo(os.path.join(folder, f'photo_{i:03d}.jpg'), size, seed=i) for i in range(count)]
+
+
+def make_parameters(fields=10, images=1):
+    """欄位與照片參數 (與 api_save_project 存下的格式相同)；anchor_cell 由 make_xlsx 的版面決定"""
+    parameters = []
+    for i in range(fields):
+        parameters.append({
+            'name': f'field_{i}',
+            'type': 'number' if i % 3 == 0 else 'string',
+            'original_text': f'原始值{i:04d}',
+            'description': f'欄位 {i}',
+        })
+    for j in range(images):
+        parameters.append({
+            'name': f'photo_{j}',
+            'type': 'image',
+            'original_text': f'照片{j}',
+            'description': f'照片 {j}',
+            'style': {'anchor_cell': None, 'layout': 'smart_center'},
+        })
+    return parameters
+
+
+def _field_value(param, variant, inline):
+    if variant == 'blank':
+        return None
+    value = f"{{{{ {param['name']} }}}}" if variant == 'template' else param['original_text']
+    # 每三個欄位有一個是句中標籤
+    return f'數量: {value} 公斤' if inline else value
+
+
+def make_xlsx(path, parameters, variant='template', sheets=1, rows=40, cols=8, merged=4, image_path=None):
+    """
+    每張工作表: 標題列 (合併)、欄位區 (標籤 + 值)、靜態文字、merged 個 2x3 合併區、照片區。
+    欄位與照片只放在第一張工作表 (月報以第一張為模板)，其餘工作表為同版面的靜態內容。
+    回傳 parameters (照片參數已填入 anchor_cell)。
+    """
+    if variant not in VARIANTS:
+        raise ValueError(f"Unknown variant: {variant}")
+    cols = max(cols, 4)
+    text_params = [p for p in parameters if p['type'] != 'image']
+    image_params = [p for p in parameters if p['type'] == 'image']
+    per_row = cols // 2
+    field_rows = (len(text_params) + per_row - 1) // per_row
+
+    wb = openpyxl.Workbook()
+    for s in range(sheets):
+        ws = wb.active if s == 0 else wb.create_sheet()
+        ws.title = f'Sheet{s + 1}'
+        ws.merge_cells(start_row=1, start_column=1, end_row=1, end_column=cols)
+        ws.cell(row=1, column=1, value=f'合成報表 {s + 1}')
+        for c in range(1, cols + 1):
+            ws.column_dimensions[get_column_letter(c)].width = 14
+
+        row = 3
+        if s == 0:
+            for k, param in enumerate(text_params):
+                r, c = row + k // per_row, 1 + 2 * (k % per_row)
+                ws.cell(row=r, column=c, value=param['description'])
+                ws.cell(row=r, column=c + 1, value=_field_value(param, variant, inline=k % 3 == 2))
+            row += field_rows + 1
+
+        for r in range(row, row + rows):
+            for c in range(1, cols + 1):
+                if (r + c) % 3 == 0:
+                    ws.cell(row=r, column=c, value=f'項目 {r}-{c}')
+        row += rows + 1
+
+        for m in range(merged):
+            r, c = row + 2 * (m // max(1, cols // 3)), 1 + 3 * (m % max(1, cols // 3))
+            ws.merge_cells(start_row=r, start_column=c, end_row=r + 1, end_column=min(c + 2, cols))
+            ws.cell(row=r, column=c, value=f'合併 {m}')
+        row += 2 * ((merged + max(1, cols // 3) - 1) // max(1, cols // 3)) + 1
+
+        if s == 0:
+            for param in image_params:
+                ws.merge_cells(start_row=row, start_column=1, end_row=row, end_column=4)
+                ws.merge_cells(start_row=row + 1, start_column=1, end_row=row + IMAGE_BLOCK_ROWS, end_column=4)
+                header = f"{{{{ {param['name']} }}}}" if variant == 'template' else param['original_text']
+                ws.cell(row=row, column=1, value=header)
+                param['style']['anchor_cell'] = f'{row},1'
+                if variant == 'source' and image_path:
+                    img = OpenpyxlImage(image_path)
+                    img.width, img.height = 240, 180
+                    ws.add_image(img, f'A{row + 1}')
+                row += IMAGE_BLOCK_ROWS + 2
+    wb.save(path)
+    return parameters
+
+
+def make_docx(path, parameters, variant='template', paragraphs=20, tables=1, table_rows=10, image_path=None):
+    """段落中的欄位、表格中的欄位 (交錯放置)、照片標題 (source 版本附上圖片)"""
+    if variant not in VARIANTS:
+        raise ValueError(f"Unknown variant: {variant}")
+    text_params = [p for p in parameters if p['type'] != 'image']
+    image_params = [p for p in parameters if p['type'] == 'image']
+    doc = Document()
+    doc.add_heading('合成文件', level=1)
+    for param in text_params[::2]:
+        doc.add_paragraph(f"{param['description']}: {_field_value(param, variant, False) or ''}")
+    for i in range(paragraphs):
+        doc.add_paragraph(f'固定段落 {i}：' + '說明文字' * 8)
+    table_params = text_params[1::2]
+    for t in range(tables):
+        table = doc.add_table(rows=table_rows, cols=3)
+        for r in range(table_rows):
+            table.cell(r, 0).text = f'列 {r}'
+            idx = t * table_rows + r
+            if idx < len(table_params):
+                table.cell(r, 1).text = table_params[idx]['description']
+                table.cell(r, 2).text = _field_value(table_params[idx], variant, False) or ''
+            else:
+                table.cell(r, 1).text = f'項目 {r}'
+    for param in image_params:
+        doc.add_paragraph(f"{{{{ {param['name']} }}}}" if variant == 'template' else param['original_text'])
+        if variant == 'source' and image_path:
+            doc.add_picture(image_path, width=Inches(2))
+    doc.save(path)
+    return parameters
+
+
+def make_context(parameters, seed=0):
+    """generate_document 的表單值"""
+    rng = random.Random(seed)
+    return {p['name']: (str(rng.randint(1, 9999)) if p['type'] == 'number' else f'內容{rng.randint(1, 9999)}')
+            for p in parameters if p['type'] != 'image'}
+
+
+def make_entries(parameters, count, photos=(), month_start=date(2026, 9, 1), seed=0):
+    """count 筆 entry，日期平均分布在 month_start 那個月；照片以 uploads/<檔名> 形式循環使用"""
+    rng = random.Random(seed)
+    days = ((month_start.replace(day=28) + timedelta(days=4)).replace(day=1) - month_start).days
+    entries = []
+    for i in range(count):
+        data = make_context(parameters, seed=seed + i)
+        for param in parameters:
+            if param['type'] == 'image':
+                data[param['name']] = f'uploads/{os.path.basename(photos[rng.randrange(len(photos))])}' if photos else None
+        entries.append({
+            'id': f'synthetic-{i:05d}',
+            'date': (month_start + timedelta(days=i * days // max(count, 1))).isoformat(),
+            'created_at': f'{month_start.isoformat()}T08:00:00',
+            'data': data,
+        })
+    return entries
@@ -0,0 +1,49 @@
+"""admission: 預設單一 worker；多個 worker process 時 bulkhead 上限與 per_user 由各 worker 均分"""
+import pytest
+
+import run_production
+from work_assistant import admission
+
+
+@pytest.fixture
+def fresh_admission(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)   # 沒有 system_config.json -> DEFAULTS
+    yield
+    admission.set_worker_count(1)
+    admission.settings()
+
+
+def test_single_worker_by_default(monkeypatch):
+    monkeypatch.delenv('WEB_WORKERS', raising=False)
+    assert run_production.parse_args([]).workers == 1
+    monkeypatch.setenv('WEB_WORKERS', '3')
+    assert run_production.parse_args([]).workers == 3
+
+
+def test_limits_are_split_between_workers(fresh_admission):
+    admission.set_worker_count(1)
+    state = admission.snapshot()
+    assert state['bulkheads']['reports']['limit'] == 2
+    assert state['bulkheads']['reports']['queue'] == 4
+    assert state['per_user'] == 2
+
+    admission.set_worker_count(2)
+    state = admission.snapshot()
+    assert state['workers'] == 2
+    assert state['bulkheads']['reports']['limit'] == 1
+    assert state['bulkheads']['reports']['queue'] == 2
+    # 每個 worker 至少 1
+    assert state['bulkheads']['analyze']['limit'] == 1
+    assert state['per_user'] == 1
+
+
+def test_split_limit_is_enforced(fresh_admission):
+    admission.set_worker_count(2)
+    admission.settings()
+    release = admission.admit('reports', user_id='a')
+    try:
+        with pytest.raises(admission.Rejected) as excinfo:
+            admission.admit('reports', user_id='a')
+        assert excinfo.value.reason == 'user_limit'
+    finally:
+        release()
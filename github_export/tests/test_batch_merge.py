@@ -0,0 +1,100 @@
+"""batch_merge.stream_zip: 某一列讓 worker 當掉或卡住時只記錄那一列，其餘列都照常產生"""
+import io
+import json
+import os
+import time
+import zipfile
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+from work_assistant import batch_merge, offload
+
+
+def crashing_render(template_path, parameters, context):
+    """[Worker] name 為 boom 的列直接結束 worker 行程，hang 的列卡住不回應"""
+    if context['name'] == 'boom':
+        os._exit(1)
+    if context['name'] == 'hang':
+        time.sleep(600)
+    return f"doc {context['name']}".encode('utf-8')
+
+
+@pytest.fixture
+def crashing_pool(monkeypatch):
+    monkeypatch.setattr(offload, 'WORKERS', 2)
+    monkeypatch.setattr(batch_merge, 'render_row', crashing_render)
+    offload.shutdown()
+    yield
+    offload.shutdown()
+
+
+def _run(contexts):
+    data = b''.join(batch_merge.stream_zip('template.xlsx', [{'name': 'name'}], contexts, 'doc', 'name'))
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        report = json.loads(zf.read('_report.json'))
+        names = sorted(n for n in zf.namelist() if n != '_report.json')
+    return report, names
+
+
+def test_poison_row_is_isolated(crashing_pool):
+    contexts = [{'name': f'r{i}'} for i in range(6)]
+    contexts[3] = {'name': 'boom'}
+    report, names = _run(contexts)
+    assert report['failed'] == 1
+    assert report['errors'] == [{'row': 4, 'error': 'Worker process crashed'}]
+    assert report['succeeded'] == 5
+    assert names == [f'{i + 1:04d}_r{i}.xlsx' for i in range(6) if i != 3]
+
+
+def test_rows_after_crash_use_the_shared_pool(crashing_pool):
+    contexts = [{'name': f'r{i}'} for i in range(12)]
+    contexts[0] = {'name': 'boom'}
+    contexts[9] = {'name': 'boom'}
+    report, names = _run(contexts)
+    assert [e['row'] for e in report['errors']] == [1, 10]
+    assert report['succeeded'] == 10
+    assert len(names) == 10
+
+
+def test_hung_row_times_out(crashing_pool, monkeypatch):
+    monkeypatch.setattr(batch_merge, 'ROW_TIMEOUT', 10)
+    contexts = [{'name': f'r{i}'} for i in range(8)]
+    contexts[2] = {'name': 'hang'}
+    started = time.monotonic()
+    report, names = _run(contexts)
+    assert time.monotonic() - started < 60
+    assert [e['row'] for e in report['errors']] == [3]
+    assert 'did not finish within 10s' in report['errors'][0]['error']
+    assert report['succeeded'] == 7
+    assert names == [f'{i + 1:04d}_r{i}.xlsx' for i in range(8) if i != 2]
+
+
+class _BreakingPool:
+    """submit 第 broken_after 次之後拋出 BrokenProcessPool (pool 在兩次取結果之間當掉)"""
+
+    def __init__(self, broken_after=None):
+        self.broken_after = broken_after
+        self.submitted = 0
+
+    def submit(self, fn, *args):
+        if self.broken_after is not None and self.submitted >= self.broken_after:
+            raise BrokenProcessPool('pool is broken')
+        self.submitted += 1
+        future = Future()
+        future.set_result(fn(*args))
+        return future
+
+
+def test_pool_breaking_on_submit_moves_to_a_new_pool(monkeypatch):
+    pools = [_BreakingPool(broken_after=3), _BreakingPool()]
+    reset = []
+    monkeypatch.setattr(offload, 'WORKERS', 2)
+    monkeypatch.setattr(offload, 'get_pool', lambda: pools[len(reset)])
+    monkeypatch.setattr(offload, 'reset_pool', reset.append)
+    monkeypatch.setattr(batch_merge, 'render_row', crashing_render)
+    report, names = _run([{'name': f'r{i}'} for i in range(8)])
+    assert reset == [pools[0]]
+    assert report['succeeded'] == 8 and report['errors'] == []
+    assert (pools[0].submitted, pools[1].submitted) == (3, 5)
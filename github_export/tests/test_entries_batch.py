@@ -0,0 +1,131 @@
+"""/api/project/<id>/entries/batch: 全部成功才寫入；照片只能沿用 entry 目前的檔案或本次上傳的新檔"""
+import io
+import json
+
+import pytest
+
+from work_assistant import database
+
+PARAMETERS = [
+    {'name': 'site', 'type': 'string'},
+    {'name': 'photo', 'type': 'image'},
+]
+
+
+def _entry(entry_id, site, photo=None):
+    return {'id': entry_id, 'date': '2024-05-01', 'created_at': '2024-05-01T08:00:00',
+            'data': {'site': site, 'photo': photo}}
+
+
+@pytest.fixture
+def project(app_client):
+    client, uploads = app_client
+    database.save_project_config('p1', {'name': '清運', 'template_file': 'p1_template.xlsx',
+                                        'parameters': PARAMETERS})
+    database.save_project_entries('p1', [_entry('e1', '北區', 'uploads/e1.jpg'), _entry('e2', '南區'),
+                                         _entry('e3', '東區')])
+    database.save_project_config('p2', {'name': '巡查', 'template_file': 'p2_template.xlsx',
+                                        'parameters': PARAMETERS})
+    database.save_project_entries('p2', [_entry('x1', '西區', 'uploads/p2_photo.jpg')])
+    for name in ('e1.jpg', 'p2_photo.jpg', 'p1_template.xlsx', 'p2_template.xlsx'):
+        (uploads / name).write_bytes(b'data')
+    return client, uploads
+
+
+def _batch(client, operations):
+    return client.post('/api/project/p1/entries/batch', json={'operations': operations})
+
+
+def _entries(project_id='p1'):
+    return {e['id']: e for e in database.get_project_entries(project_id)}
+
+
+def test_delete_patch_replace(project):
+    client, uploads = project
+    version = database.get_entries_version('p1')
+    resp = _batch(client, [
+        {'op': 'delete', 'id': 'e3'},
+        {'op': 'patch', 'id': 'e2', 'data': {'site': '南區二段'}},
+        {'op': 'replace', 'id': 'e1', 'entry': {'date': '2024-05-02', 'data': {'site': '北區'}}},
+    ])
+    assert resp.status_code == 200
+    body = resp.get_json()
+    assert body['applied'] == 3 and body['version'] == version + 1
+    entries = _entries()
+    assert set(entries) == {'e1', 'e2'}
+    assert entries['e2']['data'] == {'site': '南區二段', 'photo': None}
+    assert entries['e1']['date'] == '2024-05-02'
+    assert entries['e1']['created_at'] == '2024-05-01T08:00:00'
+    # replace 沒有帶照片: e1 原本的照片已無人引用，一併刪除
+    assert entries['e1']['data']['photo'] is None
+    assert body['removed_photos'] == 1 and not (uploads / 'e1.jpg').exists()
+
+
+def test_failed_operation_rolls_back_whole_batch(project):
+    client, _ = project
+    before = database.get_project_entries('p1')
+    version = database.get_entries_version('p1')
+    resp = _batch(client, [
+        {'op': 'delete', 'id': 'e3'},
+        {'op': 'patch', 'id': 'e2', 'date': 'not-a-date', 'data': {}},
+    ])
+    assert resp.status_code == 400
+    assert [err['index'] for err in resp.get_json()['errors']] == [1]
+    assert database.get_project_entries('p1') == before
+    assert database.get_entries_version('p1') == version
+
+
+def test_unknown_id_is_a_conflict(project):
+    client, _ = project
+    resp = _batch(client, [{'op': 'delete', 'id': 'e1'}, {'op': 'delete', 'id': 'gone'}])
+    assert resp.status_code == 409
+    assert resp.get_json()['errors'] == [{'index': 1, 'id': 'gone', 'error': 'Entry not found'}]
+    assert 'e1' in _entries()
+
+
+def test_replace_without_entry_is_a_bad_request(project):
+    client, _ = project
+    resp = _batch(client, [{'op': 'replace', 'id': 'e1'}])
+    assert resp.status_code == 400
+    assert resp.get_json()['errors'][0]['error'] == "Missing 'entry'"
+
+
+@pytest.mark.parametrize('value', ['uploads/p2_photo.jpg', 'p1_template.xlsx', '../p2_template.xlsx'])
+def test_photo_cannot_point_at_other_files(project, value):
+    client, uploads = project
+    resp = _batch(client, [{'op': 'patch', 'id': 'e2', 'data': {'photo': value}}])
+    assert resp.status_code == 400
+    assert resp.get_json()['errors'][0]['error'] == 'Photo not found for photo'
+    assert _entries()['e2']['data']['photo'] is None
+    # 之後刪除 e2 也不會動到其他專案的照片或模板
+    assert _batch(client, [{'op': 'delete', 'id': 'e2'}]).status_code == 200
+    assert (uploads / 'p2_photo.jpg').exists() and (uploads / 'p1_template.xlsx').exists()
+
+
+def test_keeping_the_current_photo_is_allowed(project):
+    client, uploads = project
+    resp = _batch(client, [{'op': 'patch', 'id': 'e1', 'data': {'site': '北區', 'photo': 'uploads/e1.jpg'}}])
+    assert resp.status_code == 200 and resp.get_json()['removed_photos'] == 0
+    assert (uploads / 'e1.jpg').exists()
+
+
+def test_uploaded_photo_replaces_the_old_one(project):
+    client, uploads = project
+    resp = client.post('/api/project/p1/entries/batch', data={
+        'operations': json.dumps([{'op': 'patch', 'id': 'e1', 'data': {}}]),
+        '0:photo': (io.BytesIO(b'jpeg'), 'new.jpg'),
+    }, content_type='multipart/form-data')
+    assert resp.status_code == 200 and resp.get_json()['removed_photos'] == 1
+    photo = _entries()['e1']['data']['photo']
+    assert photo.startswith('uploads/') and (uploads / photo.split('/')[-1]).read_bytes() == b'jpeg'
+    assert not (uploads / 'e1.jpg').exists()
+
+
+def test_orphan_removal_skips_files_used_by_other_projects(project):
+    client, uploads = project
+    # 舊資料 (修正前) 可能已經指到其他專案的照片: 刪除時不能把它當成孤兒
+    database.save_project_entries('p1', [_entry('e2', '南區', 'uploads/p2_photo.jpg')])
+    resp = _batch(client, [{'op': 'delete', 'id': 'e2'}])
+    assert resp.status_code == 200 and resp.get_json()['removed_photos'] == 0
+    assert (uploads / 'p2_photo.jpg').exists()
+    assert _entries('p2')['x1']['data']['photo'] == 'uploads/p2_photo.jpg'
@@ -0,0 +1,77 @@
+"""GET /api/project/<id>/entries: ETag = entries 版本 (304)，?since= 差異同步，異動紀錄被截斷時回整份"""
+import pytest
+
+from work_assistant import database
+
+
+def _entry(entry_id, site):
+    return {'id': entry_id, 'date': '2024-05-01', 'data': {'site': site}}
+
+
+@pytest.fixture
+def client(app_client):
+    client, _ = app_client
+    database.save_project_config('p1', {'name': '清運', 'parameters': [{'name': 'site', 'type': 'string'}]})
+    database.save_project_entries('p1', [_entry('e1', '北區'), _entry('e2', '南區')])
+    return client
+
+
+def _get(client, **kwargs):
+    return client.get('/api/project/p1/entries', **kwargs)
+
+
+def test_matching_etag_returns_304(client):
+    first = _get(client)
+    assert first.status_code == 200
+    etag = first.headers['ETag']
+    assert etag == f'"entries-{first.get_json()["version"]}"'
+    assert first.headers['Cache-Control'] == 'private, no-cache'
+
+    cached = _get(client, headers={'If-None-Match': etag})
+    assert cached.status_code == 304 and cached.headers['ETag'] == etag
+    assert _get(client, query_string={'since': 0}, headers={'If-None-Match': etag}).status_code == 304
+
+    database.save_project_entries('p1', [_entry('e3', '東區')])
+    changed = _get(client, headers={'If-None-Match': etag})
+    assert changed.status_code == 200 and changed.headers['ETag'] != etag
+
+
+def test_since_returns_added_updated_and_deleted(client):
+    since = _get(client).get_json()['version']
+    database.save_project_entries('p1', [_entry('e3', '東區')])         # 新增
+    database.save_project_entries('p1', [_entry('e1', '北區二段')])     # 修改
+    database.delete_project_entry('p1', 'e2')                           # 刪除
+    database.save_project_entries('p1', [_entry('e4', '暫存')])         # 新增後又刪除: 呼叫端從未看過
+    database.delete_project_entry('p1', 'e4')
+    database.save_project_entries('p1', [_entry('e3', '東區一段')])     # 新增後再修改仍算新增
+
+    body = _get(client, query_string={'since': since}).get_json()
+    assert body['version'] == since + 6 and body['since'] == since
+    assert body['added'] == [_entry('e3', '東區一段')]
+    assert body['updated'] == [_entry('e1', '北區二段')]
+    assert body['deleted'] == ['e2']
+    assert 'entries' not in body and 'full' not in body
+
+    current = _get(client, query_string={'since': body['version']}).get_json()
+    assert (current['added'], current['updated'], current['deleted']) == ([], [], [])
+
+
+def test_truncated_change_log_falls_back_to_full_list(client, monkeypatch):
+    monkeypatch.setattr(database, 'ENTRY_CHANGES_LIMIT', 2)
+    since = _get(client).get_json()['version']
+    for i in range(3):
+        database.save_project_entries('p1', [_entry(f'n{i}', f'新{i}')])
+
+    body = _get(client, query_string={'since': since}).get_json()
+    assert body['full'] is True
+    assert [e['id'] for e in body['entries']] == ['e1', 'e2', 'n0', 'n1', 'n2']
+
+    # 仍在保留範圍內的版本照常回傳差異
+    recent = _get(client, query_string={'since': body['version'] - 1}).get_json()
+    assert [e['id'] for e in recent['added']] == ['n2']
+
+
+def test_since_newer_than_current_version_falls_back(client):
+    version = _get(client).get_json()['version']
+    body = _get(client, query_string={'since': version + 5}).get_json()
+    assert body['full'] is True and len(body['entries']) == 2
@@ -0,0 +1,127 @@
+"""entry_import / import_entries API: 逐列錯誤、dry_run、照片以不分大小寫的檔名比對、解壓失敗的列不留下照片"""
+import io
+import zipfile
+
+import pandas as pd
+import pytest
+
+from work_assistant import database, entry_import
+
+PARAMETERS = [
+    {'name': 'site', 'type': 'string', 'description': '地點'},
+    {'name': 'qty', 'type': 'number'},
+    {'name': 'photo', 'type': 'image'},
+    {'name': 'photo2', 'type': 'image'},
+]
+MAPPING = {'地點': 'site', 'qty': 'qty', 'photo': 'photo', 'photo2': 'photo2'}
+
+
+def _zip(files, corrupt=()):
+    """files: {ZIP 內路徑: bytes}；corrupt 中的檔案內容在壓縮檔中被改掉 (讀取時 CRC 錯誤)"""
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w', compression=zipfile.ZIP_STORED) as zf:
+        for name, data in files.items():
+            zf.writestr(name, data)
+    raw = buf.getvalue()
+    for name in corrupt:
+        raw = raw.replace(files[name], bytes(len(files[name])))
+    return io.BytesIO(raw)
+
+
+def _df(rows):
+    return pd.DataFrame(rows, columns=['date', '地點', 'qty', 'photo', 'photo2'], dtype=str)
+
+
+def _import(tmp_path, rows, archive=None, dry_run=False):
+    zf = zipfile.ZipFile(archive) if archive is not None else None
+    return entry_import.import_entries(_df(rows), PARAMETERS, MAPPING, str(tmp_path), archive=zf, dry_run=dry_run)
+
+
+def test_row_errors_skip_only_those_rows(tmp_path):
+    entries, errors = _import(tmp_path, [
+        ['2024-05-01', '北區', '1,200', '', ''],
+        ['2024-13-01', '南區', '3', '', ''],
+        ['', '東區', 'abc', '', ''],
+        ['2024/05/04', '西區', '', 'a.jpg', ''],
+    ])
+    assert [(e['date'], e['data']['site'], e['data']['qty']) for e in entries] == [('2024-05-01', '北區', '1,200')]
+    assert entries[0]['data']['photo'] is None
+    assert errors == [
+        {'row': 3, 'column': 'date', 'error': "Invalid date: '2024-13-01'"},
+        {'row': 4, 'column': 'date', 'error': 'Missing date'},
+        {'row': 4, 'column': 'qty', 'error': "Not a number: 'abc'"},
+        {'row': 5, 'column': 'photo', 'error': "Photo 'a.jpg' given but no photo archive uploaded"},
+    ]
+
+
+def test_photos_match_by_case_insensitive_basename(tmp_path):
+    archive = _zip({'現場/IMG_01.JPG': b'one', '__MACOSX/現場/._IMG_02.jpg': b'junk', 'img_02.jpeg': b'two'})
+    entries, errors = _import(tmp_path, [
+        ['2024-05-01', '北區', '1', 'img_01.jpg', r'C:\Users\me\IMG_02.JPEG'],
+        ['2024-05-02', '南區', '2', 'IMG_01.jpg', ''],
+        ['2024-05-03', '東區', '3', 'img_03.jpg', ''],
+    ], archive)
+    assert errors == [{'row': 4, 'column': 'photo', 'error': "Photo 'img_03.jpg' not found in archive"}]
+    first, second = entries
+    assert first['data']['photo'] == second['data']['photo']      # 同一張照片只存一份
+    stored = {path.name: path.read_bytes() for path in tmp_path.iterdir()}
+    assert sorted(stored.values()) == [b'one', b'two']
+    assert first['data']['photo2'] == f"uploads/{next(n for n, b in stored.items() if b == b'two')}"
+
+
+def test_dry_run_extracts_nothing(tmp_path):
+    archive = _zip({'photos/a.jpg': b'one'})
+    entries, errors = _import(tmp_path, [['2024-05-01', '北區', '1', 'A.JPG', '']], archive, dry_run=True)
+    assert errors == [] and entries[0]['data']['photo'] == 'photos/a.jpg'
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_row_dropped_by_photo_failure_leaves_no_files(tmp_path):
+    archive = _zip({'good.jpg': b'G' * 64, 'bad.jpg': b'B' * 64, 'other.jpg': b'O' * 64}, corrupt=['bad.jpg'])
+    entries, errors = _import(tmp_path, [
+        ['2024-05-01', '北區', '1', 'good.jpg', 'bad.jpg'],
+        ['2024-05-02', '南區', '2', 'other.jpg', ''],
+    ], archive)
+    assert [e['data']['site'] for e in entries] == ['南區']
+    assert [(e['row'], e['column']) for e in errors] == [(2, 'photo2')]
+    assert 'Cannot read photo' in errors[0]['error']
+    # good.jpg 只被略過的那一列使用: 不留在 uploads
+    assert [path.read_bytes() for path in tmp_path.iterdir()] == [b'O' * 64]
+
+
+@pytest.fixture
+def project(app_client):
+    client, uploads = app_client
+    database.save_project_config('p1', {'name': '清運', 'parameters': PARAMETERS})
+    return client, uploads
+
+
+def _post(client, csv, archive=None, **form):
+    data = {'data_file': (io.BytesIO(csv.encode('utf-8')), 'rows.csv'), **form}
+    if archive is not None:
+        data['photos'] = (archive, 'photos.zip')
+    return client.post('/api/project/p1/import_entries', data=data, content_type='multipart/form-data')
+
+
+CSV = 'date,地點,qty,photo\n2024-05-01,北區,1,Site/A.jpg\n2024-05-02,南區,x,\n'
+
+
+def test_api_dry_run_does_not_write(project):
+    client, uploads = project
+    resp = _post(client, CSV, _zip({'a.JPG': b'one'}), dry_run='1')
+    body = resp.get_json()
+    assert resp.status_code == 200
+    assert (body['imported'], body['valid'], body['failed']) == (0, 1, 1)
+    assert body['errors'] == [{'row': 3, 'column': 'qty', 'error': "Not a number: 'x'"}]
+    assert database.get_project_entries('p1') == [] and list(uploads.iterdir()) == []
+
+
+def test_api_import_saves_valid_rows(project):
+    client, uploads = project
+    resp = _post(client, CSV, _zip({'a.JPG': b'one'}))
+    body = resp.get_json()
+    assert (body['imported'], body['failed']) == (1, 1)
+    assert body['version'] == database.get_entries_version('p1')
+    [entry] = database.get_project_entries('p1')
+    assert entry['data']['site'] == '北區'
+    assert (uploads / entry['data']['photo'].split('/')[-1]).read_bytes() == b'one'
@@ -0,0 +1,108 @@
+"""image_prep: 依 EXIF 轉正後縮小、透明背景補白、快取命中，以及快取的過期/超量清理"""
+import os
+import threading
+import time
+
+import pytest
+from PIL import Image
+
+from work_assistant import image_prep
+
+
+@pytest.fixture
+def upload_folder(tmp_path, monkeypatch):
+    monkeypatch.setattr(image_prep, '_pruned', {})
+    return str(tmp_path)
+
+
+def _photo(path, size, orientation=None, mode='RGB', fmt='JPEG'):
+    im = Image.new(mode, size, (200, 30, 30, 0) if mode == 'RGBA' else (200, 30, 30))
+    if fmt == 'JPEG':
+        exif = Image.Exif()
+        if orientation:
+            exif[0x0112] = orientation
+        im.save(path, fmt, exif=exif.tobytes())
+    else:
+        im.save(path, fmt)
+    return str(path)
+
+
+def test_exif_rotated_photo_is_transposed_and_resized(upload_folder, tmp_path):
+    # 橫拍存檔 (800x400)、EXIF 方向 6 = 需順時針轉 90 度 -> 實際為直式 400x800
+    src = _photo(tmp_path / 'phone.jpg', (800, 400), orientation=6)
+    out = image_prep.prepare_image(src, 100, 100, upload_folder, scale=2)
+    assert os.path.dirname(out) == image_prep.cache_dir(upload_folder)
+    with Image.open(out) as im:
+        assert im.format == 'JPEG' and im.mode == 'RGB'
+        assert im.size == (100, 200)
+        assert 0x0112 not in im.getexif()
+
+
+def test_small_photo_is_not_enlarged_and_alpha_gets_white_background(upload_folder, tmp_path):
+    src = _photo(tmp_path / 'logo.png', (40, 20), mode='RGBA', fmt='PNG')
+    out = image_prep.prepare_image(src, 300, 300, upload_folder, scale=2)
+    with Image.open(out) as im:
+        assert im.size == (40, 20)
+        assert all(channel > 240 for channel in im.getpixel((20, 10)))
+
+
+def test_cache_hit_counts_and_refreshes_mtime(upload_folder, tmp_path):
+    src = _photo(tmp_path / 'a.jpg', (300, 300))
+    before = image_prep.stats()
+    out = image_prep.prepare_image(src, 50, 50, upload_folder)
+    os.utime(out, (time.time() - 5000, time.time() - 5000))
+    assert image_prep.prepare_image(src, 50, 50, upload_folder) == out
+    after = image_prep.stats()
+    assert (after['hits'] - before['hits'], after['misses'] - before['misses']) == (1, 1)
+    assert time.time() - os.path.getmtime(out) < 60
+
+
+def test_counters_are_consistent_across_threads(upload_folder, tmp_path):
+    src = _photo(tmp_path / 'a.jpg', (200, 200))
+    image_prep.prepare_image(src, 20, 20, upload_folder)
+    before = image_prep.stats()['hits']
+    threads = [threading.Thread(target=lambda: [image_prep.prepare_image(src, 20, 20, upload_folder)
+                                                for _ in range(50)]) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert image_prep.stats()['hits'] - before == 400
+
+
+def _cached(folder, name, size, age_seconds):
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, name)
+    with open(path, 'wb') as f:
+        f.write(b'x' * size)
+    stamp = time.time() - age_seconds
+    os.utime(path, (stamp, stamp))
+    return path
+
+
+def test_prune_removes_expired_then_least_recently_used(upload_folder, monkeypatch):
+    monkeypatch.setattr(image_prep, 'CACHE_MAX_BYTES', 2500)
+    monkeypatch.setattr(image_prep, 'CACHE_MAX_AGE_SECONDS', 10 * 86400)
+    folder = image_prep.cache_dir(upload_folder)
+    expired = _cached(folder, 'expired.jpg', 100, 20 * 86400)
+    oldest = _cached(folder, 'oldest.jpg', 1000, 5 * 86400)
+    older = _cached(folder, 'older.jpg', 1000, 4 * 86400)
+    recent = _cached(folder, 'recent.jpg', 1000, 2 * 86400)
+    in_use = _cached(folder, 'in_use.jpg', 1000, 60)    # 剛用過: 即使超量也不刪
+
+    assert image_prep.prune_cache(upload_folder) == 3
+    assert sorted(os.listdir(folder)) == ['in_use.jpg', 'recent.jpg']
+    assert not any(os.path.exists(p) for p in (expired, oldest, older))
+    assert os.path.exists(recent) and os.path.exists(in_use)
+    # 間隔內不再重複掃描
+    _cached(folder, 'expired2.jpg', 10, 20 * 86400)
+    assert image_prep.prune_cache(upload_folder) == 0
+    assert image_prep.prune_cache(upload_folder, force=True) == 1
+
+
+def test_prepare_many_prunes_the_cache(upload_folder, tmp_path):
+    stale = _cached(image_prep.cache_dir(upload_folder), 'stale.jpg', 10, image_prep.CACHE_MAX_AGE_SECONDS + 60)
+    src = _photo(tmp_path / 'a.jpg', (100, 100))
+    prepared = image_prep.prepare_many([(src, 30, 30)], upload_folder)
+    assert os.path.exists(prepared[(src, 30, 30)])
+    assert not os.path.exists(stale)
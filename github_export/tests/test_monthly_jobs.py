@@ -0,0 +1,97 @@
+"""monthly_jobs.submit: 相同 key 共用一個 job；查快取等磁碟 IO 不會佔住行程層級的鎖；缺 entry 的報表不進快取"""
+import os
+import threading
+from datetime import date
+
+import pytest
+
+from work_assistant import database, monthly_jobs, report_periods
+
+
+class _Executor:
+    def __init__(self):
+        self.calls = []
+
+    def submit(self, fn, *args):
+        self.calls.append(args[0])
+
+
+@pytest.fixture
+def jobs(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / database.PROJECTS_DIR / 'p1').mkdir(parents=True)
+    executor = _Executor()
+    monkeypatch.setattr(monthly_jobs, '_executor', executor)
+    monkeypatch.setattr(monthly_jobs, '_jobs', {})
+    monkeypatch.setattr(monthly_jobs, '_active', {})
+    monkeypatch.setattr(monthly_jobs, 'period_entries', lambda project_id, period: [{'id': 'e1'}])
+    monkeypatch.setattr(monthly_jobs, 'cache_key', lambda *args: 'k1')
+    return executor
+
+
+PERIOD = report_periods.Period('month', date(2024, 1, 1), date(2024, 1, 31), '202401')
+
+
+def test_same_key_shares_one_job(jobs):
+    first, created = monthly_jobs.submit('p1', {'name': 'A'}, 'uploads', PERIOD)
+    second, created_again = monthly_jobs.submit('p1', {'name': 'A'}, 'uploads', PERIOD)
+    assert created and not created_again
+    assert second is first
+    assert jobs.calls == [first]
+    assert monthly_jobs.get_job(first.id, 'p1') is first
+
+
+def test_cache_lookup_does_not_hold_the_lock(jobs, monkeypatch):
+    entered, release = threading.Event(), threading.Event()
+
+    def slow_cached_report(project_id, key, period):
+        entered.set()
+        release.wait(5)
+        return None
+
+    monkeypatch.setattr(monthly_jobs, 'cached_report', slow_cached_report)
+    result = {}
+    submitter = threading.Thread(target=lambda: result.update(
+        job=monthly_jobs.submit('p1', {'name': 'A'}, 'uploads', PERIOD)))
+    submitter.start()
+    assert entered.wait(5)
+
+    # submit 正在等磁碟時，狀態輪詢不會被擋住
+    acquired = monthly_jobs._lock.acquire(timeout=1)
+    assert acquired
+    monthly_jobs._lock.release()
+    assert monthly_jobs.get_job('missing') is None
+
+    release.set()
+    submitter.join(5)
+    job, created = result['job']
+    assert created and job.status == 'queued'
+    assert monthly_jobs.get_job(job.id) is job
+    assert os.path.exists(monthly_jobs.job_state_path('p1', job.id))
+
+
+class _PartialBuilder:
+    """有一筆 entry 渲染失敗的建置結果"""
+
+    def __init__(self, project_id, config, upload_folder):
+        pass
+
+    def build(self, entries, out, progress, keep_ids=None):
+        out.write(b'partial')
+        return {'entries': 2, 'rendered': 1, 'failed': {'e2': 'Worker process crashed'}}
+
+
+def test_partial_report_is_not_cached(jobs, monkeypatch):
+    monkeypatch.setattr(monthly_jobs.monthly_report, 'MonthlyBuilder', _PartialBuilder)
+    job, _ = monthly_jobs.submit('p1', {'name': 'A'}, 'uploads', PERIOD)
+    monthly_jobs._run(job, {'name': 'A'}, 'uploads', [{'id': 'e1'}, {'id': 'e2'}])
+    assert job.status == 'done'
+    with open(job.path, 'rb') as f:
+        assert f.read() == b'partial'
+    # 不是 k1 的完整結果: 不放在快取路徑、不封存，ETag 也不同
+    assert job.path != monthly_jobs.report_path('p1', 'k1')
+    assert monthly_jobs.cached_report('p1', 'k1', PERIOD) is None
+    assert job.to_dict()['etag'] == job.etag != 'k1'
+
+    again, created = monthly_jobs.submit('p1', {'name': 'A'}, 'uploads', PERIOD)
+    assert created and again is not job
@@ -0,0 +1,154 @@
+"""
+monthly_report.MonthlyBuilder: 組裝後的月報保留模板的活頁簿設定 (1904 日期系統、定義名稱、列印範圍)；
+worker 當掉或卡住時只有那一筆 entry 不放入月報
+"""
+import io
+import json
+import os
+import time
+from datetime import datetime
+
+import openpyxl
+import pytest
+from openpyxl.utils.datetime import CALENDAR_MAC_1904
+from openpyxl.workbook.defined_name import DefinedName
+
+from work_assistant import database, monthly_report, offload
+
+PARAMETERS = [{'name': 'site', 'type': 'string', 'original_text': '地點'}]
+
+
+@pytest.fixture
+def workspace(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(offload, 'INLINE', True)
+    (tmp_path / database.PROJECTS_DIR / 'p1').mkdir(parents=True)
+    uploads = tmp_path / 'uploads'
+    uploads.mkdir()
+    return uploads
+
+
+def _template(path):
+    wb = openpyxl.Workbook()
+    wb.epoch = CALENDAR_MAC_1904
+    ws = wb.active
+    ws.title = '日報'
+    ws['A1'] = datetime(2024, 1, 15)
+    ws['A1'].number_format = 'yyyy-mm-dd'
+    ws['A2'] = '{{ site }}'
+    ws['A3'] = '=Rate*100'
+    ws.print_area = 'A1:C10'
+    ref = wb.create_sheet("參考's")
+    ref['B1'] = 0.05
+    wb.defined_names['Rate'] = DefinedName('Rate', attr_text="'參考''s'!$B$1")
+    wb.save(path)
+
+
+def _build(uploads, entries):
+    _template(str(uploads / 'template.xlsx'))
+    builder = monthly_report.MonthlyBuilder('p1', {'template_file': 'template.xlsx', 'parameters': PARAMETERS},
+                                            str(uploads))
+    out = io.BytesIO()
+    builder.build(entries, out)
+    out.seek(0)
+    return openpyxl.load_workbook(out)
+
+
+ENTRIES = [
+    {'id': 'e1', 'date': '2024-01-02', 'data': {'site': '北區'}},
+    {'id': 'e2', 'date': '2024-01-03', 'data': {'site': '南區'}},
+]
+
+
+def test_workbook_settings_are_kept(workspace):
+    wb = _build(workspace, ENTRIES)
+    assert wb.epoch == CALENDAR_MAC_1904
+    assert len(wb.worksheets) == 3
+    reference, *entry_sheets = wb.worksheets
+    assert reference.title == "參考's"
+    for ws, site in zip(entry_sheets, ['北區', '南區']):
+        assert ws['A1'].value == datetime(2024, 1, 15)
+        assert ws['A2'].value == site
+        assert ws['A3'].value == '=Rate*100'
+    assert wb.defined_names['Rate'].attr_text == "'參考''s'!$B$1"
+
+
+def test_sheet_local_names_follow_each_copy(workspace):
+    wb = _build(workspace, ENTRIES)
+    reference, *entry_sheets = wb.worksheets
+    assert not reference.print_area
+    for ws in entry_sheets:
+        assert ws.print_area == f"'{ws.title}'!$A$1:$C$10"
+
+
+_render_blueprint = monthly_report.render_blueprint_entry
+_render_workbook = monthly_report.render_workbook_entry
+
+
+def _misbehave(entry):
+    """[Worker] site 為 boom 的 entry 直接結束 worker 行程，hang 的卡住不回應"""
+    if entry['data']['site'] == 'boom':
+        os._exit(1)
+    if entry['data']['site'] == 'hang':
+        time.sleep(600)
+
+
+def faulty_blueprint_render(blueprint, parameters, entry, *args):
+    _misbehave(entry)
+    return _render_blueprint(blueprint, parameters, entry, *args)
+
+
+def faulty_workbook_render(template_path, parameters, entry, *args):
+    _misbehave(entry)
+    return _render_workbook(template_path, parameters, entry, *args)
+
+
+@pytest.fixture
+def faulty_pool(workspace, monkeypatch):
+    monkeypatch.setattr(offload, 'WORKERS', 2)
+    monkeypatch.setattr(monthly_report, 'PARALLEL_MIN_ENTRIES', 1)
+    monkeypatch.setattr(monthly_report, 'render_blueprint_entry', faulty_blueprint_render)
+    monkeypatch.setattr(monthly_report, 'render_workbook_entry', faulty_workbook_render)
+    offload.shutdown()
+    yield workspace
+    offload.shutdown()
+
+
+def _sites(count, **special):
+    return [{'id': f'e{i}', 'date': f'2024-01-{i:02d}', 'data': {'site': special.get(f'e{i}', f'site{i}')}}
+            for i in range(1, count + 1)]
+
+
+def _build_stats(uploads, entries):
+    if not (uploads / 'template.xlsx').exists():
+        _template(str(uploads / 'template.xlsx'))
+    builder = monthly_report.MonthlyBuilder('p1', {'template_file': 'template.xlsx', 'parameters': PARAMETERS},
+                                            str(uploads))
+    out = io.BytesIO()
+    stats = builder.build(entries, out)
+    out.seek(0)
+    return stats, openpyxl.load_workbook(out), builder
+
+
+def test_crashing_entry_is_left_out(faulty_pool):
+    stats, wb, builder = _build_stats(faulty_pool, _sites(6, e4='boom'))
+    assert stats['failed'] == {'e4': 'Worker process crashed'}
+    assert stats['rendered'] == 5
+    assert [ws['A2'].value for ws in wb.worksheets[1:]] == ['site1', 'site2', 'site3', 'site5', 'site6']
+    with open(builder.manifest_path, encoding='utf-8') as f:
+        assert 'e4' not in json.load(f)['entries']
+
+    # 下一次建置只重新渲染失敗的那一筆
+    stats, wb, _ = _build_stats(faulty_pool, _sites(6))
+    assert stats['failed'] == {} and stats['rendered'] == 1 and stats['reused'] == 5
+    assert [ws['A2'].value for ws in wb.worksheets[1:]] == [f'site{i}' for i in range(1, 7)]
+
+
+def test_hung_entry_times_out(faulty_pool, monkeypatch):
+    monkeypatch.setattr(monthly_report, 'ENTRY_TIMEOUT', 10)
+    started = time.monotonic()
+    stats, wb, _ = _build_stats(faulty_pool, _sites(5, e2='hang'))
+    assert time.monotonic() - started < 60
+    assert list(stats['failed']) == ['e2']
+    assert 'did not finish within 10s' in stats['failed']['e2']
+    assert [ws['A2'].value for ws in wb.worksheets[1:]] == ['site1', 'site3', 'site4', 'site5']
@@ -0,0 +1,58 @@
+"""offload.run: 一個工作逾時不會中斷同一個 pool 上其他請求的工作"""
+import os
+import threading
+import time
+
+import pytest
+
+from work_assistant import offload
+
+
+def record_and_sleep(path, seconds):
+    """[Worker] 每次開始執行時記錄一行，之後睡 seconds 秒"""
+    with open(path, 'a') as f:
+        f.write(f'{os.getpid()}\n')
+    time.sleep(seconds)
+    return os.getpid()
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    monkeypatch.setattr(offload, 'WORKERS', 2)
+    monkeypatch.setattr(offload, 'RETIRE_POLL_SECONDS', 0.1)
+    offload.shutdown()
+    offload.run(os.getpid)   # 先啟動 worker，逾時不要算到 spawn 的時間
+    yield
+    offload.shutdown()
+
+
+def test_timeout_does_not_break_other_tasks(pool, tmp_path):
+    stuck_log, other_log = str(tmp_path / 'stuck'), str(tmp_path / 'other')
+    shared = offload.get_pool()
+    workers = list(shared._processes.values())
+    result = {}
+
+    def other():
+        result['pid'] = offload.run(record_and_sleep, other_log, 2, timeout=30)
+
+    thread = threading.Thread(target=other)
+    thread.start()
+    with pytest.raises(offload.TaskTimeout):
+        offload.run(record_and_sleep, stuck_log, 60, timeout=0.5)
+
+    # 新的工作送到新的 pool；原本的 pool 退役但不會被立即終止
+    assert offload.get_pool() is not shared
+    assert offload.run(os.getpid) not in {p.pid for p in workers}
+
+    thread.join(30)
+    assert result.get('pid')
+    with open(other_log) as f:
+        assert len(f.readlines()) == 1   # 沒有因為 pool 被終止而重跑
+
+    # 其他工作完成後，卡住的 worker 被終止
+    deadline = time.monotonic() + 10
+    while shared in offload._retiring and time.monotonic() < deadline:
+        time.sleep(0.1)
+    assert shared not in offload._retiring
+    time.sleep(0.5)
+    assert not any(p.is_alive() for p in workers)
@@ -0,0 +1,43 @@
+"""renderer.CellRenderer 的型別轉換: 只有 number 參數做完整數字轉換，文字原樣寫入"""
+import openpyxl
+import pytest
+
+from work_assistant import renderer
+
+
+PARAMETERS = [
+    {'name': 'note', 'type': 'string'},
+    {'name': 'qty', 'type': 'number'},
+    {'name': 'photo', 'type': 'image'},
+]
+
+
+@pytest.mark.parametrize('value', ['1,2', '3,4,5', '1e3', '007', '12', '-3.5', 'nan', ' 42 '])
+def test_string_parameters_round_trip(value):
+    cell_renderer = renderer.CellRenderer(PARAMETERS)
+    assert cell_renderer.render_value('{{ note }}', {'note': value}) == value
+
+
+@pytest.mark.parametrize('value, expected', [('1,200', 1200), ('-3.5', -3.5), ('12', 12), ('abc', 'abc')])
+def test_number_parameters_are_coerced(value, expected):
+    cell_renderer = renderer.CellRenderer(PARAMETERS)
+    assert cell_renderer.render_value('{{qty}}', {'qty': value}) == expected
+
+
+@pytest.mark.parametrize('value, expected', [('12', 12), ('-3.5', -3.5), ('1,2', '1,2'), ('1e3', '1e3'), (None, '')])
+def test_untyped_keys_keep_conservative_conversion(value, expected):
+    cell_renderer = renderer.CellRenderer(PARAMETERS)
+    assert cell_renderer.render_value('{{ extra }}', {'extra': value}) == expected
+
+
+def test_render_sheet_writes_text_cells():
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws['A1'] = '{{ note }}'
+    ws['A2'] = '備註: {{ note }} / {{ qty }}'
+    ws['A3'] = '{{ missing }}'
+    changed = renderer.CellRenderer(PARAMETERS).render_sheet(ws, {'note': '1,2', 'qty': '5'})
+    assert changed == 2
+    assert ws['A1'].value == '1,2'
+    assert ws['A2'].value == '備註: 1,2 / 5'
+    assert ws['A3'].value == '{{ missing }}'
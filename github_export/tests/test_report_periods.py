@@ -0,0 +1,130 @@
+"""report_periods: 期間解析 (月/週/自訂區間) 與已關帳期間的封存"""
+import json
+import os
+import threading
+from datetime import date
+
+import pytest
+
+from work_assistant import file_store, report_periods
+
+TODAY = date(2026, 10, 15)
+
+
+def test_default_period_is_current_month():
+    period = report_periods.parse_period({}, today=TODAY)
+    assert (period.kind, period.start, period.end, period.label) == ('month', date(2026, 10, 1), date(2026, 10, 31), '202610')
+
+
+def test_december_month_ends_on_new_years_eve():
+    period = report_periods.parse_period({'period': 'month', 'month': '2025-12'}, today=TODAY)
+    assert (period.start, period.end, period.label) == (date(2025, 12, 1), date(2025, 12, 31), '202512')
+
+
+@pytest.mark.parametrize('text, start, label', [
+    ('2026-W42', date(2026, 10, 12), '2026-W42'),
+    ('2026-w01', date(2025, 12, 29), '2026-W01'),   # ISO 第 1 週可能從前一年開始
+    ('2020-W53', date(2020, 12, 28), '2020-W53'),
+])
+def test_week_parsing(text, start, label):
+    period = report_periods.parse_period({'period': 'week', 'week': text}, today=TODAY)
+    assert (period.kind, period.start, period.end, period.label) == ('week', start, date.fromordinal(start.toordinal() + 6), label)
+
+
+def test_default_week_is_current_iso_week():
+    period = report_periods.parse_period({'period': 'week'}, today=TODAY)
+    assert (period.start, period.end, period.label) == (date(2026, 10, 12), date(2026, 10, 18), '2026-W42')
+
+
+def test_range_parsing():
+    period = report_periods.parse_period({'period': 'Range', 'start': ' 2026-10-01', 'end': '2026-10-15'}, today=TODAY)
+    assert (period.kind, period.start, period.end, period.label) == ('range', date(2026, 10, 1), date(2026, 10, 15), '20261001-20261015')
+    single = report_periods.parse_period({'period': 'range', 'start': '2026-10-01', 'end': '2026-10-01'}, today=TODAY)
+    assert single.start == single.end
+
+
+def test_range_end_before_start_is_rejected():
+    with pytest.raises(ValueError, match='before start'):
+        report_periods.parse_period({'period': 'range', 'start': '2026-10-15', 'end': '2026-10-01'}, today=TODAY)
+
+
+@pytest.mark.parametrize('values', [
+    {'period': 'quarter'},
+    {'period': 'month', 'month': '2026-13'},
+    {'period': 'week', 'week': '2026-42'},
+    {'period': 'week', 'week': '2026-W54'},
+    {'period': 'range', 'start': '2026-10-01'},
+    {'period': 'range', 'start': '2026/10/01', 'end': '2026-10-15'},
+])
+def test_malformed_periods_raise_value_error(values):
+    with pytest.raises(ValueError):
+        report_periods.parse_period(values, today=TODAY)
+
+
+def test_is_closed_and_round_trip():
+    period = report_periods.parse_period({'period': 'week', 'week': '2026-W41'}, today=TODAY)
+    assert period.is_closed(TODAY)
+    assert not report_periods.parse_period({}, today=TODAY).is_closed(TODAY)
+    assert report_periods.Period.from_dict(period.to_dict()).to_dict() == period.to_dict()
+
+
+# ---------------------------------------------------------------------------
+# Archives
+# ---------------------------------------------------------------------------
+
+@pytest.fixture
+def project(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    return 'p1'
+
+
+def _report(tmp_path, content):
+    path = tmp_path / f"report-{content}.xlsx"
+    path.write_text(content)
+    return str(path)
+
+
+def test_store_archive_updates_file_and_index(tmp_path, project):
+    period = report_periods.month_period(2026, 9)
+    path = report_periods.store_archive(project, period, 'k1', _report(tmp_path, 'v1'), 3)
+    assert report_periods.get_archive(project, '202609', 'k1') == path
+    assert report_periods.get_archive(project, '202609', 'other') is None
+    meta = report_periods.load_archive_index(project)['202609']
+    assert (meta['key'], meta['entries'], meta['kind']) == ('k1', 3, 'month')
+
+    report_periods.store_archive(project, period, 'k2', _report(tmp_path, 'v2'), 4)
+    assert report_periods.get_archive(project, '202609', 'k1') is None
+    with open(report_periods.get_archive(project, '202609', 'k2')) as f:
+        assert f.read() == 'v2'
+    assert [n for n in os.listdir(report_periods.archives_dir(project)) if n.endswith('.tmp')] == []
+
+
+def test_failed_copy_leaves_archive_untouched(tmp_path, project):
+    period = report_periods.month_period(2026, 9)
+    report_periods.store_archive(project, period, 'k1', _report(tmp_path, 'v1'), 3)
+    with pytest.raises(OSError):
+        report_periods.store_archive(project, period, 'k2', str(tmp_path / 'missing.xlsx'), 4)
+    assert report_periods.get_archive(project, '202609', 'k1')
+    assert [n for n in os.listdir(report_periods.archives_dir(project)) if n.endswith('.tmp')] == []
+
+
+def test_archive_file_and_key_change_together(tmp_path, project):
+    """rename 與 index 更新在同一個鎖內：鎖住 index 時封存檔不會被換掉"""
+    period = report_periods.month_period(2026, 9)
+    report_periods.store_archive(project, period, 'k1', _report(tmp_path, 'v1'), 3)
+    source = _report(tmp_path, 'v2')
+    index_path = os.path.join(report_periods.archives_dir(project), report_periods.ARCHIVE_INDEX)
+
+    writer = threading.Thread(target=report_periods.store_archive, args=(project, period, 'k2', source, 4))
+    with file_store.lock(index_path):
+        writer.start()
+        writer.join(0.5)
+        assert writer.is_alive()
+        with open(report_periods.archive_path(project, '202609')) as f:
+            assert f.read() == 'v1'
+        with open(index_path, encoding='utf-8') as f:
+            assert json.load(f)['202609']['key'] == 'k1'
+    writer.join(5)
+    assert not writer.is_alive()
+    with open(report_periods.get_archive(project, '202609', 'k2')) as f:
+        assert f.read() == 'v2'
@@ -0,0 +1,150 @@
+"""search_index: CJK bigram、AND 查詢、專案/日期篩選、增量更新後排序快取一致、由 segment 重新載入"""
+import random
+
+import pytest
+
+from work_assistant import database, search_index
+
+PARAMETERS = [{'name': 'site', 'type': 'string'}, {'name': 'note', 'type': 'string'},
+              {'name': 'photo', 'type': 'image'}]
+
+
+def _entry(entry_id, date, site, note='', photo=None):
+    return {'id': entry_id, 'date': date, 'data': {'site': site, 'note': note, 'photo': photo}}
+
+
+@pytest.fixture
+def workspace(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    database.save_project_config('p1', {'name': '垃圾清運', 'description': '每日清運紀錄',
+                                        'created_at': '2024-01-01T00:00:00', 'parameters': PARAMETERS})
+    database.save_project_entries('p1', [
+        _entry('e1', '2024-05-01', '北區清運站', '颱風停止清運'),
+        _entry('e2', '2024-05-02', '南區', '清運正常', photo='uploads/颱風.jpg'),
+        _entry('e3', '2024-06-01', '北區', '資源回收 Truck-7'),
+    ])
+    database.save_project_config('p2', {'name': '道路巡查', 'description': '清運車輛巡查',
+                                        'created_at': '2024-02-01T00:00:00', 'parameters': PARAMETERS})
+    database.save_project_entries('p2', [_entry('x1', '2024-05-01', '西區', '清運延誤 颱風')])
+    return tmp_path
+
+
+def _index(*project_ids):
+    index = search_index.SearchIndex()
+    for project_id in project_ids or ('p1', 'p2'):
+        index.refresh(project_id)
+    return index
+
+
+def _hits(index, query, **filters):
+    return [(r['project_id'], r['entry_id']) for r in index.search(query, **filters)[1]]
+
+
+def _assert_consistent(index):
+    """增量維護的 BM25 詞頻項與 bisect 排序清單，必須與 postings 重新計算的結果相同"""
+    for token, weights in index._weights.items():
+        assert set(weights) == set(index._postings[token])
+        for key, weight in weights.items():
+            assert weight == pytest.approx(index._weight(index._postings[token][key], index._docs[key]['len']))
+        ranked = index._ranked.get(token)
+        if ranked is not None:
+            assert ranked[0] == sorted(ranked[0])
+            assert len(ranked[1]) == len(weights) and set(ranked[1]) == set(weights)
+            assert ranked[0] == [-weights[key] for key in ranked[1]]
+
+
+def test_tokenize_uses_cjk_bigrams():
+    assert search_index.tokenize('清運ABC-12', query=True) == ['清運', 'abc', '12']
+    assert search_index.tokenize('清運紀錄') == ['清', '運', '紀', '錄', '清運', '運紀', '紀錄']
+    assert search_index.tokenize('北', query=True) == ['北']
+    assert search_index.tokenize('ＴＲＵＣＫ') == ['truck']     # NFKC 全形轉半形
+
+
+def test_cjk_bigram_matching(workspace):
+    index = _index()
+    assert set(_hits(index, '清運站')) == {('p1', 'e1')}
+    # 「清站」不是相鄰的兩個字，不算命中
+    assert _hits(index, '清站') == []
+    # 單一字的查詢用單字元索引
+    assert set(_hits(index, '北')) == {('p1', 'e1'), ('p1', 'e3')}
+    assert _hits(index, 'truck') == [('p1', 'e3')]
+    # 照片欄不索引
+    assert ('p1', 'e2') not in _hits(index, '颱風')
+
+
+def test_and_semantics(workspace):
+    index = _index()
+    assert set(_hits(index, '清運 颱風')) == {('p1', 'e1'), ('p2', 'x1')}
+    assert _hits(index, '清運 颱風 回收') == []
+    assert _hits(index, '不存在的詞') == []
+
+
+def test_project_name_ranks_first_and_filters(workspace):
+    index = _index()
+    assert _hits(index, '巡查')[0] == ('p2', None)
+    assert set(_hits(index, '清運', project_ids=['p2'])) == {('p2', None), ('p2', 'x1')}
+    assert set(_hits(index, '清運', kind='entry', start='2024-05-02', end='2024-05-31')) == {('p1', 'e2')}
+    assert _hits(index, '北區', start='2024-06-01') == [('p1', 'e3')]
+    total, results = index.search('清運', project_ids=['p1'], kind='entry', limit=1)
+    assert total == 2 and len(results) == 1
+
+
+def test_incremental_refresh_keeps_ranked_lists_consistent(workspace, monkeypatch):
+    index = _index()
+    # 單詞查詢建立排序快取，之後的增刪必須同步維護
+    for query in ('清運', '北區', '颱風', '回收'):
+        index.search(query)
+    assert index._ranked
+
+    database.save_project_entries('p1', [_entry('e1', '2024-05-01', '北區清運站', '恢復清運'),
+                                         _entry('e4', '2024-05-03', '東區', '颱風 清運 清運')])
+    database.delete_project_entry('p1', 'e3')
+    rebuilds = []
+    monkeypatch.setattr(index, '_drop_project', rebuilds.append)
+    assert index.refresh('p1') is True
+    assert rebuilds == []       # 只重新索引異動的 entry
+
+    _assert_consistent(index)
+    assert set(_hits(index, '颱風')) == {('p1', 'e4'), ('p2', 'x1')}
+    assert _hits(index, '回收') == []
+    # 分數沿用平均長度偏移 10% 內的快取詞頻項，命中的文件與重建的索引相同
+    fresh = _index()
+    for query in ('清運', '北區', '颱風', '清運 颱風'):
+        assert index.search(query)[0] == fresh.search(query)[0]
+        assert set(_hits(index, query)) == set(_hits(fresh, query))
+    assert index.refresh('p1') is False
+
+
+def test_reload_from_saved_segment(workspace, monkeypatch):
+    expected = _index().search('清運')
+    monkeypatch.setattr(database, 'get_project_entries', lambda project_id: pytest.fail('segment not used'))
+    reloaded = _index()
+    assert reloaded.search('清運') == expected
+    assert reloaded.stats() == {'projects': 2, 'documents': 6, 'terms': len(reloaded._postings)}
+
+
+def test_deleted_project_is_dropped(workspace):
+    index = _index()
+    database.delete_project('p2')
+    index.sync(force=True)
+    assert all(project_id == 'p1' for project_id, _ in _hits(index, '清運'))
+
+
+def test_random_edits_keep_ranked_lists_consistent():
+    rng = random.Random(7)
+    words = ['清運', '回收', '颱風', '北區', 'truck', '巡查']
+    index = search_index.SearchIndex()
+    for step in range(300):
+        key = ('p1', f'e{rng.randrange(40)}')
+        if rng.random() < 0.3:
+            index._remove(key)
+        else:
+            text = ' '.join(rng.choice(words) for _ in range(rng.randrange(1, 6)))
+            index._add(key, search_index.entry_document({'date': '2024-05-01', 'data': {'note': text}}, None))
+        if step % 10 == 0:
+            index.search(rng.choice(words))
+        _assert_consistent(index)
+    for word in words:
+        total, results = index.search(word, limit=100)
+        assert total == len(index._postings.get(search_index.tokenize(word, query=True)[0], {}))
+        assert [r['score'] for r in results] == sorted((r['score'] for r in results), reverse=True)
@@ -0,0 +1,24 @@
+"""
+冷啟動預算 (Cold-start budget)
+
+全新的直譯器匯入 work_assistant.txtapp 的時間不得超過 STARTUP_BUDGET_MS (預設 1000 ms)，
+且重量級依賴 (Gemini、pandas、deepdiff、python-docx、docxtpl、openpyxl) 不可在匯入時載入。
+超過預算時以 python tests/import_profile.py 查看是哪個模組。
+"""
+import os
+
+import import_profile
+
+STARTUP_BUDGET_MS = float(os.getenv('STARTUP_BUDGET_MS', '1000'))
+
+
+def test_heavy_modules_are_lazy():
+    stats = import_profile.measure(runs=1)
+    assert stats['loaded'] == [], f"Loaded at import time: {stats['loaded']}"
+
+
+def test_cold_start_budget():
+    stats = import_profile.measure(runs=3)
+    assert stats['elapsed_ms'] <= STARTUP_BUDGET_MS, (
+        f"import {import_profile.DEFAULT_MODULE} took {stats['elapsed_ms']:.0f} ms "
+        f"(runs {stats['runs']}), budget {STARTUP_BUDGET_MS:.0f} ms")
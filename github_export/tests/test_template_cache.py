@@ -0,0 +1,62 @@
+"""template_cache: 每次取得獨立副本；模板內容變更後重新解析；多執行緒同時載入"""
+import os
+import threading
+
+import openpyxl
+
+from work_assistant import template_cache
+
+
+def _write_template(path, value):
+    wb = openpyxl.Workbook()
+    wb.active['A1'] = value
+    wb.save(path)
+
+
+def test_workbook_copies_are_isolated(tmp_path):
+    path = str(tmp_path / 'template.xlsx')
+    _write_template(path, '{{ name }}')
+    cache = template_cache.TemplateCache()
+    first = cache.load_workbook(path)
+    first.active['A1'] = 'changed'
+    second = cache.load_workbook(path)
+    assert second.active['A1'].value == '{{ name }}'
+    assert cache.stats()['hits'] == 1
+
+
+def test_modified_template_is_reloaded(tmp_path):
+    path = str(tmp_path / 'template.xlsx')
+    _write_template(path, 'v1')
+    cache = template_cache.TemplateCache()
+    assert cache.load_workbook(path).active['A1'].value == 'v1'
+    _write_template(path, 'version 2')
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000))
+    assert cache.load_workbook(path).active['A1'].value == 'version 2'
+
+
+def test_concurrent_template_hash(tmp_path):
+    paths = []
+    for i in range(8):
+        path = str(tmp_path / f'template{i}.xlsx')
+        _write_template(path, f'v{i}')
+        paths.append(path)
+    expected = {path: template_cache.file_hash(path) for path in paths}
+    cache = template_cache.TemplateCache()
+    errors = []
+
+    def worker():
+        try:
+            for _ in range(50):
+                for path in paths:
+                    assert cache.template_hash(path) == expected[path]
+        except Exception as e:   # pragma: no cover - 失敗時回報
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == []
+    assert len(cache._hashes) == len(paths)
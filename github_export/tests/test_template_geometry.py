@@ -0,0 +1,42 @@
+"""template_geometry: 錨點解析；格式錯誤的 anchor_cell 只略過該張圖片，不影響整份月報"""
+import json
+
+import pytest
+
+from work_assistant import template_geometry
+
+
+def _geometry():
+    # 第 2 列為標題 (A2:B2)，第 3~5 列為照片本體 (A3:B5)；每欄 60px，每列 20pt
+    cols = [0.0, 60.0, 120.0, 180.0]
+    rows_pt = [20.0 * i for i in range(7)]
+    return template_geometry.TemplateGeometry(
+        [(2, 1, 2, 2), (3, 1, 5, 2)], cols, [pt * 1.333 for pt in rows_pt], rows_pt)
+
+
+def test_header_anchor_resolves_to_the_body_below():
+    target = _geometry().resolve_anchor('2,1')
+    assert target['is_header'] and target['box'] == [3, 1, 5, 2]
+    assert target['box_w'] == 120.0 and target['row0'] == 2
+
+
+@pytest.mark.parametrize('anchor', ['(2, 1)', '2,1,3', 'B2,1', ','])
+def test_malformed_anchor_resolves_to_none(anchor):
+    geometry = _geometry()
+    assert geometry.resolve_anchor(anchor) is None
+    assert geometry.anchors[anchor] is None
+
+
+def test_get_geometry_skips_malformed_anchors(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(template_geometry, '_memory_cache', {})
+    monkeypatch.setattr(template_geometry.TemplateGeometry, 'from_sheet', classmethod(lambda cls, ws: _geometry()))
+    parameters = [
+        {'name': 'bad', 'type': 'image', 'style': {'anchor_cell': 'B2,1'}},
+        {'name': 'photo', 'type': 'image', 'style': {'anchor_cell': '2,1'}},
+    ]
+    geometry = template_geometry.get_geometry('p1', 'hash1', parameters, lambda: None)
+    assert geometry.anchors['B2,1'] is None
+    assert geometry.anchors['2,1']['box'] == [3, 1, 5, 2]
+    saved = json.loads((tmp_path / template_geometry._geometry_path('p1')).read_text(encoding='utf-8'))
+    assert saved['anchors']['B2,1'] is None
@@ -0,0 +1,84 @@
+"""template_registry: 相似模板沿用參數；照片錨點以上的版面位移時不沿用舊的 anchor_cell"""
+import json
+
+import pytest
+
+from work_assistant import database, template_registry
+
+ROWS = ['每日清運紀錄表', '日期：____', '地點：____', '數量：____', '', '照片', '備註', '承辦人', '主管',
+        '第一聯', '第二聯', '環保局', '垃圾分類', '資源回收', '巡查員簽名', '表單編號 A-01']
+PARAMETERS = [
+    {'name': 'site', 'type': 'string', 'original_text': '地點：____'},
+    {'name': 'qty', 'type': 'number', 'original_text': '數量：____'},
+    {'name': 'photo', 'type': 'image', 'original_text': '', 'style': {'anchor_cell': '5,1'}},
+]
+
+
+def _structure(rows):
+    cells = {f"{r},1": text for r, text in enumerate(rows, 1) if text}
+    return {'sheet_names': ['日報'], 'sheets': {'日報': {'cells': cells}}}
+
+
+@pytest.fixture
+def registry(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    project_dir = tmp_path / database.PROJECTS_DIR / 'p1'
+    project_dir.mkdir(parents=True)
+    (project_dir / 'config.json').write_text(
+        json.dumps({'id': 'p1', 'name': '清運', 'parameters': PARAMETERS}), encoding='utf-8')
+    monkeypatch.setattr(template_registry, '_cache', {})
+    monkeypatch.setattr(template_registry, '_project_ids', [])
+    monkeypatch.setattr(template_registry, '_listed', 0.0)
+    assert template_registry.register('p1', _structure(ROWS), 'excel')
+
+
+def _plan(rows):
+    match = template_registry.find_match(_structure(rows), 'excel')
+    assert match is not None and match['project_id'] == 'p1'
+    return template_registry.plan_reuse(match)
+
+
+def test_identical_template_reuses_everything(registry):
+    plan = _plan(ROWS)
+    assert plan['changed'] == {}
+    assert [p['name'] for p in plan['parameters']] == ['site', 'qty', 'photo']
+    assert plan['relocate'] == [] and plan['dropped'] == []
+
+
+def test_row_inserted_above_anchor_relocates_photo(registry):
+    rows = ROWS[:2] + ['天氣：____'] + ROWS[2:]
+    plan = _plan(rows)
+    # 文字參數依 original_text 沿用；照片的錨點已經往下移一列
+    assert [p['name'] for p in plan['parameters']] == ['site', 'qty']
+    assert plan['relocate'] == ['photo']
+    assert plan['changed']['日報!3,1'] == '天氣：____'
+    assert '日報!7,1' in plan['changed']     # 照片標題移到第 7 列
+
+
+def test_row_moved_above_anchor_is_detected(registry):
+    rows = list(ROWS)
+    rows[2], rows[3] = rows[3], rows[2]      # 文字集合相同，只有位置不同
+    plan = _plan(rows)
+    assert plan['relocate'] == ['photo']
+    assert set(plan['changed']) == {'日報!3,1', '日報!4,1'}
+
+
+def test_row_inserted_below_anchor_keeps_photo(registry):
+    rows = ROWS[:8] + ['複核'] + ROWS[8:]
+    plan = _plan(rows)
+    assert [p['name'] for p in plan['parameters']] == ['site', 'qty', 'photo']
+    assert plan['relocate'] == []
+    assert '日報!9,1' in plan['changed']
+
+
+def test_removed_text_parameter_is_dropped(registry):
+    rows = list(ROWS)
+    rows[3] = ''
+    plan = _plan(rows)
+    assert plan['dropped'] == ['qty']
+    assert plan['changed'] == {}
+    assert [p['name'] for p in plan['parameters']] == ['site', 'photo']
+
+
+def test_unrelated_template_does_not_match(registry):
+    assert template_registry.find_match(_structure(['完全不同的表單', '姓名', '電話', '地址']), 'excel') is None
@@ -0,0 +1,336 @@
+"""
+昂貴端點的准入控制 (Admission control / bulkheads)
+
+/api/analyze、月報、批次合併、文件產生一次可能佔住 waitress 執行緒數秒到數分鐘；
+同時湧入時會把所有執行緒用完，連 entry 新增這類便宜的請求也跟著逾時。
+以 @admission.limit('<bulkhead>') 標記的 view 需先取得該 bulkhead 的名額:
+  - 每個 bulkhead 同時執行 limit 筆，另有最多 queue 筆可排隊等待 timeout 秒
+    (排隊依角色優先順序，同優先順序先到先服務)
+  - 同一使用者同時進行中 (含排隊) 的昂貴請求不超過 per_user
+  - 所有 bulkhead 佔用 (執行 + 排隊) 的執行緒不超過 server threads - reserve_threads，
+    保留的執行緒只服務一般請求
+超過任何一項限制立即回 429 + Retry-After，不會再佔住執行緒。
+generator 串流回應 (批次 ZIP) 的名額在回應送完 (close) 時才釋放。
+
+設定放在 system_config.json 的 "admission" (未列出的項目使用 DEFAULTS)，修改後數秒內生效:
+    "admission": {
+        "bulkheads": {"analyze": {"limit": 1, "queue": 2, "timeout": 30}, ...},
+        "per_user": 2,
+        "reserve_threads": 2,
+        "priorities": {"developer": 0, "manager": 1, "operator": 2},
+        "retry_after": 5
+    }
+各 bulkhead 的執行/排隊數與拒絕次數輸出在 /metrics。
+多個 worker process (run_production --workers N) 時每個行程各自計算: bulkhead 的 limit/queue 與 per_user
+以 worker 數均分 (每個 worker 至少 1，設定值因此約略是整個 server 的上限)；reserve_threads 是每個 worker 的。
+"""
+import copy
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+import types
+from functools import wraps
+
+from flask import jsonify, make_response
+from flask_login import current_user
+
+try:
+    import database
+    import metrics
+except ImportError:
+    from . import database
+    from . import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'bulkheads': {
+        'analyze': {'limit': 1, 'queue': 2, 'timeout': 30},     # Gemini 分析
+        'reports': {'limit': 2, 'queue': 4, 'timeout': 15},     # 月報排程、批次合併、批次匯入
+        'documents': {'limit': 2, 'queue': 4, 'timeout': 15},   # 單份文件產生、模板轉換
+    },
+    'per_user': 2,
+    'reserve_threads': 2,
+    'priorities': {'developer': 0, 'manager': 1, 'operator': 2},
+    'retry_after': 5,
+}
+DEFAULT_PRIORITY = 1
+CONFIG_CHECK_SECONDS = 2.0
+
+
+class Rejected(Exception):
+    def __init__(self, bulkhead, reason):
+        super().__init__(f"{bulkhead}: {reason}")
+        self.bulkhead = bulkhead
+        self.reason = reason
+
+
+class Bulkhead:
+    """最多 limit 筆同時執行；其餘依 (priority, 到達順序) 排隊，最多 queue 筆"""
+
+    def __init__(self, name, limit, queue, timeout):
+        self.name = name
+        self.limit = limit
+        self.queue = queue
+        self.timeout = timeout
+        self.active = 0
+        self._waiting = []   # heap of [priority, seq]
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+
+    @property
+    def queued(self):
+        return len(self._waiting)
+
+    def configure(self, limit, queue, timeout):
+        with self._cond:
+            self.limit, self.queue, self.timeout = limit, queue, timeout
+            self._cond.notify_all()
+
+    def acquire(self, priority):
+        with self._cond:
+            if self.active < self.limit and not self._waiting:
+                self.active += 1
+                return 0.0
+            if len(self._waiting) >= self.queue:
+                raise Rejected(self.name, 'queue_full')
+            ticket = [priority, next(self._seq)]
+            heapq.heappush(self._waiting, ticket)
+            start = time.monotonic()
+            deadline = start + self.timeout
+            while not (self._waiting[0] is ticket and self.active < self.limit):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._waiting.remove(ticket)
+                    heapq.heapify(self._waiting)
+                    self._cond.notify_all()
+                    raise Rejected(self.name, 'queue_timeout')
+                self._cond.wait(remaining)
+            heapq.heappop(self._waiting)
+            self.active += 1
+            # 下一位可能也輪得到 (limit 調高時)
+            self._cond.notify_all()
+            return time.monotonic() - start
+
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify_all()
+
+
+_bulkheads = {}
+_settings = copy.deepcopy(DEFAULTS)
+_config_stamp = None
+_config_checked = 0.0
+_server_threads = None
+_workers = 1
+_RELOAD = object()
+_lock = threading.Lock()
+_occupied = 0          # 所有 bulkhead 執行 + 排隊中的請求
+_per_user = {}         # user id -> 執行 + 排隊中的請求
+
+
+def set_server_threads(threads):
+    """server 啟動時呼叫；未設定時不檢查 reserve_threads"""
+    global _server_threads
+    _server_threads = threads
+
+
+def set_worker_count(workers):
+    """prefork worker 啟動時呼叫: 之後的設定以 worker 數均分"""
+    global _workers, _config_stamp, _config_checked
+    with _lock:
+        _workers = max(1, int(workers))
+        _config_stamp = _RELOAD
+        _config_checked = 0.0
+
+
+def _per_worker(value):
+    """設定值 (整個 server) -> 單一 worker 的上限；0 (不限制/不排隊) 維持 0"""
+    return max(1, value // _workers) if value > 0 else value
+
+
+def _merge(settings):
+    merged = copy.deepcopy(DEFAULTS)
+    for key, value in (settings or {}).items():
+        if key == 'bulkheads' and isinstance(value, dict):
+            for name, limits in value.items():
+                merged['bulkheads'][name] = dict(merged['bulkheads'].get(name, {}), **(limits or {}))
+        elif key == 'priorities' and isinstance(value, dict):
+            merged['priorities'].update(value)
+        else:
+            merged[key] = value
+    return merged
+
+
+def _apply(settings):
+    global _settings
+    _settings = settings
+    for name, limits in settings['bulkheads'].items():
+        limit = _per_worker(int(limits.get('limit', 1)))
+        queue = _per_worker(int(limits.get('queue', 0)))
+        timeout = float(limits.get('timeout', 0))
+        if name in _bulkheads:
+            _bulkheads[name].configure(limit, queue, timeout)
+        else:
+            _bulkheads[name] = Bulkhead(name, limit, queue, timeout)
+
+
+def settings():
+    """目前生效的設定 (system_config.json 變更後最多 CONFIG_CHECK_SECONDS 秒內重新載入)"""
+    global _config_stamp, _config_checked
+    now = time.monotonic()
+    if now - _config_checked < CONFIG_CHECK_SECONDS and _bulkheads:
+        return _settings
+    with _lock:
+        _config_checked = now
+        try:
+            st = os.stat(database.SYSTEM_CONFIG_FILE)
+            stamp = (st.st_mtime_ns, st.st_size)
+        except OSError:
+            stamp = None
+        if stamp != _config_stamp or not _bulkheads:
+            config = database.get_system_config() if stamp else {}
+            try:
+                _apply(_merge(config.get('admission')))
+            except (TypeError, ValueError, AttributeError) as e:
+                logger.error(f"Invalid admission settings in {database.SYSTEM_CONFIG_FILE}, using defaults: {e}")
+                _apply(copy.deepcopy(DEFAULTS))
+            _config_stamp = stamp
+        return _settings
+
+
+def _reserve(name, user_id):
+    """檢查全域與使用者上限並先佔位；失敗時拋出 Rejected"""
+    global _occupied
+    conf = settings()
+    with _lock:
+        reserve = int(conf.get('reserve_threads') or 0)
+        if _server_threads and _occupied >= max(1, _server_threads - reserve):
+            raise Rejected(name, 'server_busy')
+        per_user = _per_worker(int(conf.get('per_user') or 0))
+        if per_user and user_id is not None and _per_user.get(user_id, 0) >= per_user:
+            raise Rejected(name, 'user_limit')
+        _occupied += 1
+        if user_id is not None:
+            _per_user[user_id] = _per_user.get(user_id, 0) + 1
+
+
+def _unreserve(user_id):
+    global _occupied
+    with _lock:
+        _occupied -= 1
+        if user_id is not None:
+            remaining = _per_user.get(user_id, 0) - 1
+            if remaining > 0:
+                _per_user[user_id] = remaining
+            else:
+                _per_user.pop(user_id, None)
+
+
+def admit(name, user_id=None, role=None):
+    """取得 bulkhead 名額 (必要時排隊)；回傳只會生效一次的 release()，失敗拋出 Rejected"""
+    conf = settings()
+    bulkhead = _bulkheads.get(name)
+    if bulkhead is None:
+        raise KeyError(f"Unknown bulkhead: {name}")
+    priority = conf['priorities'].get(role, DEFAULT_PRIORITY)
+    _reserve(name, user_id)
+    try:
+        waited = bulkhead.acquire(priority)
+    except Rejected:
+        _unreserve(user_id)
+        raise
+    metrics.ADMISSION_WAIT_SECONDS.observe(waited, bulkhead=name)
+    released = threading.Event()
+
+    def release():
+        if not released.is_set():
+            released.set()
+            bulkhead.release()
+            _unreserve(user_id)
+    return release
+
+
+def _rejected_response(e):
+    metrics.ADMISSION_REJECTED.inc(bulkhead=e.bulkhead, reason=e.reason)
+    logger.warning(f"Admission rejected ({e.bulkhead}, {e.reason})")
+    retry_after = int(settings().get('retry_after') or 1)
+    response = jsonify({'error': f'Server is busy, please retry in {retry_after} seconds.',
+                        'bulkhead': e.bulkhead, 'reason': e.reason, 'retry_after': retry_after})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+
+class _ReleaseOnClose:
+    """
+    包住串流回應的 generator: 送完或連線中斷時 server 會呼叫 close()，此時釋放名額。
+    (direct_passthrough 的回應不經過 Response.close，call_on_close 不會被呼叫)
+    """
+
+    def __init__(self, iterable, release):
+        self._iterable = iterable
+        self._release = release
+
+    def __iter__(self):
+        return iter(self._iterable)
+
+    def close(self):
+        try:
+            self._iterable.close()
+        finally:
+            self._release()
+
+
+def limit(name):
+    """View decorator (放在 @login_required 之後): 依 bulkhead 限制同時執行數"""
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            user_id = current_user.get_id() if current_user.is_authenticated else None
+            try:
+                release = admit(name, user_id, getattr(current_user, 'role', None))
+            except Rejected as e:
+                return _rejected_response(e)
+            try:
+                response = make_response(f(*args, **kwargs))
+            except BaseException:
+                release()
+                raise
+            if isinstance(response.response, types.GeneratorType):
+                # generator 串流 (批次 ZIP) 在 view 回傳後才真正產生內容；send_file 的檔案已產生完畢
+                response.response = _ReleaseOnClose(response.response, release)
+            else:
+                release()
+            return response
+        return wrapper
+    return decorator
+
+
+def snapshot():
+    """各 bulkhead 的設定與目前執行/排隊數"""
+    conf = settings()
+    with _lock:
+        occupied, users = _occupied, len(_per_user)
+    return {
+        'bulkheads': {name: {'limit': b.limit, 'queue': b.queue, 'timeout': b.timeout,
+                             'active': b.active, 'queued': b.queued}
+                      for name, b in sorted(_bulkheads.items())},
+        'occupied': occupied,
+        'users': users,
+        'server_threads': _server_threads,
+        'workers': _workers,
+        'reserve_threads': conf.get('reserve_threads'),
+        'per_user': _per_worker(int(conf.get('per_user') or 0)),
+    }
+
+
+@metrics.register_collector
+def _collect_admission_metrics():
+    for name, state in snapshot()['bulkheads'].items():
+        metrics.ADMISSION_ACTIVE.set(state['active'], bulkhead=name)
+        metrics.ADMISSION_QUEUED.set(state['queued'], bulkhead=name)
@@ -0,0 +1,234 @@
+"""
+批次合併列印 (Batch mail-merge)
+
+以 Zone C 的 Excel/CSV 資料檔，每一列產生一份文件，於 offload 的 process pool 中平行渲染，
+結果以 ZIP 串流回傳 (邊產生邊送出，不會把整個壓縮檔放在記憶體)。
+單列失敗 (含逾時、worker 當掉) 不會中斷整批工作，會記錄在 ZIP 內的 _report.json。
+"""
+import io
+import json
+import logging
+import os
+import time
+import zipfile
+from collections import deque
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    import offload
+    import renderer
+    import template_cache
+    from lazy_imports import pandas as pd
+except ImportError:
+    from . import offload
+    from . import renderer
+    from . import template_cache
+    from .lazy_imports import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+DATA_EXTENSIONS = {'.xlsx', '.xls', '.csv'}
+# 單列最多等待的秒數 (輪到該列時開始計算)；逾時的列記為失敗，執行它的 pool 退役
+ROW_TIMEOUT = float(os.getenv('BATCH_ROW_TIMEOUT', '120'))
+
+
+def read_data_rows(source, ext):
+    """讀取資料檔 (路徑或上傳的檔案串流)，所有欄位以字串處理 (避免 00123 被轉成 123)"""
+    if ext == '.csv':
+        df = pd.read_csv(source, dtype=str, keep_default_na=False)
+    else:
+        df = pd.read_excel(source, dtype=str, keep_default_na=False)
+    df.columns = [str(c).strip() for c in df.columns]
+    return df
+
+
+def resolve_mapping(columns, parameters, mapping=None):
+    """
+    回傳 {欄位名稱: 參數名稱}。
+    未提供 mapping 時，自動以欄位名稱 = 參數 name 或 description 對應。
+    """
+    param_names = {p['name'] for p in parameters}
+    if mapping:
+        return {col: name for col, name in mapping.items() if col in columns and name in param_names}
+
+    by_desc = {str(p.get('description', '')).strip(): p['name'] for p in parameters if p.get('description')}
+    resolved = {}
+    for col in columns:
+        if col in param_names:
+            resolved[col] = col
+        elif col in by_desc:
+            resolved[col] = by_desc[col]
+    return resolved
+
+
+def build_contexts(df, parameters, mapping):
+    """每一列轉成 generate_document 相同格式的 context"""
+    records = df.to_dict('records')
+    contexts = []
+    for record in records:
+        context = {p['name']: '' for p in parameters}
+        for col, name in mapping.items():
+            context[name] = record.get(col, '')
+        contexts.append(context)
+    return contexts
+
+
+def render_row(template_path, parameters, context):
+    """[Worker] 渲染單份文件並回傳 bytes"""
+    ext = os.path.splitext(template_path)[1].lower()
+    out = io.BytesIO()
+    if ext == '.docx':
+        doc = template_cache.load_docx_template(template_path)
+        doc.render(context)
+        doc.save(out)
+    elif ext in ['.xlsx', '.xls']:
+        wb = template_cache.load_workbook(template_path)
+        renderer.CellRenderer(parameters).render_workbook(wb, context)
+        wb.save(out)
+    else:
+        raise ValueError(f"Unsupported template type: {ext}")
+    return out.getvalue()
+
+
+def safe_name(value, fallback):
+    text = str(value or '').strip()
+    for ch in '\\/:*?"<>|\r\n\t':
+        text = text.replace(ch, '')
+    return text[:60] or fallback
+
+
+class _ChunkWriter(io.RawIOBase):
+    """不可 seek 的輸出端；zipfile 寫入的資料暫存於此，由 generator 取走"""
+
+    def __init__(self):
+        self.chunks = deque()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self):
+        while self.chunks:
+            yield self.chunks.popleft()
+
+
+def stream_zip(template_path, parameters, contexts, base_name, name_param=None):
+    """
+    Generator: 以滑動視窗送出工作 (最多 2 x workers 份在途)，
+    依列順序把完成的文件寫入 ZIP 並立即 yield。每一列最多等待 ROW_TIMEOUT 秒。
+    """
+    ext = os.path.splitext(template_path)[1].lower()
+    pool = offload.get_pool()
+    window = offload.WORKERS * 2
+    writer = _ChunkWriter()
+    report = {'total': len(contexts), 'succeeded': 0, 'failed': 0, 'errors': []}
+    started = time.time()
+
+    pending = deque()   # (列序號, context, 送出的 pool, future)
+    next_index = 0
+    zf = None
+    solo = None
+
+    def cancel_pending():
+        for _, _, _, future in pending:
+            future.cancel()
+
+    def add_row(index, ctx, data):
+        label = safe_name(ctx.get(name_param) if name_param else '', base_name)
+        zf.writestr(f"{index + 1:04d}_{label}{ext}", data)
+        report['succeeded'] += 1
+
+    def fail_row(index, error):
+        report['failed'] += 1
+        report['errors'].append({'row': index + 1, 'error': error})
+
+    def run_isolated(index, ctx):
+        """在單一 worker 的 pool 重跑一列；這時當掉就一定是這一列造成的"""
+        nonlocal solo
+        if solo is None:
+            solo = offload.isolated_pool()
+        future = solo.submit(render_row, template_path, parameters, ctx)
+        try:
+            data = offload.result(solo, future, ROW_TIMEOUT, f"batch row {index + 1}")
+        except BrokenProcessPool as e:
+            logger.error(f"Batch worker crashed on row {index + 1}: {e}")
+            fail_row(index, 'Worker process crashed')
+            solo.shutdown(wait=False, cancel_futures=True)
+            solo = None
+        except offload.TaskTimeout as e:
+            fail_row(index, str(e))
+            solo = None     # 已退役，卡住的 worker 由 offload 終止
+        except Exception as e:
+            logger.warning(f"Batch row {index + 1} failed: {e}")
+            fail_row(index, str(e))
+        else:
+            add_row(index, ctx, data)
+
+    def submit(ctx):
+        """送到共用 pool；pool 在兩次取結果之間當掉時 submit 本身會拋出 BrokenProcessPool，換新 pool 再送"""
+        nonlocal pool
+        try:
+            return pool, pool.submit(render_row, template_path, parameters, ctx)
+        except BrokenProcessPool:
+            offload.reset_pool(pool)
+            pool = offload.get_pool()
+            return pool, pool.submit(render_row, template_path, parameters, ctx)
+
+    try:
+        zf = zipfile.ZipFile(writer, 'w', compression=zipfile.ZIP_STORED)
+
+        def submit_more():
+            nonlocal next_index
+            while next_index < len(contexts) and len(pending) < window:
+                ctx = contexts[next_index]
+                pending.append((next_index, ctx) + submit(ctx))
+                next_index += 1
+
+        submit_more()
+        while pending:
+            index, ctx, row_pool, future = pending.popleft()
+            try:
+                data = offload.result(row_pool, future, ROW_TIMEOUT, f"batch row {index + 1}")
+            except BrokenProcessPool as e:
+                # pool 當掉時其上所有在途的列都會收到 BrokenProcessPool，無法得知是哪一列造成的:
+                # 換新的共用 pool，這一列與同一 pool 上其餘在途的列依序在獨立的單一 worker pool 重跑
+                logger.error(f"Batch worker pool crashed while rendering rows {index + 1}-{next_index}: {e}")
+                offload.reset_pool(row_pool)
+                if pool is row_pool:
+                    pool = offload.get_pool()
+                suspects = [(index, ctx)] + [(i, c) for i, c, p, _ in pending if p is row_pool]
+                healthy = [item for item in pending if item[2] is not row_pool]
+                pending.clear()
+                pending.extend(healthy)
+                for i, c in suspects:
+                    run_isolated(i, c)
+                    yield from writer.drain()
+                if solo is not None:
+                    solo.shutdown(wait=False)
+                    solo = None
+            except offload.TaskTimeout as e:
+                # 這一列卡住: 原 pool 已退役 (其他在途的列照常完成)，之後的列送到新的 pool
+                fail_row(index, str(e))
+                pool = offload.get_pool()
+            except Exception as e:
+                logger.warning(f"Batch row {index + 1} failed: {e}")
+                fail_row(index, str(e))
+            else:
+                add_row(index, ctx, data)
+            submit_more()
+            yield from writer.drain()
+
+        report['seconds'] = round(time.time() - started, 3)
+        zf.writestr('_report.json', json.dumps(report, ensure_ascii=False, indent=2))
+        zf.close()
+        yield from writer.drain()
+    finally:
+        # 使用者中斷下載時，不再渲染尚未開始的列
+        cancel_pending()
+        if solo is not None:
+            solo.shutdown(wait=False, cancel_futures=True)
+        if zf is not None and zf.fp is not None:
+            zf.close()
@@ -1,8 +1,14 @@
+import bisect
 import json
 import os
 import shutil
 import time
 
+try:
+    import file_store
+except ImportError:
+    from . import file_store
+
 USERS_FILE = 'users.json'
 PROJECTS_DIR = os.path.join('work_assistant', 'projects')
 SYSTEM_CONFIG_FILE = 'system_config.json'
@@ -95,8 +101,9 @@ def save_project_config(project_id, config_data):
         os.makedirs(project_path)
     
     config_path = os.path.join(project_path, 'config.json')
-    with open(config_path, 'w', encoding='utf-8') as f:
-        json.dump(config_data, f, ensure_ascii=False, indent=4)
+    with file_store.lock(config_path):
+        file_store.write_json(config_path, config_data, indent=4)
+        _bump_version(project_id, 'config')
 
 def get_project_config(project_id):
     config_path = os.path.join(PROJECTS_DIR, project_id, 'config.json')
@@ -115,36 +122,229 @@ def get_project_entries(project_id):
                 return []
     return []
 
+def _versions_path(project_id):
+    return os.path.join(PROJECTS_DIR, project_id, 'versions.json')
+
+def _changes_path(project_id):
+    return os.path.join(PROJECTS_DIR, project_id, 'entries_changes.json')
+
+# entries_changes.json 保留的最近異動筆數；更早的版本只能整份重新下載
+ENTRY_CHANGES_LIMIT = 2000
+
+def get_project_versions(project_id):
+    """{'entries': n, 'config': n}；每次寫入 entries.json / config.json 都會遞增"""
+    versions = file_store.read_json(_versions_path(project_id), {})
+    return {'entries': versions.get('entries', 0), 'config': versions.get('config', 0)}
+
+def get_entries_version(project_id):
+    """entries.json 每次寫入都會遞增的版本號 (月報快取等以此判斷資料是否變更)"""
+    return get_project_versions(project_id)['entries']
+
+def get_config_version(project_id):
+    return get_project_versions(project_id)['config']
+
+def _bump_version(project_id, key):
+    path = _versions_path(project_id)
+    with file_store.lock(path):
+        versions = file_store.read_json(path, {})
+        versions[key] = versions.get(key, 0) + 1
+        file_store.write_json(path, versions)
+    return versions[key]
+
+def bump_entries_version(project_id, changes=()):
+    """
+    遞增 entries 版本；changes = [(entry_id, 'add' | 'update' | 'delete')] 記錄到 entries_changes.json，
+    供 get_entry_changes() 回傳差異。必須在 entries.json 的 lock 之內呼叫。
+    """
+    version = _bump_version(project_id, 'entries')
+    path = _changes_path(project_id)
+    log = file_store.read_json(path, None) or {'base': version - 1, 'changes': []}
+    log['changes'].extend([version, entry_id, op] for entry_id, op in changes)
+    if len(log['changes']) > ENTRY_CHANGES_LIMIT:
+        dropped = log['changes'][:-ENTRY_CHANGES_LIMIT]
+        log['changes'] = log['changes'][-ENTRY_CHANGES_LIMIT:]
+        log['base'] = max(log['base'], dropped[-1][0])
+    file_store.write_json(path, log)
+    return version
+
+def get_entry_changes(project_id, since, until):
+    """
+    版本 since 之後、until (含) 之前的異動: {'added': [id], 'updated': [id], 'deleted': [id]}。
+    until 應先以 get_entries_version() 取得 (之後才讀取的紀錄一定涵蓋到 until)。
+    since 早於保留的紀錄 (或大於 until) 時回傳 None，呼叫端應改回傳整份資料。
+    """
+    if since == until:
+        return {'added': [], 'updated': [], 'deleted': []}
+    log = file_store.read_json(_changes_path(project_id), None)
+    if log is None or since < log['base'] or since > until:
+        return None
+    first, last = {}, {}
+    for version, entry_id, op in log['changes']:
+        if since < version <= until:
+            first.setdefault(entry_id, op)
+            last[entry_id] = op
+    changes = {'added': [], 'updated': [], 'deleted': []}
+    for entry_id, op in last.items():
+        if op == 'delete':
+            # 在 since 之後新增又刪除的 entry，呼叫端從未看過
+            if first[entry_id] != 'add':
+                changes['deleted'].append(entry_id)
+        elif first[entry_id] == 'add':
+            changes['added'].append(entry_id)
+        else:
+            changes['updated'].append(entry_id)
+    return changes
+
+# project_id -> (entries version, 排序好的日期, 依日期排序的 entries)
+_date_index = {}
+
+def _entry_date(entry):
+    return (entry.get('date') or entry.get('created_at') or '')[:10]
+
+def get_entries_between(project_id, start, end):
+    """日期在 start ~ end (YYYY-MM-DD，含) 之間的 entries，依日期排序；排序索引以 entries 版本快取"""
+    version = get_entries_version(project_id)
+    cached = _date_index.get(project_id)
+    if not cached or cached[0] != version:
+        entries = sorted(get_project_entries(project_id), key=_entry_date)
+        cached = (version, [_entry_date(e) for e in entries], entries)
+        _date_index[project_id] = cached
+    _, dates, entries = cached
+    return entries[bisect.bisect_left(dates, start):bisect.bisect_right(dates, end)]
+
 def save_project_entry(project_id, entry_data):
+    save_project_entries(project_id, [entry_data])
+
+def save_project_entries(project_id, entries_data):
+    """
+    一次寫入多筆 entry (批次匯入): 同一個 lock 內讀 -> 合併 -> 寫一次，版本只遞增一次。
+    相同 id 視為修改 (原位置取代)，否則依序新增在最後。回傳新的 entries 版本。
+    """
     path = os.path.join(PROJECTS_DIR, project_id, 'entries.json')
-    entries = []
-    if os.path.exists(path):
+    # 讀 -> 附加 -> 寫 必須與其他 worker process 互斥，否則同時新增會互相覆蓋
+    with file_store.lock(path):
+        entries = []
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                try:
+                    entries = json.load(f)
+                except:
+                    pass
+
+        positions = {entry.get('id'): i for i, entry in enumerate(entries)}
+        changes = []
+        for entry_data in entries_data:
+            entry_id = entry_data.get('id')
+            if entry_id in positions:
+                entries[positions[entry_id]] = entry_data
+                changes.append((entry_id, 'update'))
+            else:
+                positions[entry_id] = len(entries)
+                entries.append(entry_data)
+                changes.append((entry_id, 'add'))
+
+        file_store.write_json(path, entries, indent=4)
+        return bump_entries_version(project_id, changes)
+
+ENTRY_OPERATIONS = ('delete', 'patch', 'replace')
+
+class EntryBatchError(ValueError):
+    """批次異動中有無法套用的操作；errors = [{'index', 'id', 'error'}]，整批都不會寫入"""
+    def __init__(self, errors):
+        super().__init__(f"{len(errors)} operation(s) cannot be applied")
+        self.errors = errors
+
+def _photo_name(value):
+    return os.path.basename(str(value)) if value else ''
+
+def _foreign_photos(current, data, image_fields, uploaded):
+    """data 中照片欄位指向的檔案既不是 entry 目前的照片、也不是本次上傳的新檔 (可能是其他專案的檔案)"""
+    existing = current.get('data') or {}
+    return [name for name in image_fields
+            if data.get(name) and _photo_name(data[name]) not in uploaded
+            and _photo_name(data[name]) != _photo_name(existing.get(name))]
+
+def apply_entry_operations(project_id, operations, image_fields=(), uploaded=()):
+    """
+    在同一個 lock 內套用多筆異動並只寫一次 entries.json (全部成功或全部不套用):
+      {'op': 'delete', 'id'}
+      {'op': 'patch', 'id', 'date'?, 'data': {欄位: 值}}   只合併列出的欄位
+      {'op': 'replace', 'id', 'entry': {'date', 'data', ...}} 整筆取代 (保留 id 與 created_at)
+    image_fields 的值只能維持 entry 目前的照片、清空，或是 uploaded (本次上傳的檔名) 之一。
+    回傳 (新的 entries 版本, {id: 異動前的 entry}, 異動後全部 entries)；
+    任何一筆無法套用時拋出 EntryBatchError。
+    """
+    path = os.path.join(PROJECTS_DIR, project_id, 'entries.json')
+    with file_store.lock(path):
+        entries = file_store.read_json(path, [])
+        positions = {entry.get('id'): i for i, entry in enumerate(entries)}
+        previous = {}
+        changes = []
+        errors = []
+
+        for index, operation in enumerate(operations):
+            op = operation.get('op')
+            entry_id = operation.get('id')
+            if op not in ENTRY_OPERATIONS:
+                errors.append({'index': index, 'id': entry_id, 'error': f"Unknown op '{op}'"})
+                continue
+            pos = positions.get(entry_id)
+            if pos is None or entries[pos] is None:
+                errors.append({'index': index, 'id': entry_id, 'error': 'Entry not found'})
+                continue
+            current = entries[pos]
+            previous.setdefault(entry_id, current)
+            if op == 'replace' and not isinstance(operation.get('entry'), dict):
+                errors.append({'index': index, 'id': entry_id, 'error': "Missing 'entry'"})
+                continue
+            data = (operation.get('entry') or {}).get('data') if op == 'replace' else operation.get('data')
+            foreign = _foreign_photos(current, data or {}, image_fields, uploaded) if op != 'delete' else []
+            if foreign:
+                errors.append({'index': index, 'id': entry_id,
+                               'error': f"Photo not found for {', '.join(foreign)}"})
+                continue
+
+            if op == 'delete':
+                entries[pos] = None
+            elif op == 'patch':
+                updated = dict(current, data=dict(current.get('data') or {}, **(operation.get('data') or {})))
+                if operation.get('date'):
+                    updated['date'] = operation['date']
+                entries[pos] = updated
+            else:
+                replacement = operation['entry']
+                entries[pos] = dict(replacement, id=entry_id,
+                                    created_at=replacement.get('created_at') or current.get('created_at'))
+            changes.append((entry_id, 'delete' if op == 'delete' else 'update'))
+
+        if errors:
+            raise EntryBatchError(errors)
+        if not changes:
+            return get_entries_version(project_id), previous, entries
+
+        entries = [entry for entry in entries if entry is not None]
+        file_store.write_json(path, entries, indent=4)
+        version = bump_entries_version(project_id, changes)
+    return version, previous, entries
+
+def delete_project_entry(project_id, entry_id):
+    path = os.path.join(PROJECTS_DIR, project_id, 'entries.json')
+    if not os.path.exists(path): return
+
+    with file_store.lock(path):
+        entries = []
         with open(path, 'r', encoding='utf-8') as f:
             try:
                 entries = json.load(f)
             except:
-                pass
-    
-    entries.append(entry_data)
-    
-    with open(path, 'w', encoding='utf-8') as f:
-        json.dump(entries, f, ensure_ascii=False, indent=4)
+                return
 
-def delete_project_entry(project_id, entry_id):
-    path = os.path.join(PROJECTS_DIR, project_id, 'entries.json')
-    if not os.path.exists(path): return
-    
-    entries = []
-    with open(path, 'r', encoding='utf-8') as f:
-        try:
-            entries = json.load(f)
-        except:
+        new_entries = [e for e in entries if e.get('id') != entry_id]
+        if len(new_entries) == len(entries):
             return
-            
-    new_entries = [e for e in entries if e.get('id') != entry_id]
-    
-    with open(path, 'w', encoding='utf-8') as f:
-        json.dump(new_entries, f, ensure_ascii=False, indent=4)
+
+        file_store.write_json(path, new_entries, indent=4)
+        bump_entries_version(project_id, [(entry_id, 'delete')])
 
 def get_system_config():
     """Load system configuration, creating default if not exists."""
@@ -168,31 +368,42 @@ def get_system_config():
         except:
              return {"ai_prompt_template": DEFAULT_SYSTEM_PROMPT}
 
+def get_system_config_stamp():
+    """system_config.json 的 (修改時間, 大小) 標記，作為設定回應的 ETag；檔案不存在時為 None"""
+    try:
+        st = os.stat(SYSTEM_CONFIG_FILE)
+    except OSError:
+        return None
+    return f"{st.st_mtime_ns:x}-{st.st_size:x}"
+
 def save_system_config(config):
-    with open(SYSTEM_CONFIG_FILE, 'w', encoding='utf-8') as f:
-        json.dump(config, f, ensure_ascii=False, indent=4)
+    with file_store.lock(SYSTEM_CONFIG_FILE):
+        file_store.write_json(SYSTEM_CONFIG_FILE, config, indent=4)
 
-def log_token_usage(project_id, tokens):
-    logs = []
-    if os.path.exists(TOKEN_LOGS_FILE):
-        with open(TOKEN_LOGS_FILE, 'r', encoding='utf-8') as f:
-            try:
-                logs = json.load(f)
-            except:
-                pass
-    
+def log_token_usage(project_id, tokens, spans=None):
+    """tokens 可為 None (模型呼叫失敗)；spans 為 metrics.Trace 的階段紀錄"""
     entry = {
         "timestamp": time.time(),
         "date": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()),
         "project_id": project_id,
         "tokens": tokens
     }
-    logs.append(entry)
-    if len(logs) > 1000:
-        logs = logs[-1000:]
-        
-    with open(TOKEN_LOGS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(logs, f, ensure_ascii=False, indent=4)
+    if spans is not None:
+        entry["spans"] = spans
+
+    with file_store.lock(TOKEN_LOGS_FILE):
+        logs = []
+        if os.path.exists(TOKEN_LOGS_FILE):
+            with open(TOKEN_LOGS_FILE, 'r', encoding='utf-8') as f:
+                try:
+                    logs = json.load(f)
+                except:
+                    pass
+        logs.append(entry)
+        if len(logs) > 1000:
+            logs = logs[-1000:]
+
+        file_store.write_json(TOKEN_LOGS_FILE, logs, indent=4)
 
 def get_token_usage_stats():
     logs = []
@@ -0,0 +1,131 @@
+"""
+產出文件的輸出流程 (In-memory output & unique naming)
+
+產生的文件先序列化到 SpooledTemporaryFile (小檔留在記憶體，超過門檻才落到暫存檔)，
+直接串流給使用者；只有在要求保存 (persist) 時才以不會互相覆蓋的檔名寫入 uploads/。
+"""
+import os
+import shutil
+import tempfile
+import unicodedata
+import uuid
+from datetime import datetime
+from urllib.parse import quote
+
+from flask import Response, send_file
+
+SPOOL_MAX_BYTES = int(os.getenv('OUTPUT_SPOOL_MB', '16')) * 1024 * 1024
+
+MIMETYPES = {
+    '.xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    '.docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    '.zip': 'application/zip',
+}
+
+
+def spool(save_fn):
+    """呼叫 save_fn(fileobj) 把文件寫入暫存緩衝區，回傳已倒回開頭的緩衝區"""
+    buf = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+    try:
+        save_fn(buf)
+    except Exception:
+        buf.close()
+        raise
+    buf.seek(0)
+    return buf
+
+
+def unique_filename(prefix, ext):
+    """產生不會碰撞的檔名: {prefix}_{YYYYmmddHHMMSS}_{8位亂數}{ext}"""
+    safe_prefix = str(prefix).replace('/', '-').replace('\\', '-').strip() or 'Document'
+    return f"{safe_prefix}_{datetime.now().strftime('%Y%m%d%H%M%S')}_{uuid.uuid4().hex[:8]}{ext}"
+
+
+def persist(buf, folder, filename):
+    """把緩衝區內容寫到 folder/filename (先寫暫存檔再 rename，避免讀到寫一半的檔案)"""
+    os.makedirs(folder, exist_ok=True)
+    final_path = os.path.join(folder, filename)
+    tmp_path = f"{final_path}.{uuid.uuid4().hex}.tmp"
+    buf.seek(0)
+    with open(tmp_path, 'wb') as f:
+        shutil.copyfileobj(buf, f, 1024 * 1024)
+    os.replace(tmp_path, final_path)
+    buf.seek(0)
+    return final_path
+
+
+def wants_persist(req):
+    """前端以 form/query/json 的 persist=1 要求保留一份在伺服器上"""
+    value = req.values.get('persist')
+    if value is None and req.is_json:
+        value = (req.get_json(silent=True) or {}).get('persist')
+    return str(value).lower() in ('1', 'true', 'yes', 'on')
+
+
+def send_buffer(buf, download_name, persisted_name=None):
+    """串流緩衝區給使用者；回應結束後由 werkzeug 關閉緩衝區"""
+    buf.seek(0, os.SEEK_END)
+    size = buf.tell()
+    buf.seek(0)
+    ext = os.path.splitext(download_name)[1].lower()
+    response = send_file(
+        buf,
+        as_attachment=True,
+        download_name=download_name,
+        mimetype=MIMETYPES.get(ext, 'application/octet-stream'),
+    )
+    response.content_length = size
+    if persisted_name:
+        response.headers['X-Persisted-File'] = persisted_name
+    return response
+
+
+def deliver(save_fn, download_name, persist_folder=None, persist_prefix=None):
+    """
+    序列化 -> (選擇性保存) -> 串流。
+    persist_folder 為 None 時不寫入磁碟。
+    """
+    buf = spool(save_fn)
+    persisted_name = None
+    if persist_folder:
+        ext = os.path.splitext(download_name)[1].lower()
+        persisted_name = unique_filename(persist_prefix or os.path.splitext(download_name)[0], ext)
+        persist(buf, persist_folder, persisted_name)
+    return send_buffer(buf, download_name, persisted_name)
+
+
+def send_cached(path, download_name, etag, persisted_name=None):
+    """
+    傳送已快取在磁碟上的產出檔；ETag 與 If-None-Match 相同時回 304。
+    no-cache: 瀏覽器每次都要回來確認，但內容未變時不必重新下載。
+    """
+    ext = os.path.splitext(download_name)[1].lower()
+    response = send_file(
+        path,
+        as_attachment=True,
+        download_name=download_name,
+        mimetype=MIMETYPES.get(ext, 'application/octet-stream'),
+        etag=etag,
+        conditional=True,
+        max_age=0,
+    )
+    response.headers['Cache-Control'] = 'private, no-cache'
+    if persisted_name:
+        response.headers['X-Persisted-File'] = persisted_name
+    return response
+
+
+def stream_response(chunks, download_name):
+    """以 generator 逐塊串流 (例如批次 ZIP)，長度未知所以使用 chunked 傳輸"""
+    ext = os.path.splitext(download_name)[1].lower()
+    response = Response(chunks, mimetype=MIMETYPES.get(ext, 'application/octet-stream'),
+                        direct_passthrough=True)
+    try:
+        download_name.encode('ascii')
+        names = {'filename': download_name}
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize('NFKD', download_name).encode('ascii', 'ignore').decode('ascii')
+        names = {'filename': simple, 'filename*': f"UTF-8''{quote(download_name, safe='!#$&+-.^_`|~')}"}
+    response.headers.set('Content-Disposition', 'attachment', **names)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
@@ -0,0 +1,209 @@
+"""
+在 offload process pool 中執行的文件工作 (Document structure / template conversion)
+
+這些函式會載入整份 docx/xlsx 並長時間持有 GIL，由 txtapp 透過 offload.run() 送到 worker 執行:
+  - extract_docx_structure / extract_xlsx_structure: Zone A/B 文件的結構化內容 (供 DeepDiff 與 AI 分析)
+  - structure_changes: 兩份結構的 DeepDiff 結果，整理成給 AI 的變更清單
+  - create_template: 把 original_text 換成 {{ tag }} 並存成新的模板檔
+參數與回傳值都是路徑、dict、list、字串，可直接 pickle。
+"""
+import logging
+import os
+import uuid
+
+try:
+    from lazy_imports import openpyxl, docx, deepdiff
+except ImportError:
+    from .lazy_imports import openpyxl, docx, deepdiff
+
+logger = logging.getLogger(__name__)
+
+
+def extract_docx_structure(filepath, limit=2000):
+    """提取 Word 文件的結構化資訊 (段落與表格) [New for DeepDiff]"""
+    if not filepath or not os.path.exists(filepath):
+        return {}
+        
+    try:
+        doc = docx.Document(filepath)
+        structure = {
+            "paragraphs": [],
+            "tables": []
+        }
+        
+        # 提取段落 (含索引，方便比對位置)
+        for i, p in enumerate(doc.paragraphs):
+            text = p.text.strip()
+            if text: # 忽略完全空白行
+                structure["paragraphs"].append({
+                    "index": i,
+                    "text": text[:500] 
+                })
+                
+        # 提取表格 (含坐標)
+        for t_idx, table in enumerate(doc.tables):
+            table_data = []
+            for r_idx, row in enumerate(table.rows):
+                for c_idx, cell in enumerate(row.cells):
+                    text = cell.text.strip()
+                    if text:
+                        table_data.append({
+                            "loc": f"T{t_idx}:R{r_idx}:C{c_idx}",
+                            "text": text
+                        })
+            if table_data:
+                structure["tables"].append(table_data)
+                
+        return structure
+    except Exception as e:
+        logger.error(f"Docx structure error: {e}")
+        return {}
+
+
+def extract_xlsx_structure(filepath, limit_rows=100):
+    """提取 Excel 文件的結構化資訊 (Sheet 與 Cell) [New for DeepDiff]"""
+    if not filepath or not os.path.exists(filepath):
+        return {}
+
+    try:
+        # Load without read_only to access images. data_only=True for Formula values.
+        wb = openpyxl.load_workbook(filepath, data_only=True)
+        structure = {
+            "sheet_names": wb.sheetnames,
+            "sheets": {}
+        }
+        
+        for sheet_name in wb.sheetnames:
+            ws = wb[sheet_name]
+            cells_data = {}
+            row_count = 0
+            
+            # 1. Extract Text Data
+            for row in ws.iter_rows():
+                if row_count > limit_rows: break
+                for cell in row:
+                    if cell.value is not None:
+                        # 記錄坐標與值
+                        cells_data[f"{cell.row},{cell.column}"] = str(cell.value).strip()
+                row_count += 1
+            
+            # 2. Extract Images (Marker only)
+            # This is crucial for "Photo Evaluation"
+            try:
+                # openpyxl 3.0+ uses ws._images or ws.images
+                images_list = getattr(ws, '_images', []) or getattr(ws, 'images', [])
+                for img in images_list:
+                    # Attempt to find anchor (Top-Left)
+                    r, c = None, None
+                    
+                    # Handling different anchor types (OneCell, TwoCell, Absolute)
+                    anchor = img.anchor
+                    if hasattr(anchor, '_from'): # TwoCellAnchor
+                        r = anchor._from.row + 1 # 0-index to 1-index
+                        c = anchor._from.col + 1
+                    elif hasattr(anchor, 'row'): # OneCellAnchor (sometimes)
+                        r = anchor.row + 1
+                        c = anchor.col + 1
+                        
+                    if r and c:
+                        key = f"{r},{c}"
+                        exist_val = cells_data.get(key, "")
+                        
+                        # Extract dimensions avoiding distoration
+                        w = getattr(img, 'width', 0)
+                        h = getattr(img, 'height', 0)
+                        marker = f"<<IMAGE_PRESENT|W:{w}|H:{h}>>"
+                        
+                        cells_data[key] = f"{exist_val} {marker}".strip()
+                        
+            except Exception as img_err:
+                logger.warning(f"Excel Image extraction warning: {img_err}")
+            
+            structure["sheets"][sheet_name] = {
+                "cells": cells_data
+            }
+        return structure
+    except Exception as e:
+        logger.error(f"Excel structure error: {e}")
+        return {}
+
+
+def structure_changes(blank_structure, filled_structure):
+    """DeepDiff 兩份結構，回傳變更描述 (內容變更 / 新增內容) 的清單"""
+    # ignore_order=False ensures exact positional matching, vital for forms
+    diff = deepdiff.DeepDiff(blank_structure, filled_structure, ignore_order=False, view='tree')
+    changes = []
+
+    # Value Changes (The most common filling action)
+    if 'values_changed' in diff:
+        for node in diff['values_changed']:
+            # path example: ['sheets', 'Sheet1', 'cells', '2,2']
+            path = " -> ".join([str(k) for k in node.path(output_format='list')])
+            old_val = node.t1
+            new_val = node.t2
+            changes.append(f"[內容變更] 位置: {path} | 原始: '{old_val}' -> 填寫: '{new_val}'")
+
+    # Item Added (e.g., repeating rows in tables)
+    if 'dictionary_item_added' in diff:
+        for node in diff['dictionary_item_added']:
+            path = " -> ".join([str(k) for k in node.path(output_format='list')])
+            val = node.t2
+            changes.append(f"[新增內容] 位置: {path} | 內容: '{val}'")
+    return changes
+
+
+def create_template(source_path, params, output_folder):
+    """
+    Convert original Docx/Excel to Template by replacing original_text with {{ tags }};
+    the template is saved in output_folder and its filename returned (None on failure)
+    """
+    ext = os.path.splitext(source_path)[1].lower()
+    
+    try:
+        if ext in ['.docx', '.doc']:
+            doc = docx.Document(source_path)
+            for p in params:
+                target = p.get('original_text')
+                var_name = p.get('name')
+                
+                if target and var_name:
+                    tag = f"{{{{ {var_name} }}}}"
+                    
+                    # Replace in Paragraphs
+                    for para in doc.paragraphs:
+                        if target in para.text:
+                            para.text = para.text.replace(target, tag)
+                    
+                    # Replace in Tables
+                    for table in doc.tables:
+                        for row in table.rows:
+                            for cell in row.cells:
+                                if target in cell.text:
+                                    cell.text = cell.text.replace(target, tag)
+                                    
+            new_filename = f"Template_{uuid.uuid4()}.docx"
+            new_path = os.path.join(output_folder, new_filename)
+            doc.save(new_path)
+            return new_filename
+
+        elif ext in ['.xlsx', '.xls']:
+            wb = openpyxl.load_workbook(source_path)
+            for sheet in wb.worksheets:
+                for row in sheet.iter_rows():
+                    for cell in row:
+                        if cell.value and isinstance(cell.value, str):
+                            for p in params:
+                                target = p.get('original_text')
+                                var_name = p.get('name')
+                                if target and var_name and target in cell.value:
+                                    tag = f"{{{{ {var_name} }}}}"
+                                    cell.value = cell.value.replace(target, tag)
+
+            new_filename = f"Template_{uuid.uuid4()}.xlsx"
+            new_path = os.path.join(output_folder, new_filename)
+            wb.save(new_path)
+            return new_filename
+
+    except Exception as e:
+        logger.error(f"Template conversion failed: {e}")
+        return None
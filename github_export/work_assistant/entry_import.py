@@ -0,0 +1,234 @@
+"""
+月報專案的批次匯入 (Bulk entry import)
+
+Excel/CSV 每一列 = 一筆 entry，欄位依 batch_merge.resolve_mapping 對應到專案 parameters；
+照片欄填檔名，從一併上傳的 ZIP 中以檔名 (不分大小寫、忽略資料夾) 找對應的照片。
+  - 日期、數字欄以整欄向量化驗證 (pandas)，逐列只組裝結果
+  - 有任何錯誤的列整列略過，錯誤以 {'row', 'column', 'error'} 回報 (row = 試算表列號，標題為第 1 列)
+  - 照片以 thread pool 平行解壓到 UPLOAD_FOLDER (與 api_add_entry 相同的 <uuid><ext> 命名)，
+    同一張照片被多列引用時只存一份；因照片解壓失敗而略過的列，其他已解壓的照片會刪除
+  - 通過驗證的 entries 由呼叫端以 database.save_project_entries 一次寫入
+ZIP 內的路徑只用來比對檔名，輸出檔名一律重新產生 (不會寫到 UPLOAD_FOLDER 以外)。
+"""
+import logging
+import os
+import shutil
+import uuid
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+try:
+    from lazy_imports import pandas as pd
+except ImportError:
+    from .lazy_imports import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# 未指定 date_column 時依序尋找的日期欄
+DATE_COLUMNS = ('date', 'Date', 'DATE', 'entry_date', '日期')
+PHOTO_EXTENSIONS = {'.png', '.jpg', '.jpeg'}
+MAX_ROWS = int(os.getenv('IMPORT_MAX_ROWS', '5000'))
+MAX_PHOTO_BYTES = int(os.getenv('IMPORT_MAX_PHOTO_MB', '25')) * 1024 * 1024
+PHOTO_WORKERS = int(os.getenv('IMPORT_PHOTO_WORKERS', '0')) or min(8, (os.cpu_count() or 2) * 2)
+
+
+class InvalidImport(ValueError):
+    """整個檔案無法匯入 (不是單列的錯誤)；訊息直接回給使用者"""
+
+
+def resolve_date_column(columns, date_column=None):
+    if date_column:
+        if date_column not in columns:
+            raise InvalidImport(f"Date column '{date_column}' not found")
+        return date_column
+    for name in DATE_COLUMNS:
+        if name in columns:
+            return name
+    raise InvalidImport(f"Missing date column (one of: {', '.join(DATE_COLUMNS)})")
+
+
+def open_archive(source):
+    """開啟照片 ZIP (路徑或上傳的檔案串流)"""
+    try:
+        return zipfile.ZipFile(source)
+    except (zipfile.BadZipFile, OSError) as e:
+        raise InvalidImport(f"Photo archive is not a valid ZIP file: {e}")
+
+
+def photo_index(archive):
+    """{小寫檔名: ZipInfo}；只收支援的圖片格式，略過資料夾與 macOS 的 __MACOSX/._ 檔案"""
+    index = {}
+    for info in archive.infolist():
+        if info.is_dir():
+            continue
+        name = info.filename.replace('\\', '/').rsplit('/', 1)[-1]
+        if not name or name.startswith('._') or info.filename.startswith('__MACOSX/'):
+            continue
+        if os.path.splitext(name)[1].lower() in PHOTO_EXTENSIONS:
+            index.setdefault(name.lower(), info)
+    return index
+
+
+def _column_errors(errors, mask, rows, column, messages):
+    """mask 為 True 的列加入錯誤 (messages 與 mask 等長)"""
+    for pos in mask.to_numpy().nonzero()[0]:
+        errors.append({'row': int(rows[pos]), 'column': column, 'error': messages[pos]})
+
+
+def validate_rows(df, parameters, mapping, date_column, photos=None):
+    """
+    向量化驗證整張表。回傳 (values, errors):
+      values: {參數名稱: 正規化後的字串 list} + '__date__'；照片欄為 ZipInfo 或 None
+      errors: [{'row', 'column', 'error'}]
+    """
+    rows = list(range(2, len(df) + 2))
+    errors = []
+    values = {}
+
+    raw_dates = df[date_column].astype(str).str.strip()
+    dates = pd.to_datetime(raw_dates, errors='coerce', format='mixed')
+    bad = dates.isna()
+    _column_errors(errors, bad, rows, date_column,
+                   [f"Invalid date: '{v}'" if v else 'Missing date' for v in raw_dates])
+    values['__date__'] = dates.dt.strftime('%Y-%m-%d').where(~bad, None).tolist()
+
+    columns_by_param = {name: col for col, name in mapping.items()}
+    for param in parameters:
+        name = param['name']
+        col = columns_by_param.get(name)
+        if col is None:
+            values[name] = [None if param.get('type') == 'image' else ''] * len(df)
+            continue
+        text = df[col].astype(str).str.strip()
+
+        if param.get('type') == 'number':
+            numbers = pd.to_numeric(text.str.replace(',', '', regex=False), errors='coerce')
+            _column_errors(errors, numbers.isna() & (text != ''), rows, col,
+                           [f"Not a number: '{v}'" for v in text])
+            values[name] = text.tolist()
+
+        elif param.get('type') == 'image':
+            keys = text.str.replace('\\', '/', regex=False).str.rsplit('/', n=1).str[-1].str.lower()
+            found = keys.map(lambda key: photos.get(key) if photos is not None else None)
+            _column_errors(errors, found.isna() & (text != ''), rows, col,
+                           [f"Photo '{v}' not found in archive" if photos is not None
+                            else f"Photo '{v}' given but no photo archive uploaded" for v in text])
+            too_big = found.map(lambda info: info is not None and info.file_size > MAX_PHOTO_BYTES)
+            _column_errors(errors, too_big, rows, col,
+                           [f"Photo '{v}' exceeds {MAX_PHOTO_BYTES // (1024 * 1024)}MB" for v in text])
+            values[name] = found.tolist()
+
+        else:
+            values[name] = text.tolist()
+
+    errors.sort(key=lambda e: e['row'])
+    return values, errors
+
+
+def extract_photos(archive, infos, upload_folder):
+    """
+    平行解壓照片到 upload_folder；回傳 ({ZipInfo.filename: 'uploads/<uuid><ext>'}, {ZipInfo.filename: 錯誤訊息})
+    """
+    def extract(info):
+        ext = os.path.splitext(info.filename)[1].lower()
+        filename = f"{uuid.uuid4()}{ext}"
+        target = os.path.join(upload_folder, filename)
+        try:
+            with archive.open(info) as src, open(target, 'wb') as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+        except Exception:
+            if os.path.exists(target):
+                os.remove(target)
+            raise
+        return f"uploads/{filename}"
+
+    stored, failed = {}, {}
+    if not infos:
+        return stored, failed
+    with ThreadPoolExecutor(max_workers=min(PHOTO_WORKERS, len(infos)), thread_name_prefix='import-photo') as pool:
+        futures = {info.filename: pool.submit(extract, info) for info in infos}
+        for name, future in futures.items():
+            try:
+                stored[name] = future.result()
+            except Exception as e:
+                logger.warning(f"Import: cannot extract photo {name}: {e}")
+                failed[name] = str(e)
+    return stored, failed
+
+
+def _photo_paths(entries, image_params):
+    return {entry['data'][name] for entry in entries for name in image_params if entry['data'].get(name)}
+
+
+def discard_photos(paths, upload_folder):
+    """刪除解壓出來的照片 ('uploads/<檔名>')"""
+    for path in paths:
+        try:
+            os.remove(os.path.join(upload_folder, os.path.basename(path)))
+        except OSError:
+            pass
+
+
+def discard_entry_photos(entries, parameters, upload_folder):
+    """寫入失敗時由呼叫端呼叫: 刪除這些 entries 解壓出來的照片"""
+    discard_photos(_photo_paths(entries, [p['name'] for p in parameters if p.get('type') == 'image']),
+                   upload_folder)
+
+
+def import_entries(df, parameters, mapping, upload_folder, date_column=None, archive=None, dry_run=False):
+    """
+    驗證 df 並組成 entries。回傳 (entries, errors)；dry_run 時不解壓照片 (照片欄保留 ZIP 內的檔名)。
+    只有通過驗證的列會被解壓照片；其中某張照片解壓失敗而略過的列，已解壓的其他照片若沒有其他列引用也會刪除，
+    不會留下沒有 entry 引用的檔案。
+    """
+    if len(df) > MAX_ROWS:
+        raise InvalidImport(f"Too many rows ({len(df)}), the limit is {MAX_ROWS}")
+    date_column = resolve_date_column(list(df.columns), date_column)
+    photos = photo_index(archive) if archive is not None else None
+    values, errors = validate_rows(df, parameters, mapping, date_column, photos)
+
+    failed_rows = {e['row'] for e in errors}
+    valid = [pos for pos in range(len(df)) if pos + 2 not in failed_rows]
+    image_params = [p['name'] for p in parameters if p.get('type') == 'image']
+
+    stored, failed = {}, {}
+    if not dry_run:
+        needed = {}
+        for name in image_params:
+            for pos in valid:
+                info = values[name][pos]
+                if info is not None:
+                    needed[info.filename] = info
+        stored, failed = extract_photos(archive, list(needed.values()), upload_folder)
+
+    created_at = datetime.now().isoformat()
+    entries = []
+    for pos in valid:
+        data = {}
+        photo_error = None
+        for param in parameters:
+            name = param['name']
+            value = values[name][pos]
+            if name in image_params and value is not None:
+                if value.filename in failed:
+                    photo_error = {'row': pos + 2, 'column': name,
+                                   'error': f"Cannot read photo '{value.filename}': {failed[value.filename]}"}
+                    break
+                value = value.filename if dry_run else stored[value.filename]
+            data[name] = value
+        if photo_error:
+            errors.append(photo_error)
+            continue
+        entries.append({
+            'id': str(uuid.uuid4()),
+            'date': values['__date__'][pos],
+            'created_at': created_at,
+            'data': data,
+        })
+
+    if stored:
+        discard_photos(set(stored.values()) - _photo_paths(entries, image_params), upload_folder)
+
+    errors.sort(key=lambda e: e['row'])
+    return entries, errors
@@ -0,0 +1,136 @@
+"""
+多行程共用的 JSON 檔案存取 (Cross-process file locks / atomic writes)
+
+run_production 以多個 worker process 服務時，users/projects 的 JSON 檔會被不同行程同時讀寫:
+  - lock(path): 以 <path>.lock 做跨行程互斥 (POSIX fcntl.flock / Windows msvcrt.locking)，
+    同一執行緒可重入 (例如 save_project_entry 內再 bump_entries_version)
+  - write_json(path, data): 先寫暫存檔再 os.replace，讀取端永遠看到完整的舊檔或新檔
+  - read_json(path, default): 檔案不存在或內容損壞時回傳 default
+讀取不需要上鎖；「讀 -> 修改 -> 寫」整段必須在 lock() 之內。
+"""
+import json
+import os
+import threading
+import time
+import uuid
+
+if os.name == 'nt':
+    import msvcrt
+else:
+    import fcntl
+
+LOCK_SUFFIX = '.lock'
+LOCK_POLL_SECONDS = 0.05
+# Windows: 目標檔正被其他行程讀取時 os.replace 會暫時失敗
+REPLACE_RETRIES = 20
+
+
+class _PathLock:
+    """同一路徑在本行程內共用一個；第一層取得時才鎖住檔案"""
+
+    def __init__(self, lock_path):
+        self.lock_path = lock_path
+        self._rlock = threading.RLock()
+        self._depth = 0
+        self._fd = None
+
+    def acquire(self, timeout=None):
+        if not self._rlock.acquire(timeout=-1 if timeout is None else timeout):
+            raise TimeoutError(f"Timed out waiting for {self.lock_path}")
+        if self._depth == 0:
+            try:
+                self._fd = _lock_file(self.lock_path, timeout)
+            except BaseException:
+                self._rlock.release()
+                raise
+        self._depth += 1
+
+    def release(self):
+        self._depth -= 1
+        if self._depth == 0:
+            fd, self._fd = self._fd, None
+            _unlock_file(fd)
+        self._rlock.release()
+
+
+def _lock_file(lock_path, timeout):
+    os.makedirs(os.path.dirname(lock_path) or '.', exist_ok=True)
+    fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        try:
+            if os.name == 'nt':
+                msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+            else:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return fd
+        except OSError:
+            if deadline is not None and time.monotonic() >= deadline:
+                os.close(fd)
+                raise TimeoutError(f"Timed out waiting for {lock_path}")
+            time.sleep(LOCK_POLL_SECONDS)
+
+
+def _unlock_file(fd):
+    try:
+        if os.name == 'nt':
+            os.lseek(fd, 0, os.SEEK_SET)
+            msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+        else:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
+
+
+_locks = {}
+_locks_guard = threading.Lock()
+
+
+class lock:
+    """with file_store.lock(path): ...   跨行程、同執行緒可重入"""
+
+    def __init__(self, path, timeout=None):
+        key = os.path.abspath(path) + LOCK_SUFFIX
+        with _locks_guard:
+            self._lock = _locks.setdefault(key, _PathLock(key))
+        self._timeout = timeout
+
+    def __enter__(self):
+        self._lock.acquire(self._timeout)
+        return self
+
+    def __exit__(self, *exc):
+        self._lock.release()
+
+
+def replace(tmp_path, path):
+    for attempt in range(REPLACE_RETRIES):
+        try:
+            os.replace(tmp_path, path)
+            return
+        except PermissionError:
+            if os.name != 'nt' or attempt == REPLACE_RETRIES - 1:
+                raise
+            time.sleep(LOCK_POLL_SECONDS)
+
+
+def write_json(path, data, **dump_kwargs):
+    dump_kwargs.setdefault('ensure_ascii', False)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, **dump_kwargs)
+        replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def read_json(path, default=None):
+    if not os.path.exists(path):
+        return default
+    with open(path, 'r', encoding='utf-8') as f:
+        try:
+            return json.load(f)
+        except json.JSONDecodeError:
+            return default
@@ -0,0 +1,208 @@
+"""
+照片前處理 (Image preprocessing)
+
+手機照片常常 4~8MB，直接嵌入 xlsx 只是畫面上縮小，檔案裡仍是原始解析度。
+嵌入前先:
+  - 依 EXIF 方向轉正
+  - 縮小到目標方框大小 x IMAGE_DPI_SCALE (保留高 DPI 螢幕/列印的清晰度)
+  - 重新壓縮成 JPEG (IMAGE_JPEG_QUALITY)
+結果快取在 uploads/_image_cache/，key = (原圖雜湊, 方框尺寸, 品質)，
+同一張照片不會重複處理；多張照片以 thread pool 平行解碼 (PIL 解碼/縮放時會釋放 GIL)。
+快取命中時更新檔案 mtime；超過 IMAGE_CACHE_MAX_DAYS 沒用到、或總量超過 IMAGE_CACHE_MAX_MB 時
+由最久沒用到的開始刪除 (最近 CACHE_MIN_AGE_SECONDS 內用過的不刪，進行中的月報不會失去剛處理好的照片)。
+"""
+import hashlib
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR_NAME = '_image_cache'
+DPI_SCALE = float(os.getenv('IMAGE_DPI_SCALE', '2'))
+JPEG_QUALITY = int(os.getenv('IMAGE_JPEG_QUALITY', '85'))
+PREP_WORKERS = int(os.getenv('IMAGE_PREP_WORKERS', '0')) or min(8, os.cpu_count() or 2)
+CACHE_MAX_BYTES = int(os.getenv('IMAGE_CACHE_MAX_MB', '1024')) * 1024 * 1024
+CACHE_MAX_AGE_SECONDS = float(os.getenv('IMAGE_CACHE_MAX_DAYS', '30')) * 86400
+CACHE_MIN_AGE_SECONDS = 3600       # 這段時間內用過的快取檔不刪
+PRUNE_INTERVAL_SECONDS = 300       # 同一個快取資料夾最多每 5 分鐘檢查一次
+
+_hashes = {}    # path -> (mtime_ns, size, sha1)
+_hashes_lock = threading.Lock()
+_pool = None
+_pool_lock = threading.Lock()
+
+# 快取統計 (供監控使用)；prepare_image 在 thread pool 中執行，更新時持有 _stats_lock
+hits = 0
+misses = 0
+evicted = 0
+_stats_lock = threading.Lock()
+_pruned = {}    # 快取資料夾 -> 上次清理時間 (monotonic)
+
+
+def settings_key():
+    """影響輸出結果的設定；變更時月報片段需要重新渲染"""
+    return f"jpeg:{JPEG_QUALITY}:scale:{DPI_SCALE}"
+
+
+def source_hash(path):
+    st = os.stat(path)
+    stamp = (st.st_mtime_ns, st.st_size)
+    with _hashes_lock:
+        cached = _hashes.get(path)
+    if cached and cached[:2] == stamp:
+        return cached[2]
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    digest = h.hexdigest()
+    with _hashes_lock:
+        _hashes[path] = stamp + (digest,)
+    return digest
+
+
+def cache_dir(upload_folder):
+    return os.path.join(upload_folder, CACHE_DIR_NAME)
+
+
+def _target_size(src_w, src_h, box_w, box_h, scale):
+    """等比例縮放到 (box x scale) 內；只縮小不放大"""
+    max_w = max(1, int(box_w * scale))
+    max_h = max(1, int(box_h * scale))
+    ratio = min(max_w / src_w, max_h / src_h, 1.0)
+    return max(1, round(src_w * ratio)), max(1, round(src_h * ratio))
+
+
+def prepare_image(src_path, box_w, box_h, upload_folder, quality=None, scale=None):
+    """
+    回傳可直接嵌入的 JPEG 路徑 (已快取則直接回傳)。
+    處理失敗時拋出例外，由呼叫端決定是否退回原圖。
+    """
+    global hits, misses
+    quality = quality or JPEG_QUALITY
+    scale = scale or DPI_SCALE
+    key = hashlib.sha1(
+        f"{source_hash(src_path)}|{int(box_w)}x{int(box_h)}|{quality}|{scale}".encode('utf-8')
+    ).hexdigest()
+    folder = cache_dir(upload_folder)
+    out_path = os.path.join(folder, f"{key}.jpg")
+    if os.path.exists(out_path):
+        try:
+            os.utime(out_path)      # 標記為最近使用 (清理時由最久沒用到的開始刪)
+        except OSError:
+            pass
+        else:
+            with _stats_lock:
+                hits += 1
+            return out_path
+    with _stats_lock:
+        misses += 1
+
+    with Image.open(src_path) as im:
+        # draft 讓 JPEG 解碼時直接以 1/2、1/4、1/8 解析度解碼，大幅減少解碼時間
+        target = _target_size(im.width, im.height, box_w, box_h, scale)
+        if im.format == 'JPEG':
+            im.draft('RGB', (target[0] * 2, target[1] * 2))
+        im = ImageOps.exif_transpose(im)
+        target = _target_size(im.width, im.height, box_w, box_h, scale)
+        if im.mode in ('RGBA', 'LA', 'P'):
+            im = im.convert('RGBA')
+            background = Image.new('RGB', im.size, (255, 255, 255))
+            background.paste(im, mask=im.split()[-1])
+            im = background
+        elif im.mode != 'RGB':
+            im = im.convert('RGB')
+        if im.size != target:
+            im = im.resize(target, Image.LANCZOS)
+
+        os.makedirs(folder, exist_ok=True)
+        tmp_path = f"{out_path}.{uuid.uuid4().hex}.tmp"
+        im.save(tmp_path, 'JPEG', quality=quality, optimize=True)
+    os.replace(tmp_path, out_path)
+    return out_path
+
+
+def prune_cache(upload_folder, force=False):
+    """
+    刪除過期與超量的快取檔；回傳刪除的檔案數。
+    force=False 時同一資料夾最多每 PRUNE_INTERVAL_SECONDS 秒檢查一次。
+    """
+    global evicted
+    folder = cache_dir(upload_folder)
+    now = time.monotonic()
+    with _stats_lock:
+        if not force and now - _pruned.get(folder, -PRUNE_INTERVAL_SECONDS) < PRUNE_INTERVAL_SECONDS:
+            return 0
+        _pruned[folder] = now
+    files = []
+    try:
+        with os.scandir(folder) as it:
+            for item in it:
+                try:
+                    st = item.stat()
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, item.path))
+    except OSError:
+        return 0
+
+    files.sort()    # 最久沒用到的在前
+    total = sum(size for _, size, _ in files)
+    wall = time.time()
+    removed = 0
+    for mtime, size, path in files:
+        age = wall - mtime
+        if age < CACHE_MIN_AGE_SECONDS:
+            break
+        if age < CACHE_MAX_AGE_SECONDS and total <= CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        removed += 1
+    if removed:
+        with _stats_lock:
+            evicted += removed
+        logger.info(f"Image cache pruned: {removed} file(s), {total // (1024 * 1024)}MB left")
+    return removed
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=PREP_WORKERS, thread_name_prefix='image-prep')
+        return _pool
+
+
+def prepare_many(jobs, upload_folder):
+    """
+    jobs: iterable of (src_path, box_w, box_h)
+    回傳 {(src_path, box_w, box_h): prepared_path}；失敗的項目不在結果中 (使用原圖)。
+    """
+    jobs = list(dict.fromkeys(jobs))
+    if not jobs:
+        return {}
+    pool = get_pool()
+    futures = {job: pool.submit(prepare_image, job[0], job[1], job[2], upload_folder) for job in jobs}
+    prepared = {}
+    for job, future in futures.items():
+        try:
+            prepared[job] = future.result()
+        except Exception as e:
+            logger.warning(f"Image preprocessing failed for {job[0]}, embedding original: {e}")
+    prune_cache(upload_folder)
+    return prepared
+
+
+def stats():
+    with _stats_lock:
+        return {'hits': hits, 'misses': misses, 'evicted': evicted}
@@ -0,0 +1,89 @@
+"""
+延遲載入的重量級依賴 (Lazy heavy imports)
+
+google.generativeai、pandas、deepdiff、python-docx、docxtpl、openpyxl 合計佔 import txtapp
+的大部分時間，但多數請求 (登入、頁面、entry CRUD) 一個都用不到。
+這裡的 LazyModule 在第一次存取屬性時才真正 import，之後直接轉給真正的模組:
+    genai.GenerativeModel(...)   # 第一次呼叫時才載入 google.generativeai 並 configure
+測試可以直接覆寫屬性 (txtapp.genai.GenerativeModel = Stub)，不會觸發載入。
+preload() 給 worker process / 預熱使用；loaded() 列出目前已載入的項目。
+"""
+import importlib
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class LazyModule:
+    def __init__(self, name, on_load=None):
+        self._lazy_name = name
+        self._lazy_on_load = on_load
+        self._lazy_module = None
+        self._lazy_lock = threading.Lock()
+        _registry[name] = self
+
+    def _load(self):
+        module = self._lazy_module
+        if module is not None:
+            return module
+        with self._lazy_lock:
+            if self._lazy_module is None:
+                start = time.perf_counter()
+                module = importlib.import_module(self._lazy_name)
+                if self._lazy_on_load:
+                    self._lazy_on_load(module)
+                logger.info(f"Loaded {self._lazy_name} in {(time.perf_counter() - start) * 1000:.0f} ms")
+                self._lazy_module = module
+            return self._lazy_module
+
+    @property
+    def is_loaded(self):
+        return self._lazy_module is not None
+
+    def __getattr__(self, attr):
+        # 只有實例上找不到的屬性才會進來 (被覆寫的屬性不會觸發載入)
+        if attr.startswith('_lazy_'):
+            raise AttributeError(attr)
+        return getattr(self._load(), attr)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        state = 'loaded' if self.is_loaded else 'not loaded'
+        return f"<LazyModule {self._lazy_name} ({state})>"
+
+
+_registry = {}
+
+
+def _configure_gemini(module):
+    api_key = os.getenv('GEMINI_API_KEY')
+    if api_key:
+        module.configure(api_key=api_key)
+
+
+genai = LazyModule('google.generativeai', on_load=_configure_gemini)
+pandas = LazyModule('pandas')
+deepdiff = LazyModule('deepdiff')
+docx = LazyModule('docx')
+docxtpl = LazyModule('docxtpl')
+openpyxl = LazyModule('openpyxl')
+
+
+def preload(*names):
+    """載入指定 (預設全部) 的延遲模組；回傳 {name: ms}"""
+    timings = {}
+    for name in names or list(_registry):
+        lazy = _registry[name]
+        start = time.perf_counter()
+        lazy._load()
+        timings[name] = round((time.perf_counter() - start) * 1000, 1)
+    return timings
+
+
+def loaded():
+    return sorted(name for name, lazy in _registry.items() if lazy.is_loaded)
@@ -0,0 +1,325 @@
+"""
+程序內指標 (In-process metrics registry)
+
+不需要外部服務: 計數器 / 量表 / 直方圖都存在本程序記憶體，
+/metrics 以 Prometheus text exposition format (0.0.4) 輸出。
+  - 每個 Flask endpoint 的請求數與延遲直方圖、處理中請求數 (waitress 執行緒飽和度)
+  - 熱點函式的階段延遲 (stage_duration_seconds{stage=...})，以 timed() 包裝
+  - 快取命中率等在抓取時才計算的值，以 register_collector() 註冊
+注意: batch_merge / 月報的 worker process 內的計時只留在該 process，不會出現在這裡。
+"""
+import bisect
+import functools
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, request
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+PREFIX = 'work_assistant_'
+
+# 秒；openpyxl 載入/存檔與 Gemini 呼叫可能到數十秒
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    pairs.extend(f'{n}="{_escape(v)}"' for n, v in extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = PREFIX + name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def _header(self):
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def expose(self):
+        lines = self._header()
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f'{self.name}_total{_labels(self.labelnames, key)} {_number(value)}')
+        return lines
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def expose(self):
+        lines = self._header()
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_labels(self.labelnames, key)} {_number(value)}')
+        return lines
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # [各 bucket 的非累計次數..., +Inf], sum
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][bisect.bisect_left(self.buckets, value)] += 1
+            state[1] += value
+
+    def expose(self):
+        lines = self._header()
+        with self._lock:
+            items = sorted((key, (list(counts), total)) for key, (counts, total) in self._values.items())
+        for key, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{_labels(self.labelnames, key, [("le", _number(bound))])} '
+                             f'{cumulative}')
+            lines.append(f'{self.name}_sum{_labels(self.labelnames, key)} {_number(total)}')
+            lines.append(f'{self.name}_count{_labels(self.labelnames, key)} {cumulative}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def _add(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                # 同名指標只註冊一次，重複宣告時回傳既有的
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._add(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._add(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, documentation, labelnames, buckets))
+
+    def register_collector(self, fn):
+        """fn() 在每次抓取時呼叫，用來更新量表 (例如快取命中率)"""
+        with self._lock:
+            if fn not in self._collectors:
+                self._collectors.append(fn)
+        return fn
+
+    def expose(self):
+        for fn in list(self._collectors):
+            try:
+                fn()
+            except Exception:
+                pass
+        lines = []
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda m: m.name)
+        for metric in metrics:
+            lines.extend(metric.expose())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+REQUESTS = REGISTRY.counter('http_requests', 'HTTP requests by endpoint, method and status.',
+                            ('endpoint', 'method', 'status'))
+REQUEST_SECONDS = REGISTRY.histogram('http_request_duration_seconds', 'HTTP request latency by endpoint.',
+                                     ('endpoint', 'method'))
+IN_FLIGHT = REGISTRY.gauge('http_requests_in_flight', 'Requests currently being handled.', ('endpoint',))
+WORKER_THREADS = REGISTRY.gauge('server_threads', 'Request worker threads configured for the server.')
+STAGE_SECONDS = REGISTRY.histogram('stage_duration_seconds', 'Latency of hot functions and processing stages.',
+                                   ('stage',))
+STAGE_ERRORS = REGISTRY.counter('stage_errors', 'Exceptions raised inside timed stages.', ('stage',))
+CACHE_REQUESTS = REGISTRY.gauge('cache_requests', 'Cache lookups by cache and result.', ('cache', 'result'))
+CACHE_HIT_RATIO = REGISTRY.gauge('cache_hit_ratio', 'Cache hits / lookups since process start.', ('cache',))
+OFFLOAD_IN_FLIGHT = REGISTRY.gauge('offload_in_flight', 'Calls waiting for or running in the offload process pool.')
+OFFLOAD_REJECTED = REGISTRY.counter('offload_rejected', 'Offload calls rejected because the queue was full.')
+OFFLOAD_FAILURES = REGISTRY.counter('offload_failures', 'Offloaded calls that timed out or lost their worker.',
+                                    ('reason',))
+ADMISSION_ACTIVE = REGISTRY.gauge('admission_active', 'Requests running inside each bulkhead.', ('bulkhead',))
+ADMISSION_QUEUED = REGISTRY.gauge('admission_queued', 'Requests waiting for a bulkhead slot.', ('bulkhead',))
+ADMISSION_REJECTED = REGISTRY.counter('admission_rejected', 'Requests rejected with 429 by bulkhead and reason.',
+                                      ('bulkhead', 'reason'))
+ADMISSION_WAIT_SECONDS = REGISTRY.histogram('admission_wait_seconds', 'Time admitted requests spent queued.',
+                                            ('bulkhead',))
+SEARCH_INDEX_DOCUMENTS = REGISTRY.gauge('search_index_documents', 'Projects and entries in the full-text index.')
+SEARCH_INDEX_TERMS = REGISTRY.gauge('search_index_terms', 'Distinct terms in the full-text index.')
+SEARCH_INDEX_UPDATES = REGISTRY.counter('search_index_updates', 'Full-text index project updates by kind.', ('kind',))
+
+
+class timed:
+    """
+    以 STAGE_SECONDS 計時；可當 decorator 或 context manager:
+        @metrics.timed('create_template')
+        with metrics.timed('workbook_save'): ...
+    """
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        STAGE_SECONDS.observe(time.perf_counter() - self._start, stage=self.stage)
+        if exc_type is not None:
+            STAGE_ERRORS.inc(stage=self.stage)
+        return False
+
+    def __call__(self, fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with timed(self.stage):
+                return fn(*args, **kwargs)
+        return wrapper
+
+
+class Trace:
+    """
+    一次處理流程 (例如 api_analyze) 的階段紀錄。每個 span 記錄耗時、輸入/輸出大小，
+    同時計入 STAGE_SECONDS{stage="<prefix>.<name>"}:
+        trace = metrics.Trace('analyze')
+        with trace.span('gemini_call', input_size=len(prompt)) as span:
+            ...
+            span['output_size'] = len(text)
+    """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.spans = []
+
+    @contextmanager
+    def span(self, name, input_size=None):
+        record = {'name': name, 'ms': None, 'input_size': input_size, 'output_size': None}
+        start = time.perf_counter()
+        try:
+            yield record
+        except Exception:
+            record['error'] = True
+            raise
+        finally:
+            seconds = time.perf_counter() - start
+            record['ms'] = round(seconds * 1000, 1)
+            self.spans.append(record)
+            STAGE_SECONDS.observe(seconds, stage=f"{self.prefix}.{name}")
+
+    def total_ms(self):
+        return round(sum(s['ms'] for s in self.spans), 1)
+
+
+def observe_cache(name, hits, misses):
+    """給 collector 使用: 記錄某個快取的累計命中/未命中與命中率"""
+    CACHE_REQUESTS.set(hits, cache=name, result='hit')
+    CACHE_REQUESTS.set(misses, cache=name, result='miss')
+    total = hits + misses
+    CACHE_HIT_RATIO.set(hits / total if total else 0.0, cache=name)
+
+
+def register_collector(fn):
+    return REGISTRY.register_collector(fn)
+
+
+def expose():
+    return REGISTRY.expose()
+
+
+# ---------------------------------------------------------------------------
+# Flask integration
+# ---------------------------------------------------------------------------
+
+def _endpoint():
+    return request.endpoint or 'unmatched'
+
+
+def _before_request():
+    g._metrics_start = time.perf_counter()
+    g._metrics_endpoint = _endpoint()
+    IN_FLIGHT.inc(endpoint=g._metrics_endpoint)
+
+
+def _after_request(response):
+    start = g.pop('_metrics_start', None)
+    if start is not None:
+        endpoint = g._metrics_endpoint
+        REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint=endpoint, method=request.method)
+        REQUESTS.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+    return response
+
+
+def _teardown_request(exc):
+    endpoint = g.pop('_metrics_endpoint', None)
+    if endpoint is None:
+        return
+    if g.pop('_metrics_start', None) is not None:
+        # 例外沒有經過 after_request
+        REQUESTS.inc(endpoint=endpoint, method=request.method, status=500)
+    IN_FLIGHT.dec(endpoint=endpoint)
+
+
+def init_app(app):
+    """註冊請求計數/延遲/處理中的 hooks。串流回應的延遲只計到 view 回傳為止。"""
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+    app.extensions['metrics'] = REGISTRY
+    return REGISTRY
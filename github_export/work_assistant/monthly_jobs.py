@@ -0,0 +1,345 @@
+"""
+月報背景工作 (Background monthly report jobs)
+
+月報改為排入佇列的背景工作:
+  - 只包含所選期間 (report_periods) 的 entry，以日期索引取出，成本與期間長度成正比
+  - 以 (期間, 期間內 entry 摘要, 模板雜湊, 參數摘要, 照片設定) 組成 cache key，
+    相同 key 的完成檔案存在 projects/<id>/monthly_build/reports/<key>.xlsx，重複下載直接回傳
+  - 已結束的期間另外封存到 projects/<id>/archives/<label>.xlsx，不會被清除
+  - 同一 key 同時只會有一個工作 (重複點擊/多人同時下載共用同一個 job)
+  - 前端輪詢 job 狀態取得進度，完成後再下載 (ETag = cache key，未變更時回 304)
+  - job 狀態同時寫到 projects/<id>/monthly_build/jobs/<job_id>.json，
+    多個 worker process 時輪詢打到其他行程也查得到；同一專案的 build 以檔案鎖跨行程互斥
+"""
+import hashlib
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import database
+    import monthly_report
+    import template_cache
+    import image_prep
+    import report_periods
+    import metrics
+    import profiler
+    import file_store
+except ImportError:
+    from . import database
+    from . import monthly_report
+    from . import template_cache
+    from . import image_prep
+    from . import report_periods
+    from . import metrics
+    from . import profiler
+    from . import file_store
+
+logger = logging.getLogger(__name__)
+
+JOB_WORKERS = int(os.getenv('MONTHLY_JOB_WORKERS', '2'))
+JOB_TTL_SECONDS = 3600          # 完成的 job 狀態保留時間
+REPORTS_KEEP = 3                # 每個專案保留的快取報表數量
+REPORTS_DIR_NAME = 'reports'
+JOBS_DIR_NAME = 'jobs'
+PROGRESS_SAVE_SECONDS = 1.0     # 進度寫入狀態檔的最短間隔
+
+_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='monthly-job')
+_jobs = {}          # job_id -> MonthlyJob
+_active = {}        # cache key -> MonthlyJob (queued / running)
+_lock = threading.Lock()
+
+
+class MonthlyJob:
+    def __init__(self, project_id, key, filename, period, path):
+        self.id = uuid.uuid4().hex
+        self.project_id = project_id
+        self.key = key
+        self.filename = filename
+        self.period = period
+        self.path = path            # 完成後的報表檔 (reports/ 或 archives/)
+        self.status = 'queued'      # queued -> running -> done / error
+        self.done = 0
+        self.total = 0
+        self.error = None
+        self.stats = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self.pid = os.getpid()
+        self._saved_at = 0.0
+
+    @property
+    def etag(self):
+        """有 entry 渲染失敗 (未放入報表) 時檔案不是該 key 的完整結果，ETag 另外區分"""
+        return f"{self.key}-{self.id}" if (self.stats or {}).get('failed') else self.key
+
+    def state(self):
+        return dict(self.to_dict(), key=self.key, path=self.path, created_at=self.created_at,
+                    finished_at=self.finished_at, pid=self.pid)
+
+    @classmethod
+    def from_state(cls, state):
+        job = cls(state['project_id'], state['key'], state['filename'],
+                  report_periods.Period.from_dict(state['period']), state['path'])
+        job.id = state['job_id']
+        job.status = state['status']
+        job.done, job.total = state['progress']['done'], state['progress']['total']
+        job.error = state.get('error')
+        job.stats = state.get('stats')
+        job.created_at = state.get('created_at', job.created_at)
+        job.finished_at = state.get('finished_at')
+        job.pid = state.get('pid')
+        return job
+
+    def save(self, force=True):
+        """寫入狀態檔；force=False 時 (進度更新) 最多每 PROGRESS_SAVE_SECONDS 寫一次"""
+        now = time.time()
+        if not force and now - self._saved_at < PROGRESS_SAVE_SECONDS:
+            return
+        self._saved_at = now
+        path = job_state_path(self.project_id, self.id)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            file_store.write_json(path, self.state())
+        except OSError as e:
+            logger.warning(f"Failed to save monthly job state {self.id}: {e}")
+
+    def to_dict(self):
+        return {
+            'job_id': self.id,
+            'project_id': self.project_id,
+            'status': self.status,
+            'progress': {'done': self.done, 'total': self.total},
+            'error': self.error,
+            'stats': self.stats,
+            'filename': self.filename,
+            'period': self.period.to_dict(),
+            'etag': self.etag,
+        }
+
+
+def report_filename(project_id, config, period):
+    if config.get('name'):
+        return f"{config['name']}_月報_{period.label}.xlsx"
+    return f"Monthly_Report_{project_id}_{period.label}.xlsx"
+
+
+def job_state_path(project_id, job_id):
+    return os.path.join(database.PROJECTS_DIR, project_id, monthly_report.BUILD_DIR_NAME, JOBS_DIR_NAME,
+                        f"{job_id}.json")
+
+
+def reports_dir(project_id):
+    return os.path.join(database.PROJECTS_DIR, project_id, monthly_report.BUILD_DIR_NAME, REPORTS_DIR_NAME)
+
+
+def report_path(project_id, key):
+    # 絕對路徑: send_file 會把相對路徑當成相對於 app.root_path
+    return os.path.abspath(os.path.join(reports_dir(project_id), f"{key}.xlsx"))
+
+
+def period_entries(project_id, period):
+    return database.get_entries_between(project_id, period.start.isoformat(), period.end.isoformat())
+
+
+def cache_key(config, upload_folder, period, entries):
+    """期間 + 期間內 entry 摘要 + 模板雜湊 + 參數 + 照片設定；任何一個改變就是不同的報表"""
+    template_path = os.path.join(upload_folder, config['template_file'])
+    raw = '|'.join([
+        period.label,
+        report_periods.entries_digest(entries),
+        template_cache.file_hash(template_path),
+        monthly_report.params_digest(config.get('parameters', [])),
+        image_prep.settings_key(),
+    ])
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()[:20]
+
+
+def _prune_reports(project_id, keep_key):
+    """只保留最新的 REPORTS_KEEP 份 (含剛產生的這份)"""
+    folder = os.path.abspath(reports_dir(project_id))
+    try:
+        files = sorted((os.path.join(folder, name) for name in os.listdir(folder) if name.endswith('.xlsx')),
+                       key=os.path.getmtime, reverse=True)
+    except OSError:
+        return
+    keep = {report_path(project_id, keep_key)}
+    for path in files:
+        if path in keep:
+            continue
+        if len(keep) < REPORTS_KEEP:
+            keep.add(path)
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _prune_jobs(project_id):
+    """清除過期的 job: 記憶體中的在 _lock 內，狀態檔 (含其他 worker process 留下的) 在鎖外處理"""
+    cutoff = time.time() - JOB_TTL_SECONDS
+    with _lock:
+        for job_id, job in list(_jobs.items()):
+            if job.finished_at and job.finished_at < cutoff:
+                _jobs.pop(job_id, None)
+    folder = os.path.dirname(job_state_path(project_id, 'x'))
+    try:
+        names = os.listdir(folder)
+    except OSError:
+        return
+    for name in names:
+        path = os.path.join(folder, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+def cached_report(project_id, key, period):
+    """已產生過的報表路徑 (封存優先)，沒有則 None"""
+    archived = report_periods.get_archive(project_id, period.label, key)
+    if archived:
+        return archived
+    path = report_path(project_id, key)
+    return path if os.path.exists(path) else None
+
+
+def _run(job, config, upload_folder, entries):
+    job.status = 'running'
+    job.save()
+    try:
+        with monthly_report.project_lock(job.project_id):
+            # 等待鎖的期間，其他 worker process 可能已經產生了同一份報表
+            cached = cached_report(job.project_id, job.key, job.period)
+            if cached:
+                job.path = cached
+                job.done = job.total = 1
+                job.status = 'done'
+                return
+            _build(job, config, upload_folder, entries)
+        job.status = 'done'
+    except Exception as e:
+        logger.error(f"Monthly job {job.id} ({job.project_id}) failed: {e}")
+        job.status = 'error'
+        job.error = str(e)
+    finally:
+        job.finished_at = time.time()
+        job.save()
+        with _lock:
+            if _active.get(job.key) is job:
+                del _active[job.key]
+
+
+def _build(job, config, upload_folder, entries):
+    # entries 是計算 key 時的快照，檔案內容與 key 一定一致
+    builder = monthly_report.MonthlyBuilder(job.project_id, config, upload_folder)
+    keep_ids = [e.get('id') for e in database.get_project_entries(job.project_id)]
+
+    def progress(done, total):
+        job.done, job.total = done, total
+        job.save(force=False)
+
+    final_path = report_path(job.project_id, job.key)
+    os.makedirs(os.path.dirname(final_path), exist_ok=True)
+    tmp_path = f"{final_path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f, metrics.timed('monthly_build'), \
+                profiler.capture('monthly_job', project_id=job.project_id, job_id=job.id,
+                                 period=job.period.label, entries=len(entries)):
+            job.stats = builder.build(entries, f, progress, keep_ids=keep_ids)
+        if job.stats.get('failed'):
+            # 有 entry 因 worker 當掉/逾時未放入: 只給這個 job 下載，不當成該 key 的快取也不封存
+            job.path = os.path.join(os.path.dirname(final_path), f"{job.key}-partial-{job.id}.xlsx")
+        file_store.replace(tmp_path, job.path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    if job.stats.get('failed'):
+        return
+    if job.period.is_closed():
+        # 已關帳的期間: 封存，之後除非該期間的 entry 變更否則不再重新產生
+        job.path = report_periods.store_archive(job.project_id, job.period, job.key, final_path, len(entries))
+    _prune_reports(job.project_id, job.key)
+
+
+def submit(project_id, config, upload_folder, period):
+    """
+    回傳 (job, created)。期間內沒有 entry 時拋出 ValueError。
+    報表已在快取/封存中時回傳已完成的 job；相同 key 正在執行時回傳同一個 job。
+    """
+    entries = period_entries(project_id, period)
+    if not entries:
+        raise ValueError(f"No entries in period {period.label}")
+    key = cache_key(config, upload_folder, period, entries)
+    # _lock 只保護記憶體中的 map；讀寫磁碟 (清除狀態檔、查快取、寫狀態檔) 都在鎖外進行
+    with _lock:
+        job = _active.get(key)
+    if job is not None:
+        return job, False
+    _prune_jobs(project_id)
+
+    job = MonthlyJob(project_id, key, report_filename(project_id, config, period), period,
+                     report_path(project_id, key))
+    cached = cached_report(project_id, key, period)
+    if cached:
+        job.path = cached
+        job.status = 'done'
+        job.done = job.total = 1
+        job.finished_at = time.time()
+        with _lock:
+            _jobs[job.id] = job
+        job.save()
+        return job, False
+
+    with _lock:
+        # 查快取的期間可能已有其他請求排入同一個 key
+        active = _active.get(key)
+        if active is not None:
+            return active, False
+        _active[key] = job
+        _jobs[job.id] = job
+    job.save()
+    _executor.submit(_run, job, config, upload_folder, entries)
+    return job, True
+
+
+def get_job(job_id, project_id=None):
+    """本行程的 job，或 (給定 project_id 時) 其他 worker process 寫下的狀態檔"""
+    with _lock:
+        job = _jobs.get(job_id)
+    if job is not None or project_id is None or not job_id.isalnum():
+        return job
+    state = file_store.read_json(job_state_path(project_id, job_id))
+    if not state:
+        return None
+    try:
+        return MonthlyJob.from_state(state)
+    except (KeyError, TypeError, ValueError) as e:
+        logger.warning(f"Unreadable monthly job state {job_id}: {e}")
+        return None
+
+
+def drain(timeout):
+    """
+    worker process 結束前呼叫: 等待本行程排入的 job 完成 (最多 timeout 秒)。
+    逾時仍未完成的 job 標記為 error (使用者可重新產生)；回傳是否全部完成。
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with _lock:
+            if not _active:
+                return True
+        time.sleep(0.2)
+    with _lock:
+        remaining = list(_active.values())
+    for job in remaining:
+        job.status = 'error'
+        job.error = 'Server restarted before the report finished, please generate again'
+        job.finished_at = time.time()
+        job.save()
+    return not remaining
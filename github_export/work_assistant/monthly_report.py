@@ -0,0 +1,965 @@
+"""
+月報產生器 (Incremental monthly workbook builder)
+
+每一筆 entry 渲染一次成「工作表片段」(fragment)，存放在專案資料夾：
+    projects/<id>/monthly_build/
+        manifest.json            # template / parameters 雜湊與每筆 entry 的摘要
+        fragments/<entry>.frag   # 單一工作表的 XML、drawing、media 與 relationships
+下載月報時只重新渲染新增或修改過的 entry，其餘片段直接在 zip 層級拼接成最終 xlsx，
+因此下載時間不再隨著已渲染的筆數增加。
+渲染片段時以模板工作表的 XML 藍圖 (sheet_blueprint) 直接替換儲存格，筆數多時送到 offload 的
+process pool 平行處理 (藍圖不支援、需要 openpyxl 的渲染與模板重新存檔一律在 pool 執行)；
+組裝時逐一從磁碟讀取片段寫入輸出。
+"""
+import functools
+import hashlib
+import io
+import json
+import logging
+import os
+import posixpath
+import re
+import shutil
+import uuid
+import zipfile
+import xml.etree.ElementTree as ET
+from collections import deque
+from concurrent.futures.process import BrokenProcessPool
+from xml.sax.saxutils import escape, quoteattr
+
+try:
+    import database
+    import renderer
+    import template_cache
+    import template_geometry
+    import image_prep
+    import sheet_blueprint
+    import offload
+    import metrics
+    import file_store
+except ImportError:
+    from . import database
+    from . import renderer
+    from . import template_cache
+    from . import template_geometry
+    from . import image_prep
+    from . import sheet_blueprint
+    from . import offload
+    from . import metrics
+    from . import file_store
+
+logger = logging.getLogger(__name__)
+
+BUILD_DIR_NAME = 'monthly_build'
+FRAGMENT_FORMAT = 1
+# 藍圖渲染的 entry 達到此數量才送到 worker process (少量時 pickle/IPC 成本反而較高)；
+# openpyxl 渲染不論筆數都送到 worker
+PARALLEL_MIN_ENTRIES = int(os.getenv('MONTHLY_PARALLEL_MIN', '16'))
+# worker 渲染單一 entry 最多等待的秒數 (輪到該筆時開始計算)；逾時的 entry 不放入月報，該 pool 退役
+ENTRY_TIMEOUT = float(os.getenv('MONTHLY_ENTRY_TIMEOUT', '120'))
+# 與 openpyxl.utils.units 相同 (worker process 只用藍圖渲染時不必載入 openpyxl)
+EMU_PER_PIXEL = 9525
+
+
+def pixels_to_EMU(value):
+    return int(value * EMU_PER_PIXEL)
+
+NS_CT = 'http://schemas.openxmlformats.org/package/2006/content-types'
+NS_PKG_REL = 'http://schemas.openxmlformats.org/package/2006/relationships'
+NS_MAIN = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+NS_DOC_REL = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+
+REL_OFFICE_DOCUMENT = f'{NS_DOC_REL}/officeDocument'
+REL_WORKSHEET = f'{NS_DOC_REL}/worksheet'
+REL_STYLES = f'{NS_DOC_REL}/styles'
+REL_THEME = f'{NS_DOC_REL}/theme'
+REL_TABLE = f'{NS_DOC_REL}/table'
+REL_CORE = 'http://schemas.openxmlformats.org/package/2006/relationships/metadata/core-properties'
+REL_APP = f'{NS_DOC_REL}/extended-properties'
+
+CT_RELS = 'application/vnd.openxmlformats-package.relationships+xml'
+CT_WORKBOOK = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml'
+CT_WORKSHEET = 'application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml'
+
+# 片段之間不能共用的 part (table 名稱/ID 在整本活頁簿必須唯一)；copy_worksheet 也不會複製它們
+SKIPPED_SHEET_RELS = {REL_TABLE}
+
+def project_lock(project_id):
+    """同一專案的片段/manifest 同時只能有一個 build (跨 worker process)"""
+    return file_store.lock(os.path.join(database.PROJECTS_DIR, project_id, BUILD_DIR_NAME))
+
+
+# ---------------------------------------------------------------------------
+# Entry -> filled worksheet (moved from txtapp.api_generate_monthly)
+# ---------------------------------------------------------------------------
+
+def sanitize_sheet_title(name):
+    return str(name).replace(':', '').replace('/', '-').replace('\\', '').replace('?', '').replace('*', '').replace('[', '').replace(']', '')[:30]
+
+
+def entry_sheet_title(entry, parameters):
+    """預設 MMDD (來自 YYYY-MM-DD)，若有 sheet_name 參數則以其為準"""
+    sheet_name = (entry.get('date') or '')[5:]
+    for param in parameters:
+        if param['name'] == 'sheet_name' and entry['data'].get('sheet_name'):
+            raw_name = entry['data']['sheet_name']
+            if raw_name:
+                sheet_name = raw_name
+            break
+    return sanitize_sheet_title(sheet_name) or 'Sheet'
+
+
+def resolve_image_path(val, upload_folder):
+    # Check if val is an absolute path that exists (for local testing/manual entry)
+    if os.path.isabs(val) and os.path.exists(val):
+        return val
+    # Default: look in UPLOAD_FOLDER
+    return os.path.join(upload_folder, os.path.basename(val))
+
+
+def place_image(img_w, img_h, anchor, geometry):
+    """
+    Smart Positioning & Resizing。
+    目標方框由模板幾何模型 (template_geometry) 預先解析，這裡只做查表與等比例縮放。
+    回傳 {is_header, col0, row0, off_x, off_y, cx, cy} (EMU)；
+    is_header 為 True 表示錨點是標題列，圖片改放到下方本體區域。
+    錨點無效或不在合併儲存格內時拋出 ValueError (不插入圖片)。
+    """
+    if not anchor or ',' not in str(anchor):
+        raise ValueError(f"Invalid anchor_cell: {anchor}")
+
+    target = geometry.resolve_anchor(anchor)
+    if not target:
+        raise ValueError(f"Anchor {anchor} is not inside a merged range")
+
+    box_w = target['box_w']
+    box_h = target['box_h']
+    if box_w <= 10 or box_h <= 10:
+        raise ValueError(f"Target box for {anchor} is too small")
+
+    # Resize Image (Aspect Fit with padding)
+    img_ratio = img_w / img_h
+    box_ratio = box_w / box_h
+
+    pad_w = min(20, box_w * 0.1)
+    pad_h = min(20, box_h * 0.1)
+    avail_w = box_w - pad_w
+    avail_h = box_h - pad_h
+
+    if img_ratio > box_ratio:
+        # Fit to Width
+        new_w = avail_w
+        new_h = avail_w / img_ratio
+    else:
+        # Fit to Height
+        new_h = avail_h
+        new_w = avail_h * img_ratio
+
+    # Offsets for Centering; AnchorMarker uses 0-indexed row/col
+    return {
+        'is_header': target['is_header'],
+        'col0': target['col0'],
+        'row0': target['row0'],
+        'off_x': int(pixels_to_EMU(max(0, (box_w - new_w) / 2))),
+        'off_y': int(pixels_to_EMU(max(0, (box_h - new_h) / 2))),
+        'cx': int(pixels_to_EMU(new_w)),
+        'cy': int(pixels_to_EMU(new_h)),
+        'width': new_w,
+        'height': new_h,
+    }
+
+
+@metrics.timed('image_insert')
+def insert_entry_image(target_sheet, img_path, anchor, geometry):
+    """以 openpyxl 插入照片；回傳 is_header_anchor"""
+    from openpyxl.drawing.image import Image as OpenpyxlImage
+    from openpyxl.drawing.spreadsheet_drawing import OneCellAnchor, AnchorMarker
+    from openpyxl.drawing.xdr import XDRPositiveSize2D
+
+    img = OpenpyxlImage(img_path)
+    placement = place_image(img.width, img.height, anchor, geometry)
+    img.width = placement['width']
+    img.height = placement['height']
+
+    # Create proper OneCellAnchor to support offsets
+    marker = AnchorMarker(col=placement['col0'], colOff=placement['off_x'],
+                          row=placement['row0'], rowOff=placement['off_y'])
+    size_emu = XDRPositiveSize2D(placement['cx'], placement['cy'])
+
+    img.anchor = OneCellAnchor(_from=marker, ext=size_emu)
+    target_sheet.add_image(img)
+    return placement['is_header']
+
+
+def entry_image_jobs(entry, parameters, upload_folder, geometry):
+    """一筆 entry 需要前處理的照片: [(img_path, box_w, box_h)]"""
+    jobs = []
+    data_map = entry.get('data', {})
+    for param in parameters:
+        val = data_map.get(param['name'])
+        if param.get('type') != 'image' or not val:
+            continue
+        target = geometry.resolve_anchor(param.get('style', {}).get('anchor_cell'))
+        img_path = resolve_image_path(val, upload_folder)
+        if target and os.path.exists(img_path):
+            jobs.append((img_path, target['box_w'], target['box_h']))
+    return jobs
+
+
+def build_entry_context(parameters, entry, upload_folder, geometry, prepared, add_image):
+    """
+    一筆 entry 的渲染 context；照片交給 add_image(img_path, anchor) 插入 (回傳 is_header_anchor)。
+    prepared: image_prep.prepare_many 的結果，有前處理過的照片就嵌入縮小後的 JPEG。
+    """
+    prepared = prepared or {}
+    data_map = entry['data']
+    context = {}
+
+    for param in parameters:
+        key = param['name']
+        val = data_map.get(key)
+        original_text = param.get('original_text', '')
+
+        if param['type'] == 'image':
+            # --- Image Logic ---
+            anchor = param.get('style', {}).get('anchor_cell')
+            image_inserted = False
+            is_header_anchor = False
+
+            if val:
+                try:
+                    img_path = resolve_image_path(val, upload_folder)
+                    if os.path.exists(img_path):
+                        target = geometry.resolve_anchor(anchor) or {}
+                        img_path = prepared.get((img_path, target.get('box_w'), target.get('box_h')), img_path)
+                        is_header_anchor = add_image(img_path, anchor)
+                        image_inserted = True
+                    else:
+                        logger.warning(f"Image not found: {img_path}")
+                except Exception as img_err:
+                    logger.error(f"Image insert error {key}: {img_err}")
+
+            # --- Text Cleanup for Image Placeholder ---
+            # If is_header_anchor is True -> We moved the image down, so RESTORE the original header text
+            # Otherwise -> Clear the text
+            if image_inserted:
+                context[key] = original_text if is_header_anchor else ""
+            else:
+                context[key] = original_text
+        else:
+            # --- Text Logic ---
+            context[key] = "" if val is None else val
+    return context
+
+
+def fill_entry_sheet(target_sheet, parameters, entry, upload_folder, cell_renderer, geometry, prepared=None):
+    """把一筆 entry 的文字與照片填入 openpyxl 工作表"""
+    context = build_entry_context(
+        parameters, entry, upload_folder, geometry, prepared,
+        lambda img_path, anchor: insert_entry_image(target_sheet, img_path, anchor, geometry))
+    # Resolve all {{ tags }} in one pass over the sheet
+    cell_renderer.render_sheet(target_sheet, context)
+
+
+def render_blueprint_entry(blueprint, parameters, entry, upload_folder, geometry, prepared=None):
+    """[可在 worker process 執行] 以 XML 藍圖渲染一筆 entry，回傳片段"""
+    pictures = []
+
+    @metrics.timed('image_insert')
+    def add_image(img_path, anchor):
+        data, fmt, (img_w, img_h) = sheet_blueprint.read_picture(img_path)
+        placement = place_image(img_w, img_h, anchor, geometry)
+        pictures.append((data, fmt, placement))
+        return placement['is_header']
+
+    context = build_entry_context(parameters, entry, upload_folder, geometry, prepared, add_image)
+    return blueprint.render(context, renderer.CellRenderer(parameters), pictures)
+
+
+def render_workbook_entry(template_path, parameters, entry, upload_folder, geometry, prepared=None):
+    """[可在 worker process 執行] 藍圖不支援的模板: 以 openpyxl 填入一筆 entry，回傳片段"""
+    wb = template_cache.load_workbook(template_path)
+    # Assume the first sheet is the template; fill it in place
+    target_sheet = wb.worksheets[0]
+    fill_entry_sheet(target_sheet, parameters, entry, upload_folder, renderer.CellRenderer(parameters),
+                     geometry, prepared)
+    buf = io.BytesIO()
+    with metrics.timed('workbook_save'):
+        wb.save(buf)
+    buf.seek(0)
+    with zipfile.ZipFile(buf) as zf:
+        return extract_fragment(zf, _sheet_parts(zf)[0][1])
+
+
+def template_package_bytes(template_path):
+    """[可在 worker process 執行] 以 openpyxl 重新儲存模板，回傳 xlsx 內容"""
+    buf = io.BytesIO()
+    template_cache.load_workbook(template_path).save(buf)
+    return buf.getvalue()
+
+
+# ---------------------------------------------------------------------------
+# OPC package helpers
+# ---------------------------------------------------------------------------
+
+def _rels_path(part):
+    directory, name = posixpath.split(part)
+    return posixpath.join(directory, '_rels', f'{name}.rels')
+
+
+def _resolve_target(source_part, target):
+    if target.startswith('/'):
+        return target.lstrip('/')
+    return posixpath.normpath(posixpath.join(posixpath.dirname(source_part), target))
+
+
+def _read_rels(zf, part):
+    """回傳 [(Id, Type, Target, TargetMode)]；Target 已轉成 package 內的絕對路徑 (External 除外)"""
+    path = _rels_path(part) if part else '_rels/.rels'
+    try:
+        root = ET.fromstring(zf.read(path))
+    except KeyError:
+        return []
+    rels = []
+    for rel in root.findall(f'{{{NS_PKG_REL}}}Relationship'):
+        mode = rel.get('TargetMode')
+        target = rel.get('Target')
+        if mode != 'External':
+            target = _resolve_target(part or '', target)
+        rels.append((rel.get('Id'), rel.get('Type'), target, mode))
+    return rels
+
+
+def _content_types(zf):
+    root = ET.fromstring(zf.read('[Content_Types].xml'))
+    defaults = {d.get('Extension').lower(): d.get('ContentType') for d in root.findall(f'{{{NS_CT}}}Default')}
+    overrides = {o.get('PartName').lstrip('/'): o.get('ContentType') for o in root.findall(f'{{{NS_CT}}}Override')}
+    return defaults, overrides
+
+
+def _part_content_type(part, defaults, overrides):
+    if part in overrides:
+        return overrides[part]
+    ext = posixpath.splitext(part)[1].lstrip('.').lower()
+    return defaults.get(ext, 'application/octet-stream')
+
+
+def _sheet_parts(zf):
+    """依活頁簿順序回傳工作表 part 路徑"""
+    wb_rels = {rid: target for rid, _, target, _ in _read_rels(zf, 'xl/workbook.xml')}
+    root = ET.fromstring(zf.read('xl/workbook.xml'))
+    sheets = root.find(f'{{{NS_MAIN}}}sheets')
+    parts = []
+    for sheet in sheets.findall(f'{{{NS_MAIN}}}sheet'):
+        rid = sheet.get(f'{{{NS_DOC_REL}}}id')
+        parts.append((sheet.get('name'), wb_rels[rid]))
+    return parts
+
+
+_CELL_RE = re.compile(rb'<c\b([^>]*?)(?:/>|>(.*?)</c>)', re.S)
+_SI_RE = re.compile(rb'<si>(.*?)</si>|<si/>', re.S)
+_V_RE = re.compile(rb'<v>(\d+)</v>')
+
+
+def _inline_shared_strings(sheet_xml, shared_xml):
+    """把 t="s" 的儲存格改成 inlineStr，片段之間就不需要合併 sharedStrings"""
+    strings = [m.group(1) or b'<t></t>' for m in _SI_RE.finditer(shared_xml)]
+
+    def _sub(match):
+        attrs, body = match.group(1), match.group(2) or b''
+        if b't="s"' not in attrs:
+            return match.group(0)
+        v = _V_RE.search(body)
+        if not v:
+            return match.group(0)
+        inline = strings[int(v.group(1))]
+        return b'<c' + attrs.replace(b't="s"', b't="inlineStr"') + b'><is>' + inline + b'</is></c>'
+
+    return _CELL_RE.sub(_sub, sheet_xml)
+
+
+_TAB_SELECTED_RE = re.compile(rb'\s+tabSelected="(?:1|true)"')
+_TABLE_PARTS_RE = re.compile(rb'<tableParts\b.*?(?:/>|</tableParts>)', re.S)
+
+
+def extract_fragment(zf, sheet_part):
+    """
+    從 xlsx package 取出單一工作表與它引用的所有 part (drawing、media、comments...)。
+    回傳 dict:
+        sheet_xml, parts {path: bytes}, content_types {path: ct},
+        rels {source_part: [(Id, Type, Target, TargetMode)]}, sheet_part, styles_digest
+    """
+    defaults, overrides = _content_types(zf)
+    names = set(zf.namelist())
+
+    sheet_xml = zf.read(sheet_part)
+    if b't="s"' in sheet_xml and 'xl/sharedStrings.xml' in names:
+        sheet_xml = _inline_shared_strings(sheet_xml, zf.read('xl/sharedStrings.xml'))
+    sheet_xml = _TAB_SELECTED_RE.sub(b'', sheet_xml)
+
+    parts, content_types, rels = {}, {}, {}
+    stack = [sheet_part]
+    while stack:
+        source = stack.pop()
+        kept = []
+        for rid, rtype, target, mode in _read_rels(zf, source):
+            if source == sheet_part and rtype in SKIPPED_SHEET_RELS:
+                continue
+            if mode != 'External':
+                if target not in names:
+                    continue
+                if target not in parts:
+                    parts[target] = zf.read(target)
+                    content_types[target] = _part_content_type(target, defaults, overrides)
+                    stack.append(target)
+            kept.append((rid, rtype, target, mode))
+        if kept:
+            rels[source] = kept
+
+    if any(t in SKIPPED_SHEET_RELS for _, t, _, _ in _read_rels(zf, sheet_part)):
+        sheet_xml = _TABLE_PARTS_RE.sub(b'', sheet_xml)
+
+    styles = zf.read('xl/styles.xml') if 'xl/styles.xml' in names else b''
+    return {
+        'sheet_part': sheet_part,
+        'sheet_xml': sheet_xml,
+        'parts': parts,
+        'content_types': content_types,
+        'rels': rels,
+        'styles_digest': hashlib.sha1(styles).hexdigest(),
+    }
+
+
+def write_fragment(path, fragment):
+    """片段存成小 zip (先寫暫存檔再 rename)"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    meta = {
+        'format': FRAGMENT_FORMAT,
+        'sheet_part': fragment['sheet_part'],
+        'parts': sorted(fragment['parts']),
+        'content_types': fragment['content_types'],
+        'rels': fragment['rels'],
+        'styles_digest': fragment['styles_digest'],
+    }
+    with zipfile.ZipFile(tmp_path, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=1) as zf:
+        zf.writestr('fragment.json', json.dumps(meta, ensure_ascii=False))
+        zf.writestr('sheet.xml', fragment['sheet_xml'])
+        for name, data in fragment['parts'].items():
+            zf.writestr(f'parts/{name}', data)
+    os.replace(tmp_path, path)
+
+
+def read_fragment(path):
+    with zipfile.ZipFile(path) as zf:
+        meta = json.loads(zf.read('fragment.json'))
+        if meta.get('format') != FRAGMENT_FORMAT:
+            raise ValueError('Unsupported fragment format')
+        meta['sheet_xml'] = zf.read('sheet.xml')
+        meta['parts'] = {name: zf.read(f'parts/{name}') for name in meta['parts']}
+        meta['rels'] = {src: [tuple(r) for r in rel_list] for src, rel_list in meta['rels'].items()}
+    return meta
+
+
+# ---------------------------------------------------------------------------
+# Skeleton (styles / theme / docProps) and assembly
+# ---------------------------------------------------------------------------
+
+def extract_skeleton(zf):
+    """
+    共用的活頁簿層級 part：styles、theme、docProps，
+    以及 workbook.xml (workbookPr/date1904、definedNames 等設定) 與模板工作表的 (名稱, part) 順序
+    """
+    defaults, overrides = _content_types(zf)
+    names = set(zf.namelist())
+    skeleton = {'workbook_parts': [], 'root_parts': [], 'styles_digest': None,
+                'workbook_xml': zf.read('xl/workbook.xml'), 'sheets': _sheet_parts(zf)}
+
+    for rid, rtype, target, mode in _read_rels(zf, 'xl/workbook.xml'):
+        if rtype in (REL_STYLES, REL_THEME) and target in names:
+            skeleton['workbook_parts'].append((rtype, target, zf.read(target),
+                                               _part_content_type(target, defaults, overrides)))
+            if rtype == REL_STYLES:
+                skeleton['styles_digest'] = hashlib.sha1(zf.read(target)).hexdigest()
+
+    for rid, rtype, target, mode in _read_rels(zf, ''):
+        if rtype in (REL_CORE, REL_APP) and target in names:
+            skeleton['root_parts'].append((rtype, target, zf.read(target),
+                                           _part_content_type(target, defaults, overrides)))
+    if skeleton['styles_digest'] is None:
+        skeleton['styles_digest'] = hashlib.sha1(b'').hexdigest()
+    return skeleton
+
+
+def _unique_title(title, used):
+    """與 openpyxl 相同的規則: 重複名稱 (不分大小寫) 後面加上數字"""
+    base = title[:31] or 'Sheet'
+    candidate = base
+    counter = 1
+    while candidate.lower() in used:
+        suffix = str(counter)
+        candidate = f"{base[:31 - len(suffix)]}{suffix}"
+        counter += 1
+    used.add(candidate.lower())
+    return candidate
+
+
+def _rels_xml(source_new, rel_list, rename):
+    items = []
+    for rid, rtype, target, mode in rel_list:
+        if mode == 'External':
+            items.append(f'<Relationship Id={quoteattr(rid)} Type={quoteattr(rtype)} '
+                         f'Target={quoteattr(target)} TargetMode="External"/>')
+        else:
+            new_target = posixpath.relpath(rename[target], posixpath.dirname(source_new))
+            items.append(f'<Relationship Id={quoteattr(rid)} Type={quoteattr(rtype)} '
+                         f'Target={quoteattr(new_target)}/>')
+    return (f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            f'<Relationships xmlns="{NS_PKG_REL}">{"".join(items)}</Relationships>').encode('utf-8')
+
+
+_SHEETS_RE = re.compile(rb'<sheets\b(?:[^>]*/>|.*?</sheets>)', re.S)
+_DEFINED_NAMES_RE = re.compile(rb'<definedNames\b(?:[^>]*/>|.*?</definedNames>)', re.S)
+_CALC_PR_RE = re.compile(rb'<calcPr\b[^>]*?(?:/>|>.*?</calcPr>)', re.S)
+# 參照 workbook 層級 relationship 的元素 (外部連結、樞紐分析快取) 在組裝後不存在
+_WORKBOOK_REL_ELEMENTS_RE = re.compile(rb'<(externalReferences|pivotCaches)\b(?:[^>]*/>|.*?</\1>)', re.S)
+_ACTIVE_TAB_RE = re.compile(rb'\s(?:activeTab|firstSheet)="\d+"')
+_WORKBOOK_TAG_RE = re.compile(rb'<workbook\b[^>]*>')
+CALC_PR = b'<calcPr calcId="124519" fullCalcOnLoad="1"/>'
+
+
+def _sheet_ref_pattern(name):
+    """公式中對工作表 name 的參照: 'name'! 或 name!"""
+    quoted = re.escape("'" + name.replace("'", "''") + "'!")
+    return re.compile(f"{quoted}|(?<![\\w.']){re.escape(name)}!")
+
+
+def _defined_names_xml(skeleton, sources):
+    """
+    依輸出工作表重新對應模板的 definedNames:
+    活頁簿層級的名稱原樣保留；工作表層級 (localSheetId) 的名稱指到輸出中對應的工作表，
+    模板工作表被複製成多張 (每筆 entry 一張) 時每張各一份，公式中的工作表名稱換成新名稱。
+    sources: 每張輸出工作表的 (模板工作表 index, 輸出名稱)
+    """
+    root = ET.fromstring(skeleton['workbook_xml'])
+    defined = root.find(f'{{{NS_MAIN}}}definedNames')
+    if defined is None:
+        return None
+    template_names = [name for name, _ in skeleton['sheets']]
+    items = []
+    for element in defined.findall(f'{{{NS_MAIN}}}definedName'):
+        attrs = dict(element.attrib)
+        text = element.text or ''
+        local = attrs.pop('localSheetId', None)
+        if local is None:
+            targets = [(None, text)]
+        else:
+            source = int(local)
+            pattern = _sheet_ref_pattern(template_names[source]) if source < len(template_names) else None
+            targets = []
+            for position, (index, title) in enumerate(sources):
+                if index == source:
+                    new_ref = "'" + title.replace("'", "''") + "'!"
+                    targets.append((position, pattern.sub(lambda m: new_ref, text) if pattern else text))
+        for position, value in targets:
+            attr_xml = ''.join(f' {key}={quoteattr(val)}' for key, val in attrs.items())
+            if position is not None:
+                attr_xml += f' localSheetId="{position}"'
+            items.append(f'<definedName{attr_xml}>{escape(value)}</definedName>')
+    return f'<definedNames>{"".join(items)}</definedNames>'.encode('utf-8') if items else b''
+
+
+def _workbook_xml(skeleton, sheet_entries, sources):
+    """
+    以模板的 workbook.xml 為基礎 (保留 workbookPr/date1904、definedNames、workbookView 等設定)，
+    只換掉 <sheets> 並重新對應 definedNames；第一張工作表為使用中的工作表，開啟時重新計算。
+    """
+    xml = skeleton['workbook_xml']
+    root_tag = _WORKBOOK_TAG_RE.search(xml)
+    if b'xmlns:r=' not in root_tag.group(0):
+        # openpyxl 只在各 <sheet> 上宣告 r: 命名空間
+        xml = xml[:root_tag.end() - 1] + f' xmlns:r="{NS_DOC_REL}"'.encode('utf-8') + xml[root_tag.end() - 1:]
+    if not xml.startswith(b'<?xml'):
+        xml = b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n' + xml
+    xml = _WORKBOOK_REL_ELEMENTS_RE.sub(b'', xml)
+    xml = _ACTIVE_TAB_RE.sub(b'', xml)
+    sheets_xml = f'<sheets>{"".join(sheet_entries)}</sheets>'.encode('utf-8')
+    xml = _SHEETS_RE.sub(lambda m: sheets_xml, xml, count=1)
+    defined_xml = _defined_names_xml(skeleton, sources)
+    if defined_xml is not None:
+        xml = _DEFINED_NAMES_RE.sub(lambda m: defined_xml, xml, count=1)
+    if _CALC_PR_RE.search(xml):
+        xml = _CALC_PR_RE.sub(lambda m: CALC_PR, xml, count=1)
+    else:
+        anchor = _DEFINED_NAMES_RE.search(xml) or _SHEETS_RE.search(xml)
+        xml = xml[:anchor.end()] + CALC_PR + xml[anchor.end():]
+    return xml
+
+
+_STORED_EXTS = {'.png', '.jpg', '.jpeg', '.gif', '.emf', '.wmf', '.bin'}
+_SHEET_VIEW_RE = re.compile(rb'<sheetView\b')
+
+
+def assemble(skeleton, sheets, out):
+    """
+    把 (title, fragment) 依序拼成一份 xlsx 寫入 out (路徑或 file object)。
+    fragment 也可以是無參數的 callable (例如從磁碟讀取片段)，寫入時才載入，
+    因此同時只有一個片段在記憶體中。
+    每個片段的 part 會重新命名 (f{k}_ 前綴) 以避免衝突，rels 以新路徑重寫。
+    """
+    overrides = {'xl/workbook.xml': CT_WORKBOOK}
+    workbook_rels = []
+    sheet_entries = []
+    sources = []   # 每張輸出工作表的 (模板工作表 index, 名稱)
+    template_parts = [part for _, part in skeleton['sheets']]
+    used_titles = set()
+
+    with zipfile.ZipFile(out, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+        def write(name, data):
+            ext = posixpath.splitext(name)[1].lower()
+            zf.writestr(name, data, compress_type=zipfile.ZIP_STORED if ext in _STORED_EXTS else zipfile.ZIP_DEFLATED)
+
+        for k, (title, fragment) in enumerate(sheets, 1):
+            if callable(fragment):
+                fragment = fragment()
+            if fragment['styles_digest'] != skeleton['styles_digest']:
+                raise ValueError(f"Fragment for sheet '{title}' was rendered from a different template")
+
+            sheet_path = f'xl/worksheets/sheet{k}.xml'
+            rename = {fragment['sheet_part']: sheet_path}
+            for part in fragment['parts']:
+                directory, name = posixpath.split(part)
+                rename[part] = posixpath.join(directory, f'f{k}_{name}')
+
+            sheet_xml = fragment['sheet_xml']
+            if k == 1:
+                sheet_xml = _SHEET_VIEW_RE.sub(b'<sheetView tabSelected="1"', sheet_xml, count=1)
+            write(sheet_path, sheet_xml)
+            overrides[sheet_path] = CT_WORKSHEET
+            for part, data in fragment['parts'].items():
+                write(rename[part], data)
+                overrides[rename[part]] = fragment['content_types'][part]
+            for source, rel_list in fragment['rels'].items():
+                write(_rels_path(rename[source]), _rels_xml(rename[source], rel_list, rename))
+
+            rid = f'rId{k}'
+            workbook_rels.append((rid, REL_WORKSHEET, sheet_path, None))
+            title = _unique_title(title, used_titles)
+            sheet_entries.append(f'<sheet name={quoteattr(title)} sheetId="{k}" r:id="{rid}"/>')
+            source = fragment['sheet_part']
+            sources.append((template_parts.index(source) if source in template_parts else None, title))
+
+        rename = {}
+        for n, (rtype, path, data, ctype) in enumerate(skeleton['workbook_parts'], len(sheet_entries) + 1):
+            write(path, data)
+            overrides[path] = ctype
+            rename[path] = path
+            workbook_rels.append((f'rId{n}', rtype, path, None))
+        root_rels = [('rId1', REL_OFFICE_DOCUMENT, 'xl/workbook.xml', None)]
+        rename['xl/workbook.xml'] = 'xl/workbook.xml'
+        for n, (rtype, path, data, ctype) in enumerate(skeleton['root_parts'], 2):
+            write(path, data)
+            overrides[path] = ctype
+            rename[path] = path
+            root_rels.append((f'rId{n}', rtype, path, None))
+        for _, _, path, _ in workbook_rels:
+            rename.setdefault(path, path)
+
+        write('xl/workbook.xml', _workbook_xml(skeleton, sheet_entries, sources))
+        write('xl/_rels/workbook.xml.rels', _rels_xml('xl/workbook.xml', workbook_rels, rename))
+        write('_rels/.rels', _rels_xml('', root_rels, rename))
+
+        ct_items = [f'<Default Extension="rels" ContentType="{CT_RELS}"/>',
+                    '<Default Extension="xml" ContentType="application/xml"/>']
+        ct_items += [f'<Override PartName={quoteattr("/" + p)} ContentType={quoteattr(ct)}/>'
+                     for p, ct in overrides.items()]
+        write('[Content_Types].xml',
+              (f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+               f'<Types xmlns="{NS_CT}">{"".join(ct_items)}</Types>').encode('utf-8'))
+
+
+# ---------------------------------------------------------------------------
+# Incremental builder
+# ---------------------------------------------------------------------------
+
+def params_digest(parameters):
+    return hashlib.sha1(json.dumps(parameters, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+def entry_digest(entry, parameters, upload_folder):
+    """entry 內容 + 引用照片的 (大小, 修改時間)；任何一個改變都要重新渲染"""
+    h = hashlib.sha1()
+    h.update(json.dumps({'date': entry.get('date'), 'data': entry.get('data')},
+                        sort_keys=True, ensure_ascii=False).encode('utf-8'))
+    for param in parameters:
+        if param.get('type') == 'image':
+            val = entry.get('data', {}).get(param['name'])
+            if val:
+                path = resolve_image_path(val, upload_folder)
+                try:
+                    st = os.stat(path)
+                    h.update(f"{path}|{st.st_size}|{st.st_mtime_ns}".encode('utf-8'))
+                except OSError:
+                    h.update(f"{path}|missing".encode('utf-8'))
+    return h.hexdigest()
+
+
+def _fragment_ok(path):
+    """片段檔存在且格式正確 (只讀 metadata)"""
+    try:
+        with zipfile.ZipFile(path) as zf:
+            return json.loads(zf.read('fragment.json')).get('format') == FRAGMENT_FORMAT
+    except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+        return False
+
+
+class MonthlyBuilder:
+    """單一專案的增量月報建置器"""
+
+    def __init__(self, project_id, config, upload_folder):
+        self.project_id = project_id
+        self.config = config
+        self.parameters = config.get('parameters', [])
+        self.upload_folder = upload_folder
+        self.template_path = os.path.join(upload_folder, config['template_file'])
+        self.build_dir = os.path.join(database.PROJECTS_DIR, project_id, BUILD_DIR_NAME)
+        self.fragment_dir = os.path.join(self.build_dir, 'fragments')
+        self.manifest_path = os.path.join(self.build_dir, 'manifest.json')
+
+    # --- manifest ---
+
+    def _load_manifest(self):
+        if os.path.exists(self.manifest_path):
+            try:
+                with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+            except (OSError, ValueError):
+                pass
+        return {}
+
+    def _save_manifest(self, manifest):
+        os.makedirs(self.build_dir, exist_ok=True)
+        tmp_path = f"{self.manifest_path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=4)
+        os.replace(tmp_path, self.manifest_path)
+
+    def _fragment_path(self, key):
+        return os.path.join(self.fragment_dir, f"{key}.frag")
+
+    # --- rendering ---
+
+    def _template_package(self):
+        """以 openpyxl 重新儲存過的模板 (片段與 skeleton 的 styles 因此一致)"""
+        data = offload.run(template_package_bytes, self.template_path, block=True)
+        return zipfile.ZipFile(io.BytesIO(data))
+
+    def load_geometry(self, template_hash):
+        return template_geometry.get_geometry(
+            self.project_id, template_hash, self.parameters,
+            lambda: template_cache.load_workbook(self.template_path).worksheets[0])
+
+    def load_blueprint(self, template_zf):
+        """模板第一張工作表的 XML 藍圖；結構不支援時回傳 None (改用 openpyxl 渲染)"""
+        try:
+            return sheet_blueprint.SheetBlueprint(extract_fragment(template_zf, _sheet_parts(template_zf)[0][1]))
+        except sheet_blueprint.UnsupportedTemplate as e:
+            logger.info(f"Monthly {self.project_id}: using openpyxl renderer ({e})")
+            return None
+
+    def _render_one(self, entry, blueprint, geometry, prepared):
+        if blueprint is not None:
+            return render_blueprint_entry(blueprint, self.parameters, entry, self.upload_folder, geometry, prepared)
+        return render_workbook_entry(self.template_path, self.parameters, entry, self.upload_folder,
+                                     geometry, prepared)
+
+    def _render_parallel(self, to_render, blueprint, geometry, prepared, progress):
+        """
+        在 offload 的 process pool 渲染；最多 2 x workers 筆在途，完成就寫入磁碟。
+        每筆最多等待 ENTRY_TIMEOUT 秒。worker 當掉時同一 pool 上在途的 entry 都會收到 BrokenProcessPool，
+        這些 entry 改在獨立的單一 worker pool 逐筆重跑，只有造成當機 (或逾時) 的 entry 失敗。
+        回傳 {entry_id: 錯誤訊息}。
+        """
+        pool = offload.get_pool()
+        window = offload.WORKERS * 2
+        pending = deque()   # (entry, 片段路徑, 送出的 pool, future)
+        queue = deque(to_render)
+        total = len(to_render) + 1
+        done = 0
+        failed = {}
+
+        def task(entry):
+            entry_prepared = {job: prepared[job] for job in
+                              entry_image_jobs(entry, self.parameters, self.upload_folder, geometry) if job in prepared}
+            if blueprint is not None:
+                return (render_blueprint_entry, blueprint, self.parameters, entry,
+                        self.upload_folder, geometry, entry_prepared)
+            return (render_workbook_entry, self.template_path, self.parameters, entry,
+                    self.upload_folder, geometry, entry_prepared)
+
+        def submit(entry):
+            nonlocal pool
+            try:
+                return pool, pool.submit(*task(entry))
+            except BrokenProcessPool:
+                # pool 在兩次取結果之間當掉: 換新的再送
+                offload.reset_pool(pool)
+                pool = offload.get_pool()
+                return pool, pool.submit(*task(entry))
+
+        def finish(entry, frag_path, fragment=None, error=None):
+            nonlocal done
+            if error is None:
+                write_fragment(frag_path, fragment)
+            else:
+                logger.error(f"Monthly {self.project_id}: entry {entry.get('id')} left out of the report: {error}")
+                failed[entry.get('id')] = error
+            done += 1
+            progress(done, total)
+
+        def run_isolated(suspects):
+            """逐筆在單一 worker 的 pool 重跑；這時當掉就一定是這一筆造成的"""
+            solo = None
+            try:
+                for entry, frag_path in suspects:
+                    if solo is None:
+                        solo = offload.isolated_pool()
+                    future = solo.submit(*task(entry))
+                    try:
+                        fragment = offload.result(solo, future, ENTRY_TIMEOUT, f"monthly entry {entry.get('id')}")
+                    except BrokenProcessPool:
+                        finish(entry, frag_path, error='Worker process crashed')
+                        solo.shutdown(wait=False, cancel_futures=True)
+                        solo = None
+                    except offload.TaskTimeout as e:
+                        finish(entry, frag_path, error=str(e))
+                        solo = None     # 已退役，卡住的 worker 由 offload 終止
+                    else:
+                        finish(entry, frag_path, fragment)
+            finally:
+                if solo is not None:
+                    solo.shutdown(wait=False, cancel_futures=True)
+
+        try:
+            while queue or pending:
+                while queue and len(pending) < window:
+                    entry, frag_path = queue.popleft()
+                    pending.append((entry, frag_path) + submit(entry))
+                entry, frag_path, entry_pool, future = pending.popleft()
+                try:
+                    fragment = offload.result(entry_pool, future, ENTRY_TIMEOUT, f"monthly entry {entry.get('id')}")
+                except BrokenProcessPool:
+                    logger.error(f"Monthly worker pool crashed while rendering entry {entry.get('id')}, "
+                                 f"re-running in-flight entries one at a time")
+                    offload.reset_pool(entry_pool)
+                    if pool is entry_pool:
+                        pool = offload.get_pool()
+                    suspects = [(entry, frag_path)] + [(e, p) for e, p, ep, _ in pending if ep is entry_pool]
+                    healthy = [item for item in pending if item[2] is not entry_pool]
+                    pending.clear()
+                    pending.extend(healthy)
+                    run_isolated(suspects)
+                except offload.TaskTimeout as e:
+                    # 原 pool 已退役 (其他在途的 entry 照常完成)，之後的 entry 送到新的 pool
+                    finish(entry, frag_path, error=str(e))
+                    pool = offload.get_pool()
+                else:
+                    finish(entry, frag_path, fragment)
+        finally:
+            for _, _, _, future in pending:
+                future.cancel()
+        return failed
+
+    # --- build ---
+
+    def build(self, entries, out, progress=None, keep_ids=None):
+        """
+        更新片段並組裝月報到 out；回傳統計資訊。
+        progress(done, total): 每完成一張工作表的渲染 (以及最後的組裝) 時呼叫。
+        keep_ids: 只產生部分期間時，傳入專案所有 entry id，其他期間的片段不會被當成已刪除而移除。
+        """
+        with project_lock(self.project_id):
+            return self._build(entries, out, progress or (lambda done, total: None), keep_ids)
+
+    def _build(self, entries, out, progress, keep_ids=None):
+        template_hash = template_cache.file_hash(self.template_path)
+        p_digest = params_digest(self.parameters)
+
+        prep_key = image_prep.settings_key()
+
+        manifest = self._load_manifest()
+        if (manifest.get('template_hash') != template_hash or manifest.get('params_digest') != p_digest
+                or manifest.get('image_prep') != prep_key):
+            # 模板、參數或照片壓縮設定變更 -> 所有片段失效
+            shutil.rmtree(self.fragment_dir, ignore_errors=True)
+            manifest = {}
+        known = manifest.get('entries', {})
+
+        with self._template_package() as template_zf:
+            skeleton = extract_skeleton(template_zf)
+            # 模板中第一張以外的工作表原樣保留在最前面 (與舊版 copy_worksheet 行為一致)
+            static_sheets = [(title, extract_fragment(template_zf, part))
+                             for title, part in _sheet_parts(template_zf)[1:]]
+            blueprint = self.load_blueprint(template_zf)
+
+        entries = sorted(entries, key=lambda x: x.get('date') or '')
+        stats = {'entries': len(entries), 'rendered': 0, 'reused': 0, 'removed': 0, 'failed': {}}
+
+        keep_ids = set(keep_ids or ())
+        new_known = {entry_id: digest for entry_id, digest in known.items() if entry_id in keep_ids}
+        entry_sheets = []  # (entry id, 工作表名稱, 讀取片段)
+        to_render = []  # (entry, fragment path)
+        for entry in entries:
+            entry_id = entry['id']
+            digest = entry_digest(entry, self.parameters, self.upload_folder)
+            frag_path = self._fragment_path(entry_id)
+            if known.get(entry_id) == digest and _fragment_ok(frag_path):
+                stats['reused'] += 1
+            else:
+                to_render.append((entry, frag_path))
+            new_known[entry_id] = digest
+            # 組裝時才從磁碟讀取，記憶體中同時只有一個片段
+            entry_sheets.append((entry_id, entry_sheet_title(entry, self.parameters),
+                                 functools.partial(read_fragment, frag_path)))
+
+        total = len(to_render) + 1
+        progress(0, total)
+        if to_render:
+            geometry = self.load_geometry(template_hash)
+            # 先平行縮小所有需要的照片，再渲染
+            jobs = []
+            for entry, _ in to_render:
+                jobs.extend(entry_image_jobs(entry, self.parameters, self.upload_folder, geometry))
+            prepared = image_prep.prepare_many(jobs, self.upload_folder)
+            if blueprint is None or len(to_render) >= PARALLEL_MIN_ENTRIES:
+                stats['failed'] = self._render_parallel(to_render, blueprint, geometry, prepared, progress)
+            else:
+                for done, (entry, frag_path) in enumerate(to_render, 1):
+                    write_fragment(frag_path, self._render_one(entry, blueprint, geometry, prepared))
+                    progress(done, total)
+            stats['rendered'] = len(to_render) - len(stats['failed'])
+
+        # Drop fragments of deleted entries
+        for entry_id in set(known) - set(new_known):
+            try:
+                os.remove(self._fragment_path(entry_id))
+            except OSError:
+                pass
+            stats['removed'] += 1
+
+        # 渲染失敗 (worker 當掉/逾時) 的 entry 不放入月報，也不記入 manifest，下次建置時重新渲染
+        for entry_id in stats['failed']:
+            new_known.pop(entry_id, None)
+            try:
+                os.remove(self._fragment_path(entry_id))
+            except OSError:
+                pass
+        sheets = static_sheets + [(title, read) for entry_id, title, read in entry_sheets
+                                  if entry_id not in stats['failed']]
+
+        self._save_manifest({'template_hash': template_hash, 'params_digest': p_digest,
+                             'image_prep': prep_key, 'entries': new_known})
+        assemble(skeleton, sheets, out)
+        progress(total, total)
+        logger.info(f"Monthly build {self.project_id}: {stats}")
+        return stats
@@ -0,0 +1,249 @@
+"""
+CPU 密集工作的共用 process pool (Process-pool offload)
+
+openpyxl 載入/存檔、python-docx、docxtpl 渲染、DeepDiff 都會長時間持有 GIL；
+直接在 request 執行緒上跑時，同一行程的登入、entry 列表、dashboard 都會跟著變慢。
+這些工作改送到這裡的 process pool:
+  - spawn 的 worker 啟動時先載入重量級依賴與工作模組 (warm)，第一個請求不必再等 import
+  - run(fn, *args, timeout=): 送出並等待結果
+      * 在途工作超過 workers + OFFLOAD_QUEUE 時立即拋出 PoolBusy (request 回 503 + Retry-After)
+      * 逾時拋出 TaskTimeout；工作已開始執行時該 pool 退役 (retire_pool): 新工作改送到新的 pool，
+        同一 pool 上其他進行中的工作照常完成，之後才終止卡住的 worker
+      * worker 當掉 (BrokenProcessPool) 時換新 pool 重試一次，仍失敗才拋出 WorkerCrashed
+  - get_pool() / reset_pool() / result(): 給批次合併、月報這類自行控制在途數量的串流工作
+    (result() 與 run() 相同的逾時/退役處理)；
+    isolated_pool(): 共用 pool 當掉後逐筆重跑、找出造成當機的那一筆
+送出的函式必須是模組層級函式，參數只傳檔案路徑與可 pickle 的 dict/list。
+OFFLOAD_INLINE=1 時直接在呼叫端執行 (除錯用)；在 worker 內呼叫 run() 也一律直接執行。
+"""
+import importlib
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    import lazy_imports
+    import metrics
+except ImportError:
+    from . import lazy_imports
+    from . import metrics
+
+logger = logging.getLogger(__name__)
+
+WORKERS = int(os.getenv('OFFLOAD_WORKERS') or os.getenv('BATCH_WORKERS') or '0') or (os.cpu_count() or 2)
+# 除了正在執行的 WORKERS 筆之外，最多再排隊幾筆 run() 呼叫
+QUEUE_LIMIT = int(os.getenv('OFFLOAD_QUEUE', '0')) or WORKERS * 4
+DEFAULT_TIMEOUT = float(os.getenv('OFFLOAD_TIMEOUT', '300'))
+RETRY_AFTER_SECONDS = 5
+INLINE = os.getenv('OFFLOAD_INLINE') == '1'
+# worker 啟動時預先載入 (lazy_imports 的名稱)
+WARM_MODULES = ('openpyxl', 'docx', 'docxtpl', 'deepdiff')
+# 會被送進 pool 的函式所在模組 (unpickle 第一個工作時不必再 import)
+TASK_MODULES = ('batch_merge', 'document_tasks', 'monthly_report')
+
+
+class OffloadError(RuntimeError):
+    """送到 process pool 的工作無法完成；status 為建議的 HTTP 狀態碼"""
+    status = 500
+    retry_after = None
+
+
+class PoolBusy(OffloadError):
+    status = 503
+    retry_after = RETRY_AFTER_SECONDS
+
+
+class TaskTimeout(OffloadError):
+    status = 504
+
+
+class WorkerCrashed(OffloadError):
+    status = 500
+
+
+# 逾時後退役的 pool 最多再等其他工作這麼久，之後連同卡住的 worker 一起終止
+RETIRE_GRACE_SECONDS = float(os.getenv('OFFLOAD_RETIRE_GRACE', str(DEFAULT_TIMEOUT)))
+RETIRE_POLL_SECONDS = 0.5
+
+_pool = None
+_pool_lock = threading.Lock()
+_retiring = {}      # 退役中的 pool -> (逾時 (卡住) 的 futures, worker processes)
+_slots = threading.BoundedSemaphore(WORKERS + QUEUE_LIMIT)
+_in_worker = False
+
+
+def _init_worker(modules):
+    """[Worker] spawn 後執行一次: 載入重量級依賴與會被送進來的工作模組"""
+    global _in_worker
+    _in_worker = True
+    lazy_imports.preload(*modules)
+    for name in TASK_MODULES:
+        importlib.import_module(f'{__package__}.{name}' if __package__ else name)
+
+
+def in_worker():
+    return _in_worker
+
+
+def _new_pool(workers):
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                               initializer=_init_worker, initargs=(WARM_MODULES,))
+
+
+def get_pool():
+    """共用的 process pool (spawn，避免在多執行緒的 server 中 fork)"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = _new_pool(WORKERS)
+        return _pool
+
+
+def isolated_pool():
+    """
+    不共用的單一 worker pool: 一次只跑一筆，當掉時就能確定是哪一筆造成的
+    (共用 pool 當掉時所有在途工作都會收到 BrokenProcessPool)。呼叫端負責 shutdown。
+    """
+    return _new_pool(1)
+
+
+def reset_pool(broken):
+    """worker 異常結束後 pool 會整個失效，換一個新的給後續工作使用"""
+    global _pool
+    with _pool_lock:
+        if _pool is broken:
+            _pool = None
+    broken.shutdown(wait=False, cancel_futures=True)
+
+
+def _unfinished(pool):
+    """pool 中尚未完成的 futures (ProcessPoolExecutor 沒有公開的 API)"""
+    while True:
+        try:
+            return [item.future for item in list(pool._pending_work_items.values())]
+        except RuntimeError:
+            # dict changed size during iteration: 管理執行緒正在更新，重試
+            continue
+
+
+def _reap(pool):
+    """等退役 pool 上其他工作完成 (最多 RETIRE_GRACE_SECONDS)，再終止仍在執行卡住工作的 worker"""
+    deadline = time.monotonic() + RETIRE_GRACE_SECONDS
+    while time.monotonic() < deadline:
+        with _pool_lock:
+            stuck = set(_retiring[pool][0])
+        if all(future in stuck for future in _unfinished(pool)):
+            break
+        time.sleep(RETIRE_POLL_SECONDS)
+    with _pool_lock:
+        _, processes = _retiring.pop(pool)
+    _terminate(processes)
+    logger.info("Retired offload pool terminated")
+
+
+def _terminate(processes):
+    for process in processes:
+        if process.is_alive():
+            process.terminate()
+
+
+def retire_pool(pool, stuck):
+    """
+    有工作逾時 (stuck 仍在 worker 中執行): 之後的工作改送到新的 pool；
+    同一 pool 上其他進行中/排隊中的工作照常完成，不會因為終止 worker 而收到 BrokenProcessPool。
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+        first = pool not in _retiring
+        if first:
+            # shutdown() 之後 pool 不再保留 worker 的參照，先記下來
+            _retiring[pool] = (set(), list((pool._processes or {}).values()))
+        _retiring[pool][0].add(stuck)
+    if first:
+        pool.shutdown(wait=False, cancel_futures=False)
+        threading.Thread(target=_reap, args=(pool,), name='offload-reaper', daemon=True).start()
+
+
+def result(pool, future, timeout, name='task'):
+    """
+    等待 pool 上的 future (給自行送出工作的串流呼叫端)。逾時拋出 TaskTimeout:
+    工作尚未開始就直接取消，已在 worker 中執行則該 pool 退役 (retire_pool)，
+    呼叫端之後應以 get_pool() 取得新的 pool；同一 pool 上其他在途工作照常完成。
+    """
+    try:
+        return future.result(timeout=timeout)
+    except FutureTimeout:
+        metrics.OFFLOAD_FAILURES.inc(reason='timeout')
+        if not future.cancel():
+            logger.error(f"Offloaded {name} exceeded {timeout}s, retiring the pool")
+            retire_pool(pool, future)
+        raise TaskTimeout(f"{name} did not finish within {timeout:g}s")
+
+
+def shutdown(wait=True):
+    """結束 pool 與其 worker (server worker 回收/結束前呼叫，否則行程結束時會等待這些子行程)"""
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+        retiring = [processes for _, processes in _retiring.values()]
+    # 退役中的 pool 還有卡住的 worker，不終止的話行程結束時會一直等它
+    for processes in retiring:
+        _terminate(processes)
+    if pool is not None:
+        pool.shutdown(wait=wait, cancel_futures=True)
+
+
+def _ping():
+    return os.getpid()
+
+
+def warm():
+    """在背景啟動所有 worker (含 initializer)；server 啟動時呼叫"""
+    if INLINE:
+        return
+
+    def start():
+        try:
+            futures = [get_pool().submit(_ping) for _ in range(WORKERS)]
+            pids = {future.result(timeout=120) for future in futures}
+            logger.info(f"Offload pool ready: {len(pids)} worker(s)")
+        except Exception as e:
+            logger.warning(f"Offload pool warm-up failed: {e}")
+
+    threading.Thread(target=start, name='offload-warm', daemon=True).start()
+
+
+def run(fn, *args, timeout=None, block=False, **kwargs):
+    """
+    在 process pool 執行 fn(*args, **kwargs) 並回傳結果；fn 自己拋出的例外原樣往上拋。
+    block=True: 佇列已滿時等待空位而不是拋出 PoolBusy (背景工作使用，例如月報 job)
+    """
+    if INLINE or _in_worker:
+        return fn(*args, **kwargs)
+    if not _slots.acquire(blocking=block):
+        metrics.OFFLOAD_REJECTED.inc()
+        raise PoolBusy(f"Offload queue full ({WORKERS + QUEUE_LIMIT} calls in flight)")
+    timeout = DEFAULT_TIMEOUT if timeout is None else timeout
+    name = getattr(fn, '__name__', repr(fn))
+    metrics.OFFLOAD_IN_FLIGHT.inc()
+    try:
+        for attempt in (1, 2):
+            pool = get_pool()
+            future = pool.submit(fn, *args, **kwargs)
+            try:
+                return result(pool, future, timeout, name)
+            except BrokenProcessPool:
+                metrics.OFFLOAD_FAILURES.inc(reason='crash')
+                reset_pool(pool)
+                if attempt == 2:
+                    raise WorkerCrashed(f"Worker process crashed while running {name}")
+                logger.warning(f"Offload worker crashed while running {name}, retrying once")
+    finally:
+        metrics.OFFLOAD_IN_FLIGHT.dec()
+        _slots.release()
@@ -0,0 +1,349 @@
+"""
+多行程服務 (Pre-forked waitress workers)
+
+openpyxl 載入/存檔、照片處理、diff 都是持有 GIL 的純 Python，單一行程時一個月報就會拖慢所有人。
+master 先開好監聽 socket，再啟動 N 個 worker process (spawn，Windows 也可用)，
+每個 worker 在同一個 socket 上跑自己的 waitress:
+  - master 監看 worker，結束就補上新的；啟動後 CRASH_WINDOW_SECONDS 內就崩潰的以指數退避重啟
+  - worker 處理 max_requests (加上隨機抖動) 個請求，或 RSS 超過 max_memory_mb 後自行回收
+  - 優雅結束: 停止 accept (新連線由其他 worker 接手)，之後的回應帶 Connection: close，
+    等進行中的請求與 on_drain(剩餘秒數) 完成，最多 graceful_timeout 秒
+  - SIGTERM / Ctrl+C: master 通知所有 worker 優雅結束，逾時才強制終止
+多個 worker 同時寫入 JSON 檔的保護見 file_store.py；metrics / profiler 的狀態是每個 worker 各自一份。
+"""
+import importlib
+import logging
+import multiprocessing
+import os
+import random
+import signal
+import socket
+import sys
+import threading
+import time
+
+from waitress import wasyncore
+from waitress.channel import HTTPChannel
+from waitress.server import create_server
+from waitress.task import WSGITask
+
+logger = logging.getLogger(__name__)
+
+EXIT_OK = 0
+EXIT_STARTUP_FAILED = 3
+CRASH_WINDOW_SECONDS = 30       # 啟動後這段時間內結束 (非回收) 視為崩潰
+MAX_RESTART_DELAY = 30
+MEMORY_CHECK_SECONDS = 5
+MAX_REQUESTS_JITTER = 0.1       # 避免所有 worker 同時回收
+
+
+def load_object(spec):
+    """'package.module:attr' -> 物件"""
+    module_name, _, attr = spec.partition(':')
+    obj = importlib.import_module(module_name)
+    for part in filter(None, attr.split('.')):
+        obj = getattr(obj, part)
+    return obj
+
+
+def rss_bytes():
+    """目前行程的常駐記憶體 (bytes)；無法取得時為 None"""
+    if sys.platform.startswith('linux'):
+        try:
+            with open('/proc/self/statm', 'r') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError, IndexError):
+            return None
+    if os.name == 'nt':
+        import ctypes
+        from ctypes import wintypes
+
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD)] + \
+                [(name, ctypes.c_size_t) for name in (
+                    'PeakWorkingSetSize', 'WorkingSetSize', 'QuotaPeakPagedPoolUsage', 'QuotaPagedPoolUsage',
+                    'QuotaPeakNonPagedPoolUsage', 'QuotaNonPagedPoolUsage', 'PagefileUsage', 'PeakPagefileUsage')]
+
+        kernel32 = ctypes.WinDLL('kernel32')
+        psapi = ctypes.WinDLL('psapi')
+        kernel32.GetCurrentProcess.restype = wintypes.HANDLE
+        psapi.GetProcessMemoryInfo.argtypes = [wintypes.HANDLE, ctypes.POINTER(PROCESS_MEMORY_COUNTERS),
+                                               wintypes.DWORD]
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        if psapi.GetProcessMemoryInfo(kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb):
+            return counters.WorkingSetSize
+        return None
+    try:
+        import resource
+    except ImportError:
+        return None
+    # 其他 POSIX 只有峰值 (macOS 以 bytes、其餘以 KB 計)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+# ---------------------------------------------------------------------------
+# Worker process
+# ---------------------------------------------------------------------------
+
+class _DrainAwareTask(WSGITask):
+    def build_response_header(self):
+        if getattr(self.channel.server, 'draining', False):
+            # 結束前的回應: 請客戶端之後改用新連線 (會由其他 worker 接手)
+            self.set_close_on_finish()
+        return super().build_response_header()
+
+
+class _Channel(HTTPChannel):
+    task_class = _DrainAwareTask
+
+
+class _Worker:
+    def __init__(self, worker_id, app, sock, options, stop_event):
+        self.worker_id = worker_id
+        self.app = app
+        self.options = options
+        self.stop_event = stop_event
+        self.requests = 0
+        self.reason = None
+        self.clean = True
+        self._lock = threading.Lock()
+        max_requests = options.get('max_requests') or 0
+        if max_requests:
+            max_requests += random.randint(0, int(max_requests * MAX_REQUESTS_JITTER))
+        self.max_requests = max_requests
+        self.server = create_server(self.wsgi, sockets=[sock], threads=options['threads'],
+                                    **options.get('waitress', {}))
+        self.server.channel_class = _Channel
+        self.server.draining = False
+
+    def wsgi(self, environ, start_response):
+        with self._lock:
+            self.requests += 1
+            count = self.requests
+        if self.max_requests and count >= self.max_requests:
+            self.request_stop(f'max_requests ({count})')
+        return self.app(environ, start_response)
+
+    def request_stop(self, reason):
+        if self.reason is None:
+            self.reason = reason
+        self.stop_event.set()
+
+    # --- lifecycle ---
+
+    def run(self):
+        watcher = threading.Thread(target=self._watch, name='prefork-watcher', daemon=True)
+        watcher.start()
+        logger.info(f"Worker {self.worker_id} (pid {os.getpid()}) serving with {self.options['threads']} threads")
+        self.server.run()       # drain 結束時 close_all 讓 loop 返回
+        self.server.task_dispatcher.shutdown(cancel_pending=True, timeout=5)
+
+    def _watch(self):
+        parent = multiprocessing.parent_process()
+        limit = (self.options.get('max_memory_mb') or 0) * 1024 * 1024
+        next_memory_check = 0
+        while not self.stop_event.wait(1):
+            if parent is not None and not parent.is_alive():
+                self.request_stop('master exited')
+            elif limit and time.monotonic() >= next_memory_check:
+                next_memory_check = time.monotonic() + MEMORY_CHECK_SECONDS
+                rss = rss_bytes()
+                if rss is not None and rss > limit:
+                    self.request_stop(f'memory {rss // (1024 * 1024)} MB > {limit // (1024 * 1024)} MB')
+        self._drain()
+
+    @staticmethod
+    def _channel_busy(channel):
+        return bool(channel.requests or channel.request is not None or channel.total_outbufs_len)
+
+    def _channels(self):
+        return [c for c in list(self.server._map.values()) if isinstance(c, HTTPChannel)]
+
+    def _busy(self):
+        dispatcher = self.server.task_dispatcher
+        if dispatcher.active_count or dispatcher.queue:
+            return True
+        return any(self._channel_busy(c) for c in self._channels())
+
+
+    def _drain(self):
+        self.reason = self.reason or 'stop requested'
+        timeout = self.options['graceful_timeout']
+        deadline = time.monotonic() + timeout
+        logger.info(f"Worker {self.worker_id} draining: {self.reason}")
+        self.server.draining = True
+
+        stopped = threading.Event()
+
+        def stop_accepting():
+            # 在 waitress 的 loop 執行緒中執行
+            self.server.accepting = False
+            stopped.set()
+        self.server.trigger.pull_trigger(stop_accepting)
+        stopped.wait(1)
+
+        while self._busy() and time.monotonic() < deadline:
+            time.sleep(0.1)
+        clean = not self._busy()
+        on_drain = self.options.get('on_drain')
+        if on_drain is not None:
+            try:
+                clean = on_drain(max(0.0, deadline - time.monotonic())) is not False and clean
+            except Exception as e:
+                logger.error(f"Worker {self.worker_id} drain hook failed: {e}")
+                clean = False
+        if not clean:
+            logger.warning(f"Worker {self.worker_id} did not finish within {timeout}s; exiting anyway")
+
+        self.clean = clean
+        # 關閉所有 dispatcher (含閒置的 keep-alive 連線) 後 map 為空，server.run() 隨即返回
+        self.server.trigger.pull_trigger(lambda: wasyncore.close_all(self.server._map))
+
+
+def _worker_main(worker_id, sock, options, stop_event):
+    # Ctrl+C 由 master 統一處理；SIGTERM 視為優雅結束
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if hasattr(signal, 'SIGTERM'):
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+    logging.basicConfig(level=logging.INFO,
+                        format=f'[worker {worker_id}:%(process)d] %(levelname)s:%(name)s:%(message)s')
+    try:
+        app = load_object(options['app'])
+        if options.get('on_worker_start') is not None:
+            options['on_worker_start'](options['threads'])
+        worker = _Worker(worker_id, app, sock, options, stop_event)
+    except Exception:
+        logger.exception(f"Worker {worker_id} failed to start")
+        sys.exit(EXIT_STARTUP_FAILED)
+    worker.run()
+    logger.info(f"Worker {worker_id} exiting after {worker.requests} requests ({worker.reason})")
+    logging.shutdown()
+    if not worker.clean:
+        # 仍有背景執行緒 (例如月報 job) 未結束，不等待它們
+        os._exit(EXIT_OK)
+    sys.exit(EXIT_OK)
+
+
+# ---------------------------------------------------------------------------
+# Master
+# ---------------------------------------------------------------------------
+
+class _Slot:
+    def __init__(self, worker_id):
+        self.worker_id = worker_id
+        self.process = None
+        self.stop_event = None
+        self.started_at = 0.0
+        self.failures = 0           # 連續快速崩潰次數
+        self.restart_at = 0.0
+
+
+class Master:
+    def __init__(self, app, host='0.0.0.0', port=8080, workers=2, threads=6, max_requests=0,
+                 max_memory_mb=0, graceful_timeout=30, on_worker_start=None, on_drain=None, **waitress_options):
+        """
+        app: 'package.module:attr' (每個 worker 自行 import)。
+        on_worker_start(threads) / on_drain(timeout) 必須可 pickle (模組層級的函式)。
+        """
+        self.host = host
+        self.port = port
+        self.options = {
+            'app': app,
+            'threads': threads,
+            'max_requests': max_requests,
+            'max_memory_mb': max_memory_mb,
+            'graceful_timeout': graceful_timeout,
+            'on_worker_start': on_worker_start,
+            'on_drain': on_drain,
+            'waitress': waitress_options,
+        }
+        self.slots = [_Slot(i + 1) for i in range(max(1, workers))]
+        self.ctx = multiprocessing.get_context('spawn')
+        self.sock = None
+        self._stopping = threading.Event()
+
+    def listen(self):
+        self.sock = socket.create_server((self.host, self.port), backlog=1024)
+        self.port = self.sock.getsockname()[1]
+        return self.sock
+
+    def _spawn(self, slot):
+        slot.stop_event = self.ctx.Event()
+        slot.process = self.ctx.Process(target=_worker_main, name=f'web-worker-{slot.worker_id}',
+                                        args=(slot.worker_id, self.sock, self.options, slot.stop_event))
+        slot.process.start()
+        slot.started_at = time.monotonic()
+        logger.info(f"Started worker {slot.worker_id} (pid {slot.process.pid})")
+
+    def _reap(self, slot):
+        """worker 已結束: 決定何時重新啟動"""
+        code = slot.process.exitcode
+        lifetime = time.monotonic() - slot.started_at
+        slot.process = None
+        if code == EXIT_OK:
+            logger.info(f"Worker {slot.worker_id} recycled after {lifetime:.0f}s")
+            slot.failures = 0
+            slot.restart_at = 0.0
+            return
+        slot.failures = slot.failures + 1 if lifetime < CRASH_WINDOW_SECONDS else 1
+        delay = min(MAX_RESTART_DELAY, 0.5 * 2 ** (slot.failures - 1)) if lifetime < CRASH_WINDOW_SECONDS else 0
+        slot.restart_at = time.monotonic() + delay
+        logger.warning(f"Worker {slot.worker_id} exited with code {code} after {lifetime:.1f}s; "
+                       f"restarting in {delay:.1f}s")
+
+    def stop(self):
+        self._stopping.set()
+
+    def run(self):
+        if self.sock is None:
+            self.listen()
+        self._install_signals()
+        logger.info(f"Listening on http://{self.host}:{self.port} with {len(self.slots)} workers")
+        try:
+            while not self._stopping.is_set():
+                now = time.monotonic()
+                for slot in self.slots:
+                    if slot.process is not None and not slot.process.is_alive():
+                        slot.process.join()
+                        self._reap(slot)
+                    if slot.process is None and now >= slot.restart_at:
+                        self._spawn(slot)
+                self._stopping.wait(0.5)
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        running = [slot for slot in self.slots if slot.process is not None]
+        logger.info(f"Stopping {len(running)} workers (graceful timeout {self.options['graceful_timeout']}s)")
+        for slot in running:
+            slot.stop_event.set()
+        deadline = time.monotonic() + self.options['graceful_timeout'] + 5
+        for slot in running:
+            slot.process.join(max(0.0, deadline - time.monotonic()))
+            if slot.process.is_alive():
+                logger.warning(f"Worker {slot.worker_id} did not stop in time; terminating")
+                slot.process.terminate()
+                slot.process.join(5)
+            slot.process = None
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def _install_signals(self):
+        if threading.current_thread() is not threading.main_thread():
+            return
+
+        def handle(signum, frame):
+            logger.info(f"Received signal {signum}, shutting down")
+            self.stop()
+        signal.signal(signal.SIGINT, handle)
+        if hasattr(signal, 'SIGTERM'):
+            signal.signal(signal.SIGTERM, handle)
+        if hasattr(signal, 'SIGBREAK'):
+            signal.signal(signal.SIGBREAK, handle)
+
+
+def serve(app, **kwargs):
+    Master(app, **kwargs).run()
@@ -0,0 +1,335 @@
+"""
+隨選效能分析 (On-demand profiler)
+
+開發者在 developer_dashboard 啟用，不需要把資料複製回本機重現:
+  - arm(endpoint, count, mode): 分析接下來 count 個打到該 endpoint 的請求
+  - set_sample_rate(rate, mode): 以 rate (0~1) 的機率抽樣所有請求
+  - 目標 'monthly_job' 代表月報背景工作 (api_generate_monthly 只負責排入佇列)
+mode:
+  - 'cprofile': cProfile，可下載 .prof (pstats) 或文字摘要
+  - 'sampling': 每 PROFILE_SAMPLE_MS 擷取該執行緒的堆疊，輸出 collapsed stack (flamegraph.pl / speedscope)
+未啟用時每個請求只多一次布林判斷。結果存在 work_assistant/profiles/，保留最新 PROFILES_KEEP 份。
+"""
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+
+from flask import g, request
+from flask_login import current_user
+
+try:
+    import file_store
+except ImportError:
+    from . import file_store
+
+logger = logging.getLogger(__name__)
+
+PROFILES_DIR = os.path.join('work_assistant', 'profiles')
+PROFILES_INDEX = 'index.json'
+PROFILES_KEEP = 50
+SAMPLE_INTERVAL = int(os.getenv('PROFILE_SAMPLE_MS', '5')) / 1000.0
+MODES = ('cprofile', 'sampling')
+BACKGROUND_TARGETS = ('monthly_job',)
+
+_lock = threading.Lock()
+_targets = {}                       # endpoint -> {'remaining': n, 'mode': m}
+_sampling = {'rate': 0.0, 'mode': 'sampling'}
+_armed = False                      # 快速路徑: 未啟用時 before_request 直接返回
+# 同時只跑一個 cProfile (Python 3.12 起 cProfile 使用全域的 sys.monitoring)
+_cprofile_lock = threading.Lock()
+
+
+def _refresh_armed():
+    global _armed
+    _armed = bool(_targets) or _sampling['rate'] > 0
+
+
+def _check_mode(mode):
+    if mode not in MODES:
+        raise ValueError(f"Unknown profiler mode: {mode}")
+
+
+def arm(endpoint, count, mode='cprofile'):
+    _check_mode(mode)
+    count = int(count)
+    if count < 1:
+        raise ValueError("count must be at least 1")
+    with _lock:
+        _targets[endpoint] = {'remaining': count, 'mode': mode}
+        _refresh_armed()
+
+
+def set_sample_rate(rate, mode='sampling'):
+    _check_mode(mode)
+    rate = float(rate)
+    if not 0 <= rate <= 1:
+        raise ValueError("rate must be between 0 and 1")
+    with _lock:
+        _sampling.update(rate=rate, mode=mode)
+        _refresh_armed()
+
+
+def disarm(endpoint=None):
+    """endpoint 為 None 時全部停用"""
+    with _lock:
+        if endpoint is None:
+            _targets.clear()
+            _sampling['rate'] = 0.0
+        else:
+            _targets.pop(endpoint, None)
+        _refresh_armed()
+
+
+def status():
+    with _lock:
+        return {
+            'armed': _armed,
+            'targets': {k: dict(v) for k, v in _targets.items()},
+            'sampling': dict(_sampling),
+        }
+
+
+def _claim(target):
+    """這次執行是否要分析；是的話回傳 mode 並扣掉剩餘次數"""
+    if not _armed:
+        return None
+    with _lock:
+        spec = _targets.get(target)
+        if spec is not None:
+            mode = spec['mode']
+            if mode == 'cprofile' and not _cprofile_lock.acquire(blocking=False):
+                return None     # 已有 cProfile 在跑，留給下一個請求
+            spec['remaining'] -= 1
+            if spec['remaining'] <= 0:
+                del _targets[target]
+                _refresh_armed()
+            return mode
+        if _sampling['rate'] > 0 and random.random() < _sampling['rate']:
+            mode = _sampling['mode']
+            if mode == 'cprofile' and not _cprofile_lock.acquire(blocking=False):
+                return None
+            return mode
+    return None
+
+
+# ---------------------------------------------------------------------------
+# Stack sampler
+# ---------------------------------------------------------------------------
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class _Sampler:
+    """單一背景執行緒，輪流擷取所有登記中執行緒的堆疊"""
+
+    def __init__(self):
+        self._stacks = {}       # thread id -> Counter(collapsed stack -> samples)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self, thread_id):
+        with self._lock:
+            self._stacks[thread_id] = Counter()
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='profiler-sampler', daemon=True)
+                self._thread.start()
+
+    def stop(self, thread_id):
+        with self._lock:
+            return self._stacks.pop(thread_id, Counter())
+
+    def _run(self):
+        me = threading.get_ident()
+        while True:
+            with self._lock:
+                if not self._stacks:
+                    self._thread = None
+                    return
+                frames = sys._current_frames()
+                for thread_id, counter in self._stacks.items():
+                    frame = frames.get(thread_id)
+                    stack = []
+                    while frame is not None:
+                        stack.append(_frame_label(frame))
+                        frame = frame.f_back
+                    if stack and thread_id != me:
+                        counter[';'.join(reversed(stack))] += 1
+            time.sleep(SAMPLE_INTERVAL)
+
+
+_sampler = _Sampler()
+
+
+# ---------------------------------------------------------------------------
+# Storage
+# ---------------------------------------------------------------------------
+
+def profiles_dir():
+    return os.path.abspath(PROFILES_DIR)
+
+
+def _load_index():
+    path = os.path.join(profiles_dir(), PROFILES_INDEX)
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            try:
+                return json.load(f)
+            except json.JSONDecodeError:
+                pass
+    return []
+
+
+def _save_index(index):
+    file_store.write_json(os.path.join(profiles_dir(), PROFILES_INDEX), index, indent=4)
+
+
+def _data_filename(meta):
+    return f"{meta['id']}.prof" if meta['mode'] == 'cprofile' else f"{meta['id']}.folded"
+
+
+def _store(meta, write):
+    folder = profiles_dir()
+    os.makedirs(folder, exist_ok=True)
+    write(os.path.join(folder, _data_filename(meta)))
+    # index 由所有 worker process 共用
+    with _lock, file_store.lock(os.path.join(folder, PROFILES_INDEX)):
+        index = _load_index()
+        index.append(meta)
+        for old in index[:-PROFILES_KEEP]:
+            try:
+                os.remove(os.path.join(folder, _data_filename(old)))
+            except OSError:
+                pass
+        _save_index(index[-PROFILES_KEEP:])
+
+
+def list_profiles():
+    with _lock:
+        return list(reversed(_load_index()))
+
+
+def get_profile(profile_id):
+    """回傳 (meta, 檔案路徑)，找不到為 (None, None)"""
+    for meta in list_profiles():
+        if meta['id'] == profile_id:
+            path = os.path.join(profiles_dir(), _data_filename(meta))
+            return (meta, path) if os.path.exists(path) else (None, None)
+    return None, None
+
+
+def pstats_text(path, limit=60):
+    out = io.StringIO()
+    stats = pstats.Stats(path, stream=out)
+    stats.sort_stats('cumulative').print_stats(limit)
+    return out.getvalue()
+
+
+# ---------------------------------------------------------------------------
+# Capture
+# ---------------------------------------------------------------------------
+
+class _Session:
+    def __init__(self, target, mode, meta):
+        self.meta = dict(meta, id=uuid.uuid4().hex[:12], target=target, mode=mode,
+                         created_at=datetime.now().isoformat(timespec='seconds'))
+        self.mode = mode
+        self._profile = None
+        self._thread_id = threading.get_ident()
+
+    def start(self):
+        self._start = time.perf_counter()
+        if self.mode == 'cprofile':
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        else:
+            _sampler.start(self._thread_id)
+
+    def finish(self):
+        try:
+            if self.mode == 'cprofile':
+                self._profile.disable()
+            else:
+                stacks = _sampler.stop(self._thread_id)
+        finally:
+            if self.mode == 'cprofile':
+                _cprofile_lock.release()
+        self.meta['seconds'] = round(time.perf_counter() - self._start, 4)
+        try:
+            if self.mode == 'cprofile':
+                _store(self.meta, self._profile.dump_stats)
+            else:
+                self.meta['samples'] = sum(stacks.values())
+
+                def write(path):
+                    with open(path, 'w', encoding='utf-8') as f:
+                        for stack, count in stacks.most_common():
+                            f.write(f"{stack} {count}\n")
+                _store(self.meta, write)
+        except Exception as e:
+            logger.error(f"Failed to store profile {self.meta['id']}: {e}")
+
+
+def _begin(target, meta):
+    mode = _claim(target)
+    if mode is None:
+        return None
+    session = _Session(target, mode, meta)
+    session.start()
+    return session
+
+
+@contextmanager
+def capture(target, **meta):
+    """背景工作用: 目標已啟用時分析 with 區塊內的執行"""
+    session = _begin(target, meta)
+    try:
+        yield session
+    finally:
+        if session is not None:
+            session.finish()
+
+
+# ---------------------------------------------------------------------------
+# Flask integration
+# ---------------------------------------------------------------------------
+
+def _before_request():
+    if not _armed or request.endpoint is None:
+        return
+    user = current_user.get_id() if current_user.is_authenticated else None
+    g._profile_session = _begin(request.endpoint, {'method': request.method,
+                                                   'path': request.full_path.rstrip('?'), 'user': user})
+
+
+def _after_request(response):
+    session = g.get('_profile_session')
+    if session is not None:
+        session.meta['status'] = response.status_code
+    return response
+
+
+def _teardown_request(exc):
+    session = g.pop('_profile_session', None)
+    if session is not None:
+        if exc is not None:
+            session.meta.setdefault('status', 500)
+        session.finish()
+
+
+def init_app(app):
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
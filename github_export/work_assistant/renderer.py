@@ -0,0 +1,122 @@
+"""
+Excel 儲存格標籤渲染器 (Compiled single-pass renderer)
+
+一次編譯專案參數 (名稱 -> 型別轉換函式)，之後每個儲存格只做一次正則掃描，
+透過 dict 解析所有 {{ name }} 標籤。generate_document 與 api_generate_monthly 共用。
+"""
+import re
+
+# {{ name }} / {{name}} — 與 create_template 產生的格式相容
+TAG_PATTERN = re.compile(r"\{\{\s*([^{}\s]+)\s*\}\}")
+
+
+def to_number(val):
+    """統一的數字轉換: '12' -> 12, '-3.5' -> -3.5, '1,200' -> 1200。無法轉換則回傳原值。"""
+    if isinstance(val, (int, float)) or val is None:
+        return val
+    text = str(val).strip().replace(',', '')
+    if not text:
+        return val
+    try:
+        return int(text)
+    except ValueError:
+        pass
+    try:
+        number = float(text)
+    except ValueError:
+        return val
+    # 'nan' / 'inf' 之類的字串不當成數字
+    if number != number or number in (float('inf'), float('-inf')):
+        return val
+    return number
+
+
+def to_text(val):
+    return "" if val is None else val
+
+
+PLAIN_NUMBER = re.compile(r"-?[0-9]+(\.[0-9]+)?")
+
+
+def to_plain_number(val):
+    """舊行為: 只有純數字 ('12', '-3.5') 轉成數字；'1,2'、'1e3' 之類維持原字串"""
+    if val is None:
+        return ""
+    if not isinstance(val, str):
+        return val
+    text = val.strip()
+    if not PLAIN_NUMBER.fullmatch(text):
+        return val
+    return float(text) if '.' in text else int(text)
+
+
+# 型別 -> 轉換函式 (僅在儲存格內容「完全等於」標籤時套用)
+# 只有 number 型別做完整的數字轉換 (含千分位)；文字原樣寫入；
+# 未列出的型別 (舊專案、未定義型別的 context key) 沿用舊行為，只轉換純數字。
+COERCERS = {
+    'number': to_number,
+    'string': to_text,
+    'image': to_text,
+    'date': to_text,
+}
+DEFAULT_COERCER = to_plain_number
+
+
+def compile_coercers(parameters):
+    """依專案 parameters 的 type 預先決定每個變數的轉換函式"""
+    coercers = {}
+    for param in parameters or []:
+        name = param.get('name')
+        if name:
+            coercers[name] = COERCERS.get(param.get('type'), DEFAULT_COERCER)
+    return coercers
+
+
+class CellRenderer:
+    """預先編譯好的渲染器；同一個專案可重複用於多張工作表/多筆資料"""
+
+    def __init__(self, parameters):
+        self.coercers = compile_coercers(parameters)
+
+    def render_value(self, value, context):
+        """回傳渲染後的值；沒有標籤時原樣回傳 (同一物件)"""
+        if not isinstance(value, str) or '{{' not in value:
+            return value
+
+        # 整格就是一個標籤 -> 套用型別轉換
+        exact = TAG_PATTERN.fullmatch(value.strip())
+        if exact:
+            key = exact.group(1)
+            if key not in context:
+                return value
+            coerce = self.coercers.get(key, DEFAULT_COERCER)
+            return coerce(context[key])
+
+        def _sub(match):
+            key = match.group(1)
+            if key not in context:
+                return match.group(0)
+            val = context[key]
+            return "" if val is None else str(val)
+
+        return TAG_PATTERN.sub(_sub, value)
+
+    def render_sheet(self, sheet, context):
+        """單次掃描整張工作表；回傳被修改的儲存格數量"""
+        changed = 0
+        render_value = self.render_value
+        for row in sheet.iter_rows():
+            for cell in row:
+                value = cell.value
+                if isinstance(value, str) and '{{' in value:
+                    new_value = render_value(value, context)
+                    if new_value is not value:
+                        cell.value = new_value
+                        changed += 1
+        return changed
+
+    def render_workbook(self, wb, context):
+        changed = 0
+        for sheet in wb.worksheets:
+            changed += self.render_sheet(sheet, context)
+        return changed
@@ -0,0 +1,160 @@
+"""
+報表期間 (Report periods)
+
+月報只包含所選期間的 entry: 月 (month=YYYY-MM)、週 (week=YYYY-Www，ISO 週) 或自訂區間 (start/end)。
+已結束的期間 (end 早於今天) 視為「已關帳」，產生的報表會封存在
+projects/<id>/archives/，之後除非該期間的 entry 有變更，否則直接回傳封存檔不再重新產生。
+"""
+import hashlib
+import json
+import os
+import shutil
+import uuid
+from datetime import date, datetime, timedelta
+
+try:
+    import database
+    import file_store
+except ImportError:
+    from . import database
+    from . import file_store
+
+ARCHIVES_DIR_NAME = 'archives'
+ARCHIVE_INDEX = 'index.json'
+PERIOD_KINDS = ('month', 'week', 'range')
+
+
+class Period:
+    def __init__(self, kind, start, end, label):
+        self.kind = kind
+        self.start = start      # date (含)
+        self.end = end          # date (含)
+        self.label = label      # 用於檔名與封存 key，例如 202610 / 2026-W42 / 20261001-20261015
+
+    def is_closed(self, today=None):
+        return self.end < (today or date.today())
+
+    def to_dict(self):
+        return {'kind': self.kind, 'start': self.start.isoformat(), 'end': self.end.isoformat(),
+                'label': self.label}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['kind'], date.fromisoformat(data['start']), date.fromisoformat(data['end']), data['label'])
+
+
+def _parse_date(text, field):
+    try:
+        return datetime.strptime(str(text).strip(), '%Y-%m-%d').date()
+    except ValueError:
+        raise ValueError(f"Invalid {field}: {text} (expected YYYY-MM-DD)")
+
+
+def month_period(year, month):
+    start = date(year, month, 1)
+    next_month = date(year + (month == 12), month % 12 + 1, 1)
+    return Period('month', start, next_month - timedelta(days=1), start.strftime('%Y%m'))
+
+
+def parse_period(values, today=None):
+    """
+    values: request 參數 (period, month, week, start, end)。
+    未指定時為本月，與舊版檔名 {name}_月報_{%Y%m} 相同。格式錯誤拋出 ValueError。
+    """
+    today = today or date.today()
+    kind = (values.get('period') or 'month').strip().lower()
+    if kind not in PERIOD_KINDS:
+        raise ValueError(f"Unknown period: {kind}")
+
+    if kind == 'month':
+        text = values.get('month')
+        if not text:
+            return month_period(today.year, today.month)
+        try:
+            parsed = datetime.strptime(str(text).strip(), '%Y-%m')
+        except ValueError:
+            raise ValueError(f"Invalid month: {text} (expected YYYY-MM)")
+        return month_period(parsed.year, parsed.month)
+
+    if kind == 'week':
+        text = values.get('week')
+        if text:
+            try:
+                year, week = str(text).strip().upper().split('-W')
+                start = date.fromisocalendar(int(year), int(week), 1)
+            except ValueError:
+                raise ValueError(f"Invalid week: {text} (expected YYYY-Www)")
+        else:
+            start = today - timedelta(days=today.weekday())
+        iso = start.isocalendar()
+        return Period('week', start, start + timedelta(days=6), f"{iso[0]}-W{iso[1]:02d}")
+
+    start = _parse_date(values.get('start'), 'start')
+    end = _parse_date(values.get('end'), 'end')
+    if end < start:
+        raise ValueError("Period end is before start")
+    return Period('range', start, end, f"{start.strftime('%Y%m%d')}-{end.strftime('%Y%m%d')}")
+
+
+def entries_digest(entries):
+    """期間內 entry 的內容摘要；封存的報表只在這個值改變時才重新產生"""
+    payload = sorted(((e.get('id'), e.get('date'), e.get('data')) for e in entries), key=lambda x: str(x[0]))
+    return hashlib.sha1(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+# ---------------------------------------------------------------------------
+# Archives of closed periods
+# ---------------------------------------------------------------------------
+
+def archives_dir(project_id):
+    return os.path.abspath(os.path.join(database.PROJECTS_DIR, project_id, ARCHIVES_DIR_NAME))
+
+
+def archive_path(project_id, label):
+    return os.path.join(archives_dir(project_id), f"{label}.xlsx")
+
+
+def load_archive_index(project_id):
+    path = os.path.join(archives_dir(project_id), ARCHIVE_INDEX)
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            try:
+                return json.load(f)
+            except json.JSONDecodeError:
+                pass
+    return {}
+
+
+def get_archive(project_id, label, key):
+    """cache key 相同 (期間內 entry 未變更) 的封存報表路徑，沒有則 None"""
+    path = archive_path(project_id, label)
+    with file_store.lock(os.path.join(archives_dir(project_id), ARCHIVE_INDEX)):
+        meta = load_archive_index(project_id).get(label)
+        if meta and meta.get('key') == key and os.path.exists(path):
+            return path
+    return None
+
+
+def store_archive(project_id, period, key, source_path, entry_count):
+    """
+    把已關帳期間的報表複製到封存區並更新 index。
+    複製到暫存檔在鎖外進行；rename 與 index 更新在同一個 index 鎖內，
+    讀取端 (get_archive) 不會看到新檔案配上舊的 key。
+    """
+    folder = archives_dir(project_id)
+    os.makedirs(folder, exist_ok=True)
+    final_path = archive_path(project_id, period.label)
+    tmp_path = f"{final_path}.{uuid.uuid4().hex}.tmp"
+    index_path = os.path.join(folder, ARCHIVE_INDEX)
+    try:
+        shutil.copyfile(source_path, tmp_path)
+        with file_store.lock(index_path):
+            file_store.replace(tmp_path, final_path)
+            index = load_archive_index(project_id)
+            index[period.label] = dict(period.to_dict(), key=key, entries=entry_count,
+                                       archived_at=datetime.now().isoformat(timespec='seconds'))
+            file_store.write_json(index_path, index, indent=4)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return final_path
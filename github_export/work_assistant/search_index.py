@@ -0,0 +1,424 @@
+"""
+全文檢索 (Inverted full-text index)
+
+索引專案名稱/說明與 entry 的文字欄位 (照片欄除外)，供 /api/search 查詢:
+  - 斷詞: NFKC 正規化 + 小寫；中日韓文字以字元 bigram (另加單字元) 索引，其餘以連續英數字為一個詞
+  - 倒排索引 (詞 -> {文件: 詞頻}) 常駐記憶體，查詢為 AND 語意，以 BM25 排序，可依專案與日期範圍篩選
+  - 每個專案一個 segment，存在 projects/<id>/search_index.json (每份文件的詞頻與原文)，
+    重啟或其他 worker process 載入後不必重新斷詞
+  - 增量更新: segment 記錄索引時的 entries / config 版本，之後以 database.get_entry_changes
+    只重新索引新增/修改/刪除的 entry (異動紀錄已清除時才整個專案重建)
+  - entry 寫入後由 schedule_refresh() 在背景更新；查詢前也會檢查版本 (每 SYNC_SECONDS 秒最多一次)，
+    其他 worker process 寫入的資料最晚 SYNC_SECONDS 秒後可查到
+"""
+import bisect
+import heapq
+import logging
+import math
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import defaultdict
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import database
+    import file_store
+    import metrics
+except ImportError:
+    from . import database
+    from . import file_store
+    from . import metrics
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_FILE = 'search_index.json'
+SEGMENT_FORMAT = 1
+SYNC_SECONDS = float(os.getenv('SEARCH_SYNC_SECONDS', '1'))
+SNIPPET_CHARS = 80
+# BM25 參數；專案名稱的詞頻加權 (名稱命中排在說明命中之前)
+BM25_K1 = 1.2
+BM25_B = 0.75
+TITLE_WEIGHT = 2
+
+_CJK = '\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff'
+CJK_PATTERN = re.compile(f'[{_CJK}]')
+TOKEN_PATTERN = re.compile(f'[{_CJK}]+|[^\\W_{_CJK}]+')
+
+
+def normalize(text):
+    return unicodedata.normalize('NFKC', str(text)).lower()
+
+
+def tokenize(text, query=False):
+    """
+    文件: 中日韓文字產生單字元 + bigram，英數字整個詞。
+    查詢: 中日韓文字長度 >= 2 時只用 bigram (單字元只用於單一字的查詢)。
+    """
+    tokens = []
+    for run in TOKEN_PATTERN.findall(normalize(text)):
+        if CJK_PATTERN.match(run):
+            bigrams = [run[i:i + 2] for i in range(len(run) - 1)]
+            if query:
+                tokens.extend(bigrams or [run])
+            else:
+                tokens.extend(run)
+                tokens.extend(bigrams)
+        else:
+            tokens.append(run)
+    return tokens
+
+
+def _term_frequencies(tokens, weight=1):
+    tf = {}
+    for token in tokens:
+        tf[token] = tf.get(token, 0) + weight
+    return tf
+
+
+def project_document(config):
+    name = config.get('name') or ''
+    description = config.get('description') or ''
+    tf = _term_frequencies(tokenize(name), TITLE_WEIGHT)
+    for token, n in _term_frequencies(tokenize(description)).items():
+        tf[token] = tf.get(token, 0) + n
+    return {'kind': 'project', 'date': (config.get('created_at') or '')[:10], 'title': name,
+            'text': f"{name}\n{description}".strip(), 'tf': tf}
+
+
+def entry_document(entry, text_fields):
+    data = entry.get('data') or {}
+    fields = text_fields if text_fields is not None else list(data)
+    values = [str(data[name]).strip() for name in fields
+              if isinstance(data.get(name), (str, int, float)) and str(data[name]).strip()]
+    text = '\n'.join(values)
+    return {'kind': 'entry', 'date': (entry.get('date') or entry.get('created_at') or '')[:10],
+            'title': values[0][:SNIPPET_CHARS] if values else '', 'text': text, 'tf': _term_frequencies(tokenize(text))}
+
+
+def _text_fields(config):
+    """照片欄以外的參數名稱；沒有參數定義時索引所有文字值"""
+    parameters = (config or {}).get('parameters')
+    if not parameters:
+        return None
+    return [p['name'] for p in parameters if p.get('type') != 'image']
+
+
+class SearchIndex:
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._postings = defaultdict(dict)    # token -> {doc key: tf}
+        self._docs = {}                       # (project_id, entry_id | None) -> document
+        self._by_project = defaultdict(set)   # project_id -> doc keys
+        self._total_len = 0
+        # token -> {doc key: BM25 詞頻項 (不含 idf)}，隨文件增刪同步更新；平均長度偏移過大時全部重算
+        self._weights = {}
+        self._weights_avg_len = None
+        # token -> ([-詞頻項 (遞增)], [doc key])：單詞查詢直接取前 limit 筆，文件增刪時以 bisect 維護
+        self._ranked = {}
+        self._segments = {}                   # project_id -> {'entries': v, 'config': v}
+        self._synced = 0.0
+
+    # --- 文件增刪 ---
+    def _add(self, key, doc):
+        self._remove(key)
+        doc['len'] = sum(doc['tf'].values())
+        self._docs[key] = doc
+        self._by_project[key[0]].add(key)
+        self._total_len += doc['len']
+        for token, n in doc['tf'].items():
+            self._postings[token][key] = n
+            weights = self._weights.get(token)
+            if weights is not None:
+                weight = weights[key] = self._weight(n, doc['len'])
+                ranked = self._ranked.get(token)
+                if ranked is not None:
+                    pos = bisect.bisect_right(ranked[0], -weight)
+                    ranked[0].insert(pos, -weight)
+                    ranked[1].insert(pos, key)
+
+    def _remove(self, key):
+        doc = self._docs.pop(key, None)
+        if doc is None:
+            return
+        keys = self._by_project.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_project[key[0]]
+        self._total_len -= doc['len']
+        for token in doc['tf']:
+            weights = self._weights.get(token)
+            if weights is not None:
+                weight = weights.pop(key)
+                ranked = self._ranked.get(token)
+                if ranked is not None:
+                    pos = bisect.bisect_left(ranked[0], -weight)
+                    while ranked[1][pos] != key:
+                        pos += 1
+                    del ranked[0][pos], ranked[1][pos]
+            postings = self._postings[token]
+            del postings[key]
+            if not postings:
+                del self._postings[token]
+                self._weights.pop(token, None)
+                self._ranked.pop(token, None)
+
+    def _drop_project(self, project_id):
+        for key in list(self._by_project.get(project_id, ())):
+            self._remove(key)
+        self._segments.pop(project_id, None)
+
+    # --- segment 載入 / 更新 / 保存 ---
+    def _segment_path(self, project_id):
+        return os.path.join(database.PROJECTS_DIR, project_id, SEGMENT_FILE)
+
+    def _load_segment(self, project_id):
+        saved = file_store.read_json(self._segment_path(project_id), None)
+        if not saved or saved.get('format') != SEGMENT_FORMAT:
+            return False
+        for entry_id, doc in saved['docs'].items():
+            self._add((project_id, entry_id or None), doc)
+        self._segments[project_id] = {'entries': saved['entries'], 'config': saved['config']}
+        return True
+
+    def _save_segment(self, project_id):
+        docs = {key[1] or '': {k: v for k, v in doc.items() if k != 'len'}
+                for key, doc in self._docs.items() if key[0] == project_id}
+        state = self._segments[project_id]
+        try:
+            file_store.write_json(self._segment_path(project_id),
+                                  {'format': SEGMENT_FORMAT, 'entries': state['entries'],
+                                   'config': state['config'], 'docs': docs})
+        except OSError as e:
+            # 專案剛被刪除之類；下次查詢時再處理
+            logger.warning(f"Cannot save search segment for {project_id}: {e}")
+
+    def refresh(self, project_id):
+        """把專案的索引更新到目前的 entries / config 版本；回傳是否有變更"""
+        with self._lock:
+            if not os.path.exists(os.path.join(database.PROJECTS_DIR, project_id, 'config.json')):
+                had = project_id in self._segments
+                self._drop_project(project_id)
+                return had
+            versions = database.get_project_versions(project_id)
+            if project_id not in self._segments and not self._load_segment(project_id):
+                self._segments[project_id] = {'entries': None, 'config': None}
+            state = self._segments[project_id]
+            if state == versions:
+                return False
+
+            started = time.perf_counter()
+            config = database.get_project_config(project_id) or {}
+            rebuild = state['entries'] is None or state['config'] != versions['config']
+            changes = None if rebuild else database.get_entry_changes(project_id, state['entries'], versions['entries'])
+            if changes is None:
+                # 第一次索引、參數定義變更 (文字欄位可能不同) 或異動紀錄已清除: 整個專案重建
+                self._drop_project(project_id)
+                self._add((project_id, None), project_document(config))
+                ids = None
+            else:
+                for entry_id in changes['deleted']:
+                    self._remove((project_id, entry_id))
+                ids = set(changes['added']) | set(changes['updated'])
+
+            count = 0
+            if ids is None or ids:
+                fields = _text_fields(config)
+                for entry in database.get_project_entries(project_id):
+                    entry_id = entry.get('id')
+                    if entry_id and (ids is None or entry_id in ids):
+                        self._add((project_id, entry_id), entry_document(entry, fields))
+                        count += 1
+            self._segments[project_id] = versions
+            self._save_segment(project_id)
+            metrics.SEARCH_INDEX_UPDATES.inc(kind='rebuild' if ids is None else 'incremental')
+            logger.info(f"Search index {'rebuilt' if ids is None else 'updated'} for {project_id}: "
+                        f"{count} entries in {(time.perf_counter() - started) * 1000:.0f} ms")
+            return True
+
+    def sync(self, force=False):
+        """檢查所有專案的版本 (最多每 SYNC_SECONDS 秒一次)，把其他行程的寫入與新增/刪除的專案同步進來"""
+        now = time.monotonic()
+        if not force and now - self._synced < SYNC_SECONDS:
+            return
+        self._synced = now
+        try:
+            project_ids = set(os.listdir(database.PROJECTS_DIR))
+        except OSError:
+            project_ids = set()
+        with self._lock:
+            for project_id in set(self._segments) - project_ids:
+                self._drop_project(project_id)
+        for project_id in sorted(project_ids):
+            if os.path.isdir(os.path.join(database.PROJECTS_DIR, project_id)):
+                try:
+                    self.refresh(project_id)
+                except Exception as e:
+                    logger.error(f"Search index refresh failed for {project_id}: {e}")
+
+    # --- 查詢 ---
+    def search(self, query, project_ids=None, start=None, end=None, kind=None, limit=20):
+        """
+        AND 查詢並以 BM25 排序。project_ids: 只查這些專案；start/end: entry 日期範圍 (YYYY-MM-DD，含)；
+        kind: 'entry' | 'project'。回傳 (符合筆數, 前 limit 筆結果)
+        """
+        tokens = list(dict.fromkeys(tokenize(query, query=True)))
+        if not tokens:
+            return 0, []
+        with self._lock:
+            postings = [self._postings.get(token) for token in tokens]
+            if not all(postings):
+                return 0, []
+            order = sorted(range(len(tokens)), key=lambda i: len(postings[i]))
+            total_docs = len(self._docs)
+            idf = [math.log(1 + (total_docs - len(postings[i]) + 0.5) / (len(postings[i]) + 0.5)) for i in order]
+            weights = [self._term_weights(tokens[i]) for i in order]
+
+            # 最短的 postings 決定候選文件，其餘詞以 dict 查表 (AND)
+            first_idf, first = idf[0], weights[0]
+            candidates = first
+            project_ids = set(project_ids) if project_ids else None
+            if project_ids:
+                # 指定專案時從較小的一方 (專案文件 / postings) 出發
+                scoped = [self._by_project.get(project_id, ()) for project_id in project_ids]
+                if sum(len(keys) for keys in scoped) < len(first):
+                    candidates = [key for keys in scoped for key in keys if key in first]
+            if project_ids or kind or start or end:
+                candidates = [key for key in candidates if self._accept(key, project_ids, start, end, kind)]
+            if len(weights) == 1 and candidates is first:
+                # 單詞、無篩選: 排序結果依 token 快取，查詢只取前 limit 筆
+                total = len(first)
+                top = [(first_idf * first[key], key) for key in self._ranked_keys(tokens[order[0]], first)[:limit]]
+            elif len(weights) == 1:
+                total = len(candidates)
+                top = [(first_idf * first[key], key) for key in heapq.nlargest(limit, candidates, key=first.__getitem__)]
+            else:
+                scored = []
+                rest = list(zip(idf[1:], weights[1:]))
+                for key in candidates:
+                    score = first_idf * first[key]
+                    for weight, term in rest:
+                        value = term.get(key)
+                        if value is None:
+                            break
+                        score += weight * value
+                    else:
+                        scored.append((score, key))
+                total = len(scored)
+                top = heapq.nlargest(limit, scored, key=itemgetter(0))
+
+            results = []
+            for score, (project_id, entry_id) in top:
+                doc = self._docs[(project_id, entry_id)]
+                project = self._docs.get((project_id, None))
+                results.append({
+                    'kind': doc['kind'],
+                    'project_id': project_id,
+                    'project_name': project['title'] if project else project_id,
+                    'entry_id': entry_id,
+                    'date': doc['date'],
+                    'title': doc['title'],
+                    'snippet': snippet(doc['text'], query),
+                    'score': round(score, 4),
+                })
+            return total, results
+
+    def _accept(self, key, project_ids, start, end, kind):
+        if project_ids and key[0] not in project_ids:
+            return False
+        doc = self._docs[key]
+        if kind and doc['kind'] != kind:
+            return False
+        if doc['kind'] == 'entry' and ((start and doc['date'] < start) or (end and doc['date'] > end)):
+            return False
+        return True
+
+    def _term_weights(self, token):
+        """BM25 的詞頻項 tf * (k1 + 1) / (tf + k1 * (1 - b + b * len / avg_len))，依 token 快取"""
+        avg_len = self._total_len / (len(self._docs) or 1) or 1
+        if self._weights_avg_len is None or abs(avg_len - self._weights_avg_len) > 0.1 * self._weights_avg_len:
+            self._weights.clear()
+            self._ranked.clear()
+            self._weights_avg_len = avg_len
+        weights = self._weights.get(token)
+        if weights is None:
+            docs, weight = self._docs, self._weight
+            weights = {key: weight(tf, docs[key]['len']) for key, tf in self._postings[token].items()}
+            self._weights[token] = weights
+        return weights
+
+    def _weight(self, tf, length):
+        return tf * (BM25_K1 + 1) / (tf + BM25_K1 * (1 - BM25_B + BM25_B * length / self._weights_avg_len))
+
+    def _ranked_keys(self, token, weights):
+        ranked = self._ranked.get(token)
+        if ranked is None:
+            keys = sorted(weights, key=weights.__getitem__, reverse=True)
+            ranked = self._ranked[token] = ([-weights[key] for key in keys], keys)
+        return ranked[1]
+
+    def stats(self):
+        with self._lock:
+            return {'projects': len(self._segments), 'documents': len(self._docs), 'terms': len(self._postings)}
+
+
+def snippet(text, query):
+    """原文中第一個命中處前後的片段"""
+    normalized = normalize(text)
+    position = -1
+    for token in tokenize(query, query=True):
+        position = normalized.find(token)
+        if position >= 0:
+            break
+    begin = max(0, position - SNIPPET_CHARS // 2) if position >= 0 else 0
+    piece = text[begin:begin + SNIPPET_CHARS].replace('\n', ' ')
+    return ('…' if begin else '') + piece + ('…' if begin + SNIPPET_CHARS < len(text) else '')
+
+
+_index = SearchIndex()
+_refresher = ThreadPoolExecutor(max_workers=1, thread_name_prefix='search-index')
+_pending = set()
+_pending_lock = threading.Lock()
+
+
+def get_index():
+    return _index
+
+
+def search(query, **filters):
+    _index.sync()
+    return _index.search(query, **filters)
+
+
+def schedule_refresh(project_id):
+    """entry / 專案設定寫入後呼叫: 在背景更新該專案的索引 (同一專案排隊中的更新只做一次)"""
+    with _pending_lock:
+        if project_id in _pending:
+            return
+        _pending.add(project_id)
+
+    def run():
+        with _pending_lock:
+            _pending.discard(project_id)
+        try:
+            _index.refresh(project_id)
+        except Exception as e:
+            logger.error(f"Search index refresh failed for {project_id}: {e}")
+
+    _refresher.submit(run)
+
+
+def warm():
+    """server 啟動時在背景載入所有專案的 segment"""
+    _refresher.submit(_index.sync, True)
+
+
+@metrics.register_collector
+def _collect_search_metrics():
+    stats = _index.stats()
+    metrics.SEARCH_INDEX_DOCUMENTS.set(stats['documents'])
+    metrics.SEARCH_INDEX_TERMS.set(stats['terms'])
@@ -0,0 +1,178 @@
+"""
+工作表 XML 藍圖 (Sheet XML blueprint)
+
+月報每一張工作表都是「模板第一張工作表 + 一筆 entry 的資料」。
+與其每筆都用 openpyxl 載入整本活頁簿、填值、再存檔，
+這裡把模板工作表的 XML 預先切成「固定片段 + 含 {{ 標籤 }} 的儲存格」，
+渲染時只替換那幾個儲存格並附上照片的 drawing，直接產出 monthly_report 的片段格式。
+藍圖可 pickle，因此可以送到 worker process 平行渲染。
+"""
+import html
+import io
+import re
+from xml.sax.saxutils import escape, quoteattr
+
+from PIL import Image
+
+NS_DOC_REL = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+REL_DRAWING = f'{NS_DOC_REL}/drawing'
+REL_IMAGE = f'{NS_DOC_REL}/image'
+CT_DRAWING = 'application/vnd.openxmlformats-officedocument.drawing+xml'
+IMAGE_CONTENT_TYPES = {'png': 'image/png', 'jpeg': 'image/jpeg', 'gif': 'image/gif'}
+
+_CELL_RE = re.compile(rb'<c\b([^>]*?)(?:/>|>(.*?)</c>)', re.S)
+_T_RE = re.compile(rb'<t\b[^>]*>(.*?)</t>|<t\b[^>]*/>', re.S)
+# 與 openpyxl.cell.cell 相同 (worker process 渲染藍圖時不必載入 openpyxl)
+ERROR_CODES = ('#NULL!', '#DIV/0!', '#VALUE!', '#REF!', '#NAME?', '#NUM!', '#N/A')
+ILLEGAL_CHARACTERS_RE = re.compile(r'[\000-\010]|[\013-\014]|[\016-\037]')
+_TYPE_ATTR_RE = re.compile(rb'\s+t="[^"]*"')
+# drawing 之後才能出現的元素 (CT_Worksheet 的順序)
+_AFTER_DRAWING_RE = re.compile(
+    rb'<(?:legacyDrawing|legacyDrawingHF|drawingHF|picture|oleObjects|controls|webPublishItems|tableParts|extLst)\b'
+    rb'|</worksheet>')
+
+DRAWING_PART = 'xl/drawings/drawing1.xml'
+
+_PIC_XML = (
+    '<oneCellAnchor><from><col>{col}</col><colOff>{col_off}</colOff><row>{row}</row><rowOff>{row_off}</rowOff>'
+    '</from><ext cx="{cx}" cy="{cy}"/><pic><nvPicPr><cNvPr id="{n}" name="Image {n}" descr="Picture"/><cNvPicPr/>'
+    '</nvPicPr><blipFill><a:blip xmlns:a="http://schemas.openxmlformats.org/drawingml/2006/main" '
+    f'xmlns:r="{NS_DOC_REL}" cstate="print" r:embed="{{rid}}"/>'
+    '<a:stretch xmlns:a="http://schemas.openxmlformats.org/drawingml/2006/main"><a:fillRect/></a:stretch>'
+    '</blipFill><spPr><a:prstGeom xmlns:a="http://schemas.openxmlformats.org/drawingml/2006/main" prst="rect"/>'
+    '</spPr></pic><clientData/></oneCellAnchor>'
+)
+
+
+class UnsupportedTemplate(Exception):
+    """模板工作表的結構無法以 XML 藍圖渲染 (改用 openpyxl)"""
+
+
+def _cell_text(body):
+    """inlineStr 儲存格的純文字 (rich text 的多個 run 會合併，與 openpyxl 載入時相同)"""
+    return ''.join(html.unescape((m.group(1) or b'').decode('utf-8')) for m in _T_RE.finditer(body))
+
+
+def _number_xml(value):
+    return b'%.16g' % value
+
+
+class SheetBlueprint:
+    def __init__(self, fragment):
+        """fragment: monthly_report.extract_fragment 取出的模板工作表"""
+        for source, rel_list in fragment['rels'].items():
+            if any(rtype == REL_DRAWING for _, rtype, _, _ in rel_list):
+                # 模板本身已有圖片/圖表時，照片要併入既有 drawing；交給 openpyxl 處理
+                raise UnsupportedTemplate('Template sheet already contains a drawing')
+
+        self.sheet_part = fragment['sheet_part']
+        self.parts = fragment['parts']
+        self.content_types = fragment['content_types']
+        self.rels = fragment['rels']
+        self.styles_digest = fragment['styles_digest']
+
+        sheet_xml = fragment['sheet_xml']
+        self.segments = []   # 固定的 XML 片段 (bytes)
+        self.slots = []      # (原始 XML, 不含 t 的屬性, 儲存格文字)
+        pos = 0
+        for match in _CELL_RE.finditer(sheet_xml):
+            attrs, body = match.group(1), match.group(2) or b''
+            if b'{{' not in body:
+                continue
+            if b't="inlineStr"' not in attrs or b'<f' in body:
+                raise UnsupportedTemplate(f'Tagged cell is not a plain string: {attrs!r}')
+            self.segments.append(sheet_xml[pos:match.start()])
+            self.slots.append((match.group(0), _TYPE_ATTR_RE.sub(b'', attrs), _cell_text(body)))
+            pos = match.end()
+        self.segments.append(sheet_xml[pos:])
+
+    # --- cells ---
+
+    @staticmethod
+    def _cell_xml(attrs, value):
+        """與 openpyxl 寫出的儲存格格式相同"""
+        if value is None:
+            return b'<c' + attrs + b' t="n"/>'
+        if isinstance(value, (int, float)):
+            return b'<c' + attrs + b' t="n"><v>' + _number_xml(value) + b'</v></c>'
+
+        text = ILLEGAL_CHARACTERS_RE.sub('', str(value))[:32767]
+        if text.startswith('=') and len(text) > 1:
+            return b'<c' + attrs + b'><f>' + escape(text[1:]).encode('utf-8') + b'</f><v></v></c>'
+        if text in ERROR_CODES:
+            return b'<c' + attrs + b' t="e"><v>' + text.encode('utf-8') + b'</v></c>'
+        if text == '':
+            return b'<c' + attrs + b' t="inlineStr"/>'
+        stripped = text.strip()
+        space = b' xml:space="preserve"' if stripped and stripped != text else b''
+        return (b'<c' + attrs + b' t="inlineStr"><is><t' + space + b'>' + escape(text).encode('utf-8')
+                + b'</t></is></c>')
+
+    # --- render ---
+
+    def render(self, context, cell_renderer, pictures=()):
+        """
+        回傳片段 dict (與 monthly_report.extract_fragment 相同格式)。
+        pictures: [(image bytes, format, placement)]；placement 為 monthly_report.place_image 的結果。
+        """
+        out = [self.segments[0]]
+        for (original, attrs, text), tail in zip(self.slots, self.segments[1:]):
+            value = cell_renderer.render_value(text, context)
+            out.append(original if value is text else self._cell_xml(attrs, value))
+            out.append(tail)
+        sheet_xml = b''.join(out)
+
+        parts = dict(self.parts)
+        content_types = dict(self.content_types)
+        rels = {source: list(rel_list) for source, rel_list in self.rels.items()}
+
+        if pictures:
+            sheet_rels = rels.setdefault(self.sheet_part, [])
+            used = {rid for rid, _, _, _ in sheet_rels}
+            n = len(sheet_rels) + 1
+            while f'rId{n}' in used:
+                n += 1
+            drawing_rid = f'rId{n}'
+            sheet_rels.append((drawing_rid, REL_DRAWING, DRAWING_PART, None))
+
+            anchors, drawing_rels = [], []
+            for k, (data, fmt, placement) in enumerate(pictures, 1):
+                media = f'xl/media/image{k}.{fmt}'
+                parts[media] = data
+                content_types[media] = IMAGE_CONTENT_TYPES[fmt]
+                drawing_rels.append((f'rId{k}', REL_IMAGE, media, None))
+                anchors.append(_PIC_XML.format(
+                    col=placement['col0'], col_off=placement['off_x'],
+                    row=placement['row0'], row_off=placement['off_y'],
+                    cx=placement['cx'], cy=placement['cy'], n=k, rid=f'rId{k}'))
+            parts[DRAWING_PART] = (
+                '<wsDr xmlns="http://schemas.openxmlformats.org/drawingml/2006/spreadsheetDrawing">'
+                + ''.join(anchors) + '</wsDr>').encode('utf-8')
+            content_types[DRAWING_PART] = CT_DRAWING
+            rels[DRAWING_PART] = drawing_rels
+
+            drawing_el = f'<drawing xmlns:r="{NS_DOC_REL}" r:id={quoteattr(drawing_rid)}/>'.encode('utf-8')
+            at = _AFTER_DRAWING_RE.search(sheet_xml).start()
+            sheet_xml = sheet_xml[:at] + drawing_el + sheet_xml[at:]
+
+        return {
+            'sheet_part': self.sheet_part,
+            'sheet_xml': sheet_xml,
+            'parts': parts,
+            'content_types': content_types,
+            'rels': rels,
+            'styles_digest': self.styles_digest,
+        }
+
+
+def read_picture(img_path):
+    """回傳 (bytes, format, (width, height))；非 png/jpeg/gif 的圖片轉成 PNG (與 openpyxl 相同)"""
+    with Image.open(img_path) as im:
+        fmt = (im.format or 'png').lower()
+        size = im.size
+        if fmt in IMAGE_CONTENT_TYPES:
+            with open(img_path, 'rb') as f:
+                return f.read(), fmt, size
+        buf = io.BytesIO()
+        im.save(buf, format='png')
+        return buf.getvalue(), 'png', size
@@ -111,7 +111,10 @@ document.addEventListener('DOMContentLoaded', () => {
     const loadingIcon = document.getElementById('loadingIcon');
     const btnText = document.getElementById('btnText');
 
-    btnAnalyze.addEventListener('click', () => {
+    btnAnalyze.addEventListener('click', () => runAnalysis(false));
+
+    // force: skip the template fingerprint registry and run the full AI analysis
+    function runAnalysis(force) {
         if (!uploadedFiles.A) {
             alert('請至少上傳範本檔案 (Zone A)');
             return;
@@ -125,7 +128,8 @@ document.addEventListener('DOMContentLoaded', () => {
         const payload = {
             template_file_id: uploadedFiles.A.id,
             excel_file_id: uploadedFiles.C?.id,
-            old_doc_file_id: uploadedFiles.B?.id
+            old_doc_file_id: uploadedFiles.B?.id,
+            force_analysis: force
         };
 
         fetch('/api/analyze', {
@@ -143,7 +147,7 @@ document.addEventListener('DOMContentLoaded', () => {
             
             analyzedParams = data.parameters || [];
             // Updated: Pass logic summary and token usage
-            renderParams(analyzedParams, data.diff_report, data.logic_summary, data.token_usage);
+            renderParams(analyzedParams, data.diff_report, data.logic_summary, data.token_usage, data.spans, data.reuse);
             
             // Go to Step 2
             goToStep(2);
@@ -153,7 +157,7 @@ document.addEventListener('DOMContentLoaded', () => {
             alert('Analysis request failed');
             resetAnalyzeBtn();
         });
-    });
+    }
 
     function resetAnalyzeBtn() {
         btnAnalyze.disabled = false;
@@ -161,10 +165,29 @@ document.addEventListener('DOMContentLoaded', () => {
         btnText.textContent = '開始 AI 分析';
     }
 
-    function renderParams(params, diffReport, logicSummary, tokenUsage) {
+    function renderParams(params, diffReport, logicSummary, tokenUsage, spans, reuse) {
         const container = document.getElementById('paramsContainer');
         container.innerHTML = '';
 
+        // [Template Reuse Section] parameters taken over from a near-identical, already analyzed template
+        if (reuse) {
+            const reuseBox = document.createElement('div');
+            reuseBox.className = 'mb-6 bg-sky-50 border border-sky-200 p-4 rounded text-sm text-sky-800';
+            reuseBox.innerHTML = `
+                <h4 class="font-bold mb-2">沿用既有模板設定</h4>
+                <p>與專案「${reuse.project_name}」相似度 ${Math.round(reuse.similarity * 100)}%，沿用 ${reuse.reused} 個參數${
+                    reuse.model_called ? `，僅就 ${reuse.changed_regions} 個變更區域請 AI 分析` : '，未呼叫 AI'}。</p>
+                ${reuse.dropped.length ? `<p class="mt-1">新模板中已不存在: ${reuse.dropped.join(', ')}</p>` : ''}
+                ${reuse.relocate && reuse.relocate.length ? `<p class="mt-1">照片位置已重新判斷: ${reuse.relocate.join(', ')}</p>` : ''}
+                <button type="button" class="mt-2 underline text-sky-700 hover:text-sky-900">改為完整 AI 分析</button>
+            `;
+            reuseBox.querySelector('button').addEventListener('click', () => {
+                goToStep(1);
+                runAnalysis(true);
+            });
+            container.appendChild(reuseBox);
+        }
+
         // [Logic Summary Section]
         if (logicSummary) {
              const logicBox = document.createElement('div');
@@ -193,6 +216,24 @@ document.addEventListener('DOMContentLoaded', () => {
              container.appendChild(tokenBox);
         }
 
+        // [Stage Timing Section] (debug view)
+        if (spans && spans.length) {
+            const total = spans.reduce((a, s) => a + s.ms, 0);
+            const timingBox = document.createElement('details');
+            timingBox.className = 'mb-4 text-xs text-slate-500';
+            timingBox.innerHTML = `
+                <summary class="cursor-pointer">分析耗時 ${(total / 1000).toFixed(2)}s</summary>
+                <table class="mt-2 font-mono">
+                    ${spans.map(s => `<tr>
+                        <td class="pr-4">${s.name}${s.error ? ' ⚠' : ''}</td>
+                        <td class="pr-4 text-right">${s.ms} ms</td>
+                        <td class="pr-4 text-right">${s.input_size ?? '-'} → ${s.output_size ?? '-'}</td>
+                    </tr>`).join('')}
+                </table>
+            `;
+            container.appendChild(timingBox);
+        }
+
         // [Diff Report Section]
         if (diffReport) {
             const reportBox = document.createElement('div');
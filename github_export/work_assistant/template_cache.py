@@ -0,0 +1,161 @@
+"""
+已解析模板快取 (Parsed template cache)
+
+同一份模板每天被重複產生文件，每次都從磁碟解壓縮、解析 XML 很浪費。
+這裡以「模板檔案內容的雜湊」為 key，保存解析後的快照：
+  - Excel: openpyxl Workbook 的 pickle 快照，每次 pickle.loads 出獨立副本
+  - Word: python-docx Document，每次 deepcopy 出獨立副本後交給 DocxTemplate
+依快照佔用的記憶體大小做 LRU 淘汰。
+"""
+import copy
+import hashlib
+import io
+import logging
+import os
+import pickle
+import threading
+from collections import OrderedDict
+
+try:
+    import metrics
+    from lazy_imports import openpyxl, docx, docxtpl
+except ImportError:
+    from . import metrics
+    from .lazy_imports import openpyxl, docx, docxtpl
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_BYTES = int(os.getenv('TEMPLATE_CACHE_MB', '256')) * 1024 * 1024
+
+
+def file_hash(path):
+    """模板檔內容的 SHA-1 (同內容不同檔名會共用快取)"""
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _restore_workbook(wb):
+    """pickle 不會保留 DimensionHolder 的 default_factory (bound method)，需補回才能存取未定義的列/欄"""
+    for ws in wb.worksheets:
+        if hasattr(ws, '_add_row'):
+            ws.row_dimensions.default_factory = ws._add_row
+            ws.column_dimensions.default_factory = ws._add_column
+    return wb
+
+
+class TemplateCache:
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()   # key -> (snapshot, size)
+        self._hashes = {}               # path -> (mtime_ns, size, sha1)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # --- Key helpers ---
+
+    def template_hash(self, path):
+        """以 (mtime, size) 記住路徑對應的雜湊，避免每次都重讀整個檔案"""
+        st = os.stat(path)
+        stamp = (st.st_mtime_ns, st.st_size)
+        with self._lock:
+            cached = self._hashes.get(path)
+        if cached and cached[:2] == stamp:
+            return cached[2]
+        digest = file_hash(path)
+        with self._lock:
+            self._hashes[path] = stamp + (digest,)
+        return digest
+
+    # --- Storage ---
+
+    def _get(self, key):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def _put(self, key, snapshot, size):
+        if size > self.max_bytes:
+            logger.info(f"Template snapshot too large to cache ({size} bytes)")
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = (snapshot, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes and self._entries:
+                _, (_, old_size) = self._entries.popitem(last=False)
+                self._bytes -= old_size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._hashes.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+    # --- Public loaders ---
+
+    @metrics.timed('workbook_load')
+    def load_workbook(self, path):
+        """回傳獨立的 openpyxl Workbook (等同 openpyxl.load_workbook(path))"""
+        key = ('xlsx', self.template_hash(path))
+        blob = self._get(key)
+        if blob is None:
+            with metrics.timed('workbook_parse'):
+                wb = openpyxl.load_workbook(path)
+            blob = pickle.dumps(wb, protocol=pickle.HIGHEST_PROTOCOL)
+            self._put(key, blob, len(blob))
+        return _restore_workbook(pickle.loads(blob))
+
+    def load_docx_template(self, path):
+        """回傳使用獨立 Document 副本的 DocxTemplate (等同 DocxTemplate(path))"""
+        key = ('docx', self.template_hash(path))
+        doc = self._get(key)
+        if doc is None:
+            doc = docx.Document(path)
+            # 以封裝內所有 part 的序列化大小估算記憶體佔用
+            size = sum(len(part.blob) for part in doc.part.package.iter_parts())
+            self._put(key, doc, size)
+        tpl = docxtpl.DocxTemplate(io.BytesIO())
+        tpl.template_file = path
+        tpl.docx = copy.deepcopy(doc)
+        return tpl
+
+
+# Process-wide default cache
+_default_cache = TemplateCache()
+
+
+def load_workbook(path):
+    return _default_cache.load_workbook(path)
+
+
+def load_docx_template(path):
+    return _default_cache.load_docx_template(path)
+
+
+def stats():
+    return _default_cache.stats()
+
+
+def clear():
+    _default_cache.clear()
@@ -0,0 +1,220 @@
+"""
+模板幾何模型 (Template geometry)
+
+月報每一張工作表都是同一個模板，合併儲存格與欄寬列高完全相同，
+因此只在模板變更時計算一次：
+  - 合併儲存格的區間索引 (每列一組排序好的 [min_col, max_col] 區間)
+  - 欄寬、列高的前綴和 (像素)，任意範圍的寬高為 O(1)
+  - 每個圖片錨點解析後的目標方框 (含「標題列 -> 下方本體」的判斷)
+結果以模板雜湊為 key，存成 projects/<id>/template_geometry.json。
+"""
+import bisect
+import json
+import logging
+import os
+import threading
+import uuid
+
+try:
+    import database
+except ImportError:
+    from . import database
+
+logger = logging.getLogger(__name__)
+
+GEOMETRY_FILE = 'template_geometry.json'
+GEOMETRY_VERSION = 1
+
+# 與原本月報計算相同的近似換算
+DEFAULT_COL_WIDTH = 8.43   # 欄寬為 0 時使用的 Excel 預設欄寬 (字元)
+PX_PER_WIDTH_UNIT = 7.5    # Approx 7.5 px per unit
+DEFAULT_ROW_HEIGHT = 15    # points
+PX_PER_POINT = 1.333       # Approx 1.33 px per point
+HEADER_MAX_POINTS = 60     # 小於 60 pt (約 80px) 的合併區視為標題
+
+_memory_cache = {}
+_memory_lock = threading.Lock()
+
+
+class TemplateGeometry:
+    def __init__(self, merged, col_px, row_px, row_pt, anchors=None):
+        self.merged = merged          # [(min_row, min_col, max_row, max_col)]
+        self.col_px = col_px          # col_px[i] = 第 1..i 欄寬度總和 (px)
+        self.row_px = row_px          # row_px[i] = 第 1..i 列高度總和 (px)
+        self.row_pt = row_pt          # row_pt[i] = 第 1..i 列高度總和 (pt)
+        self.anchors = anchors or {}  # "r,c" -> resolved box dict (或 None)
+        self._build_index()
+
+    # --- Construction ---
+
+    @classmethod
+    def from_sheet(cls, ws):
+        # 只有重新計算幾何時才需要 (此時 openpyxl 已因載入模板而匯入)
+        from openpyxl.utils import get_column_letter
+        from openpyxl.utils.units import DEFAULT_COLUMN_WIDTH as OPENPYXL_COLUMN_WIDTH
+        merged = sorted((r.min_row, r.min_col, r.max_row, r.max_col) for r in ws.merged_cells.ranges)
+        max_col = max([ws.max_column] + [m[3] for m in merged]) + 1
+        max_row = max([ws.max_row] + [m[2] for m in merged]) + 1
+
+        col_px = [0.0]
+        for ci in range(1, max_col + 1):
+            # 未定義的欄與 column_dimensions[...] 建立的預設值相同 (openpyxl 預設 13)
+            dim = ws.column_dimensions.get(get_column_letter(ci))
+            cw = dim.width if dim is not None else OPENPYXL_COLUMN_WIDTH
+            col_px.append(col_px[-1] + (cw if cw else DEFAULT_COL_WIDTH) * PX_PER_WIDTH_UNIT)
+
+        row_px, row_pt = [0.0], [0.0]
+        for ri in range(1, max_row + 1):
+            dim = ws.row_dimensions.get(ri)
+            rh = dim.height if dim is not None else None
+            rh = rh if rh else DEFAULT_ROW_HEIGHT
+            row_pt.append(row_pt[-1] + rh)
+            row_px.append(row_px[-1] + rh * PX_PER_POINT)
+        return cls(merged, col_px, row_px, row_pt)
+
+    def _build_index(self):
+        # row -> sorted [(min_col, max_col, idx)]；starts (min_row, min_col) -> idx
+        self._rows = {}
+        self._starts = {}
+        for idx, (min_row, min_col, max_row, max_col) in enumerate(self.merged):
+            self._starts[(min_row, min_col)] = idx
+            for row in range(min_row, max_row + 1):
+                self._rows.setdefault(row, []).append((min_col, max_col, idx))
+        self._row_keys = {}
+        for row, intervals in self._rows.items():
+            intervals.sort()
+            self._row_keys[row] = [iv[0] for iv in intervals]
+
+    # --- Lookups ---
+
+    def merged_at(self, row, col):
+        """含 (row, col) 的合併範圍，沒有則 None"""
+        intervals = self._rows.get(row)
+        if not intervals:
+            return None
+        pos = bisect.bisect_right(self._row_keys[row], col) - 1
+        if pos >= 0:
+            min_col, max_col, idx = intervals[pos]
+            if col <= max_col:
+                return self.merged[idx]
+        return None
+
+    def merged_starting_at(self, row, col):
+        idx = self._starts.get((row, col))
+        return self.merged[idx] if idx is not None else None
+
+    def _span(self, prefix, start, end):
+        # 超出預先計算範圍時以預設尺寸補上
+        last = len(prefix) - 1
+        if end <= last:
+            return prefix[end] - prefix[start - 1]
+        step = prefix[last] - prefix[last - 1] if last else 0
+        return prefix[last] - prefix[start - 1] + step * (end - last)
+
+    def box_size_px(self, box):
+        min_row, min_col, max_row, max_col = box
+        return self._span(self.col_px, min_col, max_col), self._span(self.row_px, min_row, max_row)
+
+    def resolve_anchor(self, anchor):
+        """
+        錨點 "r,c" -> 目標方框:
+            {box, box_w, box_h, is_header, row0, col0}
+        錨點無效 (格式錯誤，例如模型輸出的 "B2" 或 "(2, 1)") 或不在合併儲存格內時回傳 None。
+        """
+        key = str(anchor) if anchor else ''
+        if key in self.anchors:
+            return self.anchors[key]
+        resolved = None
+        if ',' in key:
+            try:
+                r_start, c_start = map(int, key.split(','))
+            except ValueError:
+                logger.warning(f"Invalid image anchor_cell {key!r}, image will be skipped")
+                anchor_range = None
+            else:
+                anchor_range = self.merged_at(r_start, c_start)
+            if anchor_range:
+                target_box = anchor_range
+                is_header = self._span(self.row_pt, anchor_range[0], anchor_range[2]) < HEADER_MAX_POINTS
+                row0 = r_start - 1
+                if is_header:
+                    # It is likely a header. Look for the BODY below it.
+                    next_row = anchor_range[2] + 1
+                    body_range = self.merged_starting_at(next_row, c_start)
+                    if body_range:
+                        target_box = body_range
+                    row0 = next_row - 1
+                box_w, box_h = self.box_size_px(target_box)
+                resolved = {
+                    'box': list(target_box),
+                    'box_w': box_w,
+                    'box_h': box_h,
+                    'is_header': is_header,
+                    'row0': row0,
+                    'col0': c_start - 1,
+                }
+        self.anchors[key] = resolved
+        return resolved
+
+    # --- Serialization ---
+
+    def to_dict(self):
+        return {
+            'version': GEOMETRY_VERSION,
+            'merged': [list(m) for m in self.merged],
+            'col_px': self.col_px,
+            'row_px': self.row_px,
+            'row_pt': self.row_pt,
+            'anchors': self.anchors,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls([tuple(m) for m in data['merged']], data['col_px'], data['row_px'],
+                   data['row_pt'], data.get('anchors'))
+
+
+def _geometry_path(project_id):
+    return os.path.join(database.PROJECTS_DIR, project_id, GEOMETRY_FILE)
+
+
+def get_geometry(project_id, template_hash, parameters, load_sheet):
+    """
+    取得專案模板的幾何模型；順序: 記憶體 -> 專案資料夾的 JSON -> load_sheet() 重新計算。
+    load_sheet 只在需要重新計算時才呼叫 (回傳模板的第一張工作表)。
+    """
+    with _memory_lock:
+        cached = _memory_cache.get(template_hash)
+    geometry = cached
+
+    path = _geometry_path(project_id)
+    if geometry is None and os.path.exists(path):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('template_hash') == template_hash and data.get('version') == GEOMETRY_VERSION:
+                geometry = TemplateGeometry.from_dict(data)
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Template geometry cache unreadable: {e}")
+
+    if geometry is None:
+        geometry = TemplateGeometry.from_sheet(load_sheet())
+
+    # 預先解析所有圖片錨點
+    missing = [p for p in parameters
+               if p.get('type') == 'image' and str(p.get('style', {}).get('anchor_cell') or '') not in geometry.anchors]
+    for param in missing:
+        geometry.resolve_anchor(param.get('style', {}).get('anchor_cell'))
+
+    if missing or cached is None:
+        with _memory_lock:
+            _memory_cache[template_hash] = geometry
+        if missing or not os.path.exists(path):
+            data = geometry.to_dict()
+            data['template_hash'] = template_hash
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+    return geometry
@@ -0,0 +1,332 @@
+"""
+模板指紋登錄 (Template fingerprint registry)
+
+各站常把已經分析過的空白表單稍作修改後再上傳一次；/api/analyze 每次都要重新花一整輪 Gemini
+與數千 token 找出同樣的參數。這裡為每個已儲存專案的原始模板留下結構指紋:
+  - 元素: 結構擷取 (document_tasks.extract_*_structure) 的每個儲存格/段落/表格格子的文字
+  - 指紋: 正規化後元素文字集合的 MinHash (NUM_PERM 個 hash)，估計兩份模板的 Jaccard 相似度
+  - 存在 projects/<id>/template_fingerprint.json (含元素文字，供比對變更區域)，
+    專案刪除時一併消失；舊專案由 backfill() 從轉換後的模板 (把 {{ tag }} 換回 original_text) 補建
+新上傳的模板相似度 >= REUSE_THRESHOLD 時 (plan_reuse):
+  - 既有專案的參數中，original_text 仍存在於新模板的直接沿用；找不到的列為 dropped
+  - 照片參數的 anchor_cell 以上的版面 (位置與內容) 沒有變動才沿用，否則交給模型重新定位 (relocate)
+  - 新模板中位置或內容與舊模板不同的元素 = 變更區域；沒有變更區域時完全不呼叫模型，
+    有的話只把變更區域 (subset_structure) 交給模型分析
+"""
+import hashlib
+import logging
+import os
+import random
+import re
+import threading
+import time
+import unicodedata
+from datetime import datetime
+
+try:
+    import database
+    import file_store
+except ImportError:
+    from . import database
+    from . import file_store
+
+logger = logging.getLogger(__name__)
+
+FINGERPRINT_FILE = 'template_fingerprint.json'
+FINGERPRINT_FORMAT = 1
+NUM_PERM = 64
+REUSE_THRESHOLD = float(os.getenv('TEMPLATE_REUSE_THRESHOLD', '0.8'))
+# 重新列出專案目錄的間隔 (其他 worker process 新增/刪除的專案)
+CHECK_SECONDS = 5.0
+
+_PRIME = (1 << 61) - 1
+_rng = random.Random(0x5EED)
+_PERMUTATIONS = [(_rng.randrange(1, _PRIME), _rng.randrange(0, _PRIME)) for _ in range(NUM_PERM)]
+
+IMAGE_MARKER = re.compile(r'<<IMAGE_PRESENT[^>]*>>')
+TAG_PATTERN = re.compile(r"\{\{\s*([^{}\s]+)\s*\}\}")
+
+
+def structure_elements(structure):
+    """{位置: 文字}。Excel: '<sheet>!r,c'；Word: 'P<段落 index>' / 表格 'T0:R1:C2'"""
+    elements = {}
+    for sheet_name, sheet in (structure.get('sheets') or {}).items():
+        for coord, text in (sheet.get('cells') or {}).items():
+            elements[f"{sheet_name}!{coord}"] = text
+    for paragraph in structure.get('paragraphs') or []:
+        elements[f"P{paragraph['index']}"] = paragraph['text']
+    for table in structure.get('tables') or []:
+        for cell in table:
+            elements[cell['loc']] = cell['text']
+    return elements
+
+
+def subset_structure(structure, locations):
+    """只保留 locations 中元素的結構 (與擷取結果同樣的格式，給模型的輸入)"""
+    locations = set(locations)
+    if 'sheets' in structure:
+        sheets = {}
+        for sheet_name, sheet in structure['sheets'].items():
+            cells = {coord: text for coord, text in (sheet.get('cells') or {}).items()
+                     if f"{sheet_name}!{coord}" in locations}
+            if cells:
+                sheets[sheet_name] = {'cells': cells}
+        return {'sheet_names': structure.get('sheet_names', []), 'sheets': sheets}
+    tables = [[cell for cell in table if cell['loc'] in locations] for table in structure.get('tables') or []]
+    return {'paragraphs': [p for p in structure.get('paragraphs') or [] if f"P{p['index']}" in locations],
+            'tables': [table for table in tables if table]}
+
+
+def normalize(text):
+    text = IMAGE_MARKER.sub('<<image>>', unicodedata.normalize('NFKC', str(text)))
+    return ' '.join(text.split()).lower()
+
+
+def _hash64(text):
+    return int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+def signature(elements):
+    """正規化元素文字集合的 MinHash"""
+    hashes = {_hash64(text) for text in map(normalize, elements.values()) if text}
+    if not hashes:
+        return None
+    return [min((a * h + b) % _PRIME for h in hashes) for a, b in _PERMUTATIONS]
+
+
+def similarity(sig_a, sig_b):
+    """兩個 MinHash 相同位置相等的比例 ≈ Jaccard 相似度"""
+    return sum(1 for a, b in zip(sig_a, sig_b) if a == b) / NUM_PERM
+
+
+def fingerprint(structure, template_type):
+    elements = structure_elements(structure or {})
+    sig = signature(elements)
+    if sig is None:
+        return None
+    return {'format': FINGERPRINT_FORMAT, 'template_type': template_type, 'signature': sig,
+            'elements': elements, 'created_at': datetime.now().isoformat()}
+
+
+def _fingerprint_path(project_id):
+    return os.path.join(database.PROJECTS_DIR, project_id, FINGERPRINT_FILE)
+
+
+def register(project_id, structure, template_type):
+    """儲存專案原始模板的指紋；結構是空的 (擷取失敗) 時不登錄"""
+    fp = fingerprint(structure, template_type)
+    if fp is None:
+        return False
+    path = _fingerprint_path(project_id)
+    with file_store.lock(path):
+        file_store.write_json(path, fp)
+    with _lock:
+        _cache.pop(project_id, None)
+        if project_id not in _project_ids:
+            _project_ids.append(project_id)
+    return True
+
+
+_lock = threading.Lock()
+_cache = {}          # project_id -> (mtime_ns, fingerprint)
+_project_ids = []
+_listed = 0.0
+
+
+def _fingerprints():
+    """[(project_id, fingerprint)]；依檔案 mtime 快取"""
+    global _project_ids, _listed
+    now = time.monotonic()
+    with _lock:
+        if now - _listed >= CHECK_SECONDS:
+            try:
+                _project_ids = sorted(os.listdir(database.PROJECTS_DIR))
+            except OSError:
+                _project_ids = []
+            _listed = now
+            for project_id in set(_cache) - set(_project_ids):
+                del _cache[project_id]
+        project_ids = list(_project_ids)
+
+    found = []
+    for project_id in project_ids:
+        path = _fingerprint_path(project_id)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            continue
+        cached = _cache.get(project_id)
+        if cached is None or cached[0] != mtime:
+            fp = file_store.read_json(path, None)
+            if not fp or fp.get('format') != FINGERPRINT_FORMAT:
+                continue
+            cached = _cache[project_id] = (mtime, fp)
+        found.append((project_id, cached[1]))
+    return found
+
+
+def find_match(structure, template_type, threshold=None):
+    """
+    最相似且 >= threshold 的已登錄專案:
+    {'project_id', 'similarity', 'fingerprint', 'elements' (新模板), 'config',
+     'sheet' (Excel 照片錨點所在的第一張工作表)}，
+    沒有則 None。
+    只考慮同類型 (word/excel)、仍存在且有參數的專案。
+    """
+    threshold = REUSE_THRESHOLD if threshold is None else threshold
+    fp = fingerprint(structure, template_type)
+    if fp is None:
+        return None
+    candidates = sorted(((similarity(fp['signature'], other['signature']), project_id, other)
+                         for project_id, other in _fingerprints() if other.get('template_type') == template_type),
+                        key=lambda item: item[0], reverse=True)
+    for score, project_id, other in candidates:
+        if score < threshold:
+            break
+        config = database.get_project_config(project_id)
+        if config and config.get('parameters'):
+            return {'project_id': project_id, 'similarity': score, 'fingerprint': other,
+                    'elements': fp['elements'], 'config': config,
+                    'sheet': (structure.get('sheet_names') or [None])[0]}
+    return None
+
+
+def _cell_location(loc):
+    """'<sheet>!r,c' -> (sheet, r, c)；不是 Excel 儲存格位置時回傳 None"""
+    sheet, _, coord = loc.rpartition('!')
+    try:
+        row, col = (int(part) for part in coord.split(','))
+    except ValueError:
+        return None
+    return sheet, row, col
+
+
+def _anchor_stable(anchor, sheet, old_elements, new_elements):
+    """
+    照片錨點 'r,c' 仍指向同一個位置: 新模板在錨點那一列 (含) 以上的元素都與舊模板同位置同內容。
+    插入/刪除列會讓下方的元素換位置，因此任何一列位移都會被發現 (只清空舊儲存格不影響位置)。
+    """
+    try:
+        anchor_row = int(str(anchor).split(',')[0])
+    except ValueError:
+        return False
+    for loc, text in new_elements.items():
+        cell = _cell_location(loc)
+        if cell is None or cell[0] != sheet or cell[1] > anchor_row:
+            continue
+        if normalize(text) != normalize(old_elements.get(loc, '')):
+            return False
+    return True
+
+
+def plan_reuse(match):
+    """
+    比對新模板與既有專案模板: {'parameters': 沿用的參數, 'dropped': [參數名稱],
+    'relocate': [照片參數名稱], 'changed': {位置: 文字} (新模板中位置或內容與舊模板不同的元素),
+    'project_id', 'project_name', 'similarity'}
+    照片參數依 anchor_cell 放置，錨點以上的版面有變動時不沿用 (relocate)，
+    並把錨點那一列與照片原始文字所在的元素加入變更區域，交給模型重新判斷位置。
+    """
+    elements = match['elements']
+    old_elements = match['fingerprint']['elements']
+    changed = {loc: text for loc, text in elements.items()
+               if normalize(text) and normalize(text) != normalize(old_elements.get(loc, ''))}
+    haystack = '\n'.join(normalize(text) for text in elements.values())
+    sheet = match.get('sheet')
+
+    reused, dropped, relocate = [], [], []
+    for param in match['config'].get('parameters', []):
+        target = normalize(param.get('original_text') or '')
+        if param.get('type') == 'image':
+            anchor = (param.get('style') or {}).get('anchor_cell')
+            if not anchor or sheet is None or _anchor_stable(anchor, sheet, old_elements, elements):
+                reused.append(param)
+                continue
+            relocate.append(param.get('name'))
+            try:
+                anchor_row = int(str(anchor).split(',')[0])
+            except ValueError:
+                anchor_row = None
+            for loc, text in elements.items():
+                cell = _cell_location(loc)
+                in_row = cell is not None and cell[0] == sheet and cell[1] == anchor_row
+                if normalize(text) and (in_row or (target and target in normalize(text))):
+                    changed[loc] = text
+        elif not target or target in haystack:
+            reused.append(param)
+        else:
+            dropped.append(param.get('name'))
+    return {
+        'project_id': match['project_id'],
+        'project_name': match['config'].get('name'),
+        'similarity': round(match['similarity'], 3),
+        'parameters': reused,
+        'dropped': dropped,
+        'relocate': relocate,
+        'changed': changed,
+    }
+
+
+def merge_parameters(reused, analyzed):
+    """沿用的參數 + 模型針對變更區域找到的參數 (名稱或 original_text 重複的略過)"""
+    names = {p.get('name') for p in reused}
+    texts = {p.get('original_text') for p in reused if p.get('original_text')}
+    merged = list(reused)
+    for param in analyzed or []:
+        if param.get('name') in names or (param.get('original_text') and param.get('original_text') in texts):
+            continue
+        merged.append(param)
+        names.add(param.get('name'))
+    return merged
+
+
+def restore_tags(structure, parameters):
+    """轉換後的模板 (含 {{ name }}) 換回 original_text，還原成近似原始空白模板的結構"""
+    originals = {p['name']: p.get('original_text') or '' for p in parameters or [] if p.get('name')}
+
+    def restore(text):
+        return TAG_PATTERN.sub(lambda m: originals.get(m.group(1), m.group(0)), text)
+
+    for sheet in (structure.get('sheets') or {}).values():
+        cells = sheet.get('cells') or {}
+        for coord, text in cells.items():
+            cells[coord] = restore(text)
+    for paragraph in structure.get('paragraphs') or []:
+        paragraph['text'] = restore(paragraph['text'])
+    for table in structure.get('tables') or []:
+        for cell in table:
+            cell['text'] = restore(cell['text'])
+    return structure
+
+
+def backfill(extract, upload_folder):
+    """
+    為還沒有指紋的既有專案補建 (背景執行)。extract(path, template_type) 回傳結構；
+    同一專案只會有一個行程在處理 (鎖被佔用就跳過)。回傳補建的專案數。
+    """
+    count = 0
+    for project in database.get_all_projects():
+        project_id = project['id']
+        path = _fingerprint_path(project_id)
+        template_file = project.get('template_file')
+        if os.path.exists(path) or not template_file or not project.get('parameters'):
+            continue
+        template_path = os.path.join(upload_folder, template_file)
+        if not os.path.exists(template_path):
+            continue
+        try:
+            with file_store.lock(path, timeout=0):
+                if os.path.exists(path):
+                    continue
+                ext = os.path.splitext(template_path)[1].lower()
+                template_type = 'word' if ext in ('.docx', '.doc') else 'excel'
+                structure = restore_tags(extract(template_path, template_type), project['parameters'])
+                if register(project_id, structure, template_type):
+                    count += 1
+        except TimeoutError:
+            continue
+        except Exception as e:
+            logger.warning(f"Template fingerprint backfill failed for {project_id}: {e}")
+    if count:
+        logger.info(f"Template fingerprints backfilled for {count} project(s)")
+    return count
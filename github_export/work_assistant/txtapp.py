@@ -2,29 +2,51 @@ import os
 import uuid
 import json
 import logging
+import time
 from datetime import datetime
-from flask import Flask, render_template, request, jsonify, redirect, url_for, send_file, send_from_directory, abort
+from flask import Flask, render_template, request, jsonify, redirect, url_for, send_from_directory, send_file, abort
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from werkzeug.utils import secure_filename
 from dotenv import load_dotenv
 from functools import wraps
-import google.generativeai as genai
-from docx import Document
-from docxtpl import DocxTemplate
-import pandas as pd
-import openpyxl
-from openpyxl.utils import get_column_letter
-from openpyxl.drawing.image import Image as OpenpyxlImage
-from openpyxl.drawing.spreadsheet_drawing import OneCellAnchor, AnchorMarker
-from openpyxl.drawing.xdr import XDRPositiveSize2D
-from openpyxl.utils.units import pixels_to_EMU
-from deepdiff import DeepDiff
 
 # Local imports
 try:
     import database
+    import template_cache
+    import document_output
+    import batch_merge
+    import image_prep
+    import monthly_jobs
+    import report_periods
+    import web_assets
+    import metrics
+    import profiler
+    import lazy_imports
+    import offload
+    import document_tasks
+    import admission
+    import entry_import
+    import search_index
+    import template_registry
 except ImportError:
     from . import database
+    from . import template_cache
+    from . import document_output
+    from . import batch_merge
+    from . import image_prep
+    from . import monthly_jobs
+    from . import report_periods
+    from . import web_assets
+    from . import metrics
+    from . import profiler
+    from . import lazy_imports
+    from . import offload
+    from . import document_tasks
+    from . import admission
+    from . import entry_import
+    from . import search_index
+    from . import template_registry
 
 # Load environment variables
 load_dotenv()
@@ -43,11 +65,43 @@ app.config['MAX_CONTENT_LENGTH'] = 128 * 1024 * 1024  # 128MB
 # Ensure upload directory
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
-# Configure Gemini
-api_key = os.getenv('GEMINI_API_KEY')
-if api_key:
-    genai.configure(api_key=api_key)
-else:
+# Fingerprinted / pre-compressed static files + gzip/br for large JSON & HTML responses
+web_assets.init_app(app)
+
+# Per-endpoint request counters / latency histograms / in-flight gauges (exposed at /metrics)
+metrics.init_app(app)
+# On-demand cProfile / stack sampling, armed from the developer dashboard
+profiler.init_app(app)
+
+# CPU-heavy document work (structure extraction, DeepDiff, template conversion, rendering) runs in the
+# offload process pool so fast routes keep their latency; per-call timeouts in seconds
+STRUCTURE_TIMEOUT = float(os.getenv('OFFLOAD_STRUCTURE_TIMEOUT', '120'))
+RENDER_TIMEOUT = float(os.getenv('OFFLOAD_RENDER_TIMEOUT', '120'))
+
+@app.errorhandler(offload.OffloadError)
+def handle_offload_error(e):
+    """Pool full -> 503 + Retry-After, timeout -> 504, crashed worker -> 500"""
+    logger.warning(f"Offload failed on {request.path}: {e}")
+    response = jsonify({'error': str(e)})
+    response.status_code = e.status
+    if e.retry_after:
+        response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+@metrics.register_collector
+def _collect_cache_metrics():
+    template_stats = template_cache.stats()
+    metrics.observe_cache('template', template_stats['hits'], template_stats['misses'])
+    prep_stats = image_prep.stats()
+    metrics.observe_cache('image_prep', prep_stats['hits'], prep_stats['misses'])
+
+# Heavy dependencies are imported on first use (see lazy_imports);
+# Gemini is configured with GEMINI_API_KEY when google.generativeai is first loaded.
+genai = lazy_imports.genai
+pd = lazy_imports.pandas
+docx = lazy_imports.docx
+
+if not os.getenv('GEMINI_API_KEY'):
     logger.warning("GEMINI_API_KEY not found in environment variables.")
 
 # Setup Login Manager
@@ -101,117 +155,22 @@ def save_uploaded_file(file):
         return filepath, original_filename
     return None, None
 
+# Structure extraction / template conversion / DeepDiff run in the offload process pool
+# (openpyxl & python-docx hold the GIL for the whole file; see document_tasks)
+@metrics.timed('extract_docx_structure')
 def extract_docx_structure(filepath, limit=2000):
     """提取 Word 文件的結構化資訊 (段落與表格) [New for DeepDiff]"""
-    if not filepath or not os.path.exists(filepath):
-        return {}
-        
-    try:
-        doc = Document(filepath)
-        structure = {
-            "paragraphs": [],
-            "tables": []
-        }
-        
-        # 提取段落 (含索引，方便比對位置)
-        for i, p in enumerate(doc.paragraphs):
-            text = p.text.strip()
-            if text: # 忽略完全空白行
-                structure["paragraphs"].append({
-                    "index": i,
-                    "text": text[:500] 
-                })
-                
-        # 提取表格 (含坐標)
-        for t_idx, table in enumerate(doc.tables):
-            table_data = []
-            for r_idx, row in enumerate(table.rows):
-                for c_idx, cell in enumerate(row.cells):
-                    text = cell.text.strip()
-                    if text:
-                        table_data.append({
-                            "loc": f"T{t_idx}:R{r_idx}:C{c_idx}",
-                            "text": text
-                        })
-            if table_data:
-                structure["tables"].append(table_data)
-                
-        return structure
-    except Exception as e:
-        logger.error(f"Docx structure error: {e}")
-        return {}
+    return offload.run(document_tasks.extract_docx_structure, filepath, limit, timeout=STRUCTURE_TIMEOUT)
 
+@metrics.timed('extract_xlsx_structure')
 def extract_xlsx_structure(filepath, limit_rows=100):
     """提取 Excel 文件的結構化資訊 (Sheet 與 Cell) [New for DeepDiff]"""
-    if not filepath or not os.path.exists(filepath):
-        return {}
-
-    try:
-        # Load without read_only to access images. data_only=True for Formula values.
-        wb = openpyxl.load_workbook(filepath, data_only=True)
-        structure = {
-            "sheet_names": wb.sheetnames,
-            "sheets": {}
-        }
-        
-        for sheet_name in wb.sheetnames:
-            ws = wb[sheet_name]
-            cells_data = {}
-            row_count = 0
-            
-            # 1. Extract Text Data
-            for row in ws.iter_rows():
-                if row_count > limit_rows: break
-                for cell in row:
-                    if cell.value is not None:
-                        # 記錄坐標與值
-                        cells_data[f"{cell.row},{cell.column}"] = str(cell.value).strip()
-                row_count += 1
-            
-            # 2. Extract Images (Marker only)
-            # This is crucial for "Photo Evaluation"
-            try:
-                # openpyxl 3.0+ uses ws._images or ws.images
-                images_list = getattr(ws, '_images', []) or getattr(ws, 'images', [])
-                for img in images_list:
-                    # Attempt to find anchor (Top-Left)
-                    r, c = None, None
-                    
-                    # Handling different anchor types (OneCell, TwoCell, Absolute)
-                    anchor = img.anchor
-                    if hasattr(anchor, '_from'): # TwoCellAnchor
-                        r = anchor._from.row + 1 # 0-index to 1-index
-                        c = anchor._from.col + 1
-                    elif hasattr(anchor, 'row'): # OneCellAnchor (sometimes)
-                        r = anchor.row + 1
-                        c = anchor.col + 1
-                        
-                    if r and c:
-                        key = f"{r},{c}"
-                        exist_val = cells_data.get(key, "")
-                        
-                        # Extract dimensions avoiding distoration
-                        w = getattr(img, 'width', 0)
-                        h = getattr(img, 'height', 0)
-                        marker = f"<<IMAGE_PRESENT|W:{w}|H:{h}>>"
-                        
-                        cells_data[key] = f"{exist_val} {marker}".strip()
-                        
-            except Exception as img_err:
-                logger.warning(f"Excel Image extraction warning: {img_err}")
-            
-            structure["sheets"][sheet_name] = {
-                "cells": cells_data
-            }
-        return structure
-    except Exception as e:
-        logger.error(f"Excel structure error: {e}")
-        return {}
+    return offload.run(document_tasks.extract_xlsx_structure, filepath, limit_rows, timeout=STRUCTURE_TIMEOUT)
 
 def extract_docx_text(filepath):
     """Legacy extractor (kept for fallback)"""
     try:
-        doc = Document(filepath)
+        doc = docx.Document(filepath)
         full_text = []
         for para in doc.paragraphs:
             if para.text.strip():
@@ -281,7 +240,13 @@ def developer_dashboard():
 @role_required(['developer'])
 def api_admin_config():
     if request.method == 'GET':
-        return jsonify(database.get_system_config())
+        stamp = database.get_system_config_stamp()
+        if stamp and web_assets.etag_matches(request, f"system-{stamp}"):
+            return _versioned_response(app.response_class(status=304), f"system-{stamp}")
+        config = database.get_system_config()
+        # 標記在讀取前取得 (資料只會比標記新)；設定檔不存在時第一次讀取才建立
+        stamp = stamp or database.get_system_config_stamp()
+        return _versioned_response(jsonify(config), f"system-{stamp}")
     else:
         new_config = request.json
         current = database.get_system_config()
@@ -295,6 +260,63 @@ def api_admin_config():
 def api_admin_stats():
     return jsonify(database.get_token_usage_stats())
 
+@app.route('/api/admin/admission')
+@login_required
+@role_required(['developer'])
+def api_admin_admission():
+    """Bulkhead limits and current running / queued counts (see admission)"""
+    return jsonify(admission.snapshot())
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus text format。開發者登入，或 Authorization: Bearer $METRICS_TOKEN (給抓取程式用)"""
+    token = os.getenv('METRICS_TOKEN')
+    authorized = bool(token) and request.headers.get('Authorization') == f"Bearer {token}"
+    if not authorized:
+        if not current_user.is_authenticated:
+            return login_manager.unauthorized()
+        if current_user.role != 'developer':
+            abort(403)
+    return metrics.expose(), 200, {'Content-Type': metrics.CONTENT_TYPE, 'Cache-Control': 'no-store'}
+
+@app.route('/api/admin/profiler', methods=['GET', 'POST'])
+@login_required
+@role_required(['developer'])
+def api_admin_profiler():
+    if request.method == 'POST':
+        data = request.json or {}
+        action = data.get('action')
+        try:
+            if action == 'arm':
+                profiler.arm(data.get('endpoint'), data.get('count', 1), data.get('mode', 'cprofile'))
+            elif action == 'sample':
+                profiler.set_sample_rate(data.get('rate', 0), data.get('mode', 'sampling'))
+            elif action == 'disarm':
+                profiler.disarm(data.get('endpoint'))
+            else:
+                return jsonify({'error': f"Unknown action: {action}"}), 400
+        except (TypeError, ValueError) as e:
+            return jsonify({'error': str(e)}), 400
+
+    endpoints = sorted({rule.endpoint for rule in app.url_map.iter_rules() if rule.endpoint != 'static'})
+    return jsonify(dict(profiler.status(), profiles=profiler.list_profiles(),
+                        endpoints=list(profiler.BACKGROUND_TARGETS) + endpoints))
+
+@app.route('/api/admin/profiler/<profile_id>')
+@login_required
+@role_required(['developer'])
+def api_admin_profile_download(profile_id):
+    meta, path = profiler.get_profile(profile_id)
+    if meta is None:
+        return jsonify({'error': 'Profile not found'}), 404
+    fmt = request.args.get('format', 'pstats' if meta['mode'] == 'cprofile' else 'collapsed')
+    if meta['mode'] == 'cprofile' and fmt == 'text':
+        return profiler.pstats_text(path), 200, {'Content-Type': 'text/plain; charset=utf-8'}
+    if (meta['mode'] == 'cprofile') != (fmt == 'pstats'):
+        return jsonify({'error': f"Format {fmt} is not available for {meta['mode']} profiles"}), 400
+    return send_file(path, as_attachment=True, download_name=os.path.basename(path),
+                     mimetype='application/octet-stream' if fmt == 'pstats' else 'text/plain')
+
 @app.route('/api/admin/projects')
 @login_required
 @role_required(['developer'])
@@ -306,6 +328,7 @@ def api_admin_projects():
 @role_required(['developer'])
 def api_admin_delete_project(project_id):
     success = database.delete_project(project_id)
+    search_index.schedule_refresh(project_id)
     if success:
         return jsonify({'success': True})
     return jsonify({'error': 'Delete failed'}), 500
@@ -340,6 +363,7 @@ def api_upload():
 @app.route('/api/analyze', methods=['POST'])
 @role_required(['manager'])
 @login_required
+@admission.limit('analyze')
 def api_analyze():
     data = request.json
     logger.info(f"Analyze request received. Data keys: {data.keys()}")
@@ -363,6 +387,8 @@ def api_analyze():
 
     # Paths
     template_path = os.path.join(app.config['UPLOAD_FOLDER'], template_file_id)
+    # 各階段耗時與輸入/輸出大小 (寫入 token log、回傳給前端 debug 檢視)
+    trace = metrics.Trace('analyze')
 
     # === [Phase 1 & 2] Structure Extraction & DeepDiff ===
     
@@ -370,10 +396,12 @@ def api_analyze():
     ext = os.path.splitext(template_path)[1].lower()
     template_type = "word" if ext in ['.docx', '.doc'] else "excel"
     
-    if template_type == "word":
-        blank_structure = extract_docx_structure(template_path)
-    else:
-        blank_structure = extract_xlsx_structure(template_path)
+    with trace.span('extract_template', _file_size(template_path)) as span:
+        if template_type == "word":
+            blank_structure = extract_docx_structure(template_path)
+        else:
+            blank_structure = extract_xlsx_structure(template_path)
+        span['output_size'] = _json_size(blank_structure)
     
     # [Debug] Log Structure Size
     logger.info(f"Blank structure keys: {list(blank_structure.keys()) if blank_structure else 'Empty'}")
@@ -381,6 +409,27 @@ def api_analyze():
         for sname, sdata in blank_structure["sheets"].items():
              logger.info(f"Sheet '{sname}' cells count: {len(sdata.get('cells', {}))}")
 
+    # 1.5 Template fingerprint registry: near-identical forms reuse an existing project's parameters
+    reuse = None
+    if not data.get('force_analysis'):
+        with trace.span('fingerprint_match', _json_size(blank_structure)) as span:
+            match = template_registry.find_match(blank_structure, template_type)
+            reuse = template_registry.plan_reuse(match) if match else None
+            span['output_size'] = len(reuse['changed']) if reuse else 0
+    if reuse:
+        logger.info(f"Template matches project {reuse['project_id']} (similarity {reuse['similarity']}), "
+                    f"{len(reuse['parameters'])} parameters reused, {len(reuse['changed'])} changed regions")
+        if not reuse['changed'] and not reuse['relocate']:
+            # 與既有模板相同 (或只刪除內容): 直接沿用參數，不比對範例、不呼叫模型
+            database.log_token_usage('template_reuse', None, spans=trace.spans)
+            return jsonify({
+                'parameters': reuse['parameters'],
+                'logic_summary': f"此模板與既有專案「{reuse['project_name']}」相同 (相似度 {reuse['similarity']:.0%})，已沿用其參數設定。",
+                'diff_report': _reuse_report(reuse),
+                'reuse': _reuse_info(reuse, model_called=False),
+                'spans': trace.spans
+            })
+
     # 2. Extract Reference Structure & Calculate Diff
     formatted_diff_report = "無參考範例，將進行純靜態分析。"
     filled_structure = {}
@@ -395,33 +444,20 @@ def api_analyze():
                        
         if is_same_type:
             try:
-                if template_type == "word":
-                    filled_structure = extract_docx_structure(old_doc_path)
-                else:
-                    filled_structure = extract_xlsx_structure(old_doc_path)
+                with trace.span('extract_reference', _file_size(old_doc_path)) as span:
+                    if template_type == "word":
+                        filled_structure = extract_docx_structure(old_doc_path)
+                    else:
+                        filled_structure = extract_xlsx_structure(old_doc_path)
+                    span['output_size'] = _json_size(filled_structure)
                 
                 logger.info(f"Filled structure extracted.")
 
                 # --- DeepDiff Core ---
-                # ignore_order=False ensures exact positional matching, vital for forms
-                diff = DeepDiff(blank_structure, filled_structure, ignore_order=False, view='tree')
-                changes = []
-                
-                # Value Changes (The most common filling action)
-                if 'values_changed' in diff:
-                    for node in diff['values_changed']:
-                        # path example: ['sheets', 'Sheet1', 'cells', '2,2']
-                        path = " -> ".join([str(k) for k in node.path(output_format='list')])
-                        old_val = node.t1
-                        new_val = node.t2
-                        changes.append(f"[內容變更] 位置: {path} | 原始: '{old_val}' -> 填寫: '{new_val}'")
-
-                # Item Added (e.g., repeating rows in tables)
-                if 'dictionary_item_added' in diff:
-                    for node in diff['dictionary_item_added']:
-                        path = " -> ".join([str(k) for k in node.path(output_format='list')])
-                        val = node.t2
-                        changes.append(f"[新增內容] 位置: {path} | 內容: '{val}'")
+                with trace.span('deepdiff', _json_size(blank_structure) + _json_size(filled_structure)) as span:
+                    changes = offload.run(document_tasks.structure_changes, blank_structure, filled_structure,
+                                          timeout=STRUCTURE_TIMEOUT)
+                    span['output_size'] = len(changes)
                 
                 # [Fallback Strategy] If DeepDiff finds nothing, try Direct Text Comparison for AI
                 if not changes and template_type == "excel":
@@ -436,6 +472,8 @@ def api_analyze():
                     logger.warning("DeepDiff found ZERO changes.")
                     formatted_diff_report = "警告：程式比對後未發現顯著結構差異。\n可能原因：\n1. 兩份文件內容可能完全一致。\n2. 圖片浮動於儲存格上方未被錨定。\n3. 使用了特殊排版(如純文字方塊)導致無法讀取。"
 
+            except offload.OffloadError:
+                raise
             except Exception as e:
                 logger.error(f"DeepDiff/Structure processing failed: {e}")
                 formatted_diff_report = f"結構比對失敗: {e}"
@@ -449,13 +487,16 @@ def api_analyze():
     if excel_file_id:
         try:
             excel_path = os.path.join(app.config['UPLOAD_FOLDER'], excel_file_id)
-            df = pd.read_excel(excel_path)
-            excel_headers = df.columns.tolist()
+            with trace.span('read_headers', _file_size(excel_path)) as span:
+                df = pd.read_excel(excel_path)
+                excel_headers = df.columns.tolist()
+                span['output_size'] = len(excel_headers)
         except Exception as e:
             logger.error(f"Excel header extraction failed: {e}")
 
 
     # === [Phase 3] AI Logic Inference ===
+    tokens = None
     try:
         # Load System Config
         system_config = database.get_system_config()
@@ -466,8 +507,15 @@ def api_analyze():
         model = genai.GenerativeModel(model_name)
         
         # Prepare context data (truncate to avoid token limit)
-        blank_json = json.dumps(blank_structure, ensure_ascii=False)[:30000]
-        filled_json = json.dumps(filled_structure, ensure_ascii=False)[:30000] if filled_structure else "{}"
+        prompt_blank, prompt_filled = blank_structure, filled_structure
+        if reuse:
+            # 沿用既有參數時，只請模型分析新模板中變更的區域
+            prompt_blank = template_registry.subset_structure(blank_structure, reuse['changed'])
+            if filled_structure:
+                prompt_filled = template_registry.subset_structure(filled_structure, reuse['changed'])
+            formatted_diff_report = _reuse_prompt_report(reuse, formatted_diff_report)
+        blank_json = json.dumps(prompt_blank, ensure_ascii=False)[:30000]
+        filled_json = json.dumps(prompt_filled, ensure_ascii=False)[:30000] if prompt_filled else "{}"
 
         # Analyze Sheet Differences for Logic
         template_sheets = blank_structure.get("sheet_names", [])
@@ -480,102 +528,111 @@ def api_analyze():
         # We need to escape brace characters in JSON strings for f-string? 
         # Actually simplest is to NOT use f-string for the template content, but use string.format()
         
-        prompt = prompt_template.format(
-            template_type=template_type,
-            formatted_diff_report=formatted_diff_report[:30000],
-            template_sheets=template_sheets,
-            filled_sheets=filled_sheets,
-            new_sheets=new_sheets,
-            blank_json=blank_json,
-            filled_json=filled_json
-        )
-
-        response = model.generate_content(prompt)
-        # Clean response text if it contains markdown code blocks
-        text_resp = response.text.replace('```json', '').replace('```', '').strip()
-        result_json = json.loads(text_resp)
-        
-        # Add Diff Report & Token Usage for Step 2 UI
-        result_json['diff_report'] = formatted_diff_report
-
-        # Extract Token Usage & Log it
+        with trace.span('format_prompt', len(prompt_template)) as span:
+            prompt = prompt_template.format(
+                template_type=template_type,
+                formatted_diff_report=formatted_diff_report[:30000],
+                template_sheets=template_sheets,
+                filled_sheets=filled_sheets,
+                new_sheets=new_sheets,
+                blank_json=blank_json,
+                filled_json=filled_json
+            )
+            span['output_size'] = len(prompt)
+
+        with trace.span('gemini_call', len(prompt)) as span, metrics.timed('gemini_generate_content'):
+            response = model.generate_content(prompt)
+            span['output_size'] = len(response.text)
+
+        # Extract Token Usage (before parsing, so failed parses are still logged)
         if response.usage_metadata:
              tokens = {
                  'prompt_tokens': response.usage_metadata.prompt_token_count,
                  'candidates_tokens': response.usage_metadata.candidates_token_count,
                  'total_tokens': response.usage_metadata.total_token_count
              }
-             result_json['token_usage'] = tokens
-             # Log to database for Developer Dashboard
-             database.log_token_usage('unknown_analysis_stage', tokens)
+
+        with trace.span('parse_json', len(response.text)) as span:
+            # Clean response text if it contains markdown code blocks
+            text_resp = response.text.replace('```json', '').replace('```', '').strip()
+            result_json = json.loads(text_resp)
+            span['output_size'] = len(result_json.get('parameters') or [])
         
+        # Add Diff Report & Token Usage for Step 2 UI
+        result_json['diff_report'] = formatted_diff_report
+        if reuse:
+            result_json['parameters'] = template_registry.merge_parameters(reuse['parameters'],
+                                                                           result_json.get('parameters'))
+            result_json['reuse'] = _reuse_info(reuse, model_called=True)
+        if tokens:
+            result_json['token_usage'] = tokens
+        result_json['spans'] = trace.spans
+
+        # Log to database for Developer Dashboard
+        database.log_token_usage('unknown_analysis_stage', tokens, spans=trace.spans)
         return jsonify(result_json)
         
     except Exception as e:
         logger.error(f"AI Analysis failed: {e}")
+        database.log_token_usage('unknown_analysis_stage', tokens, spans=trace.spans)
         return jsonify({
             'parameters': [],
-            'warning': f"AI Analysis Error: {str(e)}"
+            'warning': f"AI Analysis Error: {str(e)}",
+            'spans': trace.spans
         })
 
+def _reuse_info(reuse, model_called):
+    return {'project_id': reuse['project_id'], 'project_name': reuse['project_name'],
+            'similarity': reuse['similarity'], 'reused': len(reuse['parameters']),
+            'dropped': reuse['dropped'], 'relocate': reuse['relocate'], 'changed_regions': len(reuse['changed']),
+            'model_called': model_called}
+
+def _reuse_report(reuse):
+    lines = [f"[模板指紋] 與專案「{reuse['project_name']}」相似度 {reuse['similarity']:.0%}",
+             f"沿用參數: {', '.join(p.get('name', '') for p in reuse['parameters']) or '無'}"]
+    if reuse['dropped']:
+        lines.append(f"新模板中找不到原始內容而未沿用: {', '.join(reuse['dropped'])}")
+    if reuse['relocate']:
+        lines.append(f"照片位置以上的版面已變更，需重新判斷 anchor_cell: {', '.join(reuse['relocate'])}")
+    for loc, text in reuse['changed'].items():
+        lines.append(f"[變更區域] 位置: {loc} | 內容: '{text}'")
+    return "\n".join(lines)
+
+def _reuse_prompt_report(reuse, diff_report):
+    """給模型的差異報告: 已沿用的參數 + 變更區域 + 範例比對中與變更區域有關的部分"""
+    texts = [str(text) for text in reuse['changed'].values()]
+    locations = [loc.replace('!', ' -> cells -> ') for loc in reuse['changed']]
+    related = [line for line in diff_report.splitlines()
+               if any(f"'{text}'" in line for text in texts) or any(loc in line for loc in locations)]
+    return "\n".join([
+        _reuse_report(reuse),
+        "以上參數已確定，請勿重複輸出；只需針對 [變更區域] 定義新的參數"
+        + ("，並重新輸出需重新判斷位置的照片參數 (同名稱、新的 anchor_cell)。" if reuse['relocate'] else "。"),
+        *related,
+    ])
+
+def _file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return None
+
+def _json_size(structure):
+    """結構化內容序列化後的字元數 (span 的輸入/輸出大小)"""
+    return len(json.dumps(structure, ensure_ascii=False)) if structure else 0
+
+@metrics.timed('create_template')
 def create_template(source_path, params):
     """
     Convert original Docx/Excel to Template by replacing original_text with {{ tags }}
     """
-    ext = os.path.splitext(source_path)[1].lower()
-    
-    try:
-        if ext in ['.docx', '.doc']:
-            doc = Document(source_path)
-            for p in params:
-                target = p.get('original_text')
-                var_name = p.get('name')
-                
-                if target and var_name:
-                    tag = f"{{{{ {var_name} }}}}"
-                    
-                    # Replace in Paragraphs
-                    for para in doc.paragraphs:
-                        if target in para.text:
-                            para.text = para.text.replace(target, tag)
-                    
-                    # Replace in Tables
-                    for table in doc.tables:
-                        for row in table.rows:
-                            for cell in row.cells:
-                                if target in cell.text:
-                                    cell.text = cell.text.replace(target, tag)
-                                    
-            new_filename = f"Template_{uuid.uuid4()}.docx"
-            new_path = os.path.join(app.config['UPLOAD_FOLDER'], new_filename)
-            doc.save(new_path)
-            return new_filename
-
-        elif ext in ['.xlsx', '.xls']:
-            wb = openpyxl.load_workbook(source_path)
-            for sheet in wb.worksheets:
-                for row in sheet.iter_rows():
-                    for cell in row:
-                        if cell.value and isinstance(cell.value, str):
-                            for p in params:
-                                target = p.get('original_text')
-                                var_name = p.get('name')
-                                if target and var_name and target in cell.value:
-                                    tag = f"{{{{ {var_name} }}}}"
-                                    cell.value = cell.value.replace(target, tag)
-
-            new_filename = f"Template_{uuid.uuid4()}.xlsx"
-            new_path = os.path.join(app.config['UPLOAD_FOLDER'], new_filename)
-            wb.save(new_path)
-            return new_filename
-
-    except Exception as e:
-        logger.error(f"Template conversion failed: {e}")
-        return None
+    return offload.run(document_tasks.create_template, source_path, params, app.config['UPLOAD_FOLDER'],
+                       timeout=STRUCTURE_TIMEOUT)
 
 @app.route('/api/save_project', methods=['POST'])
 @role_required(['manager'])
 @login_required
+@admission.limit('documents')
 def api_save_project():
     data = request.json
     project_id = str(uuid.uuid4())
@@ -585,6 +642,7 @@ def api_save_project():
     parameters = data.get('parameters', [])
     
     final_template_name = template_file_id
+    source_path = None
     if template_file_id:
         source_path = os.path.join(app.config['UPLOAD_FOLDER'], template_file_id)
         if os.path.exists(source_path):
@@ -603,8 +661,32 @@ def api_save_project():
     }
     
     database.save_project_config(project_id, config)
+    search_index.schedule_refresh(project_id)
+    if source_path and os.path.exists(source_path) and parameters:
+        _register_template(project_id, source_path)
     return jsonify({'success': True, 'project_id': project_id})
 
+def _extract_structure(path, template_type):
+    if template_type == 'word':
+        return extract_docx_structure(path)
+    return extract_xlsx_structure(path)
+
+def _register_template(project_id, source_path):
+    """原始空白模板的指紋登錄到 template_registry (之後相似的模板可沿用此專案的參數)"""
+    ext = os.path.splitext(source_path)[1].lower()
+    template_type = "word" if ext in ['.docx', '.doc'] else "excel"
+    try:
+        template_registry.register(project_id, _extract_structure(source_path, template_type), template_type)
+    except Exception as e:
+        logger.warning(f"Template fingerprint registration failed for {project_id}: {e}")
+
+def backfill_template_fingerprints():
+    """既有專案補建模板指紋 (run_production 啟動時於背景執行；pool 忙碌時排隊等待，不搶請求的名額)"""
+    def extract(path, template_type):
+        task = document_tasks.extract_docx_structure if template_type == 'word' else document_tasks.extract_xlsx_structure
+        return offload.run(task, path, timeout=STRUCTURE_TIMEOUT, block=True)
+    return template_registry.backfill(extract, app.config['UPLOAD_FOLDER'])
+
 
 @app.route('/project/<project_id>')
 @login_required
@@ -621,6 +703,7 @@ def project_form(project_id):
 
 @app.route('/generate_document', methods=['POST'])
 @login_required
+@admission.limit('documents')
 def generate_document():
     project_id = request.form.get('project_id')
     config = database.get_project_config(project_id)
@@ -643,47 +726,169 @@ def generate_document():
         return "Template file missing", 404
 
     try:
-        output_filename = f"Generated_{config.get('name', 'Doc')}_{datetime.now().strftime('%Y%m%d%H%M')}{ext}"
-        output_path = os.path.join(app.config['UPLOAD_FOLDER'], output_filename)
-
-        if ext == '.docx':
-            doc = DocxTemplate(template_path)
-            doc.render(context)
-            doc.save(output_path)
-            
-        elif ext in ['.xlsx', '.xls']:
-            wb = openpyxl.load_workbook(template_path)
-            # Find and replace {{ key }} with val
-            for sheet in wb.worksheets:
-                for row in sheet.iter_rows():
-                    for cell in row:
-                        if cell.value and isinstance(cell.value, str):
-                            for key, val in context.items():
-                                tag = f"{{{{ {key} }}}}"
-                                if tag in cell.value:
-                                    # If exact match, perform type adjustment if possible (number)
-                                    if cell.value.strip() == tag:
-                                        # Try to convert to number if possible
-                                        try:
-                                            cell.value = float(val) if '.' in val else int(val)
-                                        except ValueError:
-                                            cell.value = val
-                                    else:
-                                        cell.value = cell.value.replace(tag, str(val))
-            wb.save(output_path)
+        doc_name = config.get('name', 'Doc')
+        output_filename = f"Generated_{doc_name}_{datetime.now().strftime('%Y%m%d%H%M')}{ext}"
+
+        if ext not in ['.docx', '.xlsx', '.xls']:
+            return "Unsupported template type", 400
+        # Render in the offload pool (docxtpl / openpyxl hold the GIL); the worker returns the file bytes
+        data = offload.run(batch_merge.render_row, template_path, config['parameters'], context,
+                           timeout=RENDER_TIMEOUT)
         
-        return send_file(output_path, as_attachment=True)
+        # Serialize in memory and stream; only persist (under a unique name) when asked
+        persist_folder = app.config['UPLOAD_FOLDER'] if document_output.wants_persist(request) else None
+        return document_output.deliver(lambda f: f.write(data), output_filename,
+                                       persist_folder=persist_folder,
+                                       persist_prefix=f"Generated_{doc_name}")
+    except offload.OffloadError:
+        raise
     except Exception as e:
         logger.error(f"Generation failed: {e}")
         return f"Error generating document: {e}", 500
 
+@app.route('/api/project/<project_id>/generate_batch', methods=['POST'])
+@login_required
+@admission.limit('reports')
+def api_generate_batch(project_id):
+    """批次合併列印: 資料檔每一列產生一份文件，打包成 ZIP 串流下載"""
+    config = database.get_project_config(project_id)
+    if not config:
+        return jsonify({'error': 'Project not found'}), 404
+
+    template_file = config['template_file']
+    template_path = os.path.join(app.config['UPLOAD_FOLDER'], template_file)
+    if not os.path.exists(template_path):
+        return jsonify({'error': 'Template file missing'}), 404
+
+    # Data source: a new upload, or the Zone C file already uploaded via /api/upload
+    data_file = request.files.get('data_file')
+    if data_file and data_file.filename:
+        data_ext = os.path.splitext(data_file.filename)[1].lower()
+        data_source = data_file.stream
+    elif request.form.get('data_file_id'):
+        data_source = os.path.join(app.config['UPLOAD_FOLDER'], secure_filename(request.form['data_file_id']))
+        data_ext = os.path.splitext(data_source)[1].lower()
+        if not os.path.exists(data_source):
+            return jsonify({'error': 'Data file missing'}), 404
+    else:
+        return jsonify({'error': 'Missing data file'}), 400
+
+    if data_ext not in batch_merge.DATA_EXTENSIONS:
+        return jsonify({'error': 'Data file must be .xlsx, .xls or .csv'}), 400
+
+    try:
+        mapping = json.loads(request.form.get('mapping') or '{}')
+    except ValueError:
+        return jsonify({'error': 'Invalid mapping JSON'}), 400
+
+    try:
+        df = batch_merge.read_data_rows(data_source, data_ext)
+    except Exception as e:
+        logger.error(f"Batch data read failed: {e}")
+        return jsonify({'error': f'Cannot read data file: {e}'}), 400
+
+    parameters = config.get('parameters', [])
+    mapping = batch_merge.resolve_mapping(list(df.columns), parameters, mapping)
+    if not mapping:
+        return jsonify({'error': 'No data columns match the project parameters', 'columns': list(df.columns)}), 400
+
+    contexts = batch_merge.build_contexts(df, parameters, mapping)
+    if not contexts:
+        return jsonify({'error': 'Data file has no rows'}), 400
+
+    doc_name = config.get('name', 'Doc')
+    logger.info(f"Batch generation for {doc_name}: {len(contexts)} rows, mapping={mapping}")
+    zip_name = f"Batch_{doc_name}_{datetime.now().strftime('%Y%m%d%H%M')}.zip"
+    chunks = batch_merge.stream_zip(template_path, parameters, contexts,
+                                    base_name=doc_name,
+                                    name_param=request.form.get('filename_param'))
+    return document_output.stream_response(chunks, zip_name)
+
 # --- Monthly Project APIs ---
 
 @app.route('/api/project/<project_id>/entries', methods=['GET'])
 @login_required
 def api_get_entries(project_id):
-    entries = database.get_project_entries(project_id)
-    return jsonify({'entries': entries})
+    """
+    ETag = entries 版本，未變更時回 304。
+    ?since=<version>: 只回傳該版本之後新增/修改的 entries 與刪除的 id，前端自行合併；
+    since 太舊 (異動紀錄已清除) 時回傳整份 entries ('full': true)。
+    """
+    # 先取版本再讀資料: 讀到的資料只會比版本新，之後以同一版本再取差異也只是重複套用
+    version = database.get_entries_version(project_id)
+    etag = f"entries-{version}"
+    if web_assets.etag_matches(request, etag):
+        return _versioned_response(app.response_class(status=304), etag)
+
+    since = request.args.get('since', type=int)
+    changes = database.get_entry_changes(project_id, since, version) if since is not None else None
+    if changes is None:
+        payload = {'version': version, 'entries': database.get_project_entries(project_id)}
+        if since is not None:
+            payload['full'] = True
+        return _versioned_response(jsonify(payload), etag)
+
+    changed = set(changes['added']) | set(changes['updated'])
+    by_id = {e.get('id'): e for e in database.get_project_entries(project_id) if e.get('id') in changed} if changed else {}
+    return _versioned_response(jsonify({
+        'version': version,
+        'since': since,
+        'added': [by_id[i] for i in changes['added'] if i in by_id],
+        'updated': [by_id[i] for i in changes['updated'] if i in by_id],
+        'deleted': changes['deleted'],
+    }), etag)
+
+def _versioned_response(response, etag):
+    """瀏覽器每次都要回來確認 (no-cache)，但版本未變時只需 304"""
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+@app.route('/api/project/<project_id>/config', methods=['GET'])
+@login_required
+def api_get_project_config(project_id):
+    """專案設定 (參數、模板)；ETag = config 版本，未變更時回 304"""
+    etag = f"config-{database.get_config_version(project_id)}"
+    if web_assets.etag_matches(request, etag):
+        return _versioned_response(app.response_class(status=304), etag)
+    config = database.get_project_config(project_id)
+    if not config:
+        return jsonify({'error': 'Project not found'}), 404
+    return _versioned_response(jsonify(config), etag)
+
+SEARCH_LIMIT_MAX = 100
+
+@app.route('/api/search')
+@login_required
+def api_search():
+    """
+    全文檢索專案與 entries (see search_index)。
+    ?q=關鍵字 &project=<id> (可重複或以逗號分隔) &start=YYYY-MM-DD &end=YYYY-MM-DD &kind=entry|project &limit=20
+    """
+    query = (request.args.get('q') or '').strip()
+    if not query:
+        return jsonify({'error': 'Missing q'}), 400
+    projects = [p for value in request.args.getlist('project') for p in value.split(',') if p]
+    start, end = request.args.get('start') or None, request.args.get('end') or None
+    for value in (start, end):
+        if value:
+            try:
+                datetime.strptime(value, '%Y-%m-%d')
+            except ValueError:
+                return jsonify({'error': f'Invalid date: {value}'}), 400
+    kind = request.args.get('kind') or None
+    if kind not in (None, 'entry', 'project'):
+        return jsonify({'error': 'kind must be entry or project'}), 400
+    try:
+        limit = min(max(int(request.args.get('limit', 20)), 1), SEARCH_LIMIT_MAX)
+    except ValueError:
+        return jsonify({'error': 'Invalid limit'}), 400
+
+    started = time.perf_counter()
+    total, results = search_index.search(query, project_ids=projects or None, start=start, end=end,
+                                         kind=kind, limit=limit)
+    return jsonify({'query': query, 'total': total, 'results': results,
+                    'took_ms': round((time.perf_counter() - started) * 1000, 2)})
 
 @app.route('/api/project/<project_id>/entry', methods=['POST'])
 @login_required
@@ -730,270 +935,291 @@ def api_add_entry(project_id):
                 entry_data['data'][field] = request.form.get(field, '')
                 
         database.save_project_entry(project_id, entry_data)
+        search_index.schedule_refresh(project_id)
         return jsonify({'success': True})
         
     except Exception as e:
         logger.error(f"Error adding entry: {e}")
         return jsonify({'success': False, 'error': str(e)})
 
+@app.route('/api/project/<project_id>/import_entries', methods=['POST'])
+@login_required
+@admission.limit('reports')
+def api_import_entries(project_id):
+    """
+    批次匯入 entries: data_file (或已上傳的 data_file_id) 每一列一筆，選填 photos (照片 ZIP)。
+    form: mapping (欄位 -> 參數 JSON，省略時依名稱/說明自動對應)、date_column、dry_run=1 (只驗證)
+    通過驗證的列一次寫入；回傳 {success, imported, failed, errors: [{row, column, error}], version}
+    """
+    config = database.get_project_config(project_id)
+    if not config:
+        return jsonify({'success': False, 'error': 'Project not found'}), 404
+
+    data_file = request.files.get('data_file')
+    if data_file and data_file.filename:
+        data_ext = os.path.splitext(data_file.filename)[1].lower()
+        data_source = data_file.stream
+    elif request.form.get('data_file_id'):
+        data_source = os.path.join(app.config['UPLOAD_FOLDER'], secure_filename(request.form['data_file_id']))
+        data_ext = os.path.splitext(data_source)[1].lower()
+        if not os.path.exists(data_source):
+            return jsonify({'success': False, 'error': 'Data file missing'}), 404
+    else:
+        return jsonify({'success': False, 'error': 'Missing data file'}), 400
+
+    if data_ext not in batch_merge.DATA_EXTENSIONS:
+        return jsonify({'success': False, 'error': 'Data file must be .xlsx, .xls or .csv'}), 400
+
+    try:
+        mapping = json.loads(request.form.get('mapping') or '{}')
+    except ValueError:
+        return jsonify({'success': False, 'error': 'Invalid mapping JSON'}), 400
+
+    try:
+        df = batch_merge.read_data_rows(data_source, data_ext)
+    except Exception as e:
+        logger.error(f"Import data read failed: {e}")
+        return jsonify({'success': False, 'error': f'Cannot read data file: {e}'}), 400
+
+    parameters = config.get('parameters', [])
+    mapping = batch_merge.resolve_mapping(list(df.columns), parameters, mapping)
+    if not mapping:
+        return jsonify({'success': False, 'error': 'No data columns match the project parameters',
+                        'columns': list(df.columns)}), 400
+
+    dry_run = request.form.get('dry_run') in ('1', 'true')
+    photos = request.files.get('photos')
+    archive = None
+    try:
+        if photos and photos.filename:
+            archive = entry_import.open_archive(photos.stream)
+        entries, errors = entry_import.import_entries(
+            df, parameters, mapping, app.config['UPLOAD_FOLDER'],
+            date_column=request.form.get('date_column') or None, archive=archive, dry_run=dry_run)
+    except entry_import.InvalidImport as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    finally:
+        if archive is not None:
+            archive.close()
+
+    if entries and not dry_run:
+        try:
+            version = database.save_project_entries(project_id, entries)
+        except Exception:
+            entry_import.discard_entry_photos(entries, parameters, app.config['UPLOAD_FOLDER'])
+            raise
+        search_index.schedule_refresh(project_id)
+    else:
+        version = database.get_entries_version(project_id)
+    logger.info(f"Import into {config.get('name')}: {len(entries)} valid entries "
+                f"({len(df)} rows, {len(errors)} errors, dry_run={dry_run})")
+    result = {'success': True, 'imported': 0 if dry_run else len(entries), 'failed': len({e['row'] for e in errors}),
+              'errors': errors, 'version': version}
+    if dry_run:
+        result['valid'] = len(entries)
+    return jsonify(result)
+
 @app.route('/api/project/<project_id>/entry/<entry_id>', methods=['DELETE'])
 @login_required
 def api_delete_entry(project_id, entry_id):
     try:
         database.delete_project_entry(project_id, entry_id)
+        search_index.schedule_refresh(project_id)
         return jsonify({'success': True})
     except Exception as e:
         logger.error(f"Error deleting entry: {e}")
         return jsonify({'success': False, 'error': str(e)})
 
+# 單次批次異動最多幾筆操作
+ENTRY_BATCH_LIMIT = int(os.getenv('ENTRY_BATCH_LIMIT', '1000'))
+
+def _check_entry_fields(index, op, operation, parameters, files, saved):
+    """
+    檢查 patch/replace 的欄位並把上傳的照片存好 (saved 收集新檔案，失敗時由呼叫端刪除)；回傳錯誤訊息或 None。
+    照片欄位沿用的既有檔名由 database.apply_entry_operations 在 lock 內確認是該 entry 目前的照片。
+    """
+    fields = operation.get('entry') if op == 'replace' else operation
+    if not isinstance(fields, dict):
+        return "Missing 'entry'"
+    if not isinstance(fields.get('data') or {}, dict):
+        return "'data' must be an object"
+    date = fields.get('date')
+    if op == 'replace' or date:
+        try:
+            datetime.strptime(str(date), '%Y-%m-%d')
+        except ValueError:
+            return f"Invalid date: {date!r}"
+    data = fields.setdefault('data', {}) if op == 'replace' else dict(fields.get('data') or {})
+    types = {p['name']: p.get('type') for p in parameters}
+    unknown = [name for name in data if name not in types]
+    if unknown:
+        return f"Unknown field(s): {', '.join(unknown)}"
+    for name, kind in types.items():
+        if kind == 'image':
+            upload = files.get(f"{index}:{name}")
+            if upload and upload.filename:
+                filepath, _ = save_uploaded_file(upload)
+                if not filepath:
+                    return f"Unsupported photo type for {name}"
+                saved.append(filepath)
+                data[name] = f"uploads/{os.path.basename(filepath)}"
+        elif name in data and data[name] is not None and not isinstance(data[name], (str, int, float)):
+            return f"Invalid value for {name}"
+    if op == 'replace':
+        for name, kind in types.items():
+            data.setdefault(name, None if kind == 'image' else '')
+    else:
+        operation['data'] = data
+    return None
+
+def _photo_names(entries, image_fields):
+    return {os.path.basename(str(e['data'][name])) for e in entries for name in image_fields
+            if isinstance(e.get('data'), dict) and e['data'].get(name)}
+
+def _files_used_elsewhere(project_id):
+    """其他專案的 entry 照片與所有專案的模板檔 (批次異動不得刪除)"""
+    used = set()
+    for project in database.get_all_projects():
+        if project.get('template_file'):
+            used.add(os.path.basename(str(project['template_file'])))
+        if project['id'] != project_id:
+            image_fields = [p['name'] for p in project.get('parameters', []) if p.get('type') == 'image']
+            used |= _photo_names(database.get_project_entries(project['id']), image_fields)
+    return used
+
+def _remove_orphan_photos(project_id, previous, entries, parameters):
+    """
+    批次異動後，本專案舊 entry 引用、但已沒有任何 entry 引用的照片檔一併刪除；
+    仍被其他專案 entry 或任何專案模板使用的檔案不刪。
+    """
+    image_fields = [p['name'] for p in parameters if p.get('type') == 'image']
+    orphans = _photo_names(previous.values(), image_fields) - _photo_names(entries, image_fields)
+    if orphans:
+        orphans -= _files_used_elsewhere(project_id)
+    removed = 0
+    for name in orphans:
+        try:
+            os.remove(os.path.join(app.config['UPLOAD_FOLDER'], name))
+            removed += 1
+        except OSError:
+            pass
+    return removed
+
+@app.route('/api/project/<project_id>/entries/batch', methods=['POST'])
+@login_required
+def api_entries_batch(project_id):
+    """
+    批次異動 entries，全部成功才一次寫入:
+      JSON {"operations": [{"op": "delete", "id"}, {"op": "patch", "id", "date"?, "data": {...}},
+                           {"op": "replace", "id", "entry": {"date", "data"}}]}
+    或 multipart: operations = 上述 JSON 陣列，照片以 "<操作序號>:<欄位>" 為檔案欄位名稱上傳。
+    回傳 {success, version, applied, removed_photos}；有操作無法套用時回 400/409 + errors (不寫入任何資料)。
+    """
+    config = database.get_project_config(project_id)
+    if not config:
+        return jsonify({'success': False, 'error': 'Project not found'}), 404
+
+    if request.is_json:
+        operations = (request.get_json(silent=True) or {}).get('operations')
+    else:
+        try:
+            operations = json.loads(request.form.get('operations') or 'null')
+        except ValueError:
+            return jsonify({'success': False, 'error': 'Invalid operations JSON'}), 400
+    if not isinstance(operations, list) or not operations:
+        return jsonify({'success': False, 'error': 'operations must be a non-empty list'}), 400
+    if len(operations) > ENTRY_BATCH_LIMIT:
+        return jsonify({'success': False, 'error': f'At most {ENTRY_BATCH_LIMIT} operations per batch'}), 400
+
+    parameters = config.get('parameters', [])
+    errors = []
+    saved = []
+    for index, operation in enumerate(operations):
+        if not isinstance(operation, dict) or not operation.get('id'):
+            errors.append({'index': index, 'id': None, 'error': 'Each operation needs an id'})
+            continue
+        op = operation.get('op')
+        if op in ('patch', 'replace'):
+            error = _check_entry_fields(index, op, operation, parameters, request.files, saved)
+            if error:
+                errors.append({'index': index, 'id': operation['id'], 'error': error})
+
+    try:
+        if errors:
+            raise database.EntryBatchError(errors)
+        image_fields = [p['name'] for p in parameters if p.get('type') == 'image']
+        version, previous, entries = database.apply_entry_operations(
+            project_id, operations, image_fields, {os.path.basename(filepath) for filepath in saved})
+    except database.EntryBatchError as e:
+        for filepath in saved:
+            if os.path.exists(filepath):
+                os.remove(filepath)
+        status = 409 if all(err['error'] == 'Entry not found' for err in e.errors) else 400
+        return jsonify({'success': False, 'error': str(e), 'errors': e.errors}), status
+
+    search_index.schedule_refresh(project_id)
+    removed = _remove_orphan_photos(project_id, previous, entries, parameters)
+    logger.info(f"Entry batch for {config.get('name')}: {len(operations)} operation(s), "
+                f"version {version}, {removed} orphaned photo(s) removed")
+    return jsonify({'success': True, 'version': version, 'applied': len(operations), 'removed_photos': removed})
+
 @app.route('/uploads/<path:filename>')
 def uploaded_file(filename):
     return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
 
+def _monthly_job_response(project_id, job):
+    data = job.to_dict()
+    data['status_url'] = url_for('api_monthly_job', project_id=project_id, job_id=job.id)
+    data['download_url'] = url_for('api_monthly_job_download', project_id=project_id, job_id=job.id)
+    return jsonify(data), (200 if job.status in ('done', 'error') else 202)
+
+def _request_period():
+    """期間參數可放在 query/form 或 JSON body；格式錯誤拋出 ValueError"""
+    values = request.values.to_dict()
+    if request.is_json:
+        values.update(request.get_json(silent=True) or {})
+    return report_periods.parse_period(values)
+
+def _send_monthly_report(path, key, filename):
+    persisted_name = None
+    if document_output.wants_persist(request):
+        persisted_name = document_output.unique_filename(os.path.splitext(filename)[0], '.xlsx')
+        with open(path, 'rb') as f:
+            document_output.persist(f, app.config['UPLOAD_FOLDER'], persisted_name)
+    return document_output.send_cached(path, filename, key, persisted_name)
+
 @app.route('/api/project/<project_id>/generate_monthly', methods=['POST'])
 @login_required
+@admission.limit('reports')
 def api_generate_monthly(project_id):
+    """
+    排入背景工作；回傳 job 狀態 (202 進行中 / 200 已完成)，前端輪詢 status_url 後下載。
+    期間: period=month&month=YYYY-MM (預設本月) / period=week&week=YYYY-Www / period=range&start=&end=
+    """
     config = database.get_project_config(project_id)
     if not config:
         return "Project not found", 404
-        
-    entries = database.get_project_entries(project_id)
-    if not entries:
-         return "No entries to generate", 400
 
     template_file = config['template_file']
     template_path = os.path.join(app.config['UPLOAD_FOLDER'], template_file)
     
     if not os.path.exists(template_path):
         return "Template file missing", 404
-        
-    try:
-        wb = openpyxl.load_workbook(template_path)
-        # Assume the first sheet is the template to copy
-        source_sheet = wb.worksheets[0]
-        
-        # Sort entries by date
-        entries.sort(key=lambda x: x['date'])
-        
-        for entry in entries:
-            target_sheet = wb.copy_worksheet(source_sheet)
-            
-            # 1. Determine Sheet Name
-            sheet_name = entry['date'][5:] # Default MMDD from YYYY-MM-DD
-            
-            # Try to find specific sheet_name param
-            for param in config.get('parameters', []):
-                 if param['name'] == 'sheet_name' and entry['data'].get('sheet_name'):
-                      raw_name = entry['data']['sheet_name']
-                      if raw_name: sheet_name = raw_name
-                      break
-            
-            # Sanitize sheet name
-            safe_name = str(sheet_name).replace(':', '').replace('/', '-').replace('\\', '').replace('?', '').replace('*', '').replace('[', '').replace(']', '')[:30]
-            target_sheet.title = safe_name
-            
-            # 2. Fill Data & Images
-            data_map = entry['data']
-            
-            for param in config.get('parameters', []):
-                key = param['name']
-                val = data_map.get(key)
-                original_text = param.get('original_text', '')
-                
-                # Tag to look for in cells (e.g. {{ removal_photo }})
-                tag = f"{{{{ {key} }}}}"
-                
-                if param['type'] == 'image':
-                    # --- Image Logic ---
-                    # We always search for the tag to handle text restoration or clearing
-                    # But we also use anchor for insertion
-                    
-                    anchor = param.get('style', {}).get('anchor_cell')
-                    image_inserted = False
-                    
-                    if val:
-                        # Try to insert image
-                        try:
-                            # Handle different path formats
-                            # Check if val is an absolute path that exists (for local testing/manual entry)
-                            if os.path.isabs(val) and os.path.exists(val):
-                                img_path = val
-                            else:
-                                # Default: look in UPLOAD_FOLDER
-                                filename = os.path.basename(val)
-                                img_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                            
-                            if os.path.exists(img_path):
-                                img = OpenpyxlImage(img_path)
-                                
-                                # Smart Positioning & Resizing
-                                final_anchor = "A1"
-                                is_header_anchor = False
-                                
-                                if anchor and ',' in str(anchor):
-                                    r_start, c_start = map(int, anchor.split(','))
-                                    final_anchor = f"{get_column_letter(c_start)}{r_start}"
-                                    
-                                    # Find if anchor is in a merged range
-                                    anchor_range = None
-                                    for rng in target_sheet.merged_cells.ranges:
-                                        if rng.min_row <= r_start <= rng.max_row and rng.min_col <= c_start <= rng.max_col:
-                                            anchor_range = rng
-                                            break
-                                    
-                                    target_box = anchor_range
-                                    
-                                    # Check if it's a "Header" (small height)
-                                    if anchor_range:
-                                        total_h = 0
-                                        for ri in range(anchor_range.min_row, anchor_range.max_row + 1):
-                                            rh = target_sheet.row_dimensions[ri].height
-                                            total_h += rh if rh else 15
-                                        
-                                        # Threshold: 60 points (approx 80px)
-                                        if total_h < 60:
-                                            # It is likely a header. Look for the BODY below it.
-                                            is_header_anchor = True
-                                            next_row = anchor_range.max_row + 1
-                                            
-                                            # Find merged range starting at next_row, same col
-                                            body_range = None
-                                            for rng in target_sheet.merged_cells.ranges:
-                                                if rng.min_row == next_row and rng.min_col == c_start:
-                                                    body_range = rng
-                                                    break
-                                            
-                                            if body_range:
-                                                target_box = body_range
-                                                final_anchor = f"{get_column_letter(c_start)}{next_row}"
-                                    
-                                    # Calculate Target Dimensions (Pixels)
-                                    if target_box:
-                                        # Width
-                                        box_w = 0
-                                        for ci in range(target_box.min_col, target_box.max_col + 1):
-                                            cw = target_sheet.column_dimensions[get_column_letter(ci)].width
-                                            box_w += (cw if cw else 8.43) * 7.5 # Approx 7.5 px per unit
-                                            
-                                        # Height
-                                        box_h = 0
-                                        for ri in range(target_box.min_row, target_box.max_row + 1):
-                                            rh = target_sheet.row_dimensions[ri].height
-                                            box_h += (rh if rh else 15) * 1.333 # Approx 1.33 px per point
-                                            
-                                        # Resize Image (Aspect Fit with padding)
-                                        if box_w > 10 and box_h > 10:
-                                            img_ratio = img.width / img.height
-                                            box_ratio = box_w / box_h
-                                            
-                                            # Padding
-                                            pad_w = min(20, box_w * 0.1)
-                                            pad_h = min(20, box_h * 0.1)
-                                            avail_w = box_w - pad_w
-                                            avail_h = box_h - pad_h
-                                            
-                                            if img_ratio > box_ratio:
-                                                # Fit to Width
-                                                new_w = avail_w
-                                                new_h = avail_w / img_ratio
-                                            else:
-                                                # Fit to Height
-                                                new_h = avail_h
-                                                new_w = avail_h * img_ratio
-                                                
-                                            img.width = new_w
-                                            img.height = new_h
-
-                                # Calculate Offsets for Centering
-                                # Note: AnchorMarker uses 0-indexed row/col
-                                col_idx_0 = (c_start - 1)
-                                row_idx_0 = (next_row - 1 if is_header_anchor else r_start - 1)
-                                
-                                # Use box dims vs new image dims to find center
-                                # box_w, box_h are in "approximate pixels" (from our calculation loop)
-                                # But Openpyxl pixels_to_EMU is exact (1px = 9525 EMU)
-                                # Our box_w calculation: (cw * 7.5) -> approximate
-                                # It's better to center based on the available space we calculated
-                                
-                                offset_x_px = (box_w - new_w) / 2
-                                offset_y_px = (box_h - new_h) / 2
-                                
-                                # Ensure non-negative
-                                offset_x_px = max(0, offset_x_px)
-                                offset_y_px = max(0, offset_y_px)
-                                
-                                offset_x_emu = int(pixels_to_EMU(offset_x_px))
-                                offset_y_emu = int(pixels_to_EMU(offset_y_px))
-                                
-                                # Create proper OneCellAnchor to support offsets
-                                marker = AnchorMarker(col=col_idx_0, colOff=offset_x_emu, row=row_idx_0, rowOff=offset_y_emu)
-                                size_emu = XDRPositiveSize2D(int(pixels_to_EMU(new_w)), int(pixels_to_EMU(new_h)))
-                                
-                                img.anchor = OneCellAnchor(_from=marker, ext=size_emu)
-                                target_sheet.add_image(img)
-                                image_inserted = True
-                            else:
-                                logger.warning(f"Image not found: {img_path}")
-                                
-                        except Exception as img_err:
-                            logger.error(f"Image insert error {key}: {img_err}")
-                    
-                    # --- Text Cleanup for Image Placeholder ---
-                    # If is_header_anchor is True -> We moved the image down, so RESTORE the original header text
-                    # Otherwise -> Clear the text
-                    
-                    if image_inserted:
-                        replacement_text = original_text if is_header_anchor else ""
-                    else:
-                        replacement_text = original_text
-                    
-                    # Note: Anchor cell clearing was problematic if anchor != placeholder cell
-                    # So we scan for the placeholder TAG explicitly.
-                    for row in target_sheet.iter_rows():
-                        for cell in row:
-                            if cell.value and isinstance(cell.value, str) and tag in cell.value:
-                                if cell.value.strip() == tag:
-                                    cell.value = replacement_text
-                                else:
-                                    cell.value = cell.value.replace(tag, replacement_text)
 
-                else:
-                    # --- Text Logic ---
-                    if val is None: val = "" # Handle None
-                    
-                    # Search and replace
-                    for row in target_sheet.iter_rows():
-                        for cell in row:
-                             if cell.value and isinstance(cell.value, str) and tag in cell.value:
-                                 # Exact or partial match
-                                 if cell.value.strip() == tag:
-                                     # Try number conversion
-                                     try:
-                                         if str(val).isdigit():
-                                             cell.value = int(val)
-                                         elif str(val).replace('.', '', 1).isdigit():
-                                              cell.value = float(val)
-                                         else:
-                                              cell.value = val
-                                     except:
-                                         cell.value = val
-                                 else:
-                                     cell.value = cell.value.replace(tag, str(val))
-        
-        # Remove the original template sheet
-        if len(wb.sheetnames) > 1:
-            wb.remove(source_sheet)
-        
-        # Save
-        if config.get('name'):
-             out_name = f"{config['name']}_月報_{datetime.now().strftime('%Y%m')}.xlsx"
-        else:
-             out_name = f"Monthly_Report_{project_id}.xlsx"
-             
-        out_path = os.path.join(app.config['UPLOAD_FOLDER'], out_name)
-        wb.save(out_path)
+    try:
+        period = _request_period()
+        entries = monthly_jobs.period_entries(project_id, period)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if not entries:
+        return jsonify({'error': f'No entries in period {period.label}', 'period': period.to_dict()}), 400
         
-        return send_file(out_path, as_attachment=True, download_name=out_name)
+    try:
+        # Same period entries + template -> same job / cached (or archived) file
+        job, created = monthly_jobs.submit(project_id, config, app.config['UPLOAD_FOLDER'], period)
+        if created:
+            logger.info(f"Monthly job {job.id} queued for {project_id}")
+        return _monthly_job_response(project_id, job)
         
     except Exception as e:
         logger.error(f"Monthly Generation Failed: {e}")
@@ -1001,6 +1227,63 @@ def api_generate_monthly(project_id):
         traceback.print_exc()
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/project/<project_id>/monthly_jobs/<job_id>', methods=['GET'])
+@login_required
+def api_monthly_job(project_id, job_id):
+    job = monthly_jobs.get_job(job_id, project_id)
+    if not job or job.project_id != project_id:
+        return jsonify({'error': 'Job not found'}), 404
+    return _monthly_job_response(project_id, job)
+
+@app.route('/api/project/<project_id>/monthly_jobs/<job_id>/download', methods=['GET'])
+@login_required
+def api_monthly_job_download(project_id, job_id):
+    job = monthly_jobs.get_job(job_id, project_id)
+    if not job or job.project_id != project_id:
+        return jsonify({'error': 'Job not found'}), 404
+    if job.status != 'done':
+        return jsonify({'error': f'Job is {job.status}', 'job': job.to_dict()}), 409
+    if not os.path.exists(job.path):
+        return jsonify({'error': 'Report expired, please generate again'}), 410
+    return _send_monthly_report(job.path, job.etag, job.filename)
+
+@app.route('/api/project/<project_id>/monthly_report', methods=['GET'])
+@login_required
+def api_monthly_report(project_id):
+    """所選期間目前資料的月報 (已產生過才有)；未變更時回 304"""
+    config = database.get_project_config(project_id)
+    if not config:
+        return jsonify({'error': 'Project not found'}), 404
+    if not os.path.exists(os.path.join(app.config['UPLOAD_FOLDER'], config['template_file'])):
+        return jsonify({'error': 'Template file missing'}), 404
+    try:
+        period = _request_period()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    entries = monthly_jobs.period_entries(project_id, period)
+    key = monthly_jobs.cache_key(config, app.config['UPLOAD_FOLDER'], period, entries)
+    path = monthly_jobs.cached_report(project_id, key, period) if entries else None
+    if not path:
+        return jsonify({'error': 'Report not generated yet'}), 404
+    return _send_monthly_report(path, key, monthly_jobs.report_filename(project_id, config, period))
+
+@app.route('/api/project/<project_id>/monthly_archives', methods=['GET'])
+@login_required
+def api_monthly_archives(project_id):
+    """已關帳期間的封存報表清單"""
+    index = report_periods.load_archive_index(project_id)
+    archives = [dict(meta, download_url=url_for('api_monthly_report', project_id=project_id,
+                                                period=meta['kind'], **_period_query(meta)))
+                for _, meta in sorted(index.items(), reverse=True)]
+    return jsonify(archives)
+
+def _period_query(meta):
+    if meta['kind'] == 'month':
+        return {'month': f"{meta['start'][:7]}"}
+    if meta['kind'] == 'week':
+        return {'week': meta['label']}
+    return {'start': meta['start'], 'end': meta['end']}
+
 if __name__ == '__main__':
     # Ensure server reloads if this file changes...
     app.run(debug=True, port=5000)
@@ -0,0 +1,160 @@
+"""
+靜態檔與回應壓縮 (Static asset pipeline & response compression)
+
+啟動時掃描 static/:
+  - 依內容雜湊產生指紋檔名 (js/setup.js -> js/setup.<hash>.js)，url_for('static', ...) 自動改用指紋網址
+  - 預先壓縮 gzip (以及 brotli，若有安裝 `brotli` 套件)
+  - 指紋網址回傳一年的 immutable 快取標頭；內容變了網址就會變
+動態回應 (JSON / HTML) 超過 COMPRESS_MIN_BYTES 時，依 Accept-Encoding 即時壓縮。
+"""
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+import posixpath
+
+from flask import Response, abort, request
+
+try:
+    import brotli
+except ImportError:  # optional dependency
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+COMPRESS_MIN_BYTES = int(os.getenv('COMPRESS_MIN_BYTES', '1024'))
+COMPRESSIBLE_MIMETYPES = {
+    'text/html', 'text/css', 'text/plain', 'text/javascript', 'application/javascript',
+    'application/json', 'image/svg+xml',
+}
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+PLAIN_MAX_AGE = 300
+
+
+def _encodings(accept_encoding):
+    """依偏好回傳可用的編碼 (br 優先)"""
+    accepted = {item.split(';')[0].strip().lower() for item in (accept_encoding or '').split(',')}
+    result = []
+    if brotli is not None and 'br' in accepted:
+        result.append('br')
+    if 'gzip' in accepted:
+        result.append('gzip')
+    return result
+
+
+def _compress(data, encoding, static=False):
+    if encoding == 'br':
+        return brotli.compress(data, quality=11 if static else 5)
+    return gzip.compress(data, compresslevel=9 if static else 6, mtime=0)
+
+
+class StaticAsset:
+    def __init__(self, path, filename):
+        with open(path, 'rb') as f:
+            self.data = f.read()
+        self.filename = filename
+        self.etag = hashlib.sha1(self.data).hexdigest()[:12]
+        root, ext = posixpath.splitext(filename)
+        self.fingerprinted = f"{root}.{self.etag}{ext}"
+        self.mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        if self.mimetype.startswith('text/'):
+            self.mimetype += '; charset=utf-8'
+        self.variants = {}
+        if self.mimetype.split(';')[0] in COMPRESSIBLE_MIMETYPES and len(self.data) >= COMPRESS_MIN_BYTES:
+            for encoding in ('gzip', 'br') if brotli is not None else ('gzip',):
+                compressed = _compress(self.data, encoding, static=True)
+                if len(compressed) < len(self.data):
+                    self.variants[encoding] = compressed
+
+
+class AssetPipeline:
+    def __init__(self, app=None):
+        self.assets = {}        # filename -> StaticAsset
+        self.by_fingerprint = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.static_folder = app.static_folder
+        self.scan()
+        app.url_defaults(self._url_defaults)
+        app.view_functions['static'] = self.send_static
+        app.after_request(compress_response)
+        app.extensions['asset_pipeline'] = self
+
+    def scan(self):
+        self.assets.clear()
+        self.by_fingerprint.clear()
+        if not self.static_folder or not os.path.isdir(self.static_folder):
+            return
+        for root, _, files in os.walk(self.static_folder):
+            for name in files:
+                path = os.path.join(root, name)
+                filename = os.path.relpath(path, self.static_folder).replace(os.sep, '/')
+                asset = StaticAsset(path, filename)
+                self.assets[filename] = asset
+                self.by_fingerprint[asset.fingerprinted] = asset
+        logger.info(f"Static assets: {len(self.assets)} files fingerprinted"
+                    f"{' (gzip+br)' if brotli is not None else ' (gzip)'}")
+
+    def _url_defaults(self, endpoint, values):
+        if endpoint == 'static':
+            asset = self.assets.get(values.get('filename'))
+            if asset is not None:
+                values['filename'] = asset.fingerprinted
+
+    def send_static(self, filename):
+        asset = self.by_fingerprint.get(filename)
+        immutable = asset is not None
+        if asset is None:
+            asset = self.assets.get(filename)
+        if asset is None:
+            abort(404)
+
+        encoding = next((e for e in _encodings(request.headers.get('Accept-Encoding')) if e in asset.variants), None)
+        body = asset.variants[encoding] if encoding else asset.data
+        response = Response(body if request.method != 'HEAD' else b'', mimetype=asset.mimetype)
+        response.content_length = len(body)
+        response.set_etag(f"{asset.etag}-{encoding}" if encoding else asset.etag)
+        response.vary.add('Accept-Encoding')
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        if immutable:
+            response.headers['Cache-Control'] = f'public, max-age={IMMUTABLE_MAX_AGE}, immutable'
+        else:
+            response.headers['Cache-Control'] = f'public, max-age={PLAIN_MAX_AGE}'
+        return response.make_conditional(request)
+
+
+def compress_response(response):
+    """after_request: 壓縮夠大的 JSON / HTML 回應 (串流與檔案回應不處理)"""
+    if (response.direct_passthrough or response.is_streamed
+            or response.status_code < 200 or response.status_code >= 300 or response.status_code == 204
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+    response.vary.add('Accept-Encoding')
+    encodings = _encodings(request.headers.get('Accept-Encoding'))
+    if not encodings:
+        return response
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_BYTES:
+        return response
+    compressed = _compress(data, encodings[0])
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encodings[0]
+    if response.get_etag()[0]:
+        # 內容編碼不同，強 ETag 也必須不同
+        etag, weak = response.get_etag()
+        response.set_etag(f"{etag}-{encodings[0]}", weak=weak)
+    return response
+
+
+def etag_matches(req, etag):
+    """If-None-Match 是否符合 etag；compress_response 加上編碼後綴的 ETag 代表同一份資料，也算符合"""
+    return any(req.if_none_match.contains(tag) for tag in (etag, f"{etag}-gzip", f"{etag}-br"))
+
+
+def init_app(app):
+    return AssetPipeline(app)